@@ -0,0 +1,68 @@
+"""Benchmark machine state encoding: pickle vs. the versioned binary codec.
+
+Usage::
+
+    python benchmarks/bench_state_codec.py [-n ITERATIONS]
+
+Prints the per-call encode and decode cost and the encoded size for each
+codec, using a fully-populated machine state. Decoding always goes through
+:func:`dm_mac.models.state_codec.decode_state`, which is what the state
+stores call, so the pickle row includes the legacy-schema migration.
+"""
+
+import argparse
+import pickle
+import timeit
+from typing import Any
+from typing import Dict
+
+from dm_mac.models.state_codec import decode_state
+from dm_mac.models.state_codec import encode_state
+
+STATE: Dict[str, Any] = {
+    "machine_name": "metal-mill",
+    "last_checkin": 1689477248.5,
+    "last_update": 1689477200.25,
+    "rfid_value": "0014916441",
+    "rfid_present_since": 1689477100.0,
+    "relay_desired_state": True,
+    "is_oopsed": False,
+    "is_locked_out": False,
+    "is_override_login": False,
+    "current_amps": 3.5,
+    "display_text": "Welcome,\njantman",
+    "uptime": 123.0,
+    "status_led_rgb": (0.0, 1.0, 0.0),
+    "status_led_brightness": 0.5,
+    "wifi_signal_db": -54.0,
+    "wifi_signal_percent": 92.0,
+    "internal_temperature_c": 53.89,
+    "current_user_account_id": "4",
+    "second_relay_desired_state": False,
+    "second_relay_authorization": None,
+    "state_save_timeouts": 0,
+}
+
+
+def main() -> None:
+    """Run the benchmark and print a table of results."""
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("-n", "--iterations", type=int, default=100000)
+    args = p.parse_args()
+    n: int = args.iterations
+    print(f"{'codec':<8} {'encode us':>10} {'decode us':>10} {'bytes':>6}")
+    for codec in ("pickle", "binary"):
+        blob: bytes = encode_state(STATE, codec)
+        assert decode_state(blob) == STATE
+        enc: float = timeit.timeit(lambda: encode_state(STATE, codec), number=n)
+        dec: float = timeit.timeit(lambda: decode_state(blob), number=n)
+        print(
+            f"{codec:<8} {enc / n * 1e6:>10.2f} {dec / n * 1e6:>10.2f} {len(blob):>6}"
+        )
+    raw: bytes = pickle.dumps(STATE, pickle.HIGHEST_PROTOCOL)
+    dec_raw: float = timeit.timeit(lambda: pickle.loads(raw), number=n)
+    print(f"{'(raw pickle.loads, no migration)':<31} {dec_raw / n * 1e6:>.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Benchmark JSON vs. CBOR encoding of machine update bodies.
+
+Usage::
+
+    python benchmarks/bench_update_encoding.py [-n ITERATIONS]
+
+For a typical ``POST /api/machine/update`` request body and its response,
+prints the encoded size and the per-message cost of encoding and of
+decoding (request bodies are also validated, as the update view does) with:
+
+* ``json`` - the standard library, as without orjson;
+* ``orjson`` - if it is installed;
+* ``cbor`` - the in-tree :mod:`dm_mac.cbor` codec.
+
+Sizes are what goes over the ESP32's WiFi; the server's costs are the
+request decode and the response encode, though the server caches encoded
+responses until they change.
+"""
+
+import argparse
+import json
+import timeit
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Tuple
+
+from dm_mac import cbor
+from dm_mac.json_provider import orjson
+from dm_mac.models.api_schemas import MachineUpdateRequest
+
+REQUEST: Dict[str, Any] = {
+    "machine_name": "metal-mill",
+    "oops": False,
+    "rfid_value": "14916441",
+    "uptime": 59.29299927,
+    "wifi_signal_db": -58,
+    "wifi_signal_percent": 84,
+    "internal_temperature_c": 53.88888931,
+    "amps": 3.5,
+    "state_version": 1721096048000,
+}
+
+RESPONSE: Dict[str, Any] = {
+    "relay": True,
+    "display": "Welcome,\njantman",
+    "oops_led": False,
+    "status_led_rgb": [0.0, 1.0, 0.0],
+    "status_led_brightness": 0.5,
+    "second_relay": False,
+    "state_version": 1721096048001,
+}
+
+
+def json_dumps(obj: Any) -> bytes:
+    """Encode compact JSON, as the server does."""
+    return json.dumps(obj, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+#: Codecs to compare: name -> (encode, decode-and-validate a request).
+CODECS: Dict[str, Tuple[Callable[[Any], bytes], Callable[[bytes], Any]]] = {
+    "json": (
+        json_dumps,
+        lambda b: MachineUpdateRequest.model_validate_json(b),
+    ),
+    "cbor": (
+        cbor.dumps,
+        lambda b: MachineUpdateRequest.model_validate(cbor.loads(b)),
+    ),
+}
+if orjson is not None:
+    CODECS["orjson"] = (
+        lambda o: orjson.dumps(o, option=orjson.OPT_SORT_KEYS),
+        lambda b: MachineUpdateRequest.model_validate(orjson.loads(b)),
+    )
+
+
+def main() -> None:
+    """Run the benchmark and print a table of results."""
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("-n", "--iterations", type=int, default=100000)
+    args = p.parse_args()
+    n: int = args.iterations
+    print(
+        f"{'codec':<8} {'req bytes':>9} {'resp bytes':>10} {'encode us':>9} "
+        f"{'decode us':>9}"
+    )
+    for name, (encode, decode) in CODECS.items():
+        req: bytes = encode(REQUEST)
+        resp: bytes = encode(RESPONSE)
+        assert decode(req).model_dump(exclude_unset=True) == REQUEST
+        enc: float = timeit.timeit(lambda: encode(RESPONSE), number=n)
+        dec: float = timeit.timeit(lambda: decode(req), number=n)
+        print(
+            f"{name:<8} {len(req):>9} {len(resp):>10} {enc / n * 1e6:>9.2f} "
+            f"{dec / n * 1e6:>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -192,6 +192,7 @@ def tests(session: Session) -> None:
         "pytest-html",
         "freezegun",
         "pytest-asyncio",
+        "orjson",
     )
     try:
         session.run(
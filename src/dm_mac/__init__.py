@@ -9,19 +9,26 @@ from asyncio import get_event_loop
 from time import time
 
 from quart import Quart
+from quart import current_app
 from quart import has_request_context
 from quart import request
 from quart.logging import default_handler
 from quart_schema import QuartSchema
 from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
 
+from dm_mac import json_provider
+from dm_mac.models.events import EventBus
+from dm_mac.models.heartbeat_log import HeartbeatLog
 from dm_mac.models.machine import FleetTimeoutTracker
 from dm_mac.models.machine import MachinesConfig
+from dm_mac.models.machine import make_event_bus
+from dm_mac.models.persistence import StatePersister
 from dm_mac.models.users import UsersConfig
 from dm_mac.slack_handler import SlackHandler
 from dm_mac.utils import set_log_debug
 from dm_mac.utils import set_log_info
 from dm_mac.views.api import api
+from dm_mac.views.machine import DEFAULT_LONG_POLL_MAX_SEC
 from dm_mac.views.machine import machineapi
 from dm_mac.views.prometheus import prometheus_route
 
@@ -39,7 +46,8 @@ class RequestFormatter(logging.Formatter):
     def format(self, record: logging.LogRecord) -> str:
         """Custom log formatter to add request information."""
         if has_request_context():
-            record.url = request.url
+            # building the URL is relatively costly; only do it if it's used
+            record.url = request.url if "(url)" in (self._fmt or "") else None
             record.remote_addr = request.remote_addr
         else:
             record.url = None
@@ -75,6 +83,40 @@ def asyncio_exception_handler(_, context):
     logger.error(f"Task failed, msg={message}, exception={exception}")
 
 
+async def start_state_persister() -> None:
+    """Start the write-behind state flusher when the server starts serving."""
+    current_app.config["STATE_PERSISTER"].start()
+
+
+async def stop_state_persister() -> None:
+    """Stop the state flusher and commit any pending state on shutdown."""
+    await current_app.config["STATE_PERSISTER"].stop()
+
+
+async def start_event_bus() -> None:
+    """Start the event dispatcher when the server starts serving."""
+    current_app.config["EVENT_BUS"].start()
+
+
+async def stop_event_bus() -> None:
+    """Deliver any queued events and stop the dispatcher on shutdown."""
+    await current_app.config["EVENT_BUS"].stop()
+
+
+async def start_heartbeat_log() -> None:
+    """Let the heartbeat log drop access log lines it replaces."""
+    logging.getLogger("hypercorn.access").addFilter(
+        current_app.config["HEARTBEAT_LOG"].access_filter
+    )
+
+
+async def stop_heartbeat_log() -> None:
+    """Remove the access log filter added by :func:`start_heartbeat_log`."""
+    logging.getLogger("hypercorn.access").removeFilter(
+        current_app.config["HEARTBEAT_LOG"].access_filter
+    )
+
+
 def create_app() -> Quart:
     """Factory to create the app."""
     app: Quart = Quart("dm_mac")
@@ -95,13 +137,36 @@ def create_app() -> Quart:
             {"name": "Monitoring", "description": "Monitoring and metrics endpoints"},
         ],
     )
-    app.config.update({"MACHINES": MachinesConfig()})
-    app.config.update({"USERS": UsersConfig()})
+    if json_provider.install(app):
+        logger.info("Using orjson for JSON encoding and decoding")
+    persister: StatePersister = StatePersister()
+    events: EventBus = make_event_bus()
+    mconf: MachinesConfig = MachinesConfig(persister=persister, event_bus=events)
+    app.config.update({"MACHINES": mconf})
+    app.config.update({"STATE_PERSISTER": persister})
+    app.config.update({"EVENT_BUS": events})
+    uconf: UsersConfig = UsersConfig()
+    mconf.resolve_users(uconf)
+    app.config.update({"USERS": uconf})
     app.config.update({"START_TIME": time()})
     app.config.update({"SLACK_HANDLER": None})
     app.config.update({"FLEET_TIMEOUT_TRACKER": FleetTimeoutTracker()})
+    app.config.update({"HEARTBEAT_LOG": HeartbeatLog()})
+    app.config.update(
+        {
+            "LONG_POLL_MAX_SEC": float(
+                os.environ.get("LONG_POLL_MAX_SEC", DEFAULT_LONG_POLL_MAX_SEC)
+            )
+        }
+    )
     app.register_blueprint(api)
     app.add_url_rule("/metrics", view_func=prometheus_route)
+    app.before_serving(start_state_persister)
+    app.before_serving(start_event_bus)
+    app.before_serving(start_heartbeat_log)
+    app.after_serving(stop_state_persister)
+    app.after_serving(stop_event_bus)
+    app.after_serving(stop_heartbeat_log)
     return app
 
 
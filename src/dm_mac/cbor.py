@@ -0,0 +1,250 @@
+"""Minimal CBOR (RFC 8949) encoding and decoding.
+
+MCUs on weak WiFi can exchange ``/api/machine/update`` bodies as `CBOR
+<https://cbor.io/>`_ (``application/cbor``) instead of JSON; a typical
+heartbeat is about a fifth smaller. Only the subset of CBOR needed for
+JSON-like data is implemented here, so no extra dependency is required:
+
+* :func:`dumps` encodes ``None``, booleans, integers (up to 64 bits),
+  floats, strings, bytes, lists/tuples and dicts, always with definite
+  lengths and in the shortest form. Floats are written as half, single or
+  double precision, whichever is the smallest that holds the value exactly,
+  and dict keys are sorted, as in the server's JSON responses.
+* :func:`loads` additionally accepts indefinite-length items and longer
+  than necessary encodings, as other encoders may produce them, and ignores
+  semantic tags. Anything else raises :class:`CBORDecodeError`.
+"""
+
+import math
+import struct
+from typing import Any
+from typing import Dict
+from typing import List
+
+#: MIME type of CBOR request and response bodies.
+CBOR_MIMETYPE: str = "application/cbor"
+
+#: Deepest nesting of arrays and maps :func:`loads` accepts.
+MAX_DEPTH: int = 16
+
+_FALSE: bytes = b"\xf4"
+_TRUE: bytes = b"\xf5"
+_NULL: bytes = b"\xf6"
+
+#: Initial-byte additional info for an indefinite-length item.
+_INDEFINITE: int = 31
+
+#: "break" stop code ending an indefinite-length item.
+_BREAK: int = 0xFF
+
+
+class CBORDecodeError(ValueError):
+    """Raised when bytes are not valid (supported) CBOR."""
+
+
+def _head(major: int, value: int) -> bytes:
+    """Return the initial byte(s) of an item with the given argument."""
+    mt: int = major << 5
+    if value < 24:
+        return bytes((mt | value,))
+    if value < 0x100:
+        return bytes((mt | 24, value))
+    if value < 0x10000:
+        return bytes((mt | 25,)) + struct.pack(">H", value)
+    if value < 0x100000000:
+        return bytes((mt | 26,)) + struct.pack(">I", value)
+    if value < 0x10000000000000000:
+        return bytes((mt | 27,)) + struct.pack(">Q", value)
+    raise ValueError(f"Integer too large for CBOR: {value}")
+
+
+def _encode_float(value: float) -> bytes:
+    """Return ``value`` in the smallest float encoding that is exact."""
+    if math.isnan(value):
+        return b"\xf9\x7e\x00"
+    for code, fmt in ((0xF9, ">e"), (0xFA, ">f")):
+        try:
+            packed: bytes = struct.pack(fmt, value)
+        except OverflowError:
+            continue
+        if struct.unpack(fmt, packed)[0] == value:
+            return bytes((code,)) + packed
+    return b"\xfb" + struct.pack(">d", value)
+
+
+def _encode(obj: Any, out: List[bytes]) -> None:
+    """Append the encoding of ``obj`` to ``out``."""
+    if obj is None:
+        out.append(_NULL)
+    elif obj is True:
+        out.append(_TRUE)
+    elif obj is False:
+        out.append(_FALSE)
+    elif isinstance(obj, int):
+        out.append(_head(0, obj) if obj >= 0 else _head(1, -1 - obj))
+    elif isinstance(obj, float):
+        out.append(_encode_float(obj))
+    elif isinstance(obj, str):
+        raw: bytes = obj.encode("utf-8")
+        out.append(_head(3, len(raw)))
+        out.append(raw)
+    elif isinstance(obj, (bytes, bytearray)):
+        out.append(_head(2, len(obj)))
+        out.append(bytes(obj))
+    elif isinstance(obj, (list, tuple)):
+        out.append(_head(4, len(obj)))
+        for item in obj:
+            _encode(item, out)
+    elif isinstance(obj, dict):
+        out.append(_head(5, len(obj)))
+        keys: List[Any] = list(obj)
+        if all(isinstance(k, str) for k in keys):
+            keys.sort()
+        for key in keys:
+            _encode(key, out)
+            _encode(obj[key], out)
+    else:
+        raise TypeError(f"Object of type {type(obj).__name__} is not CBOR serializable")
+
+
+def dumps(obj: Any) -> bytes:
+    """Return ``obj`` encoded as CBOR.
+
+    :raises TypeError: if ``obj`` contains an unsupported type.
+    :raises ValueError: if it contains an integer that needs more than 64 bits.
+    """
+    out: List[bytes] = []
+    _encode(obj, out)
+    return b"".join(out)
+
+
+class _Decoder:
+    """Decodes one CBOR data item from a buffer."""
+
+    def __init__(self, buf: bytes) -> None:
+        """Initialize _Decoder.
+
+        :param buf: Bytes to decode.
+        """
+        self.buf: bytes = buf
+        self.pos: int = 0
+
+    def _take(self, length: int) -> bytes:
+        """Return the next ``length`` bytes."""
+        end: int = self.pos + length
+        if end > len(self.buf):
+            raise CBORDecodeError("Unexpected end of data")
+        chunk: bytes = self.buf[self.pos : end]
+        self.pos = end
+        return chunk
+
+    def _argument(self, info: int) -> int:
+        """Return the argument encoded by additional info ``info``."""
+        if info < 24:
+            return info
+        if info == 24:
+            return self._take(1)[0]
+        if info == 25:
+            return int(struct.unpack(">H", self._take(2))[0])
+        if info == 26:
+            return int(struct.unpack(">I", self._take(4))[0])
+        if info == 27:
+            return int(struct.unpack(">Q", self._take(8))[0])
+        raise CBORDecodeError(f"Invalid additional information {info}")
+
+    def _at_break(self) -> bool:
+        """Consume and return whether the next byte is the break code."""
+        if self.pos >= len(self.buf):
+            raise CBORDecodeError("Unexpected end of data")
+        if self.buf[self.pos] == _BREAK:
+            self.pos += 1
+            return True
+        return False
+
+    def _string(self, major: int, info: int) -> bytes:
+        """Return the content of a byte or text string item."""
+        if info != _INDEFINITE:
+            return self._take(self._argument(info))
+        chunks: List[bytes] = []
+        while not self._at_break():
+            initial: int = self._take(1)[0]
+            if initial >> 5 != major or initial & 0x1F == _INDEFINITE:
+                raise CBORDecodeError("Invalid chunk in indefinite-length string")
+            chunks.append(self._take(self._argument(initial & 0x1F)))
+        return b"".join(chunks)
+
+    def decode(self, depth: int = 0) -> Any:
+        """Decode and return the next data item."""
+        if depth > MAX_DEPTH:
+            raise CBORDecodeError(f"Nesting deeper than {MAX_DEPTH} levels")
+        initial: int = self._take(1)[0]
+        major: int = initial >> 5
+        info: int = initial & 0x1F
+        if major == 0:
+            return self._argument(info)
+        if major == 1:
+            return -1 - self._argument(info)
+        if major == 2:
+            return self._string(major, info)
+        if major == 3:
+            try:
+                return self._string(major, info).decode("utf-8")
+            except UnicodeDecodeError as ex:
+                raise CBORDecodeError(f"Invalid UTF-8 in text string: {ex}") from ex
+        if major == 4:
+            items: List[Any] = []
+            if info == _INDEFINITE:
+                while not self._at_break():
+                    items.append(self.decode(depth + 1))
+            else:
+                for _ in range(self._argument(info)):
+                    items.append(self.decode(depth + 1))
+            return items
+        if major == 5:
+            result: Dict[Any, Any] = {}
+            if info == _INDEFINITE:
+                while not self._at_break():
+                    self._map_entry(result, depth)
+            else:
+                for _ in range(self._argument(info)):
+                    self._map_entry(result, depth)
+            return result
+        if major == 6:
+            self._argument(info)
+            return self.decode(depth + 1)
+        return self._simple(info)
+
+    def _map_entry(self, result: Dict[Any, Any], depth: int) -> None:
+        """Decode one key/value pair of a map into ``result``."""
+        key: Any = self.decode(depth + 1)
+        if isinstance(key, (list, dict)):
+            raise CBORDecodeError("Unsupported map key type")
+        result[key] = self.decode(depth + 1)
+
+    def _simple(self, info: int) -> Any:
+        """Decode a major type 7 item (simple value or float)."""
+        if info == 20:
+            return False
+        if info == 21:
+            return True
+        if info in (22, 23):
+            return None
+        if info == 25:
+            return float(struct.unpack(">e", self._take(2))[0])
+        if info == 26:
+            return float(struct.unpack(">f", self._take(4))[0])
+        if info == 27:
+            return float(struct.unpack(">d", self._take(8))[0])
+        raise CBORDecodeError(f"Unsupported simple value {info}")
+
+
+def loads(buf: bytes) -> Any:
+    """Decode a single CBOR data item occupying all of ``buf``.
+
+    :raises CBORDecodeError: if ``buf`` is not exactly one supported item.
+    """
+    decoder: _Decoder = _Decoder(bytes(buf))
+    obj: Any = decoder.decode()
+    if decoder.pos != len(decoder.buf):
+        raise CBORDecodeError(f"{len(decoder.buf) - decoder.pos} bytes of extra data")
+    return obj
@@ -0,0 +1,125 @@
+"""Fast JSON encoding and decoding, using orjson when it is installed.
+
+Every ``POST /api/machine/update`` decodes the MCU's JSON payload and
+encodes a JSON response. The optional `orjson
+<https://github.com/ijl/orjson>`_ package does both several times faster
+than the standard library. If it is importable, :func:`install` replaces
+the app's JSON provider with an :class:`OrjsonProvider`, and
+:func:`dumps_bytes` uses it as well; otherwise both fall back to the
+standard library with identical output. orjson always writes non-ASCII
+characters as raw UTF-8, so :func:`install` turns off ``ensure_ascii`` on
+the app's provider either way.
+"""
+
+import json
+from importlib import import_module
+from typing import Any
+from typing import Optional
+from typing import cast
+
+from quart import Quart
+from quart.json.provider import DefaultJSONProvider
+
+orjson: Any
+try:
+    orjson = import_module("orjson")
+except ImportError:  # pragma: no cover
+    orjson = None
+
+#: orjson options giving the same output as Quart's compact ``jsonify``.
+#: Dates and dataclasses are passed through to the fallback provider's
+#: ``default``, so they are encoded the same way as without orjson.
+ORJSON_OPTIONS: int = (
+    0
+    if orjson is None
+    else (
+        orjson.OPT_SORT_KEYS
+        | orjson.OPT_NON_STR_KEYS
+        | orjson.OPT_PASSTHROUGH_DATETIME
+        | orjson.OPT_PASSTHROUGH_DATACLASS
+    )
+)
+
+#: ``separators`` argument for compact output, which orjson always produces.
+_COMPACT: Any = (",", ":")
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that uses orjson, deferring to another for the rest.
+
+    Output is always compact, as ``jsonify`` produces outside of debug
+    mode. Calls asking for anything else (such as ``indent`` for
+    pretty-printed output), and objects orjson does not support natively,
+    go to the provider being replaced, e.g. the one installed by
+    ``QuartSchema``.
+    """
+
+    def __init__(self, app: Quart, fallback: DefaultJSONProvider) -> None:
+        """Initialize OrjsonProvider.
+
+        :param app: The application.
+        :param fallback: Provider used for everything orjson cannot do.
+        """
+        super().__init__(app)
+        #: Provider being replaced.
+        self.fallback: DefaultJSONProvider = fallback
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        """Serialize ``obj`` to a (compact) JSON string."""
+        if orjson is None or (kwargs and kwargs != {"separators": _COMPACT}):
+            return self.fallback.dumps(obj, **kwargs)
+        return str(
+            orjson.dumps(obj, default=self.fallback.default, option=ORJSON_OPTIONS),
+            "utf-8",
+        )
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        """Deserialize a JSON string or bytes."""
+        if kwargs or orjson is None:
+            return self.fallback.loads(s, **kwargs)
+        return orjson.loads(s)
+
+
+def install(app: Quart) -> bool:
+    """Use an :class:`OrjsonProvider` for ``app``, if orjson is installed.
+
+    Must be called after anything else that replaces ``app.json``. The
+    existing provider's ``ensure_ascii`` is turned off whether or not orjson
+    is installed, so responses are the same with or without it.
+
+    :returns: Whether orjson is now in use.
+    """
+    app.json.ensure_ascii = False  # type: ignore[attr-defined]
+    if orjson is None:
+        return False
+    app.json = OrjsonProvider(app, fallback=app.json)  # type: ignore[arg-type]
+    return True
+
+
+def dumps_bytes(obj: Any, default: Optional[Any] = None) -> bytes:
+    """Return ``obj`` as compact JSON bytes, exactly as ``jsonify`` would.
+
+    Keys are sorted, non-ASCII characters are not escaped (see
+    :func:`install`) and the result ends with a newline.
+
+    :param obj: Object to serialize; only JSON-native types are supported.
+    :param default: Optional callable for other types, as for
+        :func:`json.dumps`.
+    """
+    if orjson is not None:
+        return cast(
+            bytes,
+            orjson.dumps(
+                obj, default=default, option=ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE
+            ),
+        )
+    return (
+        json.dumps(
+            obj,
+            default=default,
+            ensure_ascii=False,
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        + "\n"
+    ).encode("utf-8")
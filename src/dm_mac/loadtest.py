@@ -0,0 +1,774 @@
+"""Load test a MAC server with a simulated fleet of machine control units.
+
+``mac-loadtest`` emulates any number of ESPHome MCUs, each posting a
+realistic ``/api/machine/update`` heartbeat every
+:attr:`Scenario.interval_sec` seconds. Along the way each simulated MCU has
+RFID cards inserted and removed (login sessions lasting a number of
+heartbeats, some with unknown fobs), its Oops button pressed, and
+occasionally reboots (its uptime resets to zero).
+
+The fleet runs either against an in-process server built with
+:func:`dm_mac.create_app` (the default), using generated machine and user
+configs in a temporary directory, or against a running ``mac-server`` given
+by ``--url``. For the latter, ``--write-config DIR`` writes matching
+``machines.json`` and ``users.json`` files to start it with.
+
+The fleet's size and behavior are described by a scenario file; see
+:data:`SCENARIO_SCHEMA`. Each run reports request count and throughput,
+p50/p95/p99 latency, response status counts, the error rate and the number
+of 503 responses (state save timeouts). ``--output`` saves those results
+as JSON, and ``--compare`` checks a run against results saved by a previous
+release, exiting non-zero if latency or error rates regressed by more than
+``--max-regression`` percent.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from aiohttp import ClientError
+from aiohttp import ClientSession
+from aiohttp import ClientTimeout
+from aiohttp import TCPConnector
+from jsonschema import validate
+
+from dm_mac import create_app
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+#: Path of the machine update endpoint.
+UPDATE_PATH: str = "/api/machine/update"
+
+#: Authorization given to every generated machine and user.
+LOADTEST_AUTHORIZATION: str = "Load Test"
+
+#: Status recorded for requests that got no HTTP response at all.
+NO_RESPONSE: str = "error"
+
+#: Latency percentiles reported, as (name, quantile) pairs.
+PERCENTILES: Tuple[Tuple[str, float], ...] = (
+    ("p50", 0.50),
+    ("p95", 0.95),
+    ("p99", 0.99),
+)
+
+SCENARIO_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "name": {
+            "type": "string",
+            "description": "Name of the scenario, included in the results.",
+        },
+        "machines": {
+            "description": "Number of simulated machines, named "
+            "``loadtest-0001`` and so on; or a list of machine names.",
+            "oneOf": [
+                {"type": "integer", "minimum": 1},
+                {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "minItems": 1,
+                },
+            ],
+        },
+        "duration_sec": {
+            "type": "number",
+            "exclusiveMinimum": 0,
+            "description": "How long to run the test for.",
+        },
+        "interval_sec": {
+            "type": "number",
+            "exclusiveMinimum": 0,
+            "description": "Seconds between heartbeats from each machine "
+            "(default 10). Machines start at random offsets within the "
+            "first interval.",
+        },
+        "timeout_sec": {
+            "type": "number",
+            "exclusiveMinimum": 0,
+            "description": "Request timeout, when testing against a URL "
+            "(default 10).",
+        },
+        "fobs": {
+            "type": "array",
+            "items": {"type": "string"},
+            "description": "RFID fob codes authorized on every machine. "
+            "Defaults to one generated fob per machine, as written to the "
+            "generated users.json; set this when testing a server with its "
+            "own users.",
+        },
+        "session_probability": {
+            "type": "number",
+            "minimum": 0,
+            "maximum": 1,
+            "description": "Chance, at each heartbeat without an RFID card "
+            "present, that one is inserted (default 0.02).",
+        },
+        "session_heartbeats": {
+            "type": "array",
+            "items": {"type": "integer", "minimum": 1},
+            "minItems": 2,
+            "maxItems": 2,
+            "description": "Minimum and maximum number of heartbeats an RFID "
+            "card stays inserted (default [6, 60]).",
+        },
+        "unknown_fob_probability": {
+            "type": "number",
+            "minimum": 0,
+            "maximum": 1,
+            "description": "Chance that an inserted card is not a known fob "
+            "(default 0.05).",
+        },
+        "oops_probability": {
+            "type": "number",
+            "minimum": 0,
+            "maximum": 1,
+            "description": "Chance, at each heartbeat, that the Oops button "
+            "is pressed (default 0.001). Oopsed machines stay so until "
+            "cleared by an admin.",
+        },
+        "reboot_probability": {
+            "type": "number",
+            "minimum": 0,
+            "maximum": 1,
+            "description": "Chance, at each heartbeat, that the MCU has "
+            "rebooted since the last one (default 0.0005).",
+        },
+        "seed": {
+            "type": "integer",
+            "description": "Random seed, so runs of a scenario are "
+            "repeatable (default 0).",
+        },
+    },
+    "required": ["machines", "duration_sec"],
+    "additionalProperties": False,
+}
+
+
+class Scenario:
+    """Size and behavior of a simulated MCU fleet."""
+
+    #: Values of optional scenario fields that are not given.
+    DEFAULTS: Dict[str, Any] = {
+        "name": "default",
+        "interval_sec": 10.0,
+        "timeout_sec": 10.0,
+        "session_probability": 0.02,
+        "session_heartbeats": [6, 60],
+        "unknown_fob_probability": 0.05,
+        "oops_probability": 0.001,
+        "reboot_probability": 0.0005,
+        "seed": 0,
+    }
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        """Initialize Scenario.
+
+        :param config: Scenario as described by :data:`SCENARIO_SCHEMA`.
+        :raises jsonschema.ValidationError: if ``config`` is invalid.
+        """
+        validate(config, SCENARIO_SCHEMA)
+        merged: Dict[str, Any] = {**self.DEFAULTS, **config}
+        self.name: str = merged["name"]
+        if isinstance(merged["machines"], int):
+            #: Names of the simulated machines.
+            self.machine_names: List[str] = [
+                f"loadtest-{i:04d}" for i in range(1, merged["machines"] + 1)
+            ]
+        else:
+            self.machine_names = list(merged["machines"])
+        self.duration_sec: float = float(merged["duration_sec"])
+        self.interval_sec: float = float(merged["interval_sec"])
+        self.timeout_sec: float = float(merged["timeout_sec"])
+        #: Known RFID fob codes used for sessions.
+        self.fobs: List[str] = merged.get(
+            "fobs",
+            [f"{9000000000 + i}" for i in range(1, len(self.machine_names) + 1)],
+        )
+        self.session_probability: float = merged["session_probability"]
+        self.session_heartbeats: Tuple[int, int] = (
+            min(merged["session_heartbeats"]),
+            max(merged["session_heartbeats"]),
+        )
+        self.unknown_fob_probability: float = merged["unknown_fob_probability"]
+        self.oops_probability: float = merged["oops_probability"]
+        self.reboot_probability: float = merged["reboot_probability"]
+        self.seed: int = merged["seed"]
+        self._config: Dict[str, Any] = merged
+
+    @classmethod
+    def from_file(cls, path: str) -> "Scenario":
+        """Load a scenario from a JSON file."""
+        with open(path) as fh:
+            return cls(json.load(fh))
+
+    @staticmethod
+    def example() -> Dict[str, Any]:
+        """Return an example scenario: 200 MCUs for five minutes."""
+        return {
+            "name": "200-mcus",
+            "machines": 200,
+            "duration_sec": 300,
+            "interval_sec": 10,
+            "session_probability": 0.02,
+            "session_heartbeats": [6, 60],
+            "unknown_fob_probability": 0.05,
+            "oops_probability": 0.001,
+            "reboot_probability": 0.0005,
+            "seed": 0,
+        }
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Return the scenario, with defaults filled in."""
+        return dict(self._config)
+
+    def machines_config(self) -> Dict[str, Any]:
+        """Return a ``machines.json`` config for the simulated machines."""
+        return {
+            name: {"authorizations_or": [LOADTEST_AUTHORIZATION]}
+            for name in self.machine_names
+        }
+
+    def users_config(self) -> List[Dict[str, Any]]:
+        """Return a ``users.json`` config with one user per :attr:`fobs`."""
+        return [
+            {
+                "account_id": f"loadtest-{i}",
+                "authorizations": [LOADTEST_AUTHORIZATION],
+                "email": f"loadtest-{i}@example.com",
+                "expiration_ymd": "2099-12-31",
+                "fob_codes": [fob],
+                "full_name": f"Load Test {i}",
+                "first_name": "Load",
+                "last_name": f"Test {i}",
+                "preferred_name": "Load",
+            }
+            for i, fob in enumerate(self.fobs, start=1)
+        ]
+
+    def write_config(self, directory: str) -> Tuple[str, str]:
+        """Write ``machines.json`` and ``users.json`` to ``directory``.
+
+        :returns: Paths of the machines and users config files.
+        """
+        os.makedirs(directory, exist_ok=True)
+        mpath: str = os.path.join(directory, "machines.json")
+        upath: str = os.path.join(directory, "users.json")
+        with open(mpath, "w") as fh:
+            json.dump(self.machines_config(), fh, sort_keys=True, indent=4)
+        with open(upath, "w") as fh:
+            json.dump(self.users_config(), fh, sort_keys=True, indent=4)
+        return mpath, upath
+
+
+class SimulatedMCU:
+    """One machine control unit's heartbeats, RFID sessions and mishaps."""
+
+    def __init__(self, name: str, scenario: Scenario, rng: random.Random) -> None:
+        """Initialize SimulatedMCU.
+
+        :param name: Name of the machine.
+        :param scenario: Scenario being run.
+        :param rng: Random number generator for this MCU alone.
+        """
+        self.name: str = name
+        self.scenario: Scenario = scenario
+        self.rng: random.Random = rng
+        #: Seconds since the MCU booted, as it will next report.
+        self.uptime: float = rng.uniform(60, 86400)
+        #: RFID value currently inserted, or empty string.
+        self.rfid_value: str = ""
+        #: Heartbeats left until the inserted card is removed.
+        self.session_left: int = 0
+        #: Number of RFID sessions started.
+        self.sessions: int = 0
+        #: Number of those sessions using an unknown fob.
+        self.unknown_sessions: int = 0
+        #: Number of Oops button presses.
+        self.oopses: int = 0
+        #: Number of reboots.
+        self.reboots: int = 0
+
+    def _rfid(self) -> str:
+        """Advance the RFID session and return the value to report."""
+        if self.rfid_value:
+            self.session_left -= 1
+            if self.session_left <= 0:
+                self.rfid_value = ""
+        elif self.rng.random() < self.scenario.session_probability:
+            self.sessions += 1
+            self.session_left = self.rng.randint(*self.scenario.session_heartbeats)
+            if (
+                not self.scenario.fobs
+                or self.rng.random() < self.scenario.unknown_fob_probability
+            ):
+                self.unknown_sessions += 1
+                self.rfid_value = str(self.rng.randrange(1000000000, 8999999999))
+            else:
+                self.rfid_value = self.rng.choice(self.scenario.fobs)
+        return self.rfid_value
+
+    def heartbeat(self) -> Dict[str, Any]:
+        """Return the next update payload, advancing the MCU's state."""
+        if self.rng.random() < self.scenario.reboot_probability:
+            # the card reader comes back up empty, as does the relay
+            self.reboots += 1
+            self.uptime = self.rng.uniform(2, 10)
+            self.rfid_value = ""
+            self.session_left = 0
+        else:
+            self.uptime += self.scenario.interval_sec
+        oops: bool = self.rng.random() < self.scenario.oops_probability
+        if oops:
+            self.oopses += 1
+        amps: float = 0.0
+        if self.rfid_value:
+            amps = round(self.rng.uniform(2.0, 12.0), 2)
+        return {
+            "machine_name": self.name,
+            "oops": oops,
+            "rfid_value": self._rfid(),
+            "uptime": round(self.uptime, 3),
+            "wifi_signal_db": self.rng.randint(-80, -45),
+            "wifi_signal_percent": self.rng.randint(30, 100),
+            "internal_temperature_c": round(self.rng.uniform(40.0, 60.0), 2),
+            "amps": amps,
+        }
+
+
+class Target:
+    """Where simulated heartbeats are sent."""
+
+    #: Description of the target, included in the results.
+    description: str = ""
+
+    async def start(self) -> None:
+        """Prepare to send requests."""
+
+    async def stop(self) -> None:
+        """Release any resources used."""
+
+    async def post(self, payload: Dict[str, Any]) -> int:
+        """Send one machine update and return the response status code.
+
+        :raises Exception: if no response was received.
+        """
+        raise NotImplementedError()
+
+
+@contextmanager
+def _environ(values: Dict[str, str]) -> Iterator[None]:
+    """Temporarily set environment variables."""
+    saved: Dict[str, Optional[str]] = {k: os.environ.get(k) for k in values}
+    os.environ.update(values)
+    try:
+        yield
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                del os.environ[key]
+            else:
+                os.environ[key] = value
+
+
+class InProcessTarget(Target):
+    """An app from :func:`dm_mac.create_app`, called via its test client.
+
+    Runs with the scenario's generated configs and a fresh state directory,
+    all in a temporary directory removed by :meth:`stop`.
+    """
+
+    description = "in-process"
+
+    def __init__(self, scenario: Scenario) -> None:
+        """Initialize InProcessTarget.
+
+        :param scenario: Scenario being run.
+        """
+        self.scenario: Scenario = scenario
+        self._tmpdir: Optional[tempfile.TemporaryDirectory[str]] = None
+        self._app: Any = None
+        self._client: Any = None
+
+    async def start(self) -> None:
+        """Create and start up the app."""
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="mac-loadtest-")
+        mpath, upath = self.scenario.write_config(self._tmpdir.name)
+        with _environ(
+            {
+                "MACHINES_CONFIG": mpath,
+                "USERS_CONFIG": upath,
+                "MACHINE_STATE_DIR": os.path.join(self._tmpdir.name, "state"),
+            }
+        ):
+            self._app = create_app()
+        await self._app.startup()
+        self._client = self._app.test_client()
+
+    async def stop(self) -> None:
+        """Shut down the app and remove its temporary directory."""
+        if self._app is not None:
+            await self._app.shutdown()
+            self._app = None
+        if self._tmpdir is not None:
+            self._tmpdir.cleanup()
+            self._tmpdir = None
+
+    async def post(self, payload: Dict[str, Any]) -> int:
+        """Send one machine update and return the response status code."""
+        response = await self._client.post(UPDATE_PATH, json=payload)
+        await response.get_data()
+        return int(response.status_code)
+
+
+class HttpTarget(Target):
+    """A running ``mac-server``."""
+
+    def __init__(self, url: str, timeout_sec: float) -> None:
+        """Initialize HttpTarget.
+
+        :param url: Base URL of the server, e.g. ``http://localhost:5000``.
+        :param timeout_sec: Timeout for each request.
+        """
+        self.description = url.rstrip("/")
+        self.url: str = self.description + UPDATE_PATH
+        self.timeout_sec: float = timeout_sec
+        self._session: Optional[ClientSession] = None
+
+    async def start(self) -> None:
+        """Open an HTTP session with no limit on concurrent connections."""
+        self._session = ClientSession(
+            connector=TCPConnector(limit=0),
+            timeout=ClientTimeout(total=self.timeout_sec),
+        )
+
+    async def stop(self) -> None:
+        """Close the HTTP session."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def post(self, payload: Dict[str, Any]) -> int:
+        """Send one machine update and return the response status code."""
+        assert self._session is not None
+        async with self._session.post(self.url, json=payload) as response:
+            await response.read()
+            return response.status
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    """Return the ``q`` quantile (nearest rank) of sorted ``ordered``."""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class LoadTest:
+    """Runs a :class:`Scenario` against a :class:`Target`."""
+
+    def __init__(self, scenario: Scenario, target: Target) -> None:
+        """Initialize LoadTest.
+
+        :param scenario: Scenario to run.
+        :param target: Where to send heartbeats.
+        """
+        self.scenario: Scenario = scenario
+        self.target: Target = target
+        rng: random.Random = random.Random(scenario.seed)
+        #: One simulated MCU per machine, each with its own random stream.
+        self.mcus: List[SimulatedMCU] = [
+            SimulatedMCU(name, scenario, random.Random(rng.getrandbits(64)))
+            for name in scenario.machine_names
+        ]
+        #: Latency of each request, in seconds.
+        self.latencies: List[float] = []
+        #: Count of responses by status code, or :data:`NO_RESPONSE`.
+        self.statuses: Dict[str, int] = {}
+        #: Heartbeats sent late because the previous one was still running.
+        self.late: int = 0
+
+    async def _send(self, payload: Dict[str, Any]) -> None:
+        """Send one heartbeat and record its latency and status."""
+        start: float = time.perf_counter()
+        try:
+            status: str = str(await self.target.post(payload))
+        except (ClientError, asyncio.TimeoutError, OSError) as ex:
+            logger.debug("Update for %s failed: %s", payload["machine_name"], ex)
+            status = NO_RESPONSE
+        self.latencies.append(time.perf_counter() - start)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    async def _run_mcu(self, mcu: SimulatedMCU, deadline: float) -> None:
+        """Send heartbeats from ``mcu`` on its interval until ``deadline``."""
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        interval: float = self.scenario.interval_sec
+        next_at: float = loop.time() + mcu.rng.uniform(0, interval)
+        while next_at < deadline:
+            delay: float = next_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                self.late += 1
+            await self._send(mcu.heartbeat())
+            next_at += interval
+
+    async def run(self) -> Dict[str, Any]:
+        """Run the scenario and return its :meth:`results`."""
+        await self.target.start()
+        try:
+            loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+            start: float = loop.time()
+            deadline: float = start + self.scenario.duration_sec
+            logger.info(
+                "Running scenario %s: %d machines for %s seconds against %s",
+                self.scenario.name,
+                len(self.mcus),
+                self.scenario.duration_sec,
+                self.target.description,
+            )
+            await asyncio.gather(*[self._run_mcu(m, deadline) for m in self.mcus])
+            elapsed: float = loop.time() - start
+        finally:
+            await self.target.stop()
+        return self.results(elapsed)
+
+    def results(self, elapsed: float) -> Dict[str, Any]:
+        """Return a summary of the run.
+
+        :param elapsed: Wall-clock duration of the run, in seconds.
+        """
+        ordered: List[float] = sorted(self.latencies)
+        count: int = len(ordered)
+        errors: int = sum(
+            n
+            for status, n in self.statuses.items()
+            if status == NO_RESPONSE or int(status) >= 400
+        )
+        latency_ms: Dict[str, float] = {
+            name: round(percentile(ordered, q) * 1000, 3) for name, q in PERCENTILES
+        }
+        latency_ms["max"] = round(ordered[-1] * 1000, 3) if ordered else 0.0
+        latency_ms["mean"] = round(sum(ordered) / count * 1000, 3) if count else 0.0
+        return {
+            "scenario": self.scenario.as_dict(),
+            "target": self.target.description,
+            "elapsed_sec": round(elapsed, 3),
+            "requests": count,
+            "throughput_rps": round(count / elapsed, 3) if elapsed else 0.0,
+            "latency_ms": latency_ms,
+            "status_counts": dict(sorted(self.statuses.items())),
+            "errors": errors,
+            "error_rate": round(errors / count, 6) if count else 0.0,
+            "http_503": self.statuses.get("503", 0),
+            "late_heartbeats": self.late,
+            "sessions": sum(m.sessions for m in self.mcus),
+            "unknown_fob_sessions": sum(m.unknown_sessions for m in self.mcus),
+            "oopses": sum(m.oopses for m in self.mcus),
+            "reboots": sum(m.reboots for m in self.mcus),
+        }
+
+
+def _compared_metrics(results: Dict[str, Any]) -> Dict[str, float]:
+    """Return the metrics checked for regressions, from run results."""
+    metrics: Dict[str, float] = {
+        f"latency_ms.{name}": results["latency_ms"][name] for name, _ in PERCENTILES
+    }
+    metrics["error_rate"] = results["error_rate"]
+    count: int = results["requests"]
+    metrics["http_503_rate"] = results["http_503"] / count if count else 0.0
+    return metrics
+
+
+def compare(
+    results: Dict[str, Any], baseline: Dict[str, Any], max_regression_pct: float
+) -> Tuple[List[str], List[str]]:
+    """Compare run results with those of a baseline run.
+
+    A metric (latency percentile, error rate or 503 rate) has regressed if
+    it is more than ``max_regression_pct`` percent higher than in the
+    baseline; any errors or 503s are a regression if the baseline had none.
+
+    :returns: Lines describing each compared metric, and lines describing
+        the metrics that regressed.
+    """
+    lines: List[str] = []
+    regressions: List[str] = []
+    if results["scenario"] != baseline["scenario"]:
+        lines.append("WARNING: baseline was run with a different scenario")
+    current: Dict[str, float] = _compared_metrics(results)
+    before: Dict[str, float] = _compared_metrics(baseline)
+    for name, value in current.items():
+        old: float = before[name]
+        if old:
+            change: str = f"{(value - old) / old * 100:+.1f}%"
+        else:
+            change = "n/a"
+        line: str = f"{name}: {old:g} -> {value:g} ({change})"
+        lines.append(line)
+        if value > old * (1 + max_regression_pct / 100) and value > 0:
+            regressions.append(line)
+    return lines, regressions
+
+
+def format_results(results: Dict[str, Any]) -> str:
+    """Return run results as a human-readable report."""
+    lat: Dict[str, float] = results["latency_ms"]
+    statuses: str = ", ".join(f"{k}={v}" for k, v in results["status_counts"].items())
+    machines: Any = results["scenario"]["machines"]
+    if isinstance(machines, list):
+        machines = len(machines)
+    return "\n".join(
+        [
+            f"Scenario: {results['scenario']['name']} ({machines} machines)",
+            f"Target: {results['target']}",
+            f"Requests: {results['requests']} in {results['elapsed_sec']}s "
+            f"({results['throughput_rps']}/s)",
+            f"Latency (ms): p50={lat['p50']} p95={lat['p95']} p99={lat['p99']} "
+            f"max={lat['max']} mean={lat['mean']}",
+            f"Statuses: {statuses or 'none'}",
+            f"Errors: {results['errors']} (rate {results['error_rate']:.4%}); "
+            f"503s: {results['http_503']}; late heartbeats: "
+            f"{results['late_heartbeats']}",
+            f"Simulated: {results['sessions']} RFID sessions "
+            f"({results['unknown_fob_sessions']} unknown fob), "
+            f"{results['oopses']} oopses, {results['reboots']} reboots",
+        ]
+    )
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    """Parse command line arguments."""
+    p = argparse.ArgumentParser(
+        description="Load test a MAC server with simulated machine control units"
+    )
+    p.add_argument(
+        "scenario",
+        nargs="?",
+        action="store",
+        type=str,
+        default=None,
+        help="Path to scenario JSON file (default: the example scenario)",
+    )
+    p.add_argument(
+        "--dump-example-scenario",
+        dest="dump_example_scenario",
+        action="store_true",
+        default=False,
+        help="Just dump example scenario file to STDOUT and then exit",
+    )
+    p.add_argument(
+        "-u",
+        "--url",
+        dest="url",
+        action="store",
+        type=str,
+        default=None,
+        help="Base URL of a running mac-server to test, e.g. "
+        "http://localhost:5000 (default: test an in-process server)",
+    )
+    p.add_argument(
+        "--write-config",
+        dest="write_config",
+        action="store",
+        type=str,
+        default=None,
+        help="Just write machines.json and users.json for the scenario to "
+        "this directory and then exit",
+    )
+    p.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        action="store",
+        type=str,
+        default=None,
+        help="Path to write results JSON to",
+    )
+    p.add_argument(
+        "-c",
+        "--compare",
+        dest="compare",
+        action="store",
+        type=str,
+        default=None,
+        help="Path to results JSON of a baseline run to compare against",
+    )
+    p.add_argument(
+        "--max-regression",
+        dest="max_regression",
+        action="store",
+        type=float,
+        default=10.0,
+        help="With --compare, exit non-zero if any metric is this many "
+        "percent worse than the baseline (default 10)",
+    )
+    p.add_argument(
+        "-v",
+        "--verbose",
+        dest="verbose",
+        action="store_true",
+        default=False,
+        help="verbose output",
+    )
+    args = p.parse_args(argv)
+    return args
+
+
+def main() -> None:
+    """Main entrypoint for CLI script."""
+    args = parse_args(sys.argv[1:])
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+    else:
+        # keep the in-process server's per-request logs from drowning out
+        # the results
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger("AUTH").setLevel(logging.WARNING)
+        logger.setLevel(logging.INFO)
+    if args.dump_example_scenario:
+        print(json.dumps(Scenario.example(), sort_keys=True, indent=4))
+        return
+    if args.scenario:
+        scenario: Scenario = Scenario.from_file(args.scenario)
+    else:
+        scenario = Scenario(Scenario.example())
+    if args.write_config:
+        for path in scenario.write_config(args.write_config):
+            print(f"Wrote {path}")
+        return
+    target: Target
+    if args.url:
+        target = HttpTarget(args.url, scenario.timeout_sec)
+    else:
+        target = InProcessTarget(scenario)
+    results: Dict[str, Any] = asyncio.run(LoadTest(scenario, target).run())
+    print(format_results(results))
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(results, fh, sort_keys=True, indent=4)
+        logger.info("Wrote results to %s", args.output)
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline: Dict[str, Any] = json.load(fh)
+        lines, regressions = compare(results, baseline, args.max_regression)
+        print(f"Compared with {args.compare}:")
+        print("\n".join(lines))
+        if regressions:
+            print(
+                f"REGRESSION: {len(regressions)} metric(s) more than "
+                f"{args.max_regression:g}% worse than baseline"
+            )
+            raise SystemExit(1)
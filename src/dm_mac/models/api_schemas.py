@@ -4,26 +4,44 @@ from typing import List
 from typing import Optional
 
 from pydantic import BaseModel
+from pydantic import ConfigDict
 from pydantic import Field
+from pydantic import ValidationError
 
 
 class MachineUpdateRequest(BaseModel):
-    """Request body for POST /api/machine/update."""
+    """Request body for POST /api/machine/update.
+
+    Enforced by the update view, which parses and validates the raw body in
+    one pass with :meth:`~pydantic.BaseModel.model_validate_json`. Unknown
+    keys and values of the wrong type are rejected. Only ``machine_name``
+    is required, as MCUs send partial updates while booting; an omitted or
+    ``null`` sensor reading leaves the last reported value in place.
+    """
+
+    model_config = ConfigDict(extra="forbid")
 
     machine_name: str = Field(description="Name of the machine sending the update.")
-    oops: bool = Field(description="Whether the oops button is pressed.")
-    rfid_value: str = Field(
+    oops: bool = Field(default=False, description="Whether the oops button is pressed.")
+    rfid_value: Optional[str] = Field(
+        default=None,
         description="Value of the RFID fob/card currently present, "
         "or empty string if none. ESPHome strips leading zeroes; "
-        "the server left-pads to 10 characters."
+        "the server left-pads to 10 characters.",
+    )
+    uptime: Optional[float] = Field(
+        default=None, description="Uptime of the ESP32 (MCU) in seconds."
     )
-    uptime: float = Field(description="Uptime of the ESP32 (MCU) in seconds.")
-    wifi_signal_db: float = Field(description="WiFi signal strength in dB.")
-    wifi_signal_percent: float = Field(description="WiFi signal strength in percent.")
-    internal_temperature_c: float = Field(
-        description="Internal temperature of the ESP32 in °C."
+    wifi_signal_db: Optional[float] = Field(
+        default=None, description="WiFi signal strength in dB."
     )
-    amps: float = Field(
+    wifi_signal_percent: Optional[float] = Field(
+        default=None, description="WiFi signal strength in percent."
+    )
+    internal_temperature_c: Optional[float] = Field(
+        default=None, description="Internal temperature of the ESP32 in °C."
+    )
+    amps: Optional[float] = Field(
         default=0.0,
         description="Amperage from the current clamp ammeter, if present.",
     )
@@ -33,6 +51,41 @@ class MachineUpdateRequest(BaseModel):
         "MCU; reported for observability only and never used in "
         "authorization decisions. Older firmware omits this field.",
     )
+    state_version: Optional[int] = Field(
+        default=None,
+        description="The ``state_version`` of the last response the MCU "
+        "received (or 0 if none). If given, the response carries the current "
+        "state_version, and is cut down to just that and unchanged=true if "
+        "nothing has changed since. Older firmware omits this field.",
+    )
+
+
+#: Most machine updates accepted in one batch update request.
+MAX_BATCH_UPDATES: int = 256
+
+
+class MachineBatchUpdateRequest(BaseModel):
+    """Request body for POST /api/machine/batch_update."""
+
+    model_config = ConfigDict(extra="forbid")
+
+    updates: List[MachineUpdateRequest] = Field(
+        max_length=MAX_BATCH_UPDATES,
+        description="Updates to apply, in order; each exactly as it would be "
+        "sent to /api/machine/update.",
+    )
+
+
+def validation_error_message(ex: ValidationError) -> str:
+    """Return a short, single-line description of a validation failure."""
+    return "; ".join(
+        (
+            ".".join(str(part) for part in err["loc"]) + ": " + err["msg"]
+            if err["loc"]
+            else err["msg"]
+        )
+        for err in ex.errors(include_url=False, include_context=False)
+    )
 
 
 class MachineUpdateResponse(BaseModel):
@@ -53,6 +106,41 @@ class MachineUpdateResponse(BaseModel):
         "Always emitted; firmware that does not know about this "
         "field ignores it.",
     )
+    state_version: Optional[int] = Field(
+        default=None,
+        description="Version of this response; only emitted when the request "
+        "included state_version.",
+    )
+    unchanged: Optional[bool] = Field(
+        default=None,
+        description="True if the request's state_version is still current. "
+        "Only state_version is sent with it; the MCU should keep its current "
+        "outputs.",
+    )
+
+
+class MachineBatchUpdateResult(BaseModel):
+    """Result of one update in a batch update response."""
+
+    machine_name: str = Field(description="Name of the machine updated.")
+    status: int = Field(
+        description="HTTP status the update would have had on its own: 200, "
+        "404 for an unknown machine, or 500 on error."
+    )
+    response: Optional[MachineUpdateResponse] = Field(
+        default=None, description="Response for the MCU, if status is 200."
+    )
+    error: Optional[str] = Field(
+        default=None, description="Error message, if status is not 200."
+    )
+
+
+class MachineBatchUpdateResponse(BaseModel):
+    """Response body for POST /api/machine/batch_update (200)."""
+
+    results: List[MachineBatchUpdateResult] = Field(
+        description="One result per update, in the order of the request."
+    )
 
 
 class SuccessResponse(BaseModel):
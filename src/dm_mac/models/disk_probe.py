@@ -0,0 +1,225 @@
+"""Background measurement of state directory write latency.
+
+Without this, the only signal that the disk holding machine state is
+degrading is real heartbeats exceeding
+:data:`~dm_mac.models.machine.STATE_SAVE_TIMEOUT_SEC`. A
+:class:`DiskProbe` instead periodically writes and fsyncs a small file in
+the state directory on its own thread, and keeps an exponentially
+weighted moving average and percentiles of how long that takes. The
+:class:`~dm_mac.models.persistence.StatePersister` uses these to:
+
+* adapt the save budget (:meth:`DiskProbe.save_budget_sec`) when degraded
+  mode is enabled, so a stall on an otherwise fast disk is detected in a
+  fraction of the fixed budget;
+* lengthen the write-behind flush interval
+  (:meth:`DiskProbe.flush_interval_sec`) while the disk is slow, so each
+  batch is bigger and fewer are written;
+* enter degraded mode as soon as a probe is stuck (:attr:`DiskProbe.stalled`),
+  before any heartbeat has to time out.
+
+The probe is enabled by setting ``MACHINE_STATE_PROBE_INTERVAL_SEC`` to a
+positive number of seconds.
+"""
+
+import asyncio
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from logging import Logger
+from logging import getLogger
+from time import monotonic
+from typing import Callable
+from typing import Deque
+from typing import Optional
+
+logger: Logger = getLogger(__name__)
+
+#: Default seconds between probes; ``0`` disables the probe. Overridden by
+#: the ``MACHINE_STATE_PROBE_INTERVAL_SEC`` environment variable.
+DEFAULT_PROBE_INTERVAL_SEC: float = 0.0
+
+#: Name of the file written by each probe, within the state directory.
+PROBE_FILENAME: str = ".mac-disk-probe"
+
+#: Bytes written by each probe; about the size of one machine's state.
+PROBE_SIZE: int = 512
+
+#: Number of recent probes kept for percentiles.
+PROBE_WINDOW: int = 120
+
+#: Weight of the newest probe in :attr:`DiskProbe.ewma_sec`.
+EWMA_ALPHA: float = 0.2
+
+#: The adaptive save budget is this multiple of the p99 probe latency...
+BUDGET_MULTIPLIER: float = 4.0
+
+#: ...but never less than this many seconds.
+MIN_SAVE_BUDGET_SEC: float = 0.25
+
+#: While the disk is slow, the write-behind interval is stretched to this
+#: multiple of the average probe latency...
+FLUSH_INTERVAL_MULTIPLIER: float = 10.0
+
+#: ...up to this multiple of the configured interval.
+MAX_FLUSH_INTERVAL_FACTOR: float = 4.0
+
+
+class DiskProbe:
+    """Periodic write+fsync latency probe of one directory."""
+
+    def __init__(self, state_dir: str, interval_sec: Optional[float] = None) -> None:
+        """Initialize DiskProbe.
+
+        :param state_dir: Directory to probe.
+        :param interval_sec: Seconds between probes; ``0`` disables probing.
+            Defaults to the ``MACHINE_STATE_PROBE_INTERVAL_SEC`` environment
+            variable, or :data:`DEFAULT_PROBE_INTERVAL_SEC`.
+        """
+        if interval_sec is None:
+            interval_sec = float(
+                os.environ.get(
+                    "MACHINE_STATE_PROBE_INTERVAL_SEC", DEFAULT_PROBE_INTERVAL_SEC
+                )
+            )
+        #: Seconds between probes; ``0`` disables probing.
+        self.interval_sec: float = interval_sec
+        #: Directory being probed.
+        self.state_dir: str = state_dir
+        #: Latencies of the most recent :data:`PROBE_WINDOW` probes.
+        self.samples: Deque[float] = deque(maxlen=PROBE_WINDOW)
+        #: Exponentially weighted moving average probe latency, once known.
+        self.ewma_sec: Optional[float] = None
+        #: Lifetime count of probes that raised an exception.
+        self.errors: int = 0
+        #: Monotonic start time of the in-flight probe, if any.
+        self._started: Optional[float] = None
+        #: Probes get their own thread, so a hung disk cannot starve others.
+        self._pool: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def enabled(self) -> bool:
+        """Return whether periodic probing is enabled."""
+        return self.interval_sec > 0
+
+    @property
+    def in_flight_sec(self) -> float:
+        """Return how long the current probe has been running, or 0."""
+        started: Optional[float] = self._started
+        return 0.0 if started is None else monotonic() - started
+
+    @property
+    def stall_after_sec(self) -> float:
+        """Return how long a probe may take before it counts as stalled.
+
+        This is the adaptive save budget (see :meth:`save_budget_sec`),
+        capped at :data:`~dm_mac.models.machine.STATE_SAVE_TIMEOUT_SEC`.
+        """
+        # imported here to avoid a circular import via persistence
+        from dm_mac.models.machine import STATE_SAVE_TIMEOUT_SEC
+
+        return self.save_budget_sec(STATE_SAVE_TIMEOUT_SEC)
+
+    @property
+    def stalled(self) -> bool:
+        """Return whether the current probe has exceeded :attr:`stall_after_sec`."""
+        in_flight: float = self.in_flight_sec
+        return in_flight > 0 and in_flight > self.stall_after_sec
+
+    def percentile(self, q: float) -> float:
+        """Return the ``q`` (0-1) percentile of recent probes, or 0 if none."""
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def record(self, seconds: float) -> None:
+        """Add one probe latency to the statistics."""
+        self.samples.append(seconds)
+        if self.ewma_sec is None:
+            self.ewma_sec = seconds
+        else:
+            self.ewma_sec += EWMA_ALPHA * (seconds - self.ewma_sec)
+
+    def save_budget_sec(self, cap: float) -> float:
+        """Return the adaptive save budget, never more than ``cap``.
+
+        :data:`BUDGET_MULTIPLIER` times the p99 probe latency, but at least
+        :data:`MIN_SAVE_BUDGET_SEC`; ``cap`` until there are samples.
+        """
+        if not self.samples:
+            return cap
+        return min(
+            cap, max(MIN_SAVE_BUDGET_SEC, BUDGET_MULTIPLIER * self.percentile(0.99))
+        )
+
+    def flush_interval_sec(self, configured: float) -> float:
+        """Return the write-behind interval to use, given the configured one.
+
+        Stretched to :data:`FLUSH_INTERVAL_MULTIPLIER` times the average
+        probe latency when that is longer, up to
+        :data:`MAX_FLUSH_INTERVAL_FACTOR` times ``configured``.
+        """
+        if self.ewma_sec is None or configured <= 0:
+            return configured
+        return min(
+            configured * MAX_FLUSH_INTERVAL_FACTOR,
+            max(configured, FLUSH_INTERVAL_MULTIPLIER * self.ewma_sec),
+        )
+
+    def probe_once(self) -> float:
+        """Write and fsync the probe file (synchronous); return the seconds taken."""
+        start: float = monotonic()
+        with open(os.path.join(self.state_dir, PROBE_FILENAME), "wb") as f:
+            f.write(b"\0" * PROBE_SIZE)
+            f.flush()
+            os.fsync(f.fileno())
+        return monotonic() - start
+
+    async def run(self, on_stall: Optional[Callable[[float], None]] = None) -> None:
+        """Probe every :attr:`interval_sec` seconds until cancelled.
+
+        :param on_stall: Called (once per probe) with the elapsed time if a
+            probe becomes :attr:`stalled`; the probe is still awaited.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="machine-state-probe"
+                )
+            self._started = monotonic()
+            future = asyncio.ensure_future(
+                loop.run_in_executor(self._pool, self.probe_once)
+            )
+            try:
+                notified: bool = False
+                while not future.done():
+                    await asyncio.wait(
+                        {future},
+                        timeout=(
+                            self.interval_sec
+                            if notified
+                            else max(0.01, self.stall_after_sec - self.in_flight_sec)
+                        ),
+                    )
+                    if not notified and not future.done() and self.stalled:
+                        notified = True
+                        logger.error(
+                            "State directory probe has taken %.1fs so far",
+                            self.in_flight_sec,
+                        )
+                        if on_stall is not None:
+                            on_stall(self.in_flight_sec)
+                self.record(future.result())
+            except Exception as ex:
+                self.errors += 1
+                logger.error("State directory probe failed: %s", ex)
+            finally:
+                self._started = None
+            await asyncio.sleep(self.interval_sec)
+
+    def shutdown(self) -> None:
+        """Stop the probe thread without waiting for a hung probe."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
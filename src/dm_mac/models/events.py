@@ -0,0 +1,649 @@
+"""In-process bus for the side effects of machine state transitions.
+
+When an RFID login, logout, Oops button press, MCU reboot or second-relay
+decision changes a machine's state, :class:`~dm_mac.models.machine.MachineState`
+publishes a typed :class:`MachineEvent` describing it instead of logging it
+and posting it to Slack itself. Consumers (*sinks*) subscribed to the
+:class:`EventBus` do that work:
+
+* :func:`log_event` writes the ``AUTH`` and ``OOPS`` log lines;
+* :class:`SlackSink` posts to the Slack admin channel, if Slack is enabled;
+* :class:`EventCounter` counts events for the Prometheus metrics.
+
+By default events are put on a bounded queue (of ``EVENT_QUEUE_SIZE``
+events) that a background dispatcher delivers in order, so a heartbeat's
+latency covers only the state transition; if the queue is full, new
+events are dropped (and counted) rather than slowing requests down.
+Setting ``EVENT_QUEUE_SIZE`` to ``0`` instead delivers each event to every
+sink before the publishing request continues, as before the bus existed.
+"""
+
+import asyncio
+import logging
+import os
+from logging import Logger
+from logging import getLogger
+from time import time
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from humanize import naturaldelta
+
+from dm_mac.models.users import User
+
+if TYPE_CHECKING:  # pragma: no cover
+    from dm_mac.models.machine import Machine
+    from dm_mac.slack_handler import SlackHandler
+
+logger: Logger = getLogger(__name__)
+
+#: Default ``EVENT_QUEUE_SIZE``: most events to hold for the dispatcher.
+DEFAULT_EVENT_QUEUE_SIZE: int = 1000
+
+#: Seconds :meth:`EventBus.stop` waits for queued events to be delivered.
+EVENT_DRAIN_TIMEOUT_SEC: float = 5.0
+
+#: :attr:`LoginEvent.authorization` of a user let in only because the
+#: machine is ``unauthorized_warn_only``.
+WARN_ONLY_AUTHORIZATION: str = "unauthorized_warn_only"
+
+
+class MachineEvent:
+    """Base class of the events published by machine state transitions."""
+
+    #: Short name of this kind of event, used in metrics.
+    kind: str = "event"
+
+    def __init__(self, machine: "Machine") -> None:
+        """Initialize MachineEvent.
+
+        :param machine: Machine the event happened on.
+        """
+        #: Machine the event happened on.
+        self.machine: "Machine" = machine
+        #: Float timestamp of when the event happened.
+        self.time: float = time()
+
+    def __repr__(self) -> str:
+        """Return a short description of the event."""
+        return f"<{type(self).__name__} {self.machine.name}>"
+
+
+class LoginEvent(MachineEvent):
+    """A user logged in with their RFID fob."""
+
+    kind: str = "login"
+
+    def __init__(
+        self,
+        machine: "Machine",
+        user: User,
+        rfid_value: str,
+        authorization: Optional[str] = None,
+        override: bool = False,
+        second_relay_authorization: Optional[str] = None,
+    ) -> None:
+        """Initialize LoginEvent.
+
+        :param machine: Machine the event happened on.
+        :param user: User who logged in.
+        :param rfid_value: Fob they used.
+        :param authorization: Which of the machine's authorizations let them
+            in, or :data:`WARN_ONLY_AUTHORIZATION`; None for an override.
+        :param override: Whether this was an ``oops_override`` login on an
+            Oopsed or locked-out machine.
+        :param second_relay_authorization: Second relay decision at login.
+        """
+        super().__init__(machine)
+        #: User who logged in.
+        self.user: User = user
+        #: Fob they used.
+        self.rfid_value: str = rfid_value
+        #: Authorization that let them in; see :data:`WARN_ONLY_AUTHORIZATION`.
+        self.authorization: Optional[str] = authorization
+        #: Whether this was an override login.
+        self.override: bool = override
+        #: Second relay decision at login, if the machine has one.
+        self.second_relay_authorization: Optional[str] = second_relay_authorization
+
+    @property
+    def warn_only(self) -> bool:
+        """Return whether the user is not actually authorized for the machine."""
+        return self.authorization == WARN_ONLY_AUTHORIZATION
+
+
+class LogoutEvent(MachineEvent):
+    """The RFID fob of a session was removed."""
+
+    kind: str = "logout"
+
+    def __init__(
+        self,
+        machine: "Machine",
+        user: Optional[User],
+        rfid_value: Optional[str],
+        duration_sec: float,
+        override: bool = False,
+    ) -> None:
+        """Initialize LogoutEvent.
+
+        :param machine: Machine the event happened on.
+        :param user: User who was logged in, if any.
+        :param rfid_value: Fob that was removed.
+        :param duration_sec: How long the fob was present.
+        :param override: Whether it was an override session.
+        """
+        super().__init__(machine)
+        #: User who was logged in, if any.
+        self.user: Optional[User] = user
+        #: Fob that was removed.
+        self.rfid_value: Optional[str] = rfid_value
+        #: How long the fob was present.
+        self.duration_sec: float = duration_sec
+        #: Whether it was an override session.
+        self.override: bool = override
+
+
+class DeniedEvent(MachineEvent):
+    """An RFID login attempt was refused."""
+
+    kind: str = "denied"
+
+    #: The fob is not any user's.
+    UNKNOWN_FOB: str = "unknown_fob"
+    #: The machine is Oopsed.
+    OOPSED: str = "oopsed"
+    #: The machine is locked out.
+    LOCKED_OUT: str = "locked_out"
+    #: The user is not authorized for the machine.
+    UNAUTHORIZED: str = "unauthorized"
+
+    def __init__(
+        self,
+        machine: "Machine",
+        reason: str,
+        rfid_value: str,
+        user: Optional[User] = None,
+        blocked: bool = False,
+    ) -> None:
+        """Initialize DeniedEvent.
+
+        :param machine: Machine the event happened on.
+        :param reason: Why; one of the constants of this class.
+        :param rfid_value: Fob that was presented.
+        :param user: User it belongs to, if known.
+        :param blocked: Whether the machine was Oopsed or locked out.
+        """
+        super().__init__(machine)
+        #: Why the login was refused; one of the constants of this class.
+        self.reason: str = reason
+        #: Fob that was presented.
+        self.rfid_value: str = rfid_value
+        #: User it belongs to, if known.
+        self.user: Optional[User] = user
+        #: Whether the machine was Oopsed or locked out.
+        self.blocked: bool = blocked
+
+
+class OopsEvent(MachineEvent):
+    """The machine's Oops button was pressed."""
+
+    kind: str = "oops"
+
+    def __init__(
+        self, machine: "Machine", rfid_value: Optional[str], user: Optional[User]
+    ) -> None:
+        """Initialize OopsEvent.
+
+        :param machine: Machine the event happened on.
+        :param rfid_value: Fob present at the time, if any.
+        :param user: User it belongs to, if known.
+        """
+        super().__init__(machine)
+        #: Fob present at the time, if any.
+        self.rfid_value: Optional[str] = rfid_value
+        #: User it belongs to, if known.
+        self.user: Optional[User] = user
+
+
+class RebootEvent(MachineEvent):
+    """The machine's MCU rebooted, resetting relay and RFID state."""
+
+    kind: str = "reboot"
+
+
+class SecondRelayEvent(MachineEvent):
+    """The second relay's authorization decision was (re)computed."""
+
+    kind: str = "second_relay"
+
+    def __init__(
+        self, machine: "Machine", authorization: str, user: Optional[User]
+    ) -> None:
+        """Initialize SecondRelayEvent.
+
+        :param machine: Machine the event happened on.
+        :param authorization: ``granted``, ``denied``, ``warn`` or
+            ``always_enabled``.
+        :param user: Current user, if any.
+        """
+        super().__init__(machine)
+        #: ``granted``, ``denied``, ``warn`` or ``always_enabled``.
+        self.authorization: str = authorization
+        #: Current user, if any.
+        self.user: Optional[User] = user
+
+    @property
+    def accessory(self) -> str:
+        """Return the name of the accessory on the second relay."""
+        sr = self.machine.second_relay
+        return sr.alias if sr is not None and sr.alias else "second relay"
+
+
+#: A consumer of events. It may return an awaitable, which is awaited
+#: before the next event is delivered.
+Sink = Callable[[MachineEvent], Optional[Awaitable[None]]]
+
+
+def _logname(user: Optional[User], rfid_value: str) -> str:
+    """Return how a user and their fob are named in ``AUTH`` log lines."""
+    return f"{user.full_name if user else 'unknown'} ({rfid_value})"
+
+
+def log_event(event: MachineEvent) -> None:
+    """Sink writing the ``AUTH`` and ``OOPS`` log lines for an event."""
+    auth: Logger = logging.getLogger("AUTH")
+    name: str = event.machine.display_name
+    if isinstance(event, LoginEvent):
+        user: User = event.user
+        if event.override:
+            auth.info(
+                "Override login on %s by %s", name, _logname(user, event.rfid_value)
+            )
+            return
+        if event.warn_only:
+            auth.warning(
+                "User %s (%s) authorized for %s based on "
+                "unauthorized_warn_only==True",
+                user.full_name,
+                user.account_id,
+                name,
+            )
+        else:
+            auth.info(
+                "User %s (%s) authorized for %s based on %s",
+                user.full_name,
+                user.account_id,
+                name,
+                event.authorization,
+            )
+        auth.info(
+            "User %s (%s) authorized for %s; session start",
+            user.full_name,
+            user.account_id,
+            name,
+        )
+    elif isinstance(event, LogoutEvent):
+        auth.info(
+            "RFID logout on %s by %s; session duration %d seconds%s",
+            name,
+            event.user.full_name if event.user else event.rfid_value,
+            int(event.duration_sec),
+            " (override session)" if event.override else "",
+        )
+    elif isinstance(event, DeniedEvent):
+        if event.reason == DeniedEvent.UNKNOWN_FOB:
+            auth.warning(
+                "RFID login attempt on %s by unknown fob %s", name, event.rfid_value
+            )
+        elif event.reason == DeniedEvent.UNAUTHORIZED:
+            assert event.user is not None
+            auth.info(
+                "User %s (%s) UNAUTHORIZED for %s",
+                event.user.full_name,
+                event.user.account_id,
+                name,
+            )
+        elif event.reason == DeniedEvent.OOPSED:
+            auth.warning(
+                "RFID login attempt while oopsed on %s by %s",
+                name,
+                _logname(event.user, event.rfid_value),
+            )
+        else:
+            auth.warning(
+                "RFID login attempt while locked out on %s by %s",
+                name,
+                _logname(event.user, event.rfid_value),
+            )
+    elif isinstance(event, OopsEvent):
+        ustr: str = ""
+        if event.rfid_value:
+            ustr = " RFID card is present but unknown."
+            if event.user:
+                ustr = f" Current user is: {event.user.full_name}."
+        logging.getLogger("OOPS").warning("Machine %s was Oopsed.%s", name, ustr)
+    elif isinstance(event, RebootEvent):
+        auth.warning("Machine %s rebooted; resetting relay and RFID state", name)
+    elif isinstance(event, SecondRelayEvent):
+        user_name: str = event.user.full_name if event.user else "<none>"
+        if event.authorization == "granted":
+            auth.info(
+                "User %s authorized for accessory %s on machine %s",
+                user_name,
+                event.accessory,
+                name,
+            )
+        elif event.authorization == "denied":
+            auth.info(
+                "User %s UNAUTHORIZED for accessory %s on machine %s",
+                user_name,
+                event.accessory,
+                name,
+            )
+        elif event.authorization == "warn":
+            auth.warning(
+                "User %s authorized for accessory %s on machine %s "
+                "(warn-only override)",
+                user_name,
+                event.accessory,
+                name,
+            )
+        elif event.authorization == "always_enabled":
+            auth.info(
+                "Accessory %s on machine %s always-enabled", event.accessory, name
+            )
+
+
+class SlackSink:
+    """Sink posting events to the Slack admin channel, if Slack is enabled."""
+
+    def __init__(self, handler: Callable[[], Optional["SlackHandler"]]) -> None:
+        """Initialize SlackSink.
+
+        :param handler: Returns the current Slack handler, or None if Slack
+            integration is not enabled; called for each event.
+        """
+        self._handler: Callable[[], Optional["SlackHandler"]] = handler
+
+    def __call__(self, event: MachineEvent) -> Optional[Awaitable[None]]:
+        """Return a coroutine posting ``event`` to Slack, if it is posted."""
+        if isinstance(event, SecondRelayEvent):
+            return None
+        slack: Optional["SlackHandler"] = self._handler()
+        if not slack:
+            # Slack integration is not enabled
+            return None
+        return self._post(slack, event)
+
+    @staticmethod
+    def login_message(event: LoginEvent) -> str:
+        """Return the admin channel message for a (non-override) login."""
+        msg: str = (
+            f"RFID login on {event.machine.display_name} by authorized user "
+            f"{event.user.full_name}"
+        )
+        sr = event.machine.second_relay
+        if sr is not None:
+            accessory: str = sr.alias if sr.alias else "second relay"
+            authz: Optional[str] = event.second_relay_authorization
+            if authz == "granted":
+                msg += f"; {accessory} authorized"
+            elif authz == "denied":
+                msg += f"; {accessory} NOT authorized — relay off"
+            elif authz == "warn":
+                msg += f"; {accessory} WARN-ONLY override — relay on"
+            elif authz == "always_enabled":
+                msg += f"; {accessory} always-enabled — relay on"
+        return msg
+
+    @staticmethod
+    def denied_message(event: DeniedEvent) -> str:
+        """Return the admin channel message for a refused login."""
+        name: str = event.machine.display_name
+        user_name: str = event.user.full_name if event.user else "unknown"
+        if event.reason == DeniedEvent.UNKNOWN_FOB:
+            if event.blocked:
+                return (
+                    f"RFID login attempt on {name} by unknown fob when oopsed or "
+                    "locked out."
+                )
+            return f"RFID login attempt on {name} by unknown fob"
+        if event.reason == DeniedEvent.OOPSED:
+            return f"RFID login attempt on {name} by {user_name} when oopsed."
+        if event.reason == DeniedEvent.LOCKED_OUT:
+            return (
+                f"RFID login attempt on {name} by {user_name} when machine "
+                "locked-out."
+            )
+        return f"rejected RFID login on {name} by UNAUTHORIZED user {user_name}"
+
+    @staticmethod
+    def logout_message(event: LogoutEvent) -> str:
+        """Return the admin channel message for a logout."""
+        msg: str = (
+            f"RFID logout on {event.machine.display_name} by "
+            + (event.user.full_name if event.user else "unknown")
+            + "; session duration "
+            + naturaldelta(event.duration_sec)
+        )
+        if event.override:
+            msg += " (override session)"
+        if event.machine.second_relay is not None:
+            msg += "; both relays off"
+        return msg
+
+    async def _post(self, slack: "SlackHandler", event: MachineEvent) -> None:
+        """Post ``event`` to Slack."""
+        if isinstance(event, LoginEvent):
+            if event.override:
+                await slack.log_override_login(event.machine, event.user.full_name)
+                return
+            if event.warn_only:
+                await slack.admin_log(
+                    f"WARNING - Authorizing user {event.user.full_name} for "
+                    f"{event.machine.display_name} based on unauthorized_warn_only "
+                    "setting for machine. User is NOT authorized for this "
+                    "machine."
+                )
+            await slack.admin_log(self.login_message(event))
+        elif isinstance(event, LogoutEvent):
+            await slack.admin_log(self.logout_message(event))
+        elif isinstance(event, DeniedEvent):
+            await slack.admin_log(self.denied_message(event))
+        elif isinstance(event, OopsEvent):
+            src: str = "Oops button"
+            if event.rfid_value:
+                src += " with RFID present"
+            else:
+                src += " without RFID present"
+            await slack.log_oops(
+                event.machine,
+                src,
+                user_name=event.user.full_name if event.user else None,
+            )
+        elif isinstance(event, RebootEvent):
+            await slack.admin_log(f"Machine {event.machine.display_name} has rebooted.")
+
+
+class EventCounter:
+    """Sink counting events by machine and kind, for Prometheus."""
+
+    def __init__(self) -> None:
+        """Initialize EventCounter."""
+        #: Lifetime count of events, by (machine name, :attr:`MachineEvent.kind`).
+        self.counts: Dict[Tuple[str, str], int] = {}
+
+    def __call__(self, event: MachineEvent) -> None:
+        """Count ``event``."""
+        key: Tuple[str, str] = (event.machine.name, event.kind)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+
+class EventBus:
+    """Delivers published events to subscribed sinks, inline or queued."""
+
+    def __init__(self, queue_size: Optional[int] = None) -> None:
+        """Initialize EventBus.
+
+        :param queue_size: Most events to hold for the dispatcher; ``0``
+            delivers each event as it is published. Defaults to the
+            ``EVENT_QUEUE_SIZE`` environment variable, or
+            :data:`DEFAULT_EVENT_QUEUE_SIZE`.
+        """
+        if queue_size is None:
+            queue_size = int(
+                os.environ.get("EVENT_QUEUE_SIZE", DEFAULT_EVENT_QUEUE_SIZE)
+            )
+        #: Most events to hold for the dispatcher; ``0`` delivers inline.
+        self.queue_size: int = queue_size
+        #: Consumers, in the order events are delivered to them.
+        self.sinks: List[Sink] = []
+        #: Counts of events delivered, for metrics; subscribe it to use it.
+        self.counter: EventCounter = EventCounter()
+        #: Lifetime count of events published.
+        self.published: int = 0
+        #: Lifetime count of events dropped because the queue was full.
+        self.dropped: int = 0
+        #: Lifetime count of exceptions raised by sinks.
+        self.errors: int = 0
+        #: Queue of events awaiting the dispatcher; created by :meth:`start`.
+        self._queue: Optional["asyncio.Queue[MachineEvent]"] = None
+        #: Dispatcher task, while running.
+        self._task: Optional["asyncio.Task[None]"] = None
+        #: Sink coroutines started by :meth:`publish_nowait` without a
+        #: dispatcher, referenced until done so they are not collected.
+        self._pending: Set["asyncio.Task[None]"] = set()
+
+    @property
+    def queued(self) -> bool:
+        """Return whether events are queued for a dispatcher when it runs."""
+        return self.queue_size > 0
+
+    @property
+    def running(self) -> bool:
+        """Return whether the dispatcher is running."""
+        return self._task is not None and not self._task.done()
+
+    @property
+    def depth(self) -> int:
+        """Return the number of events waiting for the dispatcher."""
+        return 0 if self._queue is None else self._queue.qsize()
+
+    def subscribe(self, sink: Sink) -> None:
+        """Deliver all events published from now on to ``sink`` as well."""
+        self.sinks.append(sink)
+
+    async def publish(self, event: MachineEvent) -> None:
+        """Publish an event.
+
+        If the dispatcher is running, this only queues the event (see
+        :meth:`publish_nowait`); otherwise the event is delivered to every
+        sink before returning.
+        """
+        if self.running:
+            self.publish_nowait(event)
+            return
+        self.published += 1
+        await self._deliver(event)
+
+    def publish_nowait(self, event: MachineEvent) -> None:
+        """Publish an event without waiting for any sink.
+
+        For callers that cannot ``await``. If the dispatcher is running the
+        event is queued, or dropped if the queue is full. Otherwise it is
+        delivered to every sink right away, and any coroutine a sink
+        returns is run as a task (or discarded if there is no event loop).
+        """
+        self.published += 1
+        if self.running:
+            assert self._queue is not None
+            try:
+                self._queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                logger.warning("Event queue is full; dropping %r", event)
+            return
+        for sink in self.sinks:
+            try:
+                result: Optional[Awaitable[None]] = sink(event)
+            except Exception:
+                self._sink_failed(sink, event)
+                continue
+            if result is None:
+                continue
+            try:
+                loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+            except RuntimeError:
+                # no running event loop
+                if asyncio.iscoroutine(result):
+                    result.close()
+                continue
+            task: "asyncio.Task[None]" = asyncio.ensure_future(result, loop=loop)
+            self._pending.add(task)
+            task.add_done_callback(self._pending_done)
+
+    def _pending_done(self, task: "asyncio.Task[None]") -> None:
+        """Forget a finished sink task, counting it if it failed."""
+        self._pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.errors += 1
+            logger.error("Event sink failed: %s", task.exception())
+
+    def _sink_failed(self, sink: Any, event: MachineEvent) -> None:
+        """Count and log an exception raised by ``sink`` for ``event``."""
+        self.errors += 1
+        logger.exception("Event sink %r failed for %r", sink, event)
+
+    async def _deliver(self, event: MachineEvent) -> None:
+        """Deliver ``event`` to every sink, in order."""
+        for sink in self.sinks:
+            try:
+                result: Optional[Awaitable[None]] = sink(event)
+                if result is not None:
+                    await result
+            except Exception:
+                self._sink_failed(sink, event)
+
+    async def run(self) -> None:
+        """Background loop: deliver queued events until cancelled."""
+        assert self._queue is not None
+        while True:
+            event: MachineEvent = await self._queue.get()
+            try:
+                await self._deliver(event)
+            finally:
+                self._queue.task_done()
+
+    def start(self) -> None:
+        """Start the dispatcher, if :attr:`queued`."""
+        if not self.queued or self._task is not None:
+            return
+        logger.info("Starting event dispatcher with queue of %d", self.queue_size)
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """Deliver queued events (for a while) and stop the dispatcher."""
+        if self._task is None:
+            return
+        assert self._queue is not None
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=EVENT_DRAIN_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            logger.warning(
+                "Stopping event dispatcher with %d event(s) undelivered", self.depth
+            )
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
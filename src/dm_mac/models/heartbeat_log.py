@@ -0,0 +1,146 @@
+"""Sampled, structured logging of machine update heartbeats.
+
+Every MCU posts to ``/api/machine/update`` every 10 seconds (and whenever
+an RFID card or the Oops button changes), and nearly all of those
+heartbeats change nothing but telemetry. Logging each one in
+full is a steady write load on whatever stores the logs. A
+:class:`HeartbeatLog` instead emits one ``logfmt``-style line (``key=value``
+pairs, easy to parse in Loki and similar) for:
+
+* every heartbeat that changed durable machine state (a *transition*; see
+  :attr:`~dm_mac.models.machine.MachineState.last_update_changes`), always;
+* one in every :attr:`HeartbeatLog.sample_every` no-op heartbeats, per
+  machine.
+
+The rest are counted in :attr:`HeartbeatLog.suppressed`. The sample rate
+comes from the ``HEARTBEAT_LOG_SAMPLE`` environment variable; the default
+of ``1`` logs every heartbeat, and ``0`` logs only transitions.
+
+When sampling is enabled, :meth:`HeartbeatLog.access_filter` can also be
+attached to the HTTP server's access logger to drop its line for each
+successful heartbeat, which the structured line replaces.
+"""
+
+import logging
+import os
+from logging import Logger
+from logging import getLogger
+from threading import Lock
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+
+logger: Logger = getLogger(__name__)
+
+#: Default ``HEARTBEAT_LOG_SAMPLE``: log every heartbeat.
+DEFAULT_HEARTBEAT_LOG_SAMPLE: int = 1
+
+#: Request line prefix of a heartbeat in the access log.
+_UPDATE_REQUEST: str = "POST /api/machine/update "
+
+
+def logfmt(fields: Dict[str, Any]) -> str:
+    """Return ``fields`` as ``key=value`` pairs, quoting values as needed."""
+    parts = []
+    for key, value in fields.items():
+        if value is None:
+            text = ""
+        elif isinstance(value, bool):
+            text = "true" if value else "false"
+        else:
+            text = str(value)
+        if not text or any(c in text for c in ' "=\n'):
+            text = '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+            text = text.replace("\n", "\\n")
+        parts.append(f"{key}={text}")
+    return " ".join(parts)
+
+
+class HeartbeatLog:
+    """Decides which heartbeats to log, and counts the rest."""
+
+    def __init__(self, sample_every: Optional[int] = None) -> None:
+        """Initialize HeartbeatLog.
+
+        :param sample_every: Log one in this many no-op heartbeats per
+            machine; ``0`` logs none of them. Defaults to the
+            ``HEARTBEAT_LOG_SAMPLE`` environment variable, or
+            :data:`DEFAULT_HEARTBEAT_LOG_SAMPLE`.
+        """
+        if sample_every is None:
+            sample_every = int(
+                os.environ.get("HEARTBEAT_LOG_SAMPLE", DEFAULT_HEARTBEAT_LOG_SAMPLE)
+            )
+        #: Log one in this many no-op heartbeats per machine; ``0`` for none.
+        self.sample_every: int = sample_every
+        #: Lifetime count of transition heartbeats logged.
+        self.transitions: int = 0
+        #: Lifetime count of no-op heartbeats logged as samples.
+        self.sampled: int = 0
+        #: Lifetime count of no-op heartbeats not logged.
+        self.suppressed: int = 0
+        #: Lifetime count of access log lines dropped by :meth:`access_filter`.
+        self.access_suppressed: int = 0
+        #: No-op heartbeats seen per machine, for sampling.
+        self._seen: Dict[str, int] = {}
+        self._lock: Lock = Lock()
+
+    @property
+    def sampling(self) -> bool:
+        """Return whether any heartbeats are left unlogged."""
+        return self.sample_every != 1
+
+    def record(
+        self, machine_name: str, changes: Iterable[str], fields: Dict[str, Any]
+    ) -> bool:
+        """Log a successful heartbeat if it is a transition or sampled.
+
+        :param machine_name: Machine that sent the heartbeat.
+        :param changes: Durable state fields the heartbeat changed.
+        :param fields: Request fields (other than the machine name).
+        :returns: Whether a line was logged.
+        """
+        changed = sorted(changes)
+        with self._lock:
+            if changed:
+                self.transitions += 1
+                event = "transition"
+            else:
+                seen: int = self._seen.get(machine_name, 0)
+                self._seen[machine_name] = seen + 1
+                if self.sample_every <= 0 or seen % self.sample_every:
+                    self.suppressed += 1
+                    return False
+                self.sampled += 1
+                event = "sample"
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "%s",
+                logfmt(
+                    {
+                        "event": event,
+                        "machine": machine_name,
+                        "changed": ",".join(changed) or None,
+                        **fields,
+                    }
+                ),
+            )
+        return True
+
+    def access_filter(self, record: logging.LogRecord) -> bool:
+        """Logging filter dropping access log lines of successful heartbeats.
+
+        For the ``hypercorn.access`` logger, whose records carry the
+        request line as ``r`` and the status code as ``s`` in their
+        arguments. Does nothing unless :attr:`sampling`.
+        """
+        if not self.sampling or not isinstance(record.args, dict):
+            return True
+        args: Dict[str, Any] = record.args
+        if str(args.get("s")) == "200" and str(args.get("r", "")).startswith(
+            _UPDATE_REQUEST
+        ):
+            self.access_suppressed += 1
+            return False
+        return True
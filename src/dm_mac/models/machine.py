@@ -3,7 +3,6 @@
 import asyncio
 import logging
 import os
-import pickle
 from collections import deque
 from contextlib import nullcontext
 from logging import Logger
@@ -13,23 +12,39 @@ from time import monotonic
 from time import time
 from typing import TYPE_CHECKING
 from typing import Any
+from typing import Callable
 from typing import Deque
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Set
 from typing import Tuple
 from typing import cast
 
-from filelock import FileLock
-from humanize import naturaldelta
 from jsonschema import validate
 from quart import current_app
 
+from dm_mac import cbor
+from dm_mac.json_provider import dumps_bytes
+from dm_mac.models.events import WARN_ONLY_AUTHORIZATION
+from dm_mac.models.events import DeniedEvent
+from dm_mac.models.events import EventBus
+from dm_mac.models.events import LoginEvent
+from dm_mac.models.events import LogoutEvent
+from dm_mac.models.events import MachineEvent
+from dm_mac.models.events import OopsEvent
+from dm_mac.models.events import RebootEvent
+from dm_mac.models.events import SecondRelayEvent
+from dm_mac.models.events import SlackSink
+from dm_mac.models.events import log_event
+from dm_mac.models.persistence import PersistenceQueueFullError
+from dm_mac.models.persistence import PickleStateStore
 from dm_mac.models.users import User
 from dm_mac.models.users import UsersConfig
 from dm_mac.utils import load_json_config
 
 if TYPE_CHECKING:  # pragma: no cover
+    from dm_mac.models.persistence import StatePersister
     from dm_mac.slack_handler import SlackHandler
 
 
@@ -55,6 +70,38 @@ FLEET_TIMEOUT_THRESHOLD: int = 2
 FLEET_TIMEOUT_COOLDOWN_SEC: float = 300.0
 
 
+#: Serializers for the responses sent to MCUs, by MIME type.
+RESPONSE_ENCODERS: Dict[str, Callable[[Any], bytes]] = {
+    "application/json": dumps_bytes,
+    cbor.CBOR_MIMETYPE: cbor.dumps,
+}
+
+
+def _slack_handler() -> Optional["SlackHandler"]:
+    """Return the app's Slack handler, or None if Slack is not enabled."""
+    return current_app.config.get("SLACK_HANDLER")
+
+
+def make_event_bus(queue_size: Optional[int] = None) -> EventBus:
+    """Return an :class:`~dm_mac.models.events.EventBus` with the standard sinks.
+
+    These are logging, metrics (the bus's own
+    :attr:`~dm_mac.models.events.EventBus.counter`) and Slack, in that order.
+
+    :param queue_size: See :class:`~dm_mac.models.events.EventBus`.
+    """
+    bus: EventBus = EventBus(queue_size=queue_size)
+    bus.subscribe(log_event)
+    bus.subscribe(bus.counter)
+    bus.subscribe(SlackSink(_slack_handler))
+    return bus
+
+
+#: Bus of states not attached to an app's. Its dispatcher is never started,
+#: so it delivers every event inline.
+DEFAULT_EVENT_BUS: EventBus = make_event_bus()
+
+
 class StateSaveTimeoutError(Exception):
     """Raised when persisting machine state to disk exceeds the budget.
 
@@ -243,8 +290,15 @@ class Machine:
         always_enabled: bool = False,
         alias: Optional[str] = None,
         second_relay: Optional[SecondRelayConfig] = None,
+        load_state: bool = True,
     ):
-        """Initialize a new MachineState instance."""
+        """Initialize a new MachineState instance.
+
+        :param load_state: Whether the new state should load itself from
+            disk; :class:`MachinesConfig` turns this off when a
+            :class:`~dm_mac.models.persistence.StatePersister` loads the
+            whole fleet at once.
+        """
         #: The name of the machine
         self.name: str = name
         #: List of OR'ed authorizations, any of which is sufficient
@@ -259,17 +313,16 @@ class Machine:
         #: Optional second-relay configuration
         self.second_relay: Optional[SecondRelayConfig] = second_relay
         #: state of the machine
-        self.state: "MachineState" = MachineState(self)
+        self.state: "MachineState" = MachineState(self, load_state=load_state)
 
-    async def update(
-        self, users: UsersConfig, **kwargs: Any
-    ) -> Dict[str, str | bool | float | List[float]]:
+    async def update(self, users: UsersConfig, **kwargs: Any) -> bytes:
         """Pass directly to self.state and return result."""
         return await self.state.update(users, **kwargs)
 
     async def lockout(self, slack: Optional["SlackHandler"] = None) -> None:
-        """Pass directly to self.state."""
-        self.state.lockout()
+        """Pass directly to self.state, after any in-flight update."""
+        async with self.state.update_lock:
+            self.state.lockout()
         source = "Slack"
         if not slack:
             slack = current_app.config.get("SLACK_HANDLER")
@@ -280,8 +333,9 @@ class Machine:
         await slack.log_lock(self, source)
 
     async def unlock(self, slack: Optional["SlackHandler"] = None) -> None:
-        """Pass directly to self.state."""
-        self.state.unlock()
+        """Pass directly to self.state, after any in-flight update."""
+        async with self.state.update_lock:
+            self.state.unlock()
         source = "Slack"
         if not slack:
             slack = current_app.config.get("SLACK_HANDLER")
@@ -292,8 +346,9 @@ class Machine:
         await slack.log_unlock(self, source)
 
     async def oops(self, slack: Optional["SlackHandler"] = None) -> None:
-        """Pass directly to self.state."""
-        self.state.oops()
+        """Pass directly to self.state, after any in-flight update."""
+        async with self.state.update_lock:
+            self.state.oops()
         source = "Slack"
         if not slack:
             slack = current_app.config.get("SLACK_HANDLER")
@@ -304,8 +359,9 @@ class Machine:
         await slack.log_oops(self, source)
 
     async def unoops(self, slack: Optional["SlackHandler"] = None) -> None:
-        """Pass directly to self.state."""
-        self.state.unoops()
+        """Pass directly to self.state, after any in-flight update."""
+        async with self.state.update_lock:
+            self.state.unoops()
         source = "Slack"
         if not slack:
             slack = current_app.config.get("SLACK_HANDLER")
@@ -338,8 +394,19 @@ class Machine:
 class MachinesConfig:
     """Class representing machines configuration file."""
 
-    def __init__(self) -> None:
-        """Initialize MachinesConfig."""
+    def __init__(
+        self,
+        persister: Optional["StatePersister"] = None,
+        event_bus: Optional[EventBus] = None,
+    ) -> None:
+        """Initialize MachinesConfig.
+
+        :param persister: If given, it is attached to every machine and
+            loads the fleet's state in one pass; otherwise each machine
+            loads its own state file.
+        :param event_bus: If given, every machine's state publishes its
+            events to it (see :func:`make_event_bus`).
+        """
         logger.debug("Initializing MachinesConfig")
         self.machines_by_name: Dict[str, Machine] = {}
         self.machines_by_alias: Dict[str, Machine] = {}
@@ -353,7 +420,7 @@ class MachinesConfig:
         for mname, mdict in self._load_and_validate_config().items():
             if "second_relay" in mdict:
                 mdict["second_relay"] = SecondRelayConfig(**mdict["second_relay"])
-            mach: Machine = Machine(name=mname, **mdict)
+            mach: Machine = Machine(name=mname, load_state=persister is None, **mdict)
             self.machines.append(mach)
             self.machines_by_name[mach.name] = mach
             self.machines_by_name_lower[mach.name.lower()] = mach
@@ -379,8 +446,22 @@ class MachinesConfig:
                     f"unique when compared case-insensitively."
                 )
             self.machines_by_alias_lower[alias_key] = mach
+        if persister is not None:
+            persister.attach(self.machines)
+            persister.load(self.machines)
+        if event_bus is not None:
+            for mach in self.machines:
+                mach.state.event_bus = event_bus
         self.load_time: float = time()
 
+    def resolve_users(self, users: UsersConfig) -> None:
+        """Resolve every machine's current user against ``users``.
+
+        See :meth:`MachineState.resolve_current_user`.
+        """
+        for mach in self.machines:
+            mach.state.resolve_current_user(users)
+
     def get_machine(self, name_or_alias: str) -> Optional[Machine]:
         """Get a machine by name or alias (case-insensitive)."""
         key: str = name_or_alias.lower()
@@ -418,10 +499,60 @@ class MachineState:
 
     STATUS_LED_BRIGHTNESS: float = 0.5
 
+    #: State attributes whose change affects authorization or what the
+    #: machine is allowed to do. With write-behind persistence enabled, a
+    #: change to any of these wakes the flusher immediately rather than
+    #: waiting for the next flush interval.
+    AUTH_STATE_FIELDS: Tuple[str, ...] = (
+        "rfid_value",
+        "current_user_account_id",
+        "relay_desired_state",
+        "is_oopsed",
+        "is_locked_out",
+        "is_override_login",
+        "second_relay_desired_state",
+    )
+
+    #: Persisted attributes that are telemetry rather than machine state:
+    #: losing their latest values in a crash is harmless. Every other
+    #: persisted attribute is *durable*. When
+    #: ``MACHINE_STATE_VOLATILE_SAVE_INTERVAL_SEC`` is set, an update that
+    #: changes only these fields is persisted at most once per interval.
+    VOLATILE_STATE_FIELDS: Tuple[str, ...] = (
+        "last_checkin",
+        "last_update",
+        "uptime",
+        "wifi_signal_db",
+        "wifi_signal_percent",
+        "internal_temperature_c",
+        "current_amps",
+    )
+
     def __init__(self, machine: Machine, load_state: bool = True):
-        """Initialize a new MachineState instance."""
+        """Initialize a new MachineState instance.
+
+        :param load_state: Whether to load this machine's saved state;
+            ``False`` when a
+            :class:`~dm_mac.models.persistence.StatePersister` loads the
+            whole fleet at once.
+        """
         logger.debug("Instantiating new MachineState for %s", machine)
+        #: Guards reads of the state by other threads (persistence snapshots)
+        #: against synchronous sections of request handling. Only ever held
+        #: briefly and never across an ``await``; request-path transitions
+        #: are serialized by :attr:`update_lock` instead.
         self._lock: Lock = Lock()
+        #: Serializes :meth:`_save_cache` calls, so a snapshot is never
+        #: written after a newer one. Only taken on worker threads.
+        self._save_lock: Lock = Lock()
+        #: Backing asyncio lock for :attr:`update_lock`; lazily created on
+        #: first use so we don't bind to a specific event loop at
+        #: construction time.
+        self._update_lock: Optional[asyncio.Lock] = None
+        #: :attr:`state_version` that :meth:`wait_for_change` callers are
+        #: parked on, and the event set when it advances; None when nobody
+        #: is waiting.
+        self._version_waiters: Optional[Tuple[int, asyncio.Event]] = None
         #: The Machine that this state is for
         self.machine: Machine = machine
         #: Float timestamp of the machine's last checkin time
@@ -490,6 +621,38 @@ class MachineState:
         #: created on first use so we don't bind to a specific event
         #: loop at construction time.
         self._save_spawn_lock: Optional[asyncio.Lock] = None
+        #: Fleet-wide write-behind persister, if one has been attached (see
+        #: :meth:`StatePersister.attach
+        #: <dm_mac.models.persistence.StatePersister.attach>`).
+        self.persister: Optional["StatePersister"] = None
+        #: Bus that state transitions publish their side effects to;
+        #: replaced by the app's when :class:`MachinesConfig` is given one.
+        self.event_bus: EventBus = DEFAULT_EVENT_BUS
+        #: Minimum seconds between saves of volatile-only changes (see
+        #: :attr:`VOLATILE_STATE_FIELDS`); ``0`` saves every change.
+        self.volatile_save_interval_sec: float = float(
+            os.environ.get("MACHINE_STATE_VOLATILE_SAVE_INTERVAL_SEC", "0")
+        )
+        #: Persisted attributes changed since the last save was requested.
+        self.dirty_fields: Set[str] = set()
+        #: Number of updates whose (volatile-only) save was skipped.
+        self.skipped_saves: int = 0
+        #: Durable (non-volatile) fields changed by the most recent
+        #: :meth:`update`; empty for a routine heartbeat.
+        self.last_update_changes: Set[str] = set()
+        #: :func:`time.monotonic` of the last save request, if any.
+        self._last_save_request: Optional[float] = None
+        #: Fields the cached :attr:`machine_response_body` was built from.
+        self._response_key: Optional[Tuple[Any, ...]] = None
+        #: Cached serialized responses, keyed by MIME type and kind (see
+        #: :meth:`response_body`); cleared whenever the response changes.
+        self._response_bodies: Dict[Tuple[str, str], bytes] = {}
+        #: Number of times the response changed and had to be re-serialized.
+        self.response_renders: int = 0
+        #: Current :attr:`state_version`. Seeded with the time in
+        #: milliseconds, so versions handed out before a restart are not
+        #: reused with different state afterwards.
+        self._state_version: int = int(time() * 1000)
         #: Path to the directory to save machine state in
         self._state_dir: str = os.environ.get("MACHINE_STATE_DIR", "machine_state")
         os.makedirs(self._state_dir, exist_ok=True)
@@ -500,51 +663,126 @@ class MachineState:
         if load_state:
             self._load_from_cache()
         else:
-            logger.warning("State loading disabled for machine %s", self.machine.name)
+            logger.debug("State loading disabled for machine %s", self.machine.name)
+
+    @property
+    def update_lock(self) -> asyncio.Lock:
+        """Return the asyncio lock serializing changes to this machine's state.
+
+        Held by :meth:`update` for the whole transition, including any
+        ``await`` (e.g. for Slack) in the middle of it, and by the
+        :class:`Machine` admin actions, so that two in-flight requests for
+        one machine are applied one after the other without blocking the
+        event loop. Requests for other machines are unaffected.
+        """
+        if self._update_lock is None:
+            self._update_lock = asyncio.Lock()
+        return self._update_lock
+
+    def _state_dict(self) -> Dict[str, Any]:
+        """Return the persisted fields of this state as a plain dict.
+
+        Callers must hold :attr:`_lock`.
+        """
+        return {
+            "machine_name": self.machine.name,
+            "last_checkin": self.last_checkin,
+            "last_update": self.last_update,
+            "rfid_value": self.rfid_value,
+            "rfid_present_since": self.rfid_present_since,
+            "relay_desired_state": self.relay_desired_state,
+            "is_oopsed": self.is_oopsed,
+            "is_locked_out": self.is_locked_out,
+            "is_override_login": self.is_override_login,
+            "current_amps": self.current_amps,
+            "display_text": self.display_text,
+            "uptime": self.uptime,
+            "status_led_rgb": self.status_led_rgb,
+            "status_led_brightness": self.status_led_brightness,
+            "wifi_signal_db": self.wifi_signal_db,
+            "wifi_signal_percent": self.wifi_signal_percent,
+            "internal_temperature_c": self.internal_temperature_c,
+            "current_user_account_id": (
+                self.current_user.account_id if self.current_user else None
+            ),
+            "second_relay_desired_state": self.second_relay_desired_state,
+            "second_relay_authorization": self.second_relay_authorization,
+            "state_save_timeouts": self.state_save_timeouts,
+        }
+
+    def _apply_state(self, data: Dict[str, Any]) -> None:
+        """Set attributes from a persisted state dict, ignoring unknown keys.
+
+        ``current_user`` is persisted as ``current_user_account_id`` and
+        loaded as an :meth:`unresolved <dm_mac.models.users.User.unresolved>`
+        User until :meth:`resolve_current_user` is called. State saved by
+        older versions, which pickled the whole User, is still accepted.
+        """
+        with self._lock:
+            for k, v in data.items():
+                if k == "current_user_account_id":
+                    self.current_user = None if v is None else User.unresolved(v)
+                elif hasattr(self, k):
+                    setattr(self, k, v)
+
+    def resolve_current_user(self, users: UsersConfig) -> None:
+        """Point :attr:`current_user` at the live User with the same account ID.
+
+        Called once users config is loaded and again after it is reloaded,
+        so the state never holds a stale or duplicate copy of a User. If the
+        account no longer exists the current User is left as-is (the user
+        stays logged in until they remove their card) and a warning is
+        logged.
+        """
+        with self._lock:
+            if self.current_user is None:
+                return
+            live: Optional[User] = users.users_by_account_id.get(
+                self.current_user.account_id
+            )
+            if live is None:
+                logger.warning(
+                    "Current user of %s (account %s) is not in users config",
+                    self.machine.name,
+                    self.current_user.account_id,
+                )
+                return
+            self.current_user = live
 
     def _save_cache(self) -> None:
         """Save machine state cache to disk (synchronous).
 
-        Acquires the in-process lock and on-disk filelock, builds the state
-        dict, and writes the pickle. Used directly by maintenance tools and
-        tests; request handlers should call :meth:`save_cache` instead so
-        the write is bounded by :data:`STATE_SAVE_TIMEOUT_SEC`.
+        Builds the state dict under the in-process lock, then writes it to
+        the attached :attr:`persister`'s store, or to the pickle file at
+        :attr:`_state_path` if there is no persister. The write itself is
+        done without :attr:`_lock`, so a slow disk never blocks the event
+        loop; :attr:`_save_lock` keeps concurrent saves in order. Used
+        directly by maintenance tools and tests; request handlers should
+        call :meth:`save_cache` instead so the write is bounded by
+        :data:`STATE_SAVE_TIMEOUT_SEC`.
         """
-        logger.debug("Getting lock for state file: %s", self._state_path + ".lock")
-        with self._lock:
-            lock = FileLock(self._state_path + ".lock")
-            with lock:
-                data: Dict[str, Any] = {
-                    "machine_name": self.machine.name,
-                    "last_checkin": self.last_checkin,
-                    "last_update": self.last_update,
-                    "rfid_value": self.rfid_value,
-                    "rfid_present_since": self.rfid_present_since,
-                    "relay_desired_state": self.relay_desired_state,
-                    "is_oopsed": self.is_oopsed,
-                    "is_locked_out": self.is_locked_out,
-                    "is_override_login": self.is_override_login,
-                    "current_amps": self.current_amps,
-                    "display_text": self.display_text,
-                    "uptime": self.uptime,
-                    "status_led_rgb": self.status_led_rgb,
-                    "status_led_brightness": self.status_led_brightness,
-                    "wifi_signal_db": self.wifi_signal_db,
-                    "wifi_signal_percent": self.wifi_signal_percent,
-                    "internal_temperature_c": self.internal_temperature_c,
-                    "current_user": self.current_user,
-                    "second_relay_desired_state": self.second_relay_desired_state,
-                    "second_relay_authorization": self.second_relay_authorization,
-                    "state_save_timeouts": self.state_save_timeouts,
-                }
-                logger.debug("Saving state to: %s", self._state_path)
-                with open(self._state_path, "wb") as f:
-                    pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        start: float = monotonic()
+        with self._save_lock:
+            with self._lock:
+                data: Dict[str, Any] = self._state_dict()
+            if self.persister is not None:
+                self.persister.store.record_latency(
+                    (self.machine.name,), "lock_wait", monotonic() - start
+                )
+                self.persister.store.save_batch({self.machine.name: data})
+            else:
+                PickleStateStore.write_file(self._state_path, data)
         logger.debug("State saved.")
 
-    async def save_cache(self) -> None:
+    async def save_cache(self, urgent: bool = True) -> None:
         """Save machine state cache to disk with a timeout.
 
+        If a :attr:`persister` with write-behind enabled (or currently in
+        degraded mode) is attached, the state is only marked dirty and
+        this returns immediately; the persister's background flusher
+        commits it (right away if ``urgent``, otherwise on its next tick).
+        Everything below describes the write-through path used otherwise.
+
         Single-flight per machine: only one save *thread* is
         outstanding at a time. Concurrent callers see the existing
         in-flight task and *join* it (awaiting the same task) rather
@@ -563,8 +801,25 @@ class MachineState:
         On timeout, the underlying thread is *shielded* and continues
         running (Python cannot cancel a thread blocked on file I/O);
         :attr:`state_save_timeouts` is incremented and
-        :class:`StateSaveTimeoutError` is raised.
+        :class:`StateSaveTimeoutError` is raised, unless the persister has
+        degraded mode enabled, in which case it enters degraded mode (see
+        :meth:`StatePersister.enter_degraded
+        <dm_mac.models.persistence.StatePersister.enter_degraded>`) and
+        this returns normally. With degraded mode and the disk probe both
+        enabled, the budget adapts to the probed disk latency (see
+        :attr:`StatePersister.save_budget_sec
+        <dm_mac.models.persistence.StatePersister.save_budget_sec>`). The
+        save thread comes from the persister's
+        bounded :class:`~dm_mac.models.persistence.PersistenceExecutor`;
+        if its queue is full, the save is handled as a timeout.
         """
+        self._last_save_request = monotonic()
+        self.dirty_fields.clear()
+        if self.persister is not None and self.persister.defers_saves:
+            self.persister.mark_dirty(self, urgent=urgent)
+            return
+        if self.persister is not None and self.persister.collect(self):
+            return
         if self._save_spawn_lock is None:
             self._save_spawn_lock = asyncio.Lock()
         async with self._save_spawn_lock:
@@ -579,7 +834,7 @@ class MachineState:
                 # it (so that wait_for cancelling does not propagate
                 # to the underlying thread, which cannot be cancelled
                 # anyway) and check `.done()` on subsequent calls.
-                task = asyncio.create_task(asyncio.to_thread(self._save_cache))
+                task = asyncio.create_task(self._run_save())
                 # If the underlying thread eventually completes after
                 # we've timed out, consume any exception it produced
                 # so the event loop doesn't log "Task exception was
@@ -588,16 +843,98 @@ class MachineState:
                 task.add_done_callback(self._on_save_task_done)
                 self._save_task = task
 
+        budget: float = STATE_SAVE_TIMEOUT_SEC
+        if self.persister is not None and self.persister.save_budget_sec is not None:
+            budget = self.persister.save_budget_sec
         try:
-            await asyncio.wait_for(asyncio.shield(task), timeout=STATE_SAVE_TIMEOUT_SEC)
+            await asyncio.wait_for(asyncio.shield(task), timeout=budget)
         except asyncio.TimeoutError as exc:
             count = self._record_save_timeout(reason="exceeded budget")
+            if self.persister is not None and self.persister.degraded_mode_enabled:
+                self.persister.enter_degraded(self)
+                return
             raise StateSaveTimeoutError(
                 f"State save for {self.machine.name} exceeded "
-                f"{STATE_SAVE_TIMEOUT_SEC:.1f}s budget "
+                f"{budget:.1f}s budget "
+                f"(lifetime timeout count: {count})"
+            ) from exc
+        except PersistenceQueueFullError as exc:
+            count = self._record_save_timeout(reason="persistence queue full")
+            if self.persister is not None and self.persister.degraded_mode_enabled:
+                self.persister.enter_degraded(self)
+                return
+            raise StateSaveTimeoutError(
+                f"State save for {self.machine.name} rejected: {exc} "
                 f"(lifetime timeout count: {count})"
             ) from exc
 
+    @staticmethod
+    async def save_batch(states: List["MachineState"]) -> None:
+        """Save several machines' states together, in one batch commit.
+
+        For saves collected by :meth:`StatePersister.collecting
+        <dm_mac.models.persistence.StatePersister.collecting>`. The commit
+        first waits for any write-through save of the same machines that is
+        already in flight, and shares a single save budget, with the same
+        outcome as :meth:`save_cache` if that is exceeded (or the executor's
+        queue is full): every state records a timeout, and then either the
+        persister enters degraded mode or :class:`StateSaveTimeoutError`
+        is raised.
+        """
+        if not states:
+            return
+        persister: Optional["StatePersister"] = states[0].persister
+        if persister is None or persister.defers_saves:
+            for state in states:
+                await state.save_cache()
+            return
+        in_flight: List["asyncio.Task[None]"] = [
+            s._save_task
+            for s in states
+            if s._save_task is not None and not s._save_task.done()
+        ]
+
+        async def commit() -> None:
+            assert persister is not None
+            if in_flight:
+                await asyncio.wait(in_flight)
+            await persister.commit(states)
+
+        task: "asyncio.Task[None]" = asyncio.create_task(commit())
+        task.add_done_callback(MachineState._on_batch_save_done)
+        budget: float = STATE_SAVE_TIMEOUT_SEC
+        if persister.save_budget_sec is not None:
+            budget = persister.save_budget_sec
+        reason: str
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout=budget)
+            return
+        except asyncio.TimeoutError:
+            reason = "exceeded budget"
+        except PersistenceQueueFullError:
+            reason = "persistence queue full"
+        for state in states:
+            state._record_save_timeout(reason=f"batch save {reason}")
+        if persister.degraded_mode_enabled:
+            for state in states:
+                persister.enter_degraded(state)
+            return
+        raise StateSaveTimeoutError(
+            f"Batch state save of {len(states)} machine(s) {reason} "
+            f"({budget:.1f}s budget)"
+        )
+
+    async def _run_save(self) -> None:
+        """Run :meth:`_save_cache` on the persister's bounded executor.
+
+        Falls back to the event loop's default executor when this state
+        has no persister (e.g. when constructed standalone).
+        """
+        if self.persister is not None:
+            await self.persister.executor.run(self._save_cache)
+        else:
+            await asyncio.to_thread(self._save_cache)
+
     def _on_save_task_done(self, task: "asyncio.Task[None]") -> None:
         """Done-callback for the in-flight save task.
 
@@ -621,6 +958,15 @@ class MachineState:
         if self._save_task is task:
             self._save_task = None
 
+    @staticmethod
+    def _on_batch_save_done(task: "asyncio.Task[None]") -> None:
+        """Log (and so consume) any exception of a :meth:`save_batch` commit."""
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(
+                "Background batch state save finished with an exception: %r",
+                task.exception(),
+            )
+
     def _record_save_timeout(self, reason: str) -> int:
         """Increment the timeout counter, log, and notify Slack.
 
@@ -715,19 +1061,14 @@ class MachineState:
 
     def _load_from_cache(self) -> None:
         """Load machine state cache from disk."""
-        if not os.path.exists(self._state_path):
-            logger.info("State file does not yet exist: %s", self._state_path)
+        data: Optional[Dict[str, Any]]
+        if self.persister is not None:
+            data = self.persister.store.load(self.machine.name)
+        else:
+            data = PickleStateStore.read_file(self._state_path)
+        if data is None:
             return
-        logger.debug("Getting lock for state file: %s", self._state_path + ".lock")
-        with self._lock:
-            lock = FileLock(self._state_path + ".lock")
-            with lock:
-                logger.debug("Loading state from: %s", self._state_path)
-                with open(self._state_path, "rb") as f:
-                    data = pickle.load(f)
-                for k, v in data.items():
-                    if hasattr(self, k):
-                        setattr(self, k, v)
+        self._apply_state(data)
         logger.debug("State loaded.")
 
     async def _handle_reboot(self) -> None:
@@ -736,31 +1077,23 @@ class MachineState:
         This logs out the current user if logged in and resets the machine state.
         For always-enabled machines, restores the always-on state.
         """
-        logging.getLogger("AUTH").warning(
-            "Machine %s rebooted; resetting relay and RFID state",
-            self.machine.display_name,
-        )
-        # locking handled in update()
-        self.current_user = None
-        self.is_override_login = False
-        # Restore always-enabled state if applicable
-        if self.machine.always_enabled:
-            self.relay_desired_state = True
-            self.display_text = self.ALWAYS_ON_DISPLAY_TEXT
-            self.status_led_rgb = (0.0, 1.0, 0.0)
-            self.status_led_brightness = self.STATUS_LED_BRIGHTNESS
-        else:
-            self.relay_desired_state = False
-            self.display_text = self.DEFAULT_DISPLAY_TEXT
-            self.status_led_rgb = (0.0, 0.0, 0.0)
-            self.status_led_brightness = 0.0
-        self._resolve_second_relay()
-        # log to Slack, if enabled
-        slack: Optional["SlackHandler"] = current_app.config.get("SLACK_HANDLER")
-        if not slack:
-            # Slack integration is not enabled
-            return
-        await slack.admin_log(f"Machine {self.machine.display_name} has rebooted.")
+        await self.event_bus.publish(RebootEvent(self.machine))
+        # serialized by update(); locked so saves never see a partial reset
+        with self._lock:
+            self.current_user = None
+            self.is_override_login = False
+            # Restore always-enabled state if applicable
+            if self.machine.always_enabled:
+                self.relay_desired_state = True
+                self.display_text = self.ALWAYS_ON_DISPLAY_TEXT
+                self.status_led_rgb = (0.0, 1.0, 0.0)
+                self.status_led_brightness = self.STATUS_LED_BRIGHTNESS
+            else:
+                self.relay_desired_state = False
+                self.display_text = self.DEFAULT_DISPLAY_TEXT
+                self.status_led_rgb = (0.0, 0.0, 0.0)
+                self.status_led_brightness = 0.0
+            self._resolve_second_relay()
 
     def lockout(self) -> None:
         """Lock-out the machine."""
@@ -775,6 +1108,7 @@ class MachineState:
             self.status_led_rgb = (1.0, 0.5, 0.0)
             self.status_led_brightness = self.STATUS_LED_BRIGHTNESS
             self._resolve_second_relay()
+        self._wake_version_waiters()
 
     def unlock(self) -> None:
         """Un-lock-out the machine."""
@@ -797,6 +1131,7 @@ class MachineState:
                 self.status_led_rgb = (0.0, 0.0, 0.0)
                 self.status_led_brightness = 0.0
             self._resolve_second_relay()
+        self._wake_version_waiters()
 
     def oops(self, do_locking: bool = True) -> None:
         """Oops the machine."""
@@ -812,6 +1147,7 @@ class MachineState:
             self.status_led_rgb = (1.0, 0.0, 0.0)
             self.status_led_brightness = self.STATUS_LED_BRIGHTNESS
             self._resolve_second_relay()
+        self._wake_version_waiters()
 
     def unoops(self, do_locking: bool = True) -> None:
         """Un-oops the machine."""
@@ -834,6 +1170,7 @@ class MachineState:
                 self.status_led_rgb = (0.0, 0.0, 0.0)
                 self.status_led_brightness = 0
             self._resolve_second_relay()
+        self._wake_version_waiters()
 
     async def update(
         self,
@@ -846,8 +1183,11 @@ class MachineState:
         internal_temperature_c: Optional[float] = None,
         amps: Optional[float] = None,
         second_relay_state: Optional[bool] = None,
-    ) -> Dict[str, str | bool | float | List[float]]:
-        """Handle an update to the machine via API."""
+    ) -> bytes:
+        """Handle an update to the machine via API.
+
+        :returns: The JSON response body; see :attr:`machine_response_body`.
+        """
         if second_relay_state is not None and self.machine.second_relay is None:
             logger.debug(
                 "MCU %s reported second_relay_state=%s but no second_relay "
@@ -857,26 +1197,29 @@ class MachineState:
             )
         if rfid_value is not None:
             rfid_value = rfid_value.rjust(10, "0")
-        with self._lock:
-            if amps is not None:
-                self.current_amps = amps
+        async with self.update_lock:
+            with self._lock:
+                before: Dict[str, Any] = self._state_dict()
+                if amps is not None:
+                    self.current_amps = amps
+                rebooted: bool = uptime is not None and uptime < self.uptime
+                if wifi_signal_db is not None:
+                    self.wifi_signal_db = wifi_signal_db
+                if wifi_signal_percent is not None:
+                    self.wifi_signal_percent = wifi_signal_percent
+                if internal_temperature_c is not None:
+                    self.internal_temperature_c = internal_temperature_c
+                self.last_checkin = time()
+            if rebooted:
+                logger.warning(
+                    "Uptime of %s is less than last uptime of %s; machine "
+                    "control unit has rebooted",
+                    uptime,
+                    self.uptime,
+                )
+                await self._handle_reboot()
             if uptime is not None:
-                if uptime < self.uptime:
-                    logger.warning(
-                        "Uptime of %s is less than last uptime of %s; machine "
-                        "control unit has rebooted",
-                        uptime,
-                        self.uptime,
-                    )
-                    await self._handle_reboot()
                 self.uptime = uptime
-            if wifi_signal_db is not None:
-                self.wifi_signal_db = wifi_signal_db
-            if wifi_signal_percent is not None:
-                self.wifi_signal_percent = wifi_signal_percent
-            if internal_temperature_c is not None:
-                self.internal_temperature_c = internal_temperature_c
-            self.last_checkin = time()
             if oops:
                 await self._handle_oops(users)
                 self.last_update = time()
@@ -886,11 +1229,12 @@ class MachineState:
                 and not self.is_oopsed
                 and not self.is_locked_out
             ):
-                self.relay_desired_state = True
-                self.display_text = self.ALWAYS_ON_DISPLAY_TEXT
-                self.status_led_rgb = (0.0, 1.0, 0.0)
-                self.status_led_brightness = self.STATUS_LED_BRIGHTNESS
-                self.last_update = time()
+                with self._lock:
+                    self.relay_desired_state = True
+                    self.display_text = self.ALWAYS_ON_DISPLAY_TEXT
+                    self.status_led_rgb = (0.0, 1.0, 0.0)
+                    self.status_led_brightness = self.STATUS_LED_BRIGHTNESS
+                    self.last_update = time()
                 # Track RFID changes for logging/auditing purposes
                 if rfid_value != self.rfid_value:
                     await self._handle_rfid_tracking_always_enabled(users, rfid_value)
@@ -916,215 +1260,161 @@ class MachineState:
                         "Resetting stale always-enabled state for machine %s",
                         self.machine.display_name,
                     )
-                    self.relay_desired_state = False
-                    self.display_text = self.DEFAULT_DISPLAY_TEXT
-                    self.status_led_rgb = (0.0, 0.0, 0.0)
-                    self.status_led_brightness = 0.0
-                    self.last_update = time()
-            self._resolve_second_relay()
-        await self.save_cache()
-        return self.machine_response
+                    with self._lock:
+                        self.relay_desired_state = False
+                        self.display_text = self.DEFAULT_DISPLAY_TEXT
+                        self.status_led_rgb = (0.0, 0.0, 0.0)
+                        self.status_led_brightness = 0.0
+                        self.last_update = time()
+            with self._lock:
+                self._resolve_second_relay()
+                changed: Set[str] = self._changed_fields(before)
+            self._wake_version_waiters()
+        self.last_update_changes = changed.difference(self.VOLATILE_STATE_FIELDS)
+        self.dirty_fields |= changed
+        if self._should_save():
+            await self.save_cache(urgent=not changed.isdisjoint(self.AUTH_STATE_FIELDS))
+        else:
+            self.skipped_saves += 1
+            logger.debug(
+                "Skipping save of volatile-only changes to %s: %s",
+                self.machine.name,
+                sorted(changed),
+            )
+        return self.machine_response_body
+
+    def _changed_fields(self, before: Dict[str, Any]) -> Set[str]:
+        """Return the persisted fields that differ from ``before``.
+
+        Callers must hold :attr:`_lock`.
+        """
+        after: Dict[str, Any] = self._state_dict()
+        return {k for k, v in after.items() if before.get(k) != v}
+
+    def _should_save(self) -> bool:
+        """Whether the pending :attr:`dirty_fields` should be persisted now.
+
+        Any durable change is; volatile-only changes are persisted at most
+        once per :attr:`volatile_save_interval_sec`.
+        """
+        if self.volatile_save_interval_sec <= 0:
+            return True
+        if not self.dirty_fields.issubset(self.VOLATILE_STATE_FIELDS):
+            return True
+        if self._last_save_request is None:
+            return True
+        return monotonic() - self._last_save_request >= self.volatile_save_interval_sec
 
     async def _handle_oops(self, users: UsersConfig) -> None:
         """Handle oops button press."""
-        ustr: str = ""
-        uname: Optional[str] = None
-        if self.rfid_value:
-            ustr = " RFID card is present but unknown."
-            if user := users.users_by_fob.get(self.rfid_value):
-                ustr = f" Current user is: {user.full_name}."
-                uname = user.full_name
-        logging.getLogger("OOPS").warning(
-            "Machine %s was Oopsed.%s", self.machine.display_name, ustr
+        user: Optional[User] = (
+            users.users_by_fob.get(self.rfid_value) if self.rfid_value else None
         )
-        # locking handled in update()
-        self.oops(do_locking=False)
-        # log to Slack, if enabled
-        slack: Optional["SlackHandler"] = current_app.config.get("SLACK_HANDLER")
-        if not slack:
-            # Slack integration is not enabled
-            return
-        src = "Oops button"
-        if self.rfid_value:
-            src += " with RFID present"
-        else:
-            src += " without RFID present"
-        await slack.log_oops(self.machine, src, user_name=uname)
+        await self.event_bus.publish(OopsEvent(self.machine, self.rfid_value, user))
+        self.oops()
 
     async def _handle_rfid_remove(self) -> None:
         """Handle RFID card removed."""
         was_override: bool = self.is_override_login
-        logging.getLogger("AUTH").info(
-            "RFID logout on %s by %s; session duration %d seconds%s",
-            self.machine.display_name,
-            self.current_user.full_name if self.current_user else self.rfid_value,
-            int(time() - cast(float, self.rfid_present_since)),
-            " (override session)" if was_override else "",
+        event: LogoutEvent = LogoutEvent(
+            self.machine,
+            self.current_user,
+            self.rfid_value,
+            time() - cast(float, self.rfid_present_since),
+            override=was_override,
         )
-        log_str: str = (
-            f"RFID logout on {self.machine.display_name} by "
-            + (self.current_user.full_name if self.current_user else "unknown")
-            + "; session duration "
-            + naturaldelta(time() - cast(float, self.rfid_present_since))
-        )
-        if was_override:
-            log_str += " (override session)"
-        if self.machine.second_relay is not None:
-            log_str += "; both relays off"
-        # locking handled in update()
-        self.rfid_value = None
-        self.rfid_present_since = None
-        self.current_user = None
-        self.relay_desired_state = False
-        self.is_override_login = False
-        if was_override:
-            # Restore oops/lockout display state
-            if self.is_oopsed:
-                self.display_text = self.OOPS_DISPLAY_TEXT
-                self.status_led_rgb = (1.0, 0.0, 0.0)
-                self.status_led_brightness = self.STATUS_LED_BRIGHTNESS
-            elif self.is_locked_out:
-                self.display_text = self.LOCKOUT_DISPLAY_TEXT
-                self.status_led_rgb = (1.0, 0.5, 0.0)
-                self.status_led_brightness = self.STATUS_LED_BRIGHTNESS
-            else:
-                # Admin cleared oops/lockout during override
+        # serialized by update(); locked so saves never see a partial logout
+        with self._lock:
+            self.rfid_value = None
+            self.rfid_present_since = None
+            self.current_user = None
+            self.relay_desired_state = False
+            self.is_override_login = False
+            if was_override:
+                # Restore oops/lockout display state
+                if self.is_oopsed:
+                    self.display_text = self.OOPS_DISPLAY_TEXT
+                    self.status_led_rgb = (1.0, 0.0, 0.0)
+                    self.status_led_brightness = self.STATUS_LED_BRIGHTNESS
+                elif self.is_locked_out:
+                    self.display_text = self.LOCKOUT_DISPLAY_TEXT
+                    self.status_led_rgb = (1.0, 0.5, 0.0)
+                    self.status_led_brightness = self.STATUS_LED_BRIGHTNESS
+                else:
+                    # Admin cleared oops/lockout during override
+                    self.display_text = self.DEFAULT_DISPLAY_TEXT
+                    self.status_led_rgb = (0.0, 0.0, 0.0)
+                    self.status_led_brightness = 0.0
+            elif not self.is_oopsed and not self.is_locked_out:
                 self.display_text = self.DEFAULT_DISPLAY_TEXT
                 self.status_led_rgb = (0.0, 0.0, 0.0)
                 self.status_led_brightness = 0.0
-        elif not self.is_oopsed and not self.is_locked_out:
-            self.display_text = self.DEFAULT_DISPLAY_TEXT
-            self.status_led_rgb = (0.0, 0.0, 0.0)
-            self.status_led_brightness = 0.0
-        # log to Slack, if enabled
-        slack: Optional["SlackHandler"] = current_app.config.get("SLACK_HANDLER")
-        if not slack:
-            # Slack integration is not enabled
-            return
-        await slack.admin_log(log_str)
+        await self.event_bus.publish(event)
 
     async def _handle_rfid_insert(self, users: UsersConfig, rfid_value: str) -> None:
         """Handle change in the RFID value."""
-        # locking handled in update()
-        self.rfid_present_since = time()
-        self.rfid_value = rfid_value
-        user: Optional[User] = users.users_by_fob.get(rfid_value)
-        slack: Optional["SlackHandler"] = current_app.config.get("SLACK_HANDLER")
-        if not user:
-            logging.getLogger("AUTH").warning(
-                "RFID login attempt on %s by unknown fob %s",
-                self.machine.display_name,
-                rfid_value,
-            )
-            if self.is_oopsed or self.is_locked_out:
-                if slack:
-                    await slack.admin_log(
-                        f"RFID login attempt on {self.machine.display_name} "
-                        "by unknown fob when oopsed or locked out."
-                    )
-                return
-            self.display_text = "Unknown RFID"
-            self.status_led_rgb = (1.0, 0.0, 0.0)
-            self.status_led_brightness = self.STATUS_LED_BRIGHTNESS
-            if slack:
-                await slack.admin_log(
-                    f"RFID login attempt on {self.machine.display_name} by unknown fob"
-                )
-            return
-        # ok, we have a known user
-        logname = f"{user.full_name} ({rfid_value})"
-        # Check for override login on oopsed/locked-out machine
-        if user.oops_override and (self.is_oopsed or self.is_locked_out):
-            logging.getLogger("AUTH").info(
-                "Override login on %s by %s",
-                self.machine.display_name,
-                logname,
-            )
-            self.is_override_login = True
-            self.current_user = user
-            self.relay_desired_state = True
-            self.display_text = f"OVERRIDE BY\n{user.preferred_name}"
-            self.status_led_rgb = (0.0, 1.0, 0.0)
-            self.status_led_brightness = self.STATUS_LED_BRIGHTNESS
-            if slack:
-                await slack.log_override_login(self.machine, user.full_name)
-            return
-        if self.is_oopsed:
-            logging.getLogger("AUTH").warning(
-                "RFID login attempt while oopsed on %s by %s",
-                self.machine.display_name,
-                logname,
-            )
-            # don't change anything
-            if slack:
-                await slack.admin_log(
-                    f"RFID login attempt on {self.machine.display_name} by "
-                    f"{user.full_name} when oopsed."
-                )
-            return
-        if self.is_locked_out:
-            logging.getLogger("AUTH").warning(
-                "RFID login attempt while locked out on %s by %s",
-                self.machine.display_name,
-                logname,
-            )
-            # don't change anything
-            if slack:
-                await slack.admin_log(
-                    f"RFID login attempt on {self.machine.display_name} by "
-                    f"{user.full_name} when machine locked-out."
-                )
-            return
-        if await self._user_is_authorized(user, slack=slack):
-            logging.getLogger("AUTH").info(
-                "User %s (%s) authorized for %s; session start",
-                user.full_name,
-                user.account_id,
-                self.machine.display_name,
-            )
-            self.current_user = user
-            self.relay_desired_state = True
-            self.display_text = f"Welcome,\n{user.preferred_name}"
-            self.status_led_rgb = (0.0, 1.0, 0.0)
-            self.status_led_brightness = self.STATUS_LED_BRIGHTNESS
-            # Compute second-relay decision now (no log yet) so we can craft
-            # the Slack message with the accessory clause; update() will emit
-            # the structured AUTH log later.
-            self._resolve_second_relay(emit_log=False)
-            if slack:
-                msg = (
-                    f"RFID login on {self.machine.display_name} by authorized user "
-                    f"{user.full_name}"
+        event: MachineEvent
+        # serialized by update(); locked so saves never see a partial login
+        with self._lock:
+            self.rfid_present_since = time()
+            self.rfid_value = rfid_value
+            user: Optional[User] = users.users_by_fob.get(rfid_value)
+            if not user:
+                blocked: bool = self.is_oopsed or self.is_locked_out
+                if not blocked:
+                    self.display_text = "Unknown RFID"
+                    self.status_led_rgb = (1.0, 0.0, 0.0)
+                    self.status_led_brightness = self.STATUS_LED_BRIGHTNESS
+                event = DeniedEvent(
+                    self.machine, DeniedEvent.UNKNOWN_FOB, rfid_value, blocked=blocked
                 )
-                sr = self.machine.second_relay
-                if sr is not None:
-                    accessory = sr.alias if sr.alias else "second relay"
-                    authz = self.second_relay_authorization
-                    if authz == "granted":
-                        msg += f"; {accessory} authorized"
-                    elif authz == "denied":
-                        msg += f"; {accessory} NOT authorized — relay off"
-                    elif authz == "warn":
-                        msg += f"; {accessory} WARN-ONLY override — relay on"
-                    elif authz == "always_enabled":
-                        msg += f"; {accessory} always-enabled — relay on"
-                await slack.admin_log(msg)
-        else:
-            logging.getLogger("AUTH").info(
-                "User %s (%s) UNAUTHORIZED for %s",
-                user.full_name,
-                user.account_id,
-                self.machine.display_name,
-            )
-            self.relay_desired_state = False
-            self.display_text = "Unauthorized"
-            self.status_led_rgb = (1.0, 0.5, 0.0)  # orange
-            self.status_led_brightness = self.STATUS_LED_BRIGHTNESS
-            if slack:
-                await slack.admin_log(
-                    f"rejected RFID login on {self.machine.display_name} by "
-                    f"UNAUTHORIZED user {user.full_name}"
+            # ok, we have a known user
+            # Check for override login on oopsed/locked-out machine
+            elif user.oops_override and (self.is_oopsed or self.is_locked_out):
+                self.is_override_login = True
+                self.current_user = user
+                self.relay_desired_state = True
+                self.display_text = f"OVERRIDE BY\n{user.preferred_name}"
+                self.status_led_rgb = (0.0, 1.0, 0.0)
+                self.status_led_brightness = self.STATUS_LED_BRIGHTNESS
+                event = LoginEvent(self.machine, user, rfid_value, override=True)
+            elif self.is_oopsed or self.is_locked_out:
+                # don't change anything
+                event = DeniedEvent(
+                    self.machine,
+                    DeniedEvent.OOPSED if self.is_oopsed else DeniedEvent.LOCKED_OUT,
+                    rfid_value,
+                    user=user,
+                    blocked=True,
                 )
+            else:
+                authorization: Optional[str] = self._user_authorization(user)
+                if authorization is not None:
+                    self.current_user = user
+                    self.relay_desired_state = True
+                    self.display_text = f"Welcome,\n{user.preferred_name}"
+                    self.status_led_rgb = (0.0, 1.0, 0.0)
+                    self.status_led_brightness = self.STATUS_LED_BRIGHTNESS
+                    # Compute second-relay decision now (no log yet) so the
+                    # login event can carry it; update() will publish the
+                    # decision later.
+                    self._resolve_second_relay(emit_log=False)
+                    event = LoginEvent(
+                        self.machine,
+                        user,
+                        rfid_value,
+                        authorization=authorization,
+                        second_relay_authorization=self.second_relay_authorization,
+                    )
+                else:
+                    self.relay_desired_state = False
+                    self.display_text = "Unauthorized"
+                    self.status_led_rgb = (1.0, 0.5, 0.0)  # orange
+                    self.status_led_brightness = self.STATUS_LED_BRIGHTNESS
+                    event = DeniedEvent(
+                        self.machine, DeniedEvent.UNAUTHORIZED, rfid_value, user
+                    )
+        await self.event_bus.publish(event)
 
     async def _handle_rfid_tracking_always_enabled(
         self, users: UsersConfig, rfid_value: Optional[str]
@@ -1134,43 +1424,49 @@ class MachineState:
         This method logs RFID insertions and removals for auditing purposes while
         maintaining the always-on state of the machine.
         """
-        # locking handled in update()
-        if rfid_value is None:
-            # RFID removed
-            logging.getLogger("AUTH").info(
-                "RFID removed on always-enabled machine %s (was %s); session duration %d seconds",
-                self.machine.display_name,
-                self.current_user.full_name if self.current_user else self.rfid_value,
-                (
-                    time() - cast(float, self.rfid_present_since)
-                    if self.rfid_present_since
-                    else 0
-                ),
-            )
-            self.rfid_value = None
-            self.rfid_present_since = None
-            self.current_user = None
-            # State remains always-on (relay/display/LED not changed)
-        else:
-            # RFID inserted
-            self.rfid_present_since = time()
-            self.rfid_value = rfid_value
-            user: Optional[User] = users.users_by_fob.get(rfid_value)
-            if user:
-                self.current_user = user
+        # serialized by update(); locked so saves never see a partial change
+        with self._lock:
+            if rfid_value is None:
+                # RFID removed
                 logging.getLogger("AUTH").info(
-                    "RFID inserted on always-enabled machine %s by %s (%s)",
+                    "RFID removed on always-enabled machine %s (was %s); "
+                    "session duration %d seconds",
                     self.machine.display_name,
-                    user.full_name,
-                    rfid_value,
+                    (
+                        self.current_user.full_name
+                        if self.current_user
+                        else self.rfid_value
+                    ),
+                    (
+                        time() - cast(float, self.rfid_present_since)
+                        if self.rfid_present_since
+                        else 0
+                    ),
                 )
+                self.rfid_value = None
+                self.rfid_present_since = None
+                self.current_user = None
+                # State remains always-on (relay/display/LED not changed)
             else:
-                logging.getLogger("AUTH").warning(
-                    "RFID inserted on always-enabled machine %s by unknown fob %s",
-                    self.machine.display_name,
-                    rfid_value,
-                )
-            # State remains always-on (relay/display/LED not changed)
+                # RFID inserted
+                self.rfid_present_since = time()
+                self.rfid_value = rfid_value
+                user: Optional[User] = users.users_by_fob.get(rfid_value)
+                if user:
+                    self.current_user = user
+                    logging.getLogger("AUTH").info(
+                        "RFID inserted on always-enabled machine %s by %s (%s)",
+                        self.machine.display_name,
+                        user.full_name,
+                        rfid_value,
+                    )
+                else:
+                    logging.getLogger("AUTH").warning(
+                        "RFID inserted on always-enabled machine %s by unknown fob %s",
+                        self.machine.display_name,
+                        rfid_value,
+                    )
+                # State remains always-on (relay/display/LED not changed)
 
     def _user_is_second_authorized(self, user: User) -> bool:
         """Return whether user holds any of the second-relay authorizations."""
@@ -1234,75 +1530,28 @@ class MachineState:
             self._log_second_relay_decision()
 
     def _log_second_relay_decision(self) -> None:
-        """Emit a structured AUTH log line for the current second-relay decision."""
+        """Publish the current second-relay decision, if there is one."""
         if self.machine.second_relay is None or self.second_relay_authorization is None:
             return
-        sr = self.machine.second_relay
-        accessory: str = sr.alias if sr.alias else "second relay"
-        machine_label: str = self.machine.display_name
-        user_name: str = self.current_user.full_name if self.current_user else "<none>"
-        authz = self.second_relay_authorization
-        auth_log = logging.getLogger("AUTH")
-        if authz == "granted":
-            auth_log.info(
-                "User %s authorized for accessory %s on machine %s",
-                user_name,
-                accessory,
-                machine_label,
-            )
-        elif authz == "denied":
-            auth_log.info(
-                "User %s UNAUTHORIZED for accessory %s on machine %s",
-                user_name,
-                accessory,
-                machine_label,
-            )
-        elif authz == "warn":
-            auth_log.warning(
-                "User %s authorized for accessory %s on machine %s "
-                "(warn-only override)",
-                user_name,
-                accessory,
-                machine_label,
-            )
-        elif authz == "always_enabled":
-            auth_log.info(
-                "Accessory %s on machine %s always-enabled",
-                accessory,
-                machine_label,
+        self.event_bus.publish_nowait(
+            SecondRelayEvent(
+                self.machine, self.second_relay_authorization, self.current_user
             )
+        )
 
-    async def _user_is_authorized(
-        self, user: User, slack: Optional["SlackHandler"] = None
-    ) -> bool:
-        """Return whether user is authorized for this machine."""
+    def _user_authorization(self, user: User) -> Optional[str]:
+        """Return why user is authorized for this machine, or None if not.
+
+        That is, the first of the machine's authorizations the user holds,
+        or :data:`~dm_mac.models.events.WARN_ONLY_AUTHORIZATION` if they
+        hold none but the machine is ``unauthorized_warn_only``.
+        """
         for auth in self.machine.authorizations_or:
             if auth in user.authorizations:
-                logging.getLogger("AUTH").info(
-                    "User %s (%s) authorized for %s based on %s",
-                    user.full_name,
-                    user.account_id,
-                    self.machine.display_name,
-                    auth,
-                )
-                return True
+                return auth
         if self.machine.unauthorized_warn_only:
-            logging.getLogger("AUTH").warning(
-                "User %s (%s) authorized for %s based on "
-                "unauthorized_warn_only==True",
-                user.full_name,
-                user.account_id,
-                self.machine.display_name,
-            )
-            if slack:
-                await slack.admin_log(
-                    f"WARNING - Authorizing user {user.full_name} for "
-                    f"{self.machine.display_name} based on unauthorized_warn_only "
-                    "setting for machine. User is NOT authorized for this "
-                    "machine."
-                )
-            return True
-        return False
+            return WARN_ONLY_AUTHORIZATION
+        return None
 
     @property
     def machine_response(self) -> Dict[str, str | bool | float | List[float]]:
@@ -1315,3 +1564,120 @@ class MachineState:
             "status_led_brightness": self.status_led_brightness,
             "second_relay": self.second_relay_desired_state,
         }
+
+    def _refresh_response(self) -> None:
+        """Drop the cached response bodies if the response has changed.
+
+        That is, if one of the fields the response is made from (relay,
+        display, Oops, status LED or second relay) has changed; this is also
+        when :attr:`state_version` advances.
+        """
+        key: Tuple[Any, ...] = (
+            self.relay_desired_state,
+            self.display_text,
+            self.is_oopsed,
+            self.status_led_rgb,
+            self.status_led_brightness,
+            self.second_relay_desired_state,
+        )
+        if key == self._response_key:
+            return
+        if self._response_key is not None:
+            self._state_version += 1
+        self._response_bodies = {}
+        self._response_key = key
+        self.response_renders += 1
+
+    @property
+    def state_version(self) -> int:
+        """Return the version of the response sent to this machine's MCU.
+
+        Increases every time :attr:`machine_response` changes, however it
+        was changed (heartbeat, Slack or admin API).
+        """
+        self._refresh_response()
+        return self._state_version
+
+    def _wake_version_waiters(self) -> None:
+        """Wake :meth:`wait_for_change` callers if :attr:`state_version` moved."""
+        if self._version_waiters is None:
+            return
+        version, event = self._version_waiters
+        if self.state_version != version:
+            self._version_waiters = None
+            event.set()
+
+    async def wait_for_change(self, known_version: int, timeout: float) -> int:
+        """Wait for :attr:`state_version` to differ from ``known_version``.
+
+        Returns as soon as the response to the MCU changes (however it was
+        changed) or after ``timeout`` seconds, whichever comes first. Any
+        number of callers can wait at once; they share one event, which is
+        only set when the version actually advances, so routine heartbeats
+        do not wake them.
+
+        :param known_version: The ``state_version`` the MCU last received.
+        :param timeout: Longest time to wait, in seconds.
+        :returns: The current :attr:`state_version`.
+        """
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        deadline: float = loop.time() + timeout
+        while (version := self.state_version) == known_version:
+            remaining: float = deadline - loop.time()
+            if remaining <= 0:
+                break
+            # wake anyone parked on an older version first
+            self._wake_version_waiters()
+            if self._version_waiters is None:
+                self._version_waiters = (version, asyncio.Event())
+            event: asyncio.Event = self._version_waiters[1]
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return self.state_version
+
+    def response_body(
+        self, mimetype: str = "application/json", known_version: Optional[int] = None
+    ) -> bytes:
+        """Return the serialized response to send to the MCU.
+
+        Bodies are cached until the response changes, so a routine heartbeat
+        reuses them.
+
+        :param mimetype: ``application/json`` or ``application/cbor``.
+        :param known_version: If not None, the ``state_version`` the MCU last
+            received. The response is then :attr:`machine_response` with
+            ``state_version`` added or, if that is still current, only
+            ``{"state_version": N, "unchanged": true}``.
+        """
+        self._refresh_response()
+        kind: str = "plain"
+        if known_version is not None:
+            kind = "unchanged" if known_version == self._state_version else "full"
+        body: Optional[bytes] = self._response_bodies.get((mimetype, kind))
+        if body is None:
+            body = RESPONSE_ENCODERS[mimetype](self.response_object(known_version))
+            self._response_bodies[(mimetype, kind)] = body
+        return body
+
+    def response_object(self, known_version: Optional[int] = None) -> Dict[str, Any]:
+        """Return the (unserialized) response; see :meth:`response_body`."""
+        if known_version is None:
+            return dict(self.machine_response)
+        version: int = self.state_version
+        if known_version == version:
+            return {"state_version": version, "unchanged": True}
+        return {**self.machine_response, "state_version": version}
+
+    @property
+    def machine_response_body(self) -> bytes:
+        """Return :attr:`machine_response` serialized as JSON (cached)."""
+        return self.response_body()
+
+    def conditional_response_body(self, known_version: int) -> bytes:
+        """Return the JSON response for an MCU that last saw ``known_version``.
+
+        See :meth:`response_body`.
+        """
+        return self.response_body(known_version=known_version)
@@ -0,0 +1,2104 @@
+"""Fleet-wide, write-behind persistence of machine state."""
+
+import asyncio
+import mmap
+import os
+import pickle
+import shutil
+import sqlite3
+import struct
+import zlib
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from contextlib import contextmanager
+from contextlib import nullcontext
+from contextvars import ContextVar
+from logging import Logger
+from logging import getLogger
+from multiprocessing import get_context
+from multiprocessing.connection import Connection
+from multiprocessing.process import BaseProcess
+from threading import Lock
+from threading import Thread
+from threading import get_ident
+from time import monotonic
+from time import time
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import BinaryIO
+from typing import Callable
+from typing import ContextManager
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import TypeVar
+from typing import cast
+
+from filelock import FileLock
+
+from dm_mac.models.disk_probe import DiskProbe
+from dm_mac.models.save_latency import SaveLatency
+from dm_mac.models.save_latency import save_latency_from_env
+from dm_mac.models.state_codec import DEFAULT_STATE_CODEC
+from dm_mac.models.state_codec import STATE_CODECS
+from dm_mac.models.state_codec import StateDecodeError
+from dm_mac.models.state_codec import decode_state
+from dm_mac.models.state_codec import encode_state
+from dm_mac.models.state_codec import encode_state_into
+
+if TYPE_CHECKING:  # pragma: no cover
+    from dm_mac.models.machine import Machine
+    from dm_mac.models.machine import MachineState
+
+
+logger: Logger = getLogger(__name__)
+
+
+#: Default cadence, in seconds, of the write-behind flusher. ``0`` disables
+#: write-behind entirely, so every :meth:`MachineState.save_cache` call
+#: writes through to disk before the request returns (the historical
+#: behavior). Overridden by the ``MACHINE_STATE_FLUSH_INTERVAL_SEC``
+#: environment variable.
+DEFAULT_FLUSH_INTERVAL_SEC: float = 0.0
+
+#: Default interval, in seconds, at which a persister in degraded mode
+#: retries draining its backlog to disk; ``0`` disables degraded mode, so a
+#: state save timeout fails the request with a 503. Overridden by the
+#: ``MACHINE_STATE_DEGRADED_RETRY_SEC`` environment variable.
+DEFAULT_DEGRADED_RETRY_SEC: float = 0.0
+
+#: The task collecting write-through saves for one batch commit, and the
+#: saves collected so far, keyed by machine name; see
+#: :meth:`StatePersister.collecting`. Tasks created inside the block inherit
+#: the context variable, hence the task check.
+_COLLECTED: ContextVar[
+    Optional[Tuple[Optional["asyncio.Task[Any]"], Dict[str, "MachineState"]]]
+] = ContextVar("machine_state_collected", default=None)
+
+#: Default state storage backend; see :data:`STATE_BACKENDS`. Overridden by
+#: the ``MACHINE_STATE_BACKEND`` environment variable.
+DEFAULT_STATE_BACKEND: str = "pickle"
+
+#: Default journal size, in bytes, above which :class:`JournalStateStore`
+#: compacts it into a snapshot. Overridden by the
+#: ``MACHINE_STATE_JOURNAL_COMPACT_BYTES`` environment variable.
+DEFAULT_JOURNAL_COMPACT_BYTES: int = 1024 * 1024
+
+#: Durability modes for state files, by ``MACHINE_STATE_FSYNC`` name:
+#: ``none`` leaves flushing to the OS, ``file`` fsyncs each file before it
+#: replaces the previous one, and ``file+dir`` additionally fsyncs the
+#: state directory so the rename itself survives a power loss.
+FSYNC_MODES: Tuple[str, ...] = ("none", "file", "file+dir")
+
+#: Default durability mode; see :data:`FSYNC_MODES`.
+DEFAULT_FSYNC_MODE: str = "none"
+
+#: Cross-process locking of state files, by ``MACHINE_STATE_LOCKING`` name:
+#: ``filelock`` takes a ``.lock`` FileLock around every read and write;
+#: ``none`` skips it, which is only safe when this server is the sole
+#: process using the state directory.
+LOCKING_MODES: Tuple[str, ...] = ("filelock", "none")
+
+#: Default locking mode; see :data:`LOCKING_MODES`.
+DEFAULT_LOCKING_MODE: str = "filelock"
+
+#: Seconds :class:`MirroredStateStore` waits for each directory at startup
+#: before loading without it.
+MIRROR_LOAD_TIMEOUT_SEC: float = 30.0
+
+#: Seconds :meth:`StatePersister.stop` waits for its final flush before
+#: giving up on it and logging the machines whose state was not saved.
+STOP_FLUSH_TIMEOUT_SEC: float = 10.0
+
+#: Where state I/O happens, by ``MACHINE_STATE_WRITER`` name: ``thread``
+#: runs the backend on worker threads in the server process; ``process``
+#: runs it in a :class:`ProcessStateStore` writer process.
+WRITERS: Tuple[str, ...] = ("thread", "process")
+
+#: Default writer; see :data:`WRITERS`.
+DEFAULT_WRITER: str = "thread"
+
+#: Default seconds :class:`ProcessStateStore` waits for its writer process
+#: before killing it. Overridden by ``MACHINE_STATE_WRITER_TIMEOUT_SEC``.
+DEFAULT_WRITER_TIMEOUT_SEC: float = 1.5
+
+#: Seconds :class:`ProcessStateStore` allows a new writer process to start
+#: (import its modules and open its store) before giving up on it.
+WRITER_START_TIMEOUT_SEC: float = 10.0
+
+#: Maximum number of threads :class:`PickleStateStore` uses to read state
+#: files concurrently at startup.
+STATE_LOAD_WORKERS: int = 16
+
+#: Default number of :class:`PersistenceExecutor` worker threads.
+#: Overridden by the ``MACHINE_STATE_WORKERS`` environment variable.
+DEFAULT_PERSISTENCE_WORKERS: int = 4
+
+#: Default limit on :class:`PersistenceExecutor` jobs waiting for a worker.
+#: Overridden by the ``MACHINE_STATE_QUEUE_LIMIT`` environment variable.
+DEFAULT_PERSISTENCE_QUEUE_LIMIT: int = 64
+
+
+T = TypeVar("T")
+
+
+class PersistenceQueueFullError(Exception):
+    """Raised when the persistence executor's queue is at its limit."""
+
+
+class PersistenceExecutor:
+    """Bounded thread pool dedicated to machine state I/O.
+
+    State saves used to run via :func:`asyncio.to_thread`, on the event
+    loop's default executor. A thread blocked on a hung disk cannot be
+    cancelled, so a long stall would tie up default-pool workers needed
+    by everything else in the process. All state I/O instead runs here,
+    on at most :attr:`max_workers` threads; at most :attr:`queue_limit`
+    further jobs may wait for a worker, beyond which :meth:`run` raises
+    :class:`PersistenceQueueFullError` rather than queueing without
+    bound.
+    """
+
+    def __init__(
+        self, max_workers: Optional[int] = None, queue_limit: Optional[int] = None
+    ) -> None:
+        """Initialize PersistenceExecutor; threads are started on demand.
+
+        :param max_workers: Worker thread count; defaults to the
+            ``MACHINE_STATE_WORKERS`` environment variable, or
+            :data:`DEFAULT_PERSISTENCE_WORKERS`.
+        :param queue_limit: Maximum number of jobs waiting for a worker;
+            defaults to the ``MACHINE_STATE_QUEUE_LIMIT`` environment
+            variable, or :data:`DEFAULT_PERSISTENCE_QUEUE_LIMIT`.
+        """
+        if max_workers is None:
+            max_workers = int(
+                os.environ.get("MACHINE_STATE_WORKERS", DEFAULT_PERSISTENCE_WORKERS)
+            )
+        if queue_limit is None:
+            queue_limit = int(
+                os.environ.get(
+                    "MACHINE_STATE_QUEUE_LIMIT", DEFAULT_PERSISTENCE_QUEUE_LIMIT
+                )
+            )
+        #: Number of worker threads.
+        self.max_workers: int = max_workers
+        #: Maximum number of jobs waiting for a worker.
+        self.queue_limit: int = queue_limit
+        #: Lifetime count of jobs rejected because the queue was full.
+        self.rejected: int = 0
+        self._pool: Optional[ThreadPoolExecutor] = None
+        #: Guards the counters below, which worker threads update.
+        self._lock: Lock = Lock()
+        self._queued: int = 0
+        self._active: int = 0
+        #: Monotonic submit time of every job not yet finished, by job ID.
+        self._submitted: Dict[int, float] = {}
+        #: IDs of jobs currently running on a worker.
+        self._running: Set[int] = set()
+        self._next_id: int = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """Return the number of jobs waiting for a worker."""
+        return self._queued
+
+    @property
+    def active_workers(self) -> int:
+        """Return the number of workers currently running a job."""
+        return self._active
+
+    @property
+    def oldest_inflight_sec(self) -> float:
+        """Return the age of the oldest unfinished (queued or running) job."""
+        with self._lock:
+            if not self._submitted:
+                return 0.0
+            return monotonic() - min(self._submitted.values())
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        """Run ``func(*args)`` on a worker thread and return its result.
+
+        :raises PersistenceQueueFullError: if :attr:`queue_limit` jobs are
+            already waiting for a worker.
+        """
+        with self._lock:
+            if self._queued >= self.queue_limit:
+                self.rejected += 1
+                raise PersistenceQueueFullError(
+                    f"{self._queued} state I/O jobs already waiting for "
+                    f"{self.max_workers} worker(s)"
+                )
+            job: int = self._next_id
+            self._next_id += 1
+            self._queued += 1
+            self._submitted[job] = monotonic()
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="machine-state"
+            )
+        return await asyncio.get_running_loop().run_in_executor(
+            self._pool, self._call, job, func, args
+        )
+
+    def _call(self, job: int, func: Callable[..., T], args: Tuple[Any, ...]) -> T:
+        """Run one job on a worker thread, maintaining the counters."""
+        with self._lock:
+            self._queued -= 1
+            self._active += 1
+            self._running.add(job)
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._running.discard(job)
+                self._submitted.pop(job, None)
+
+    def shutdown(self) -> None:
+        """Stop accepting work and drop queued jobs without waiting.
+
+        Jobs already running (e.g. blocked on a hung disk) are abandoned;
+        a later :meth:`run` starts a fresh pool.
+        """
+        if self._pool is None:
+            return
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = None
+        with self._lock:
+            self._queued = 0
+            self._submitted = {
+                j: t for j, t in self._submitted.items() if j in self._running
+            }
+
+
+def _env_choice(name: str, default: str, choices: Tuple[str, ...]) -> str:
+    """Return environment variable ``name``, which must be one of ``choices``."""
+    value: str = os.environ.get(name, default)
+    if value not in choices:
+        raise RuntimeError(
+            f"ERROR: Unknown {name} '{value}'; must be one of: {', '.join(choices)}"
+        )
+    return value
+
+
+def state_codec_from_env() -> str:
+    """Return the configured state codec (``MACHINE_STATE_CODEC``).
+
+    See :data:`~dm_mac.models.state_codec.STATE_CODECS`.
+    """
+    return _env_choice("MACHINE_STATE_CODEC", DEFAULT_STATE_CODEC, STATE_CODECS)
+
+
+def fsync_mode_from_env() -> str:
+    """Return the configured durability mode (``MACHINE_STATE_FSYNC``).
+
+    See :data:`FSYNC_MODES`.
+    """
+    return _env_choice("MACHINE_STATE_FSYNC", DEFAULT_FSYNC_MODE, FSYNC_MODES)
+
+
+def locking_mode_from_env() -> str:
+    """Return the configured locking mode (``MACHINE_STATE_LOCKING``).
+
+    See :data:`LOCKING_MODES`.
+    """
+    return _env_choice("MACHINE_STATE_LOCKING", DEFAULT_LOCKING_MODE, LOCKING_MODES)
+
+
+def fsync_dir(path: str) -> None:
+    """Fsync directory ``path``, so that renames within it are durable."""
+    fd: int = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_atomic(path: str, blob: bytes, fsync: str = DEFAULT_FSYNC_MODE) -> None:
+    """Replace the file at ``path`` with ``blob`` atomically.
+
+    The data is written to a temporary file in the same directory, which
+    is then renamed over ``path``; readers (and a crash at any point)
+    see either the old or the new contents, never a truncated file.
+
+    :param fsync: One of :data:`FSYNC_MODES`.
+    """
+    tmp: str = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(blob)
+            if fsync != "none":
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    if fsync == "file+dir":
+        fsync_dir(os.path.dirname(path) or ".")
+
+
+class StateStore:
+    """Base class for machine state storage backends.
+
+    A store maps machine names to the plain state dicts built by
+    :meth:`MachineState._state_dict`. Implementations must be safe to
+    call from worker threads; they are never called on the event loop
+    except at startup.
+    """
+
+    #: Directory holding this store's files.
+    state_dir: str = ""
+
+    #: Per-phase save latency histograms, if enabled via
+    #: ``MACHINE_STATE_LATENCY_BUCKETS``; see :mod:`dm_mac.models.save_latency`.
+    latency: Optional[SaveLatency] = None
+
+    def record_latency(self, names: Iterable[str], phase: str, seconds: float) -> None:
+        """Record ``seconds`` in ``phase`` for each machine, if enabled."""
+        if self.latency is not None:
+            for name in names:
+                self.latency.observe(name, phase, seconds)
+
+    def save_batch(self, records: Dict[str, Dict[str, Any]]) -> None:
+        """Persist the state of one or more machines.
+
+        :param records: Mapping of machine name to state dict.
+        """
+        raise NotImplementedError()
+
+    def load_all(self, names: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Load persisted state for the named machines.
+
+        :param names: Names of the machines to load.
+        :returns: Mapping of machine name to state dict, for those machines
+            that have persisted state.
+        """
+        raise NotImplementedError()
+
+    def load(self, name: str) -> Optional[Dict[str, Any]]:
+        """Load persisted state for one machine, or None if there is none."""
+        return self.load_all([name]).get(name)
+
+    def saved_times(self, names: Iterable[str]) -> Dict[str, float]:
+        """Return when each named machine's state was last saved.
+
+        Used by :class:`MirroredStateStore` to pick the newest copy.
+
+        :returns: Mapping of machine name to wall-clock timestamp, for those
+            machines that have persisted state; empty if the backend does
+            not know.
+        """
+        return {}
+
+    def close(self) -> None:
+        """Release any resources held by the store."""
+
+
+class PickleStateStore(StateStore):
+    """Historical backend: one ``<name>-state.pickle`` file per machine.
+
+    Each file is replaced atomically (see :func:`write_atomic`), with the
+    ``MACHINE_STATE_FSYNC`` durability mode, and unless
+    ``MACHINE_STATE_LOCKING`` is ``none`` is guarded by a
+    ``<name>-state.pickle.lock`` FileLock. At
+    startup the files are read concurrently on up to
+    :data:`STATE_LOAD_WORKERS` threads, so load time is bounded by disk
+    latency rather than by the number of machines times disk latency.
+
+    Files are written with the ``MACHINE_STATE_CODEC`` codec (despite the
+    file extension, the ``binary`` codec does not write a pickle) and
+    read with either.
+    """
+
+    def __init__(self, state_dir: str) -> None:
+        """Initialize PickleStateStore, creating the state directory."""
+        #: Directory holding the per-machine state files.
+        self.state_dir: str = state_dir
+        #: Codec used to write state files.
+        self.codec: str = state_codec_from_env()
+        #: Durability mode; one of :data:`FSYNC_MODES`.
+        self.fsync: str = fsync_mode_from_env()
+        #: Locking mode; one of :data:`LOCKING_MODES`.
+        self.locking: str = locking_mode_from_env()
+        self.latency = save_latency_from_env()
+        os.makedirs(self.state_dir, exist_ok=True)
+
+    def path_for(self, name: str) -> str:
+        """Return the path to the state file for machine ``name``."""
+        return os.path.join(self.state_dir, f"{name}-state.pickle")
+
+    @staticmethod
+    def write_file(
+        path: str,
+        data: Dict[str, Any],
+        codec: str = "pickle",
+        latency: Optional[SaveLatency] = None,
+        name: str = "",
+        fsync: str = DEFAULT_FSYNC_MODE,
+        locking: str = DEFAULT_LOCKING_MODE,
+    ) -> None:
+        """Encode ``data`` with ``codec`` and atomically replace ``path`` with it.
+
+        If ``latency`` is given, the time spent in each phase is recorded
+        for machine ``name``.
+
+        :param fsync: One of :data:`FSYNC_MODES`.
+        :param locking: One of :data:`LOCKING_MODES`.
+        """
+        start: float = monotonic()
+        blob: bytes = encode_state(data, codec)
+        encoded: float = monotonic()
+        with PickleStateStore._file_lock(path, locking):
+            locked: float = monotonic()
+            logger.debug("Saving state to: %s", path)
+            write_atomic(path, blob, fsync)
+        if latency is not None:
+            latency.observe(name, "serialize", encoded - start)
+            latency.observe(name, "filelock_wait", locked - encoded)
+            latency.observe(name, "write", monotonic() - locked)
+
+    @staticmethod
+    def _file_lock(path: str, locking: str) -> ContextManager[Any]:
+        """Return the FileLock for ``path``, or a no-op if locking is off."""
+        if locking == "none":
+            return nullcontext()
+        logger.debug("Getting lock for state file: %s", path + ".lock")
+        return FileLock(path + ".lock")
+
+    @staticmethod
+    def read_file(
+        path: str, locking: str = DEFAULT_LOCKING_MODE
+    ) -> Optional[Dict[str, Any]]:
+        """Decode the state at ``path``, or return None if it does not exist.
+
+        :param locking: One of :data:`LOCKING_MODES`.
+        """
+        if not os.path.exists(path):
+            logger.info("State file does not yet exist: %s", path)
+            return None
+        with PickleStateStore._file_lock(path, locking):
+            logger.debug("Loading state from: %s", path)
+            with open(path, "rb") as f:
+                blob: bytes = f.read()
+        return decode_state(blob)
+
+    def save_batch(self, records: Dict[str, Dict[str, Any]]) -> None:
+        """Write one state file per machine."""
+        for name, data in records.items():
+            self.write_file(
+                self.path_for(name),
+                data,
+                self.codec,
+                latency=self.latency,
+                name=name,
+                fsync=self.fsync,
+                locking=self.locking,
+            )
+
+    def load_all(self, names: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Read each machine's pickle file, skipping those that don't exist."""
+        wanted: List[str] = list(names)
+        loaded: List[Optional[Dict[str, Any]]]
+        if len(wanted) > 1:
+            with ThreadPoolExecutor(
+                max_workers=min(STATE_LOAD_WORKERS, len(wanted)),
+                thread_name_prefix="machine-state-load",
+            ) as pool:
+                loaded = list(
+                    pool.map(
+                        lambda n: self.read_file(self.path_for(n), self.locking), wanted
+                    )
+                )
+        else:
+            loaded = [self.read_file(self.path_for(n), self.locking) for n in wanted]
+        return {name: data for name, data in zip(wanted, loaded) if data is not None}
+
+    def saved_times(self, names: Iterable[str]) -> Dict[str, float]:
+        """Return the modification time of each machine's state file."""
+        result: Dict[str, float] = {}
+        for name in names:
+            try:
+                result[name] = os.path.getmtime(self.path_for(name))
+            except OSError:
+                pass
+        return result
+
+
+class SqliteStateStore(StateStore):
+    """Consolidated backend: every machine's state in one SQLite database.
+
+    The database (:attr:`FILENAME` in the state directory) runs in WAL
+    mode with ``synchronous=NORMAL``, so a batch of any size is one
+    transaction and one WAL append, and fsyncs only happen at
+    checkpoints. The whole fleet is loaded with a single query. A commit
+    is durable across a server crash; a power loss can lose at most the
+    most recent transactions since the last checkpoint.
+
+    On load, machines that have no row yet but do have a legacy
+    ``<name>-state.pickle`` file are imported from it, so switching an
+    existing install to this backend keeps its state.
+    """
+
+    #: Name of the database file within the state directory.
+    FILENAME: str = "machine_state.sqlite3"
+
+    def __init__(self, state_dir: str) -> None:
+        """Initialize SqliteStateStore; the database is opened lazily."""
+        #: Directory holding the database.
+        self.state_dir: str = state_dir
+        #: Path to the database file.
+        self.path: str = os.path.join(state_dir, self.FILENAME)
+        #: Codec used to encode each machine's row.
+        self.codec: str = state_codec_from_env()
+        self.latency = save_latency_from_env()
+        self._conn: Optional[sqlite3.Connection] = None
+        #: Serializes use of the shared connection across worker threads.
+        self._conn_lock: Lock = Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Return the shared connection, opening it on first use.
+
+        Must be called with :attr:`_conn_lock` held.
+        """
+        if self._conn is None:
+            os.makedirs(self.state_dir, exist_ok=True)
+            logger.debug("Opening state database: %s", self.path)
+            conn: sqlite3.Connection = sqlite3.connect(
+                self.path, check_same_thread=False, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS machine_state ("
+                "machine_name TEXT PRIMARY KEY, "
+                "data BLOB NOT NULL, "
+                "updated_at REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def save_batch(self, records: Dict[str, Dict[str, Any]]) -> None:
+        """Upsert every machine's state in a single transaction.
+
+        The time taken to begin and to complete the transaction is
+        recorded for every machine in the batch.
+        """
+        now: float = time()
+        rows: List[Tuple[str, bytes, float]] = []
+        for name, data in records.items():
+            start: float = monotonic()
+            rows.append((name, encode_state(data, self.codec), now))
+            self.record_latency((name,), "serialize", monotonic() - start)
+        with self._conn_lock:
+            conn: sqlite3.Connection = self._connect()
+            start = monotonic()
+            conn.execute("BEGIN IMMEDIATE")
+            locked: float = monotonic()
+            self.record_latency(records, "filelock_wait", locked - start)
+            try:
+                conn.executemany(
+                    "INSERT INTO machine_state (machine_name, data, updated_at) "
+                    "VALUES (?, ?, ?) ON CONFLICT(machine_name) DO UPDATE SET "
+                    "data=excluded.data, updated_at=excluded.updated_at",
+                    rows,
+                )
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            self.record_latency(records, "write", monotonic() - locked)
+
+    def load_all(self, names: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Load the fleet with one query, importing legacy pickles if needed."""
+        wanted: List[str] = list(names)
+        with self._conn_lock:
+            rows: List[Tuple[str, bytes]] = (
+                self._connect()
+                .execute("SELECT machine_name, data FROM machine_state")
+                .fetchall()
+            )
+        result: Dict[str, Dict[str, Any]] = {
+            name: decode_state(blob) for name, blob in rows if name in wanted
+        }
+        missing: List[str] = [n for n in wanted if n not in result]
+        if missing:
+            legacy: Dict[str, Dict[str, Any]] = PickleStateStore(
+                self.state_dir
+            ).load_all(missing)
+            if legacy:
+                logger.warning(
+                    "Importing legacy pickle state for %d machine(s) into %s",
+                    len(legacy),
+                    self.path,
+                )
+                self.save_batch(legacy)
+                result.update(legacy)
+        return result
+
+    def saved_times(self, names: Iterable[str]) -> Dict[str, float]:
+        """Return the ``updated_at`` time of each machine's row."""
+        wanted: List[str] = list(names)
+        with self._conn_lock:
+            rows: List[Tuple[str, float]] = (
+                self._connect()
+                .execute("SELECT machine_name, updated_at FROM machine_state")
+                .fetchall()
+            )
+        return {name: updated for name, updated in rows if name in wanted}
+
+    def close(self) -> None:
+        """Close the database connection."""
+        with self._conn_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class JournalStateStore(StateStore):
+    """Append-only journal of per-field deltas, compacted into a snapshot.
+
+    Each save appends one frame per machine to ``machine_state.journal``
+    holding only the fields that changed since that machine was last
+    saved, so a heartbeat that only moves ``uptime`` costs a few dozen
+    bytes of sequential write instead of a full-file rewrite. Frames are
+    a 4-byte big-endian length followed by a pickled ``(name, delta)``
+    tuple.
+
+    Unless ``MACHINE_STATE_FSYNC`` is ``none``, each append is fsynced
+    before :meth:`save_batch` returns.
+
+    Once the journal grows past ``MACHINE_STATE_JOURNAL_COMPACT_BYTES``
+    it is rotated to ``machine_state.journal.1`` (or appended to it, if a
+    previous compaction failed) and a background thread writes the full
+    fleet state to ``machine_state.snapshot`` (via a temporary file and
+    rename) and then deletes the rotated journal.
+
+    Loading replays the snapshot, then ``machine_state.journal.1`` if a
+    compaction was interrupted, then the journal. Deltas carry absolute
+    field values, so replaying a rotated journal over a snapshot that
+    already contains it is harmless. A torn final frame from a crash
+    mid-append is discarded and truncated away.
+    """
+
+    #: Name of the snapshot file within the state directory.
+    SNAPSHOT_FILENAME: str = "machine_state.snapshot"
+
+    #: Name of the journal file within the state directory.
+    JOURNAL_FILENAME: str = "machine_state.journal"
+
+    _HEADER: struct.Struct = struct.Struct(">I")
+
+    def __init__(self, state_dir: str) -> None:
+        """Initialize JournalStateStore; files are opened lazily."""
+        #: Directory holding the snapshot and journal.
+        self.state_dir: str = state_dir
+        #: Path to the snapshot file.
+        self.snapshot_path: str = os.path.join(state_dir, self.SNAPSHOT_FILENAME)
+        #: Path to the active journal.
+        self.journal_path: str = os.path.join(state_dir, self.JOURNAL_FILENAME)
+        #: Path to the journal being compacted, if any.
+        self.rotated_path: str = self.journal_path + ".1"
+        #: Journal size in bytes that triggers a compaction.
+        self.compact_bytes: int = int(
+            os.environ.get(
+                "MACHINE_STATE_JOURNAL_COMPACT_BYTES",
+                str(DEFAULT_JOURNAL_COMPACT_BYTES),
+            )
+        )
+        #: Durability mode; one of :data:`FSYNC_MODES`.
+        self.fsync: str = fsync_mode_from_env()
+        #: Number of completed compactions.
+        self.compactions: int = 0
+        self.latency = save_latency_from_env()
+        #: Latest known state of every machine, as replayed plus appended.
+        self._state: Dict[str, Dict[str, Any]] = {}
+        self._loaded: bool = False
+        self._journal: Optional[BinaryIO] = None
+        self._compactor: Optional[Thread] = None
+        #: Serializes appends, rotation and replay across worker threads.
+        self._lock: Lock = Lock()
+
+    def _replay_file(self, path: str) -> None:
+        """Apply every complete frame in a journal file to :attr:`_state`."""
+        if not os.path.exists(path):
+            return
+        good: int = 0
+        with open(path, "rb") as f:
+            buf: bytes = f.read()
+        while good + self._HEADER.size <= len(buf):
+            (length,) = self._HEADER.unpack_from(buf, good)
+            end: int = good + self._HEADER.size + length
+            if end > len(buf):
+                break
+            try:
+                name, delta = pickle.loads(buf[good + self._HEADER.size : end])
+            except Exception:
+                break
+            self._state.setdefault(name, {}).update(delta)
+            good = end
+        if good < len(buf):
+            logger.warning(
+                "Discarding %d bytes of incomplete journal data at end of %s",
+                len(buf) - good,
+                path,
+            )
+            with open(path, "r+b") as f:
+                f.truncate(good)
+
+    def _ensure_loaded(self) -> None:
+        """Replay snapshot and journals on first use.
+
+        Must be called with :attr:`_lock` held.
+        """
+        if self._loaded:
+            return
+        os.makedirs(self.state_dir, exist_ok=True)
+        if os.path.exists(self.snapshot_path):
+            logger.debug("Loading state snapshot from: %s", self.snapshot_path)
+            with open(self.snapshot_path, "rb") as f:
+                self._state = pickle.load(f)
+        self._replay_file(self.rotated_path)
+        self._replay_file(self.journal_path)
+        self._journal = open(self.journal_path, "ab")
+        self._loaded = True
+
+    def save_batch(self, records: Dict[str, Dict[str, Any]]) -> None:
+        """Append the changed fields of each machine to the journal.
+
+        Time spent waiting for the journal's lock is recorded as the
+        ``filelock_wait`` phase for every machine in the batch.
+        """
+        frames: List[bytes] = []
+        start: float = monotonic()
+        with self._lock:
+            self.record_latency(records, "filelock_wait", monotonic() - start)
+            self._ensure_loaded()
+            for name, data in records.items():
+                start = monotonic()
+                prev: Dict[str, Any] = self._state.setdefault(name, {})
+                delta: Dict[str, Any] = {
+                    k: v for k, v in data.items() if k not in prev or prev[k] != v
+                }
+                if not delta:
+                    continue
+                payload: bytes = pickle.dumps((name, delta), pickle.HIGHEST_PROTOCOL)
+                frames.append(self._HEADER.pack(len(payload)) + payload)
+                prev.update(delta)
+                self.record_latency((name,), "serialize", monotonic() - start)
+            if not frames:
+                return
+            assert self._journal is not None
+            start = monotonic()
+            self._journal.write(b"".join(frames))
+            self._journal.flush()
+            if self.fsync != "none":
+                os.fsync(self._journal.fileno())
+            self.record_latency(records, "write", monotonic() - start)
+            if self._journal.tell() >= self.compact_bytes:
+                self._start_compaction()
+
+    def _start_compaction(self) -> None:
+        """Rotate the journal and snapshot in a background thread.
+
+        Must be called with :attr:`_lock` held. Does nothing if a previous
+        compaction is still running. If a previous compaction failed, its
+        rotated journal is not in any snapshot yet, so the journal is
+        appended to it rather than replacing it.
+        """
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        assert self._journal is not None
+        self._journal.close()
+        if os.path.exists(self.rotated_path):
+            with open(self.journal_path, "rb") as src:
+                with open(self.rotated_path, "ab") as dst:
+                    shutil.copyfileobj(src, dst)
+                    dst.flush()
+                    if self.fsync != "none":
+                        os.fsync(dst.fileno())
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, self.rotated_path)
+        self._journal = open(self.journal_path, "ab")
+        snap: Dict[str, Dict[str, Any]] = {k: dict(v) for k, v in self._state.items()}
+        self._compactor = Thread(
+            target=self._write_snapshot,
+            args=(snap,),
+            name="machine-state-compactor",
+            daemon=True,
+        )
+        self._compactor.start()
+
+    def _write_snapshot(self, snap: Dict[str, Dict[str, Any]]) -> None:
+        """Write ``snap`` as the new snapshot and drop the rotated journal."""
+        try:
+            # The snapshot must be durable before the rotated journal goes.
+            write_atomic(
+                self.snapshot_path,
+                pickle.dumps(snap, pickle.HIGHEST_PROTOCOL),
+                "file+dir" if self.fsync == "file+dir" else "file",
+            )
+            os.remove(self.rotated_path)
+        except Exception:
+            logger.exception("Error compacting machine state journal")
+            return
+        self.compactions += 1
+        logger.debug("Compacted state journal into %s", self.snapshot_path)
+
+    def load_all(self, names: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Return replayed state, importing legacy pickles if needed."""
+        wanted: List[str] = list(names)
+        with self._lock:
+            self._ensure_loaded()
+            result: Dict[str, Dict[str, Any]] = {
+                n: dict(self._state[n]) for n in wanted if n in self._state
+            }
+        missing: List[str] = [n for n in wanted if n not in result]
+        if missing:
+            legacy: Dict[str, Dict[str, Any]] = PickleStateStore(
+                self.state_dir
+            ).load_all(missing)
+            if legacy:
+                logger.warning(
+                    "Importing legacy pickle state for %d machine(s) into %s",
+                    len(legacy),
+                    self.journal_path,
+                )
+                self.save_batch(legacy)
+                result.update(legacy)
+        return result
+
+    def saved_times(self, names: Iterable[str]) -> Dict[str, float]:
+        """Return the journal's modification time for every machine in it.
+
+        Deltas are not timestamped, so every machine gets the time of the
+        most recent append (or snapshot).
+        """
+        with self._lock:
+            self._ensure_loaded()
+            present: List[str] = [n for n in names if n in self._state]
+        mtimes: List[float] = [
+            os.path.getmtime(p)
+            for p in (self.journal_path, self.rotated_path, self.snapshot_path)
+            if os.path.exists(p)
+        ]
+        if not mtimes:
+            return {}
+        return {name: max(mtimes) for name in present}
+
+    def close(self) -> None:
+        """Wait for any running compaction and close the journal."""
+        if self._compactor is not None:
+            self._compactor.join()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            self._loaded = False
+
+
+class MmapStateStore(StateStore):
+    """Every machine's state in a fixed-size record of one memory-mapped file.
+
+    ``machine_state.mmap`` holds a :data:`_FILE_HEADER`, then one slot per
+    machine, in the order of the names given to :meth:`load_all` (i.e. of
+    ``MachinesConfig.machines``). Each slot is the machine's name followed
+    by two copies of its state, each a :data:`_COPY_HEADER` (CRC-32,
+    sequence number, save time and length) and the state in the
+    :mod:`~dm_mac.models.state_codec` binary layout. A save overwrites the
+    older copy in place and then bumps its sequence number, so a crash
+    mid-write leaves a copy whose CRC does not match and loading falls back
+    to the other one. There is no file open, rename or lock file per save.
+
+    The mapping is shared, so saved state reaches the page cache (and
+    survives a crash of the server) as soon as it is copied in. Unless
+    ``MACHINE_STATE_FSYNC`` is ``none``, :meth:`save_batch` then makes it
+    durable with a single ``msync`` per batch; with write-behind enabled
+    that is one ``msync`` per flush.
+
+    The file is only rewritten (atomically, keeping existing state) when a
+    machine is added, or the configured machine order changes. It must only
+    be used by one server process at a time.
+    """
+
+    #: Name of the state file within the state directory.
+    FILENAME: str = "machine_state.mmap"
+
+    #: Bytes per copy of a machine's state, including its header.
+    COPY_SIZE: int = 1024
+
+    #: Bytes reserved for each slot's machine name (a length byte first).
+    NAME_SIZE: int = 64
+
+    #: Magic, format version, copy size and slot count.
+    _FILE_HEADER: struct.Struct = struct.Struct("<4sB3xII")
+
+    #: CRC-32 of the rest of the copy, sequence number, save time, length.
+    _COPY_HEADER: struct.Struct = struct.Struct("<IQdH")
+
+    _MAGIC: bytes = b"MACM"
+
+    def __init__(self, state_dir: str) -> None:
+        """Initialize MmapStateStore; the file is mapped lazily."""
+        #: Directory holding the state file.
+        self.state_dir: str = state_dir
+        #: Path to the state file.
+        self.path: str = os.path.join(state_dir, self.FILENAME)
+        #: Durability mode; one of :data:`FSYNC_MODES`.
+        self.fsync: str = fsync_mode_from_env()
+        self.latency = save_latency_from_env()
+        #: Bytes per copy in the mapped file.
+        self.copy_size: int = self.COPY_SIZE
+        #: Slot index of each machine.
+        self.slots: Dict[str, int] = {}
+        #: Latest sequence number and copy index of each slot.
+        self._latest: List[Tuple[int, int]] = []
+        self._file: Optional[BinaryIO] = None
+        self._map: Optional[mmap.mmap] = None
+        #: Serializes access to the mapping across worker threads.
+        self._lock: Lock = Lock()
+
+    @property
+    def _slot_size(self) -> int:
+        """Return the size in bytes of one machine's slot."""
+        return self.NAME_SIZE + 2 * self.copy_size
+
+    def _offset(self, slot: int, copy: int) -> int:
+        """Return the file offset of one copy of one slot's state."""
+        return (
+            self._FILE_HEADER.size
+            + slot * self._slot_size
+            + self.NAME_SIZE
+            + copy * self.copy_size
+        )
+
+    def _read_copy(
+        self, buf: Any, slot: int, copy: int
+    ) -> Optional[Tuple[int, float, bytes]]:
+        """Return ``(sequence, saved_at, state)`` of a valid copy, else None."""
+        off: int = self._offset(slot, copy)
+        crc, seq, saved_at, length = self._COPY_HEADER.unpack_from(buf, off)
+        end: int = off + self._COPY_HEADER.size + length
+        if seq == 0 or end > off + self.copy_size:
+            return None
+        if zlib.crc32(buf[off + 4 : end]) != crc:
+            return None
+        return seq, saved_at, bytes(buf[off + self._COPY_HEADER.size : end])
+
+    def _newest(self, slot: int) -> Optional[Tuple[int, float, bytes]]:
+        """Return the newest valid copy of a slot, if any."""
+        assert self._map is not None
+        copies = [self._read_copy(self._map, slot, c) for c in (0, 1)]
+        valid = [c for c in copies if c is not None]
+        return max(valid, key=lambda c: c[0]) if valid else None
+
+    def _map_file(self) -> None:
+        """Map the state file, creating it if needed; needs :attr:`_lock`."""
+        if self._map is not None:
+            return
+        if not os.path.exists(self.path):
+            os.makedirs(self.state_dir, exist_ok=True)
+            write_atomic(
+                self.path,
+                self._FILE_HEADER.pack(self._MAGIC, 1, self.COPY_SIZE, 0),
+                self.fsync,
+            )
+        f: BinaryIO = open(self.path, "r+b")
+        try:
+            header: bytes = f.read(self._FILE_HEADER.size)
+            if len(header) < self._FILE_HEADER.size:
+                raise StateDecodeError(f"{self.path} is truncated")
+            magic, version, copy_size, count = self._FILE_HEADER.unpack(header)
+            if magic != self._MAGIC or version != 1:
+                raise StateDecodeError(f"{self.path} is not a version 1 state map")
+            self.copy_size = copy_size
+            mm: mmap.mmap = mmap.mmap(f.fileno(), 0)
+        except BaseException:
+            f.close()
+            raise
+        if len(mm) < self._FILE_HEADER.size + count * self._slot_size:
+            mm.close()
+            f.close()
+            raise StateDecodeError(f"{self.path} is truncated")
+        self._file, self._map = f, mm
+        self.slots = {}
+        self._latest = []
+        for slot in range(count):
+            off: int = self._FILE_HEADER.size + slot * self._slot_size
+            name: str = mm[off + 1 : off + 1 + mm[off]].decode("utf-8")
+            self.slots[name] = slot
+            copies = [self._read_copy(mm, slot, c) for c in (0, 1)]
+            seqs: List[int] = [0 if c is None else c[0] for c in copies]
+            newest: int = 0 if seqs[0] >= seqs[1] else 1
+            self._latest.append((seqs[newest], newest))
+
+    def _unmap(self) -> None:
+        """Unmap and close the state file; needs :attr:`_lock`."""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _relayout(self, names: List[str]) -> None:
+        """Rewrite the file with one slot per name, in order; needs :attr:`_lock`.
+
+        Existing slots are copied as-is; new ones start empty.
+        """
+        assert self._map is not None
+        old: mmap.mmap = self._map
+        size: int = self._slot_size
+        parts: List[bytes] = [
+            self._FILE_HEADER.pack(self._MAGIC, 1, self.copy_size, len(names))
+        ]
+        for name in names:
+            encoded: bytes = name.encode("utf-8")
+            if len(encoded) >= self.NAME_SIZE:
+                raise ValueError(f"Machine name too long for {self.path}: {name}")
+            if name in self.slots:
+                off: int = self._FILE_HEADER.size + self.slots[name] * size
+                parts.append(old[off : off + size])
+            else:
+                parts.append(
+                    bytes([len(encoded)]) + encoded + b"\0" * (size - 1 - len(encoded))
+                )
+        logger.info("Laying out %d machine(s) in %s", len(names), self.path)
+        self._unmap()
+        write_atomic(self.path, b"".join(parts), self.fsync)
+        self._map_file()
+
+    def save_batch(self, records: Dict[str, Dict[str, Any]]) -> None:
+        """Copy every machine's state into its slot, then ``msync`` once."""
+        start: float = monotonic()
+        with self._lock:
+            self.record_latency(records, "filelock_wait", monotonic() - start)
+            self._map_file()
+            new: List[str] = [n for n in records if n not in self.slots]
+            if new:
+                self._relayout(list(self.slots) + new)
+            assert self._map is not None
+            mm: mmap.mmap = self._map
+            now: float = time()
+            write_sec: float = 0.0
+            room: int = self.copy_size - self._COPY_HEADER.size
+            for name, data in records.items():
+                start = monotonic()
+                slot: int = self.slots[name]
+                seq, newest = self._latest[slot]
+                off: int = self._offset(slot, 1 - newest)
+                # The older copy is not read until its CRC matches, so the
+                # state is packed straight into it, followed by the header.
+                try:
+                    length: int = encode_state_into(
+                        data, mm, off + self._COPY_HEADER.size, room
+                    )
+                except ValueError as ex:
+                    raise ValueError(
+                        f"State of {name} does not fit; {self.path} holds at "
+                        f"most {room} bytes per machine"
+                    ) from ex
+                written: float = monotonic()
+                self.record_latency((name,), "serialize", written - start)
+                self._COPY_HEADER.pack_into(mm, off, 0, seq + 1, now, length)
+                end: int = off + self._COPY_HEADER.size + length
+                with memoryview(mm) as view:
+                    struct.pack_into("<I", mm, off, zlib.crc32(view[off + 4 : end]))
+                self._latest[slot] = (seq + 1, 1 - newest)
+                write_sec += monotonic() - written
+            start = monotonic()
+            if self.fsync != "none":
+                mm.flush()
+            self.record_latency(records, "write", write_sec + monotonic() - start)
+
+    def load_all(self, names: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Load state, laying the file out in ``names`` order if needed.
+
+        Machines with no state yet are imported from legacy pickles.
+        """
+        wanted: List[str] = list(names)
+        result: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            self._map_file()
+            if list(self.slots)[: len(wanted)] != wanted:
+                self._relayout(wanted + [n for n in self.slots if n not in wanted])
+            for name in wanted:
+                newest = self._newest(self.slots[name])
+                if newest is not None:
+                    result[name] = decode_state(newest[2])
+        missing: List[str] = [n for n in wanted if n not in result]
+        if missing:
+            legacy: Dict[str, Dict[str, Any]] = PickleStateStore(
+                self.state_dir
+            ).load_all(missing)
+            if legacy:
+                logger.warning(
+                    "Importing legacy pickle state for %d machine(s) into %s",
+                    len(legacy),
+                    self.path,
+                )
+                self.save_batch(legacy)
+                result.update(legacy)
+        return result
+
+    def saved_times(self, names: Iterable[str]) -> Dict[str, float]:
+        """Return the save time recorded with each machine's newest state."""
+        result: Dict[str, float] = {}
+        with self._lock:
+            self._map_file()
+            for name in names:
+                if name not in self.slots:
+                    continue
+                newest = self._newest(self.slots[name])
+                if newest is not None:
+                    result[name] = newest[1]
+        return result
+
+    def close(self) -> None:
+        """``msync`` and unmap the state file."""
+        with self._lock:
+            if self._map is not None:
+                self._map.flush()
+            self._unmap()
+
+
+#: Available state storage backends, by ``MACHINE_STATE_BACKEND`` name.
+STATE_BACKENDS: Dict[str, type] = {
+    "pickle": PickleStateStore,
+    "sqlite": SqliteStateStore,
+    "journal": JournalStateStore,
+    "mmap": MmapStateStore,
+}
+
+
+class _Mirror:
+    """One directory of a :class:`MirroredStateStore` and its writer thread.
+
+    Writes are coalesced: while a write is in progress, further batches
+    are merged into a backlog that is written (as one batch) when it
+    finishes. A hung device therefore holds at most one pending state per
+    machine, however long it stays hung.
+    """
+
+    def __init__(self, store: StateStore) -> None:
+        """Initialize _Mirror."""
+        #: The store writing to this directory.
+        self.store: StateStore = store
+        #: Lifetime count of failed writes to this directory.
+        self.errors: int = 0
+        self._pool: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="machine-state-mirror"
+        )
+        self._lock: Lock = Lock()
+        #: Records waiting to be written, keyed by machine name.
+        self._backlog: Dict[str, Dict[str, Any]] = {}
+        #: Future for the backlog's eventual write.
+        self._backlog_future: Optional["Future[None]"] = None
+        self._running: bool = False
+
+    @property
+    def backlog(self) -> int:
+        """Return the number of machines waiting to be written here."""
+        return len(self._backlog)
+
+    def submit(self, records: Dict[str, Dict[str, Any]]) -> "Future[None]":
+        """Queue ``records``; return a Future completed once they're written."""
+        with self._lock:
+            self._backlog.update(records)
+            if self._backlog_future is None:
+                self._backlog_future = Future()
+            future: "Future[None]" = self._backlog_future
+            if not self._running:
+                self._running = True
+                self._pool.submit(self._drain)
+        return future
+
+    def _drain(self) -> None:
+        """Write backlogged batches until none remain (on the writer thread)."""
+        while True:
+            with self._lock:
+                batch: Dict[str, Dict[str, Any]] = self._backlog
+                future: Optional["Future[None]"] = self._backlog_future
+                if future is None:
+                    self._running = False
+                    return
+                self._backlog = {}
+                self._backlog_future = None
+            try:
+                self.store.save_batch(batch)
+            except Exception as ex:
+                self.errors += 1
+                logger.warning(
+                    "Error writing state to %s: %s", self.store.state_dir, ex
+                )
+                future.set_exception(ex)
+            else:
+                future.set_result(None)
+
+    def close(self) -> None:
+        """Stop the writer thread without waiting, and close the store."""
+        self._pool.shutdown(wait=False)
+        self.store.close()
+
+
+class MirroredStateStore(StateStore):
+    """Hedged writes of the same state to several directories.
+
+    Each directory (typically one per physical disk) has its own store,
+    of the same backend, and its own writer thread. :meth:`save_batch`
+    hands the batch to every directory at once and returns as soon as the
+    *first* one has written it, so a slow or hung device only delays its
+    own copy instead of the save. The remaining copies finish in the
+    background; a hung device accumulates at most one pending state per
+    machine (see :class:`_Mirror`). The save only fails if every
+    directory fails.
+
+    :meth:`load_all` reads every directory concurrently (skipping any that
+    fail, or take longer than :data:`MIRROR_LOAD_TIMEOUT_SEC`) and uses
+    the most recently saved copy of each machine's state, per
+    :meth:`StateStore.saved_times`.
+    """
+
+    def __init__(self, stores: List[StateStore]) -> None:
+        """Initialize MirroredStateStore.
+
+        :param stores: One store per directory; the first is the primary,
+            whose latency histograms (if enabled) are exported.
+        """
+        self._mirrors: List[_Mirror] = [_Mirror(s) for s in stores]
+        self.latency = stores[0].latency
+        self.state_dir = stores[0].state_dir
+
+    @property
+    def stores(self) -> List[StateStore]:
+        """Return the store for each directory."""
+        return [m.store for m in self._mirrors]
+
+    @property
+    def backlogs(self) -> List[int]:
+        """Return the number of machines waiting to be written, per directory."""
+        return [m.backlog for m in self._mirrors]
+
+    @property
+    def errors(self) -> List[int]:
+        """Return the lifetime count of failed writes, per directory."""
+        return [m.errors for m in self._mirrors]
+
+    def save_batch(self, records: Dict[str, Dict[str, Any]]) -> None:
+        """Write to every directory; return once the first write succeeds.
+
+        :raises Exception: the first directory's error, if every one fails.
+        """
+        pending: Set["Future[None]"] = {m.submit(records) for m in self._mirrors}
+        errors: List[BaseException] = []
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                ex: Optional[BaseException] = future.exception()
+                if ex is None:
+                    return
+                errors.append(ex)
+        logger.error("Writing state failed in all %d directories", len(errors))
+        raise errors[0]
+
+    def _load_one(
+        self, store: StateStore, names: List[str]
+    ) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, float]]:
+        """Load state and saved times from one directory."""
+        return store.load_all(names), store.saved_times(names)
+
+    def load_all(self, names: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Load the newest valid copy of each machine's state."""
+        wanted: List[str] = list(names)
+        pool: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=len(self._mirrors), thread_name_prefix="machine-state-load"
+        )
+        futures: Dict["Future[Any]", StateStore] = {
+            pool.submit(self._load_one, m.store, wanted): m.store for m in self._mirrors
+        }
+        done, not_done = wait(futures, timeout=MIRROR_LOAD_TIMEOUT_SEC)
+        pool.shutdown(wait=False)
+        for future in not_done:
+            logger.error(
+                "Timed out loading state from %s; ignoring it",
+                futures[future].state_dir,
+            )
+        result: Dict[str, Dict[str, Any]] = {}
+        newest: Dict[str, float] = {}
+        # iterate in directory order, so ties go to the earliest directory
+        for future in [f for f in futures if f in done]:
+            try:
+                loaded, times = future.result()
+            except Exception:
+                logger.exception(
+                    "Error loading state from %s; ignoring it",
+                    futures[future].state_dir,
+                )
+                continue
+            for name, data in loaded.items():
+                saved: float = times.get(name, 0.0)
+                if name not in result or saved > newest[name]:
+                    result[name] = data
+                    newest[name] = saved
+        return result
+
+    def close(self) -> None:
+        """Close every directory's store."""
+        for mirror in self._mirrors:
+            mirror.close()
+
+
+class StateWriterHungError(Exception):
+    """Raised when the state writer process hangs even after a respawn."""
+
+
+class _RecordingLatency(SaveLatency):
+    """SaveLatency that also keeps each observation, to send to the parent."""
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        """Initialize _RecordingLatency."""
+        super().__init__(buckets)
+        #: Observations since the list was last cleared.
+        self.observations: List[Tuple[str, str, float]] = []
+
+    def observe(self, machine_name: str, phase: str, seconds: float) -> None:
+        """Keep the observation (histograms are kept by the parent)."""
+        self.observations.append((machine_name, phase, seconds))
+
+
+def _writer_main(conn: Connection, backend: str, state_dir: str) -> None:
+    """Entry point of a :class:`ProcessStateStore` writer process.
+
+    Serves ``(operation, argument)`` requests from ``conn`` against a
+    ``backend`` store in ``state_dir`` until the pipe is closed, replying to
+    each with ``(status, result, latency_observations)``.
+    """
+    store: StateStore = cast(StateStore, STATE_BACKENDS[backend](state_dir))
+    recorder: Optional[_RecordingLatency] = None
+    if store.latency is not None:
+        recorder = _RecordingLatency(store.latency.buckets)
+        store.latency = recorder
+    conn.send("ready")
+    while True:
+        try:
+            op, arg = conn.recv()
+        except EOFError:
+            break
+        result: Any = None
+        status: str = "ok"
+        try:
+            if op == "save":
+                store.save_batch(arg)
+            elif op == "load":
+                result = store.load_all(arg)
+            elif op == "times":
+                result = store.saved_times(arg)
+            elif op == "close":
+                store.close()
+        except Exception as ex:
+            status, result = "error", ex
+        observations: List[Tuple[str, str, float]] = []
+        if recorder is not None:
+            observations, recorder.observations = recorder.observations, []
+        conn.send((status, result, observations))
+        if op == "close":
+            break
+
+
+class ProcessStateStore(StateStore):
+    """Runs another backend in a child process that can be killed if it hangs.
+
+    A thread blocked in a kernel write cannot be cancelled, so with the
+    in-process backends a hung disk leaves worker threads stuck for as
+    long as the hang lasts. This store instead sends every request over a
+    pipe to a dedicated writer process (started with the ``spawn`` method)
+    and waits at most :attr:`timeout_sec` for its reply. If the writer
+    does not answer in time (or dies), it is sent SIGKILL and a new one is
+    spawned and given the same request. If that one hangs too,
+    :class:`StateWriterHungError` is raised; either way the calling thread
+    is released within about twice :attr:`timeout_sec`.
+
+    A process stuck in an uninterruptible disk wait only exits once the
+    write returns, but it no longer holds anything in the server process.
+
+    Save latency histograms (if enabled) are kept here, with the phases
+    timed in the writer process sent back with each reply.
+    """
+
+    def __init__(
+        self, backend: str, state_dir: str, timeout_sec: Optional[float] = None
+    ) -> None:
+        """Initialize ProcessStateStore; the writer is started on first use.
+
+        :param backend: Name of the backend, from :data:`STATE_BACKENDS`,
+            that the writer process runs.
+        :param state_dir: State directory for the backend.
+        :param timeout_sec: Seconds to wait for each reply before killing
+            the writer; defaults to the ``MACHINE_STATE_WRITER_TIMEOUT_SEC``
+            environment variable, or :data:`DEFAULT_WRITER_TIMEOUT_SEC`.
+        """
+        if timeout_sec is None:
+            timeout_sec = float(
+                os.environ.get(
+                    "MACHINE_STATE_WRITER_TIMEOUT_SEC", DEFAULT_WRITER_TIMEOUT_SEC
+                )
+            )
+        #: Backend run by the writer process.
+        self.backend: str = backend
+        self.state_dir = state_dir
+        #: Seconds to wait for a reply before killing the writer.
+        self.timeout_sec: float = timeout_sec
+        self.latency = save_latency_from_env()
+        #: Lifetime count of writers killed and respawned.
+        self.respawns: int = 0
+        #: Serializes requests; the writer handles one at a time.
+        self._lock: Lock = Lock()
+        self._process: Optional[BaseProcess] = None
+        self._conn: Optional[Connection] = None
+
+    @property
+    def pid(self) -> Optional[int]:
+        """Return the writer's process ID, if it is running."""
+        return None if self._process is None else self._process.pid
+
+    def _spawn(self) -> Connection:
+        """Start a writer process; return our end of its pipe.
+
+        :raises StateWriterHungError: if it is not ready within
+            :data:`WRITER_START_TIMEOUT_SEC`.
+        """
+        ctx = get_context("spawn")
+        parent, child = ctx.Pipe()
+        process = ctx.Process(
+            target=_writer_main,
+            args=(child, self.backend, self.state_dir),
+            name=f"machine-state-writer:{self.state_dir}",
+            daemon=True,
+        )
+        process.start()
+        child.close()
+        self._process = process
+        self._conn = parent
+        try:
+            ready: bool = parent.poll(WRITER_START_TIMEOUT_SEC) and parent.recv()
+        except (EOFError, OSError):
+            ready = False
+        if not ready:
+            self._kill()
+            raise StateWriterHungError(
+                f"State writer for {self.state_dir} did not start within "
+                f"{WRITER_START_TIMEOUT_SEC:.1f}s"
+            )
+        logger.info("Started state writer process %d", process.pid)
+        return parent
+
+    def _kill(self) -> None:
+        """SIGKILL the writer (if any) without waiting for it to exit."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self._process is not None:
+            self._process.kill()
+            self._process.join(timeout=0.1)
+            self._process = None
+
+    def _call(self, op: str, arg: Any, timeout: Optional[float] = None) -> Any:
+        """Send one request to the writer and return its result.
+
+        Kills and respawns the writer, resending the request, once if it
+        hangs or dies.
+
+        :raises StateWriterHungError: if the respawned writer hangs too.
+        """
+        if timeout is None:
+            timeout = self.timeout_sec
+        with self._lock:
+            for attempt in range(2):
+                conn: Connection = self._conn if self._conn else self._spawn()
+                try:
+                    conn.send((op, arg))
+                    if conn.poll(timeout):
+                        status, result, observations = conn.recv()
+                        break
+                    problem: str = f"did not respond within {timeout:.1f}s"
+                except (EOFError, OSError) as ex:
+                    problem = f"failed: {ex!r}"
+                logger.error(
+                    "State writer process %s %s; killing and respawning it",
+                    self.pid,
+                    problem,
+                )
+                self._kill()
+                self.respawns += 1
+            else:
+                raise StateWriterHungError(
+                    f"State writer for {self.state_dir} {problem} after respawn"
+                )
+        if self.latency is not None:
+            for name, phase, seconds in observations:
+                self.latency.observe(name, phase, seconds)
+        if status == "error":
+            raise result
+        return result
+
+    def save_batch(self, records: Dict[str, Dict[str, Any]]) -> None:
+        """Have the writer process persist ``records``."""
+        self._call("save", records)
+
+    def load_all(self, names: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Have the writer process load state."""
+        return cast(
+            Dict[str, Dict[str, Any]],
+            self._call("load", list(names), MIRROR_LOAD_TIMEOUT_SEC),
+        )
+
+    def saved_times(self, names: Iterable[str]) -> Dict[str, float]:
+        """Have the writer process report when each machine was saved."""
+        return cast(
+            Dict[str, float],
+            self._call("times", list(names), MIRROR_LOAD_TIMEOUT_SEC),
+        )
+
+    def close(self) -> None:
+        """Close the backend and stop the writer process."""
+        if self._conn is None:
+            return
+        try:
+            self._call("close", None)
+        except Exception:
+            logger.exception("Error closing state writer process")
+        with self._lock:
+            if self._process is not None:
+                self._process.join(timeout=self.timeout_sec)
+            self._kill()
+
+
+def make_state_store(
+    backend: Optional[str] = None, state_dir: Optional[str] = None
+) -> StateStore:
+    """Construct the configured state store.
+
+    :param backend: Backend name from :data:`STATE_BACKENDS`; defaults to
+        the ``MACHINE_STATE_BACKEND`` environment variable, or
+        :data:`DEFAULT_STATE_BACKEND`.
+    :param state_dir: State directory; defaults to the
+        ``MACHINE_STATE_DIR`` environment variable, or ``machine_state``.
+
+    If the ``MACHINE_STATE_MIRROR_DIRS`` environment variable lists further
+    directories (separated by :data:`os.pathsep`), returns a
+    :class:`MirroredStateStore` over ``state_dir`` and each of them. If
+    ``MACHINE_STATE_WRITER`` is ``process``, each directory's store is a
+    :class:`ProcessStateStore`, so every directory gets its own writer
+    process.
+    """
+    if backend is None:
+        backend = os.environ.get("MACHINE_STATE_BACKEND", DEFAULT_STATE_BACKEND)
+    if state_dir is None:
+        state_dir = os.environ.get("MACHINE_STATE_DIR", "machine_state")
+    try:
+        cls: type = STATE_BACKENDS[backend]
+    except KeyError as ex:
+        raise RuntimeError(
+            f"ERROR: Unknown MACHINE_STATE_BACKEND '{backend}'; must be one "
+            f"of: {', '.join(sorted(STATE_BACKENDS))}"
+        ) from ex
+    writer: str = _env_choice("MACHINE_STATE_WRITER", DEFAULT_WRITER, WRITERS)
+
+    def store_for(directory: str) -> StateStore:
+        if writer == "process":
+            return ProcessStateStore(backend, directory)
+        return cast(StateStore, cls(directory))
+
+    mirrors: List[str] = [
+        d
+        for d in os.environ.get("MACHINE_STATE_MIRROR_DIRS", "").split(os.pathsep)
+        if d
+    ]
+    if mirrors:
+        logger.info("Mirroring machine state to: %s", ", ".join(mirrors))
+        return MirroredStateStore([store_for(d) for d in [state_dir] + mirrors])
+    return store_for(state_dir)
+
+
+class StatePersister:
+    """Group-commit, write-behind persister for every machine's state.
+
+    When write-behind is enabled (a positive flush interval),
+    :meth:`MachineState.save_cache` no longer writes to disk itself; it
+    marks the state dirty here and returns as soon as the in-memory
+    transition is done. A single background task (:meth:`run`) then
+    commits *all* dirty machines in one batch, on one worker thread,
+    either every :attr:`flush_interval_sec` seconds or immediately when
+    a caller marks a state dirty with ``urgent=True`` (i.e. an
+    auth-relevant change such as relay, Oops, lock-out or RFID).
+
+    The durability lag (how long the oldest un-flushed change has been
+    waiting) is bounded by the flush interval plus the commit time, and
+    is exposed via :attr:`durability_lag_sec` and the
+    ``mac_state_durability_lag_seconds`` Prometheus gauge.
+
+    Because only the flusher ever writes, a hung disk blocks exactly one
+    worker thread no matter how many heartbeats arrive; dirty machines
+    simply accumulate until the disk comes back.
+
+    With *degraded mode* enabled (a positive
+    :attr:`degraded_retry_sec`), a write-through save that exceeds
+    :data:`~dm_mac.models.machine.STATE_SAVE_TIMEOUT_SEC` puts the
+    persister into :attr:`degraded` mode (see :meth:`enter_degraded`)
+    instead of failing the request: the in-memory state stays
+    authoritative, every subsequent save is queued here just as with
+    write-behind, and the background task retries the backlog every
+    :attr:`degraded_retry_sec` seconds. Once a flush drains the backlog
+    without error, the persister leaves degraded mode and saves are
+    written through again.
+    """
+
+    def __init__(
+        self,
+        flush_interval_sec: Optional[float] = None,
+        store: Optional[StateStore] = None,
+        degraded_retry_sec: Optional[float] = None,
+        executor: Optional[PersistenceExecutor] = None,
+        probe: Optional[DiskProbe] = None,
+    ) -> None:
+        """Initialize StatePersister.
+
+        :param flush_interval_sec: Write-behind cadence in seconds; ``0``
+            disables write-behind. Defaults to the
+            ``MACHINE_STATE_FLUSH_INTERVAL_SEC`` environment variable, or
+            :data:`DEFAULT_FLUSH_INTERVAL_SEC` if that is not set.
+        :param store: Storage backend; defaults to :func:`make_state_store`.
+        :param degraded_retry_sec: Degraded-mode retry interval in seconds;
+            ``0`` disables degraded mode. Defaults to the
+            ``MACHINE_STATE_DEGRADED_RETRY_SEC`` environment variable, or
+            :data:`DEFAULT_DEGRADED_RETRY_SEC` if that is not set.
+        :param executor: Thread pool for state I/O; defaults to a new
+            :class:`PersistenceExecutor`.
+        :param probe: Disk latency probe; defaults to a new
+            :class:`~dm_mac.models.disk_probe.DiskProbe` of the store's
+            (primary) state directory.
+        """
+        if flush_interval_sec is None:
+            flush_interval_sec = float(
+                os.environ.get(
+                    "MACHINE_STATE_FLUSH_INTERVAL_SEC", DEFAULT_FLUSH_INTERVAL_SEC
+                )
+            )
+        #: Seconds between background flushes; ``0`` disables write-behind.
+        self.flush_interval_sec: float = flush_interval_sec
+        if degraded_retry_sec is None:
+            degraded_retry_sec = float(
+                os.environ.get(
+                    "MACHINE_STATE_DEGRADED_RETRY_SEC", DEFAULT_DEGRADED_RETRY_SEC
+                )
+            )
+        #: Seconds between backlog drain attempts in degraded mode; ``0``
+        #: disables degraded mode.
+        self.degraded_retry_sec: float = degraded_retry_sec
+        #: Whether saves are currently being held in memory because the
+        #: state directory stalled.
+        self.degraded: bool = False
+        #: Wall-clock timestamp when the current degraded period began.
+        self.degraded_since: Optional[float] = None
+        #: Lifetime count of entries into degraded mode.
+        self.degraded_entries: int = 0
+        #: Where machine state is persisted.
+        self.store: StateStore = store if store is not None else make_state_store()
+        #: Runs all state I/O: batch commits and write-through saves.
+        self.executor: PersistenceExecutor = (
+            executor if executor is not None else PersistenceExecutor()
+        )
+        #: Measures state directory latency, if enabled.
+        self.probe: DiskProbe = (
+            probe if probe is not None else DiskProbe(self.store.state_dir)
+        )
+        #: The background probe task, while running.
+        self._probe_task: Optional["asyncio.Task[None]"] = None
+        #: Machines with un-flushed state changes, keyed by machine name.
+        self._dirty: Dict[str, "MachineState"] = {}
+        #: Monotonic timestamp of the oldest un-flushed change, or None.
+        self._dirty_since: Optional[float] = None
+        #: The batch currently being committed by :meth:`flush`.
+        self._flushing: Dict[str, "MachineState"] = {}
+        #: Set to wake the flusher early for an urgent change. Lazily
+        #: created so we don't bind to an event loop at construction time.
+        self._wakeup: Optional[asyncio.Event] = None
+        #: Serializes :meth:`flush` between the background task and
+        #: explicit callers such as :meth:`stop`.
+        self._flush_lock: Optional[asyncio.Lock] = None
+        #: The background flusher task, while running.
+        self._task: Optional["asyncio.Task[None]"] = None
+        #: Lifetime count of successful batch commits.
+        self.flush_count: int = 0
+        #: Lifetime count of machine states written by batch commits.
+        self.flushed_states: int = 0
+        #: Lifetime count of batch commits that raised an exception.
+        self.flush_errors: int = 0
+        #: Wall-clock timestamp of the last successful batch commit.
+        self.last_flush_time: Optional[float] = None
+        #: Duration in seconds of the last successful batch commit.
+        self.last_flush_duration_sec: float = 0.0
+        #: Seconds taken by the last :meth:`load` of the fleet's state.
+        self.load_duration_sec: float = 0.0
+        #: Number of machines whose state was found by the last :meth:`load`.
+        self.loaded_states: int = 0
+
+    @property
+    def write_behind(self) -> bool:
+        """Return whether write-behind persistence is enabled."""
+        return self.flush_interval_sec > 0
+
+    @property
+    def degraded_mode_enabled(self) -> bool:
+        """Return whether degraded mode is enabled."""
+        return self.degraded_retry_sec > 0
+
+    @property
+    def defers_saves(self) -> bool:
+        """Return whether saves are currently queued here, not written through.
+
+        True when write-behind is enabled or while in degraded mode.
+        """
+        return self.write_behind or self.degraded
+
+    def enter_degraded(self, state: "MachineState") -> None:
+        """Switch to degraded mode after a save of ``state`` timed out.
+
+        ``state`` is queued so that it is written once the disk recovers.
+        """
+        self._set_degraded(f"State save for {state.machine.name} timed out")
+        self.mark_dirty(state)
+
+    def _probe_stalled(self, elapsed: float) -> None:
+        """Enter degraded mode (if enabled) because the disk probe is stuck."""
+        if self.degraded_mode_enabled:
+            self._set_degraded(f"Disk probe has taken {elapsed:.1f}s")
+
+    def _set_degraded(self, reason: str) -> None:
+        """Enter degraded mode, if not already in it."""
+        if self.degraded:
+            return
+        self.degraded = True
+        self.degraded_since = time()
+        self.degraded_entries += 1
+        logger.error(
+            "%s; entering degraded mode. Machine state will be held in memory "
+            "and retried every %.1fs.",
+            reason,
+            self.degraded_retry_sec,
+        )
+
+    @property
+    def save_budget_sec(self) -> Optional[float]:
+        """Return the adaptive write-through save budget, if there is one.
+
+        Only adapted when the disk probe and degraded mode are both enabled,
+        since a save that exceeds it then degrades instead of failing.
+        Otherwise None, meaning the fixed
+        :data:`~dm_mac.models.machine.STATE_SAVE_TIMEOUT_SEC`.
+        """
+        if not (self.probe.enabled and self.degraded_mode_enabled):
+            return None
+        return self.probe.stall_after_sec
+
+    @property
+    def effective_flush_interval_sec(self) -> float:
+        """Return the write-behind interval, stretched while the disk is slow."""
+        if not self.probe.enabled:
+            return self.flush_interval_sec
+        return self.probe.flush_interval_sec(self.flush_interval_sec)
+
+    def _maybe_leave_degraded(self) -> None:
+        """Leave degraded mode once the backlog has been drained.
+
+        Stays degraded while the disk probe is stalled.
+        """
+        if not self.degraded or self._dirty or self.probe.stalled:
+            return
+        assert self.degraded_since is not None
+        logger.warning(
+            "State backlog drained; leaving degraded mode after %.1fs",
+            time() - self.degraded_since,
+        )
+        self.degraded = False
+        self.degraded_since = None
+
+    def attach(self, machines: Iterable["Machine"]) -> None:
+        """Point each machine's state at this persister."""
+        for mach in machines:
+            mach.state.persister = self
+
+    def load(self, machines: Iterable["Machine"]) -> None:
+        """Hydrate every machine's state from :attr:`store` in one pass.
+
+        The time taken is recorded in :attr:`load_duration_sec`.
+        """
+        start: float = monotonic()
+        by_name: Dict[str, "Machine"] = {m.name: m for m in machines}
+        records: Dict[str, Dict[str, Any]] = self.store.load_all(by_name.keys())
+        for name, data in records.items():
+            by_name[name].state._apply_state(data)
+        self.load_duration_sec = monotonic() - start
+        self.loaded_states = len(records)
+        logger.info(
+            "Loaded state for %d of %d machine(s) in %.3fs",
+            len(records),
+            len(by_name),
+            self.load_duration_sec,
+        )
+
+    @property
+    def dirty_count(self) -> int:
+        """Return the number of machines waiting to be flushed.
+
+        Includes machines in a batch that is being committed right now.
+        """
+        return len(self._dirty.keys() | self._flushing.keys())
+
+    @property
+    def durability_lag_sec(self) -> float:
+        """Return how long the oldest un-flushed change has been waiting."""
+        if self._dirty_since is None:
+            return 0.0
+        return monotonic() - self._dirty_since
+
+    def mark_dirty(self, state: "MachineState", urgent: bool = False) -> None:
+        """Queue ``state`` for the next batch commit.
+
+        :param state: The machine state that changed.
+        :param urgent: Wake the flusher now instead of waiting for the
+            next tick; used for auth-relevant changes.
+        """
+        self._dirty[state.machine.name] = state
+        if self._dirty_since is None:
+            self._dirty_since = monotonic()
+        if urgent:
+            self._get_wakeup().set()
+
+    @contextmanager
+    def collecting(self) -> Iterator[Dict[str, "MachineState"]]:
+        """Collect write-through saves made by this task, for one commit.
+
+        Within the block, :meth:`MachineState.save_cache
+        <dm_mac.models.machine.MachineState.save_cache>` calls made by the
+        current task (but not by concurrent requests) add the state to the
+        yielded dict instead of writing it. The caller then commits them
+        together, e.g. with :meth:`MachineState.save_batch
+        <dm_mac.models.machine.MachineState.save_batch>`.
+        Saves that this persister defers anyway are unaffected.
+        """
+        collected: Dict[str, "MachineState"] = {}
+        token = _COLLECTED.set((asyncio.current_task(), collected))
+        try:
+            yield collected
+        finally:
+            _COLLECTED.reset(token)
+
+    def collect(self, state: "MachineState") -> bool:
+        """Add ``state`` to the current :meth:`collecting` block, if any.
+
+        :returns: Whether it was collected (and so must not be saved now).
+        """
+        current = _COLLECTED.get()
+        if current is None or current[0] is not asyncio.current_task():
+            return False
+        current[1][state.machine.name] = state
+        return True
+
+    async def commit(self, states: List["MachineState"]) -> None:
+        """Write ``states`` now, in one batch on the executor.
+
+        :raises PersistenceQueueFullError: if the executor's queue is full.
+        """
+        await self.executor.run(self._commit, states)
+
+    def _get_wakeup(self) -> asyncio.Event:
+        """Return the wakeup event, creating it on first use."""
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    async def flush(self) -> int:
+        """Commit every dirty machine state in one batch.
+
+        The batch is written on a single worker thread. If the commit
+        fails or is cancelled, the batch is re-queued (without
+        clobbering newer marks) so the next flush retries it.
+
+        :returns: The number of machine states written.
+        """
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not self._dirty:
+                return 0
+            batch: Dict[str, "MachineState"] = self._dirty
+            since: Optional[float] = self._dirty_since
+            self._dirty = {}
+            self._dirty_since = None
+            self._flushing = batch
+            start: float = monotonic()
+            try:
+                await self.executor.run(self._commit, list(batch.values()))
+            except BaseException as ex:
+                self._requeue(batch, since)
+                if not isinstance(ex, Exception):
+                    raise
+                self.flush_errors += 1
+                logger.error(
+                    "Error flushing state for %d machine(s): %s",
+                    len(batch),
+                    ex,
+                    exc_info=True,
+                )
+                return 0
+            finally:
+                self._flushing = {}
+            self.last_flush_duration_sec = monotonic() - start
+            self.last_flush_time = time()
+            self.flush_count += 1
+            self.flushed_states += len(batch)
+            logger.debug(
+                "Flushed state for %d machine(s) in %.3fs",
+                len(batch),
+                self.last_flush_duration_sec,
+            )
+            return len(batch)
+
+    def _requeue(
+        self, batch: Dict[str, "MachineState"], since: Optional[float]
+    ) -> None:
+        """Put a failed batch back in the dirty set."""
+        for name, state in batch.items():
+            self._dirty.setdefault(name, state)
+        if since is not None and (
+            self._dirty_since is None or since < self._dirty_since
+        ):
+            self._dirty_since = since
+
+    def _commit(self, batch: List["MachineState"]) -> None:
+        """Write a batch of machine states to the store (synchronous).
+
+        Each state is snapshotted under its own lock, then the whole batch
+        goes to :meth:`StateStore.save_batch` in one call (one transaction
+        for the SQLite backend).
+        """
+        records: Dict[str, Dict[str, Any]] = {}
+        for state in batch:
+            start: float = monotonic()
+            with state._lock:
+                self.store.record_latency(
+                    (state.machine.name,), "lock_wait", monotonic() - start
+                )
+                records[state.machine.name] = state._state_dict()
+        self.store.save_batch(records)
+
+    async def run(self) -> None:
+        """Background loop: flush on each tick or urgent wakeup.
+
+        Ticks every :attr:`flush_interval_sec` with write-behind enabled,
+        otherwise every :attr:`degraded_retry_sec` (a flush with nothing
+        dirty is a no-op).
+        """
+        wakeup: asyncio.Event = self._get_wakeup()
+        while True:
+            interval: float = (
+                self.effective_flush_interval_sec
+                if self.write_behind
+                else self.degraded_retry_sec
+            )
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+            errors: int = self.flush_errors
+            await self.flush()
+            if self.flush_errors == errors:
+                self._maybe_leave_degraded()
+
+    def start(self) -> None:
+        """Start the disk probe and the background flusher, if enabled.
+
+        The flusher runs if write-behind or degraded mode is on.
+        """
+        if self.probe.enabled and self._probe_task is None:
+            logger.info(
+                "Starting state directory probe with %.1fs interval",
+                self.probe.interval_sec,
+            )
+            self._probe_task = asyncio.create_task(
+                self.probe.run(on_stall=self._probe_stalled)
+            )
+        if self._task is not None:
+            return
+        if self.write_behind:
+            logger.info(
+                "Starting write-behind state flusher with %.1fs interval",
+                self.flush_interval_sec,
+            )
+        elif self.degraded_mode_enabled:
+            logger.info(
+                "Starting state flusher for degraded mode with %.1fs retry " "interval",
+                self.degraded_retry_sec,
+            )
+        else:
+            return
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """Stop background tasks, commit anything dirty, stop the executor.
+
+        The final commit and closing the store are each bounded by
+        :data:`STOP_FLUSH_TIMEOUT_SEC`, so a hung state directory cannot
+        hang shutdown. If the commit timed out the store is not closed at
+        all, as closing it would wait for the hung write.
+        """
+        for task in (self._task, self._probe_task):
+            if task is None:
+                continue
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._probe_task = None
+        try:
+            await asyncio.wait_for(self.flush(), timeout=STOP_FLUSH_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            logger.error(
+                "Timed out after %.1fs saving state on shutdown; state of "
+                "%d machine(s) was not saved: %s",
+                STOP_FLUSH_TIMEOUT_SEC,
+                self.dirty_count,
+                ", ".join(sorted(self._dirty)),
+            )
+            self.probe.shutdown()
+            self.executor.shutdown()
+            return
+        self.probe.shutdown()
+        self.executor.shutdown()
+        # A write still running (e.g. a mirror's slow copy) holds locks that
+        # close() waits for; close on a daemon thread so it can't hang us.
+        closer: Thread = Thread(
+            target=self.store.close, name="machine-state-close", daemon=True
+        )
+        closer.start()
+        await asyncio.to_thread(closer.join, STOP_FLUSH_TIMEOUT_SEC)
+        if closer.is_alive():
+            logger.error(
+                "Timed out after %.1fs closing state store on shutdown",
+                STOP_FLUSH_TIMEOUT_SEC,
+            )
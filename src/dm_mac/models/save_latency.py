@@ -0,0 +1,123 @@
+"""Histograms of how long each phase of a machine state save takes.
+
+A state save that eventually exceeds
+:data:`~dm_mac.models.machine.STATE_SAVE_TIMEOUT_SEC` usually gets there
+gradually, as the disk or a contended lock slows down. To make that
+visible well before requests start failing, each save is broken into the
+phases in :data:`SAVE_PHASES`, and the time spent in each is recorded in
+a per-machine :class:`LatencyHistogram`. The
+:class:`~dm_mac.views.prometheus.PromCustomCollector` exports them as the
+``mac_state_save_phase_seconds`` histogram.
+
+Histograms are enabled by setting the ``MACHINE_STATE_LATENCY_BUCKETS``
+environment variable to a comma-separated list of bucket upper bounds in
+seconds; see :func:`save_latency_from_env`.
+"""
+
+import os
+from threading import Lock
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+#: Phases of a state save, in the order they happen.
+#:
+#: * ``lock_wait`` - waiting for the machine's in-process state lock;
+#: * ``serialize`` - encoding the state dict;
+#: * ``filelock_wait`` - waiting for the storage backend's lock (the state
+#:   file's FileLock, the SQLite write transaction, or the journal lock);
+#: * ``write`` - writing (and, where the backend does so, syncing) the data.
+SAVE_PHASES: Tuple[str, ...] = ("lock_wait", "serialize", "filelock_wait", "write")
+
+
+class LatencyHistogram:
+    """Cumulative, thread-safe histogram of durations in seconds."""
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        """Initialize LatencyHistogram.
+
+        :param buckets: Sorted bucket upper bounds in seconds, not including
+            the implicit ``+Inf`` bucket.
+        """
+        #: Bucket upper bounds in seconds.
+        self.buckets: Tuple[float, ...] = buckets
+        #: Number of observations in each bucket (non-cumulative), with the
+        #: ``+Inf`` bucket last.
+        self.counts: List[int] = [0] * (len(buckets) + 1)
+        #: Total of all observed durations.
+        self.sum: float = 0.0
+        self._lock: Lock = Lock()
+
+    @property
+    def count(self) -> int:
+        """Return the total number of observations."""
+        return sum(self.counts)
+
+    def observe(self, seconds: float) -> None:
+        """Record one duration."""
+        idx: int = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                idx = i
+                break
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += seconds
+
+    def cumulative(self) -> Tuple[List[int], float]:
+        """Return cumulative bucket counts (``+Inf`` last) and the sum."""
+        with self._lock:
+            counts: List[int] = list(self.counts)
+            total: float = self.sum
+        for i in range(1, len(counts)):
+            counts[i] += counts[i - 1]
+        return counts, total
+
+
+class SaveLatency:
+    """Per-machine, per-phase :class:`LatencyHistogram` registry."""
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        """Initialize SaveLatency.
+
+        :param buckets: Bucket upper bounds in seconds for every histogram.
+        """
+        #: Bucket upper bounds in seconds, sorted ascending.
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        #: Histograms keyed by ``(machine_name, phase)``.
+        self.histograms: Dict[Tuple[str, str], LatencyHistogram] = {}
+        self._lock: Lock = Lock()
+
+    def histogram(self, machine_name: str, phase: str) -> LatencyHistogram:
+        """Return the histogram for one machine and phase, creating it."""
+        key: Tuple[str, str] = (machine_name, phase)
+        hist: Optional[LatencyHistogram] = self.histograms.get(key)
+        if hist is None:
+            with self._lock:
+                hist = self.histograms.setdefault(key, LatencyHistogram(self.buckets))
+        return hist
+
+    def observe(self, machine_name: str, phase: str, seconds: float) -> None:
+        """Record ``seconds`` spent in ``phase`` saving ``machine_name``."""
+        self.histogram(machine_name, phase).observe(seconds)
+
+
+def save_latency_from_env() -> Optional[SaveLatency]:
+    """Return a SaveLatency per ``MACHINE_STATE_LATENCY_BUCKETS``, if set.
+
+    :raises RuntimeError: if the variable is not a list of numbers.
+    """
+    raw: str = os.environ.get("MACHINE_STATE_LATENCY_BUCKETS", "").strip()
+    if not raw:
+        return None
+    try:
+        buckets: Tuple[float, ...] = tuple(
+            float(b) for b in raw.split(",") if b.strip()
+        )
+    except ValueError as ex:
+        raise RuntimeError(
+            f"ERROR: Invalid MACHINE_STATE_LATENCY_BUCKETS '{raw}'; must be a "
+            "comma-separated list of seconds"
+        ) from ex
+    return SaveLatency(buckets)
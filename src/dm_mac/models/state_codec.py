@@ -0,0 +1,298 @@
+"""Versioned binary encoding of persisted machine state.
+
+Machine state has historically been persisted as a pickled dict, which is
+relatively slow to load, larger than necessary, and applied to
+:class:`~dm_mac.models.machine.MachineState` by setting whatever keys
+happen to be present. This module defines a fixed-schema binary layout
+instead:
+
+* a 4-byte magic (:data:`MAGIC`) and a 1-byte schema version;
+* a flags byte holding the boolean fields;
+* a 16-bit mask of which optional fields are present;
+* every float field as a little-endian double, then the lifetime save
+  timeout count as a 32-bit unsigned int;
+* the 16-bit length of each string field, then the UTF-8 bytes of each.
+
+:func:`decode_state` accepts any schema version listed in
+:data:`DECODERS`, as well as legacy pickles (treated as version 0), and
+runs the explicit :data:`MIGRATIONS` needed to bring the result up to
+:data:`CURRENT_VERSION`. The result only has keys in :data:`FIELDS`;
+binary states always have all of them.
+
+:func:`encode_state` writes either the binary layout or, for
+compatibility, a pickle; see :data:`STATE_CODECS`.
+:func:`encode_state_into` writes the binary layout directly into an
+existing buffer.
+"""
+
+import pickle
+import struct
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+#: Leading bytes of a binary-encoded state.
+MAGIC: bytes = b"MACS"
+
+#: Schema version written by :func:`encode_state`.
+CURRENT_VERSION: int = 1
+
+#: Available codecs, by ``MACHINE_STATE_CODEC`` name.
+STATE_CODECS: Tuple[str, ...] = ("pickle", "binary")
+
+#: Default codec; see :data:`STATE_CODECS`.
+DEFAULT_STATE_CODEC: str = "pickle"
+
+_BOOL_FIELDS: Tuple[str, ...] = (
+    "relay_desired_state",
+    "is_oopsed",
+    "is_locked_out",
+    "is_override_login",
+    "second_relay_desired_state",
+)
+
+_FLOAT_FIELDS: Tuple[str, ...] = (
+    "last_checkin",
+    "last_update",
+    "rfid_present_since",
+    "current_amps",
+    "uptime",
+    "status_led_r",
+    "status_led_g",
+    "status_led_b",
+    "status_led_brightness",
+    "wifi_signal_db",
+    "wifi_signal_percent",
+    "internal_temperature_c",
+)
+
+_STR_FIELDS: Tuple[str, ...] = (
+    "machine_name",
+    "rfid_value",
+    "display_text",
+    "current_user_account_id",
+    "second_relay_authorization",
+)
+
+#: Fields that may be None; their presence is recorded in the mask.
+_OPTIONAL_FIELDS: Tuple[str, ...] = (
+    "last_checkin",
+    "last_update",
+    "rfid_present_since",
+    "wifi_signal_db",
+    "wifi_signal_percent",
+    "internal_temperature_c",
+    "rfid_value",
+    "current_user_account_id",
+    "second_relay_authorization",
+)
+
+#: Every key of a decoded state dict, with its default value.
+FIELDS: Dict[str, Any] = {
+    "machine_name": "",
+    "last_checkin": None,
+    "last_update": None,
+    "rfid_value": None,
+    "rfid_present_since": None,
+    "relay_desired_state": False,
+    "is_oopsed": False,
+    "is_locked_out": False,
+    "is_override_login": False,
+    "current_amps": 0.0,
+    "display_text": "",
+    "uptime": 0.0,
+    "status_led_rgb": (0.0, 0.0, 0.0),
+    "status_led_brightness": 0.0,
+    "wifi_signal_db": None,
+    "wifi_signal_percent": None,
+    "internal_temperature_c": None,
+    "current_user_account_id": None,
+    "second_relay_desired_state": False,
+    "second_relay_authorization": None,
+    "state_save_timeouts": 0,
+}
+
+_HEADER: struct.Struct = struct.Struct("<4sB")
+#: Flags, presence mask, floats, save timeout count, then string lengths.
+_V1_FIXED: struct.Struct = struct.Struct(
+    f"<BH{len(_FLOAT_FIELDS)}dI{len(_STR_FIELDS)}H"
+)
+_BOOL_BITS: Tuple[Tuple[int, str], ...] = tuple(
+    (1 << i, k) for i, k in enumerate(_BOOL_FIELDS)
+)
+_OPTIONAL_BITS: Tuple[Tuple[int, str], ...] = tuple(
+    (1 << i, k) for i, k in enumerate(_OPTIONAL_FIELDS)
+)
+#: Float fields other than the status LED color channels.
+_PLAIN_FLOATS: Tuple[str, ...] = tuple(
+    k for k in _FLOAT_FIELDS if not k.startswith("status_led_") or k.endswith("ness")
+)
+_LED_INDEX: int = _FLOAT_FIELDS.index("status_led_r")
+
+
+class StateDecodeError(Exception):
+    """Raised when persisted state cannot be decoded."""
+
+
+def _v1_parts(data: Dict[str, Any]) -> Tuple[List[Any], List[bytes]]:
+    """Return the :data:`_V1_FIXED` values and string bytes of a state dict.
+
+    Missing keys are encoded with their :data:`FIELDS` default.
+    """
+    get = data.get
+    flags: int = 0
+    for bit, k in _BOOL_BITS:
+        if get(k):
+            flags |= bit
+    mask: int = 0
+    for bit, k in _OPTIONAL_BITS:
+        if get(k) is not None:
+            mask |= bit
+    floats: List[float] = [get(k) or 0.0 for k in _PLAIN_FLOATS]
+    floats[_LED_INDEX:_LED_INDEX] = get("status_led_rgb") or (0.0, 0.0, 0.0)
+    strs: List[bytes] = [(get(k) or "").encode("utf-8") for k in _STR_FIELDS]
+    fixed: List[Any] = [flags, mask, *floats, get("state_save_timeouts", 0)]
+    fixed.extend(map(len, strs))
+    return fixed, strs
+
+
+def _encode_v1(data: Dict[str, Any]) -> bytes:
+    """Encode a state dict in the version 1 layout."""
+    fixed, strs = _v1_parts(data)
+    return b"".join((_HEADER.pack(MAGIC, 1), _V1_FIXED.pack(*fixed), *strs))
+
+
+def _decode_v1(buf: bytes, offset: int) -> Dict[str, Any]:
+    """Decode the version 1 layout starting at ``offset``."""
+    fixed: Tuple[Any, ...] = _V1_FIXED.unpack_from(buf, offset)
+    offset += _V1_FIXED.size
+    nfloat: int = len(_FLOAT_FIELDS)
+    flags: int = fixed[0]
+    mask: int = fixed[1]
+    floats: Tuple[float, ...] = fixed[2 : 2 + nfloat]
+    result: Dict[str, Any] = dict(
+        zip(_PLAIN_FLOATS, floats[:_LED_INDEX] + floats[_LED_INDEX + 3 :])
+    )
+    result["status_led_rgb"] = floats[_LED_INDEX : _LED_INDEX + 3]
+    result["state_save_timeouts"] = fixed[2 + nfloat]
+    for bit, k in _BOOL_BITS:
+        result[k] = bool(flags & bit)
+    for k, length in zip(_STR_FIELDS, fixed[3 + nfloat :]):
+        end: int = offset + length
+        if end > len(buf):
+            raise StateDecodeError("State is truncated")
+        result[k] = buf[offset:end].decode("utf-8")
+        offset = end
+    if offset != len(buf):
+        raise StateDecodeError(f"{len(buf) - offset} trailing bytes in state")
+    for bit, k in _OPTIONAL_BITS:
+        if not mask & bit:
+            result[k] = None
+    return result
+
+
+def _migrate_0_to_1(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Migrate a legacy pickled state dict to the version 1 schema.
+
+    Older versions pickled the whole current User; only its account ID is
+    kept. Keys that are not part of the schema are dropped; missing keys
+    are left missing, so the loading MachineState keeps its own defaults.
+    """
+    data = dict(data)
+    if "current_user" in data:
+        user: Optional[Any] = data.pop("current_user")
+        data.setdefault(
+            "current_user_account_id", None if user is None else user.account_id
+        )
+    result: Dict[str, Any] = {k: v for k, v in data.items() if k in FIELDS}
+    if "status_led_rgb" in result:
+        result["status_led_rgb"] = tuple(result["status_led_rgb"])
+    return result
+
+
+#: Decoder for each binary schema version, taking the buffer and the offset
+#: just past the header.
+DECODERS: Dict[int, Callable[[bytes, int], Dict[str, Any]]] = {
+    1: _decode_v1,
+}
+
+#: ``MIGRATIONS[n]`` upgrades a decoded version ``n`` state to version
+#: ``n + 1``. Version 0 is a legacy pickled dict.
+MIGRATIONS: Dict[int, Callable[[Dict[str, Any]], Dict[str, Any]]] = {
+    0: _migrate_0_to_1,
+}
+
+
+def encode_state(data: Dict[str, Any], codec: str = "binary") -> bytes:
+    """Encode a machine state dict.
+
+    :param data: State dict, as built by
+        :meth:`~dm_mac.models.machine.MachineState._state_dict`.
+    :param codec: One of :data:`STATE_CODECS`.
+    """
+    if codec == "binary":
+        return _encode_v1(data)
+    if codec == "pickle":
+        return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+    raise ValueError(f"Unknown state codec: {codec}")
+
+
+def encode_state_into(data: Dict[str, Any], buf: Any, offset: int, limit: int) -> int:
+    """Write a state dict in the binary layout straight into a buffer.
+
+    This avoids building an intermediate ``bytes`` for callers that keep
+    state in a writable buffer, such as a memory-mapped file. Nothing is
+    written if the state does not fit.
+
+    :param data: State dict, as for :func:`encode_state`.
+    :param buf: Writable buffer, e.g. a :class:`mmap.mmap`.
+    :param offset: Offset in ``buf`` to write at.
+    :param limit: Maximum number of bytes to write.
+    :returns: Number of bytes written.
+    :raises ValueError: if the encoded state is longer than ``limit``.
+    """
+    fixed, strs = _v1_parts(data)
+    pos: int = offset + _HEADER.size + _V1_FIXED.size
+    length: int = pos - offset + sum(fixed[-len(strs) :])
+    if length > limit:
+        raise ValueError(f"Encoded state is {length} bytes; at most {limit} fit")
+    _HEADER.pack_into(buf, offset, MAGIC, 1)
+    _V1_FIXED.pack_into(buf, offset + _HEADER.size, *fixed)
+    for value in strs:
+        buf[pos : pos + len(value)] = value
+        pos += len(value)
+    return length
+
+
+def decode_state(buf: bytes) -> Dict[str, Any]:
+    """Decode state written by :func:`encode_state` with any codec.
+
+    Binary states are decoded with the decoder for their version, and
+    legacy pickles as version 0; either is then migrated up to
+    :data:`CURRENT_VERSION`.
+
+    :raises StateDecodeError: if ``buf`` is not a valid encoded state.
+    """
+    version: int
+    data: Dict[str, Any]
+    if buf[:4] == MAGIC:
+        _, version = _HEADER.unpack_from(buf, 0)
+        if version not in DECODERS:
+            raise StateDecodeError(f"Unsupported state version {version}")
+        try:
+            data = DECODERS[version](buf, _HEADER.size)
+        except (struct.error, UnicodeDecodeError) as ex:
+            raise StateDecodeError(f"Corrupt version {version} state: {ex}") from ex
+    else:
+        version = 0
+        try:
+            data = pickle.loads(buf)
+        except Exception as ex:
+            raise StateDecodeError(f"Unreadable legacy state: {ex}") from ex
+    while version < CURRENT_VERSION:
+        data = MIGRATIONS[version](data)
+        version += 1
+    return data
@@ -97,6 +97,31 @@ class User:
         self.authorizations: List[str] = authorizations
         self.oops_override: bool = oops_override
 
+    @classmethod
+    def unresolved(cls, account_id: str) -> "User":
+        """Return a stand-in User known only by its account ID.
+
+        Machine state persists only the ``account_id`` of the current user;
+        this is what a loaded state holds until it is resolved against a
+        :class:`UsersConfig` (see
+        :meth:`~dm_mac.models.machine.MachineState.resolve_current_user`).
+        Its names are ``account <account_id>``, so that log lines and Slack
+        messages about a user who is no longer in the users config still
+        say who it was.
+        """
+        name: str = f"account {account_id}"
+        return cls(
+            fob_codes=[],
+            account_id=account_id,
+            full_name=name,
+            first_name="",
+            last_name="",
+            preferred_name=name,
+            email="",
+            expiration_ymd="",
+            authorizations=[],
+        )
+
     def __eq__(self, other: Any) -> bool:
         """Check equality between Users."""
         if not isinstance(other, User):
@@ -131,12 +156,15 @@ class UsersConfig:
         """Initialize UsersConfig."""
         logger.debug("Initializing UsersConfig")
         self.users_by_fob: Dict[str, User] = {}
+        #: Users keyed by account ID.
+        self.users_by_account_id: Dict[str, User] = {}
         self.users: List[User] = []
         udict: Dict[str, Any]
         fob: str
         for udict in self._load_and_validate_config():
             user: User = User(**udict)
             self.users.append(user)
+            self.users_by_account_id[user.account_id] = user
             for fob in user.fob_codes:
                 self.users_by_fob[fob] = user
         self.load_time: float = time()
@@ -189,6 +217,7 @@ class UsersConfig:
                 for fc in user.fob_codes:
                     self.users_by_fob.pop(fc)
                 self.users.remove(user)
+                self.users_by_account_id.pop(acctid)
                 removed += 1
                 continue
             nuser = nusers[acctid]
@@ -229,6 +258,7 @@ class UsersConfig:
             if acctid not in users:
                 logger.warning("Adding new user: %s", nuser)
                 self.users.append(nuser)
+                self.users_by_account_id[acctid] = nuser
                 for fob in nuser.fob_codes:
                     self.users_by_fob[fob] = nuser
                 added += 1
@@ -48,6 +48,7 @@ async def reload_users() -> Tuple[Response, int]:
     try:
         users: UsersConfig = current_app.config["USERS"]  # noqa
         removed, updated, added = users.reload()
+        current_app.config["MACHINES"].resolve_users(users)
         return jsonify({"removed": removed, "updated": updated, "added": added}), 200
     except Exception as ex:
         logger.error("Error reloading users config: %s", ex, exc_info=True)
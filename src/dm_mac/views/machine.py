@@ -4,10 +4,14 @@ from logging import Logger
 from logging import getLogger
 from typing import Any
 from typing import Dict
+from typing import List
 from typing import Optional
 from typing import Tuple
-from typing import cast
+from typing import Type
+from typing import TypeVar
 
+from pydantic import BaseModel
+from pydantic import ValidationError
 from quart import Blueprint
 from quart import Response
 from quart import current_app
@@ -17,18 +21,35 @@ from quart_schema import document_request
 from quart_schema import document_response
 from quart_schema import tag
 
+from dm_mac import cbor
+from dm_mac.cbor import CBOR_MIMETYPE
+from dm_mac.cbor import CBORDecodeError
 from dm_mac.models.api_schemas import ErrorResponse
+from dm_mac.models.api_schemas import MachineBatchUpdateRequest
+from dm_mac.models.api_schemas import MachineBatchUpdateResponse
 from dm_mac.models.api_schemas import MachineUpdateRequest
 from dm_mac.models.api_schemas import MachineUpdateResponse
 from dm_mac.models.api_schemas import StateSaveTimeoutResponse
 from dm_mac.models.api_schemas import SuccessResponse
+from dm_mac.models.api_schemas import validation_error_message
+from dm_mac.models.heartbeat_log import HeartbeatLog
 from dm_mac.models.machine import Machine
 from dm_mac.models.machine import MachinesConfig
+from dm_mac.models.machine import MachineState
 from dm_mac.models.machine import StateSaveTimeoutError
+from dm_mac.models.persistence import StatePersister
 from dm_mac.models.users import UsersConfig
 
 logger: Logger = getLogger(__name__)
 
+#: MIME type of JSON request and response bodies.
+JSON_MIMETYPE: str = "application/json"
+
+#: Default ``LONG_POLL_MAX_SEC``: longest a ``/machine/poll`` request waits.
+DEFAULT_LONG_POLL_MAX_SEC: float = 60.0
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
 machineapi: Blueprint = Blueprint("machine", __name__, url_prefix="/machine")
 
 
@@ -36,6 +57,7 @@ machineapi: Blueprint = Blueprint("machine", __name__, url_prefix="/machine")
 @tag(["Machine"])
 @document_request(MachineUpdateRequest)
 @document_response(MachineUpdateResponse, 200)
+@document_response(ErrorResponse, 400)
 @document_response(ErrorResponse, 404)
 @document_response(ErrorResponse, 500)
 @document_response(ErrorResponse, 503)
@@ -57,6 +79,21 @@ async def update() -> Tuple[Response, int]:
         °C.
     - ``amps`` (float; optional) - amperage value from the current clamp
         ammeter, if present, or 0.0 otherwise.
+    - ``second_relay_state`` (boolean; optional) - actual state of the second
+        relay, for observability only.
+    - ``state_version`` (int; optional) - ``state_version`` of the last
+        response the MCU received, or 0 if none. If present, the response
+        includes the current ``state_version``, and is only
+        ``{"state_version": N, "unchanged": true}`` if that is unchanged.
+
+    The same fields may instead be sent as CBOR, with a ``Content-Type`` of
+    ``application/cbor``. The response is in the same format as the request,
+    unless the ``Accept`` header asks for the other one.
+
+    The body is validated against
+    :class:`~dm_mac.models.api_schemas.MachineUpdateRequest` before anything
+    else is done; a malformed body, a missing field or an unknown key gets
+    a 400 response.
     """
     # EXAMPLE Payloads for ESP without amperage sensor
     #
@@ -103,29 +140,202 @@ async def update() -> Tuple[Response, int]:
     #       'wifi_signal_percent': 92,
     #       'internal_temperature_c': 53.88888931
     #   }
-    data: Dict[str, Any] = cast(Dict[str, Any], await request.json)  # noqa
-    logger.info("UPDATE request: %s", data)
+    is_cbor: bool = request.mimetype == CBOR_MIMETYPE
+    mimetype: str = _response_mimetype(is_cbor)
+    try:
+        req: MachineUpdateRequest = await _parse_body(MachineUpdateRequest, is_cbor)
+    except (ValidationError, CBORDecodeError) as ex:
+        return _invalid(ex, mimetype)
+    data: Dict[str, Any] = _update_fields(req)
     machine_name: str = data.pop("machine_name")
+    known_version: Optional[int] = data.pop("state_version", None)
     mconf: MachinesConfig = current_app.config["MACHINES"]  # noqa
     machine: Optional[Machine] = mconf.machines_by_name.get(machine_name)
     if not machine:
-        return jsonify({"error": f"No such machine: {machine_name}"}), 404
+        return _reply({"error": f"No such machine: {machine_name}"}, 404, mimetype)
     users: UsersConfig = current_app.config["USERS"]  # noqa
-    if data.get("rfid_value") == "":
-        data["rfid_value"] = None
     try:
-        resp = await machine.update(users, **data)
-        return jsonify(resp), 200
+        await machine.update(users, **data)
+        heartbeats: Optional[HeartbeatLog] = current_app.config.get("HEARTBEAT_LOG")
+        if heartbeats is not None:
+            heartbeats.record(machine_name, machine.state.last_update_changes, data)
+        body: bytes = machine.state.response_body(mimetype, known_version)
+        return current_app.response_class(body, mimetype=mimetype), 200
     except StateSaveTimeoutError as ex:
         logger.error(
             "State save timeout for machine %s; returning 503 to firmware: %s",
             machine_name,
             ex,
         )
-        return jsonify({"error": "state save timeout"}), 503
+        return _reply({"error": "state save timeout"}, 503, mimetype)
     except Exception as ex:
         logger.error("Error in machine update %s: %s", data, ex, exc_info=True)
-        return jsonify({"error": str(ex)}), 500
+        return _reply({"error": str(ex)}, 500, mimetype)
+
+
+@machineapi.route("/batch_update", methods=["POST"])
+@tag(["Machine"])
+@document_request(MachineBatchUpdateRequest)
+@document_response(MachineBatchUpdateResponse, 200)
+@document_response(ErrorResponse, 400)
+@document_response(ErrorResponse, 503)
+async def batch_update() -> Tuple[Response, int]:
+    """API method to update the state of several machines at once.
+
+    For a local gateway relaying heartbeats from several MCUs. Accepts an
+    object with an ``updates`` list, each element of which is exactly what
+    would be POSTed to ``/api/machine/update`` (in JSON or CBOR, as for that
+    endpoint). The updates are applied in order, then the resulting state
+    of every machine is saved in a single batch commit.
+
+    The response has a ``results`` list with, for each update in turn, the
+    ``machine_name``, the ``status`` the update would have had on its own,
+    and either the ``response`` for the MCU or an ``error``. If saving the
+    batch times out, the whole request fails with a 503, as for a single
+    update.
+    """
+    is_cbor: bool = request.mimetype == CBOR_MIMETYPE
+    mimetype: str = _response_mimetype(is_cbor)
+    try:
+        req: MachineBatchUpdateRequest = await _parse_body(
+            MachineBatchUpdateRequest, is_cbor
+        )
+    except (ValidationError, CBORDecodeError) as ex:
+        return _invalid(ex, mimetype)
+    mconf: MachinesConfig = current_app.config["MACHINES"]  # noqa
+    users: UsersConfig = current_app.config["USERS"]  # noqa
+    heartbeats: Optional[HeartbeatLog] = current_app.config.get("HEARTBEAT_LOG")
+    persister: StatePersister = current_app.config["STATE_PERSISTER"]
+    results: List[Dict[str, Any]] = []
+    updated: List[Tuple[Dict[str, Any], Machine, Optional[int]]] = []
+    with persister.collecting() as collected:
+        for item in req.updates:
+            data: Dict[str, Any] = _update_fields(item)
+            machine_name: str = data.pop("machine_name")
+            known_version: Optional[int] = data.pop("state_version", None)
+            result: Dict[str, Any] = {"machine_name": machine_name}
+            results.append(result)
+            machine: Optional[Machine] = mconf.machines_by_name.get(machine_name)
+            if not machine:
+                result.update(status=404, error=f"No such machine: {machine_name}")
+                continue
+            try:
+                await machine.update(users, **data)
+            except Exception as ex:
+                logger.error(
+                    "Error in batch machine update %s: %s", data, ex, exc_info=True
+                )
+                result.update(status=500, error=str(ex))
+                continue
+            if heartbeats is not None:
+                heartbeats.record(machine_name, machine.state.last_update_changes, data)
+            updated.append((result, machine, known_version))
+    try:
+        await MachineState.save_batch(list(collected.values()))
+    except StateSaveTimeoutError as ex:
+        logger.error("State save timeout for batch update; returning 503: %s", ex)
+        return _reply({"error": "state save timeout"}, 503, mimetype)
+    for result, machine, known_version in updated:
+        result.update(status=200, response=machine.state.response_object(known_version))
+    return _reply({"results": results}, 200, mimetype)
+
+
+@machineapi.route("/poll/<machine_name>", methods=["GET"])
+@tag(["Machine"])
+@document_response(MachineUpdateResponse, 200)
+@document_response(ErrorResponse, 400)
+@document_response(ErrorResponse, 404)
+async def poll(machine_name: str) -> Tuple[Response, int]:
+    """Long-poll for a change to the response for a machine's MCU.
+
+    Takes query parameters:
+
+    - ``state_version`` (int) - ``state_version`` of the last response the
+        MCU received.
+    - ``timeout`` (float; optional) - longest time to wait, in seconds. Capped
+        at, and defaults to, the ``LONG_POLL_MAX_SEC`` setting.
+
+    Waits until the machine's ``state_version`` differs from the one given
+    (e.g. because an admin Oopsed or locked out the machine through Slack or
+    the API) and then returns the same response ``/api/machine/update`` would,
+    or, if the timeout passes first, ``{"state_version": N, "unchanged":
+    true}``. Polling does not count as a check-in; MCUs must still send
+    heartbeats. The response is CBOR if the ``Accept`` header prefers it.
+    """
+    mimetype: str = _response_mimetype(False)
+    max_wait: float = current_app.config.get(
+        "LONG_POLL_MAX_SEC", DEFAULT_LONG_POLL_MAX_SEC
+    )
+    try:
+        known_version: int = int(request.args["state_version"])
+        timeout: float = float(request.args.get("timeout", max_wait))
+    except (KeyError, ValueError) as ex:
+        return _reply({"error": f"Invalid poll: {ex}"}, 400, mimetype)
+    mconf: MachinesConfig = current_app.config["MACHINES"]  # noqa
+    machine: Optional[Machine] = mconf.machines_by_name.get(machine_name)
+    if not machine:
+        return _reply({"error": f"No such machine: {machine_name}"}, 404, mimetype)
+    await machine.state.wait_for_change(known_version, max(0.0, min(timeout, max_wait)))
+    body: bytes = machine.state.response_body(mimetype, known_version)
+    return current_app.response_class(body, mimetype=mimetype), 200
+
+
+async def _parse_body(model: Type[ModelT], is_cbor: bool) -> ModelT:
+    """Parse and validate the request body as ``model``.
+
+    :raises ValidationError: if it does not match the model.
+    :raises CBORDecodeError: if ``is_cbor`` and it is not valid CBOR.
+    """
+    raw: bytes = await request.get_data(
+        cache=True, as_text=False, parse_form_data=False
+    )
+    if is_cbor:
+        return model.model_validate(cbor.loads(raw))
+    return model.model_validate_json(raw)
+
+
+def _invalid(ex: Exception, mimetype: str) -> Tuple[Response, int]:
+    """Log and return the 400 response for a body :func:`_parse_body` rejected."""
+    msg: str = (
+        validation_error_message(ex)
+        if isinstance(ex, ValidationError)
+        else f"Invalid CBOR: {ex}"
+    )
+    logger.warning("Invalid UPDATE request: %s", msg)
+    return _reply({"error": f"Invalid update: {msg}"}, 400, mimetype)
+
+
+def _update_fields(req: MachineUpdateRequest) -> Dict[str, Any]:
+    """Return the fields set in ``req`` as :meth:`Machine.update` kwargs.
+
+    Includes ``machine_name`` and ``state_version``, for the caller to pop.
+    """
+    data: Dict[str, Any] = {
+        k: getattr(req, k)
+        for k in MachineUpdateRequest.model_fields
+        if k in req.model_fields_set
+    }
+    if data.get("rfid_value") == "":
+        data["rfid_value"] = None
+    return data
+
+
+def _response_mimetype(request_is_cbor: bool) -> str:
+    """Return the MIME type to answer a machine update in.
+
+    The request's own type, unless the ``Accept`` header prefers the other.
+    """
+    offered: List[str] = [JSON_MIMETYPE, CBOR_MIMETYPE]
+    if request_is_cbor:
+        offered.reverse()
+    return request.accept_mimetypes.best_match(offered, default=offered[0])
+
+
+def _reply(obj: Dict[str, Any], status: int, mimetype: str) -> Tuple[Response, int]:
+    """Return a (non-cached) machine update response of the given type."""
+    if mimetype == CBOR_MIMETYPE:
+        return current_app.response_class(cbor.dumps(obj), mimetype=mimetype), status
+    return jsonify(obj), status
 
 
 @machineapi.route("/oops/<machine_name>", methods=["POST", "DELETE"])
@@ -4,18 +4,28 @@ from logging import Logger
 from logging import getLogger
 from typing import Dict
 from typing import Generator
+from typing import List
 from typing import Optional
 
 from prometheus_client import CollectorRegistry
 from prometheus_client import generate_latest
+from prometheus_client.core import HistogramMetricFamily
 from prometheus_client.core import Metric
 from prometheus_client.samples import Sample
 from quart import Response
 from quart import current_app
 
+from dm_mac.models.disk_probe import DiskProbe
+from dm_mac.models.events import EventBus
+from dm_mac.models.heartbeat_log import HeartbeatLog
 from dm_mac.models.machine import STATE_SAVE_TIMEOUT_SEC
 from dm_mac.models.machine import Machine
 from dm_mac.models.machine import MachinesConfig
+from dm_mac.models.persistence import MirroredStateStore
+from dm_mac.models.persistence import PersistenceExecutor
+from dm_mac.models.persistence import ProcessStateStore
+from dm_mac.models.persistence import StatePersister
+from dm_mac.models.save_latency import SaveLatency
 from dm_mac.models.users import UsersConfig
 
 logger: Logger = getLogger(__name__)
@@ -87,6 +97,13 @@ class PromCustomCollector:
             "The timestamp when the machine config was loaded",
         )
         mconf_load.add_metric({}, mconf.load_time)
+        persister: Optional[StatePersister] = current_app.config.get("STATE_PERSISTER")
+        state_load: LabeledGaugeMetricFamily = LabeledGaugeMetricFamily(
+            "machine_state_load_seconds",
+            "Seconds taken to load the state of all machines at startup",
+        )
+        if persister is not None:
+            state_load.add_metric({}, persister.load_duration_sec)
         uconf_load: LabeledGaugeMetricFamily = LabeledGaugeMetricFamily(
             "user_config_load_timestamp",
             "The timestamp when the users config was loaded",
@@ -242,6 +259,7 @@ class PromCustomCollector:
                     sr_labels, 1 if m.second_relay.always_enabled else 0
                 )
         yield mconf_load
+        yield state_load
         yield uconf_load
         yield uconf_mtime
         yield stime
@@ -272,6 +290,277 @@ class PromCustomCollector:
             yield sr_configured
             yield sr_warn
             yield sr_always
+        if persister is not None:
+            yield from self._executor_metrics(persister)
+            if persister.store.latency is not None:
+                yield self._save_latency_metric(mconf, persister.store.latency)
+            if isinstance(persister.store, MirroredStateStore):
+                yield from self._mirror_metrics(persister.store)
+            writers: List[ProcessStateStore] = [
+                s
+                for s in (
+                    persister.store.stores
+                    if isinstance(persister.store, MirroredStateStore)
+                    else [persister.store]
+                )
+                if isinstance(s, ProcessStateStore)
+            ]
+            if writers:
+                yield self._writer_metric(writers)
+            if persister.probe.enabled:
+                yield from self._probe_metrics(persister)
+        heartbeats: Optional[HeartbeatLog] = current_app.config.get("HEARTBEAT_LOG")
+        if heartbeats is not None and heartbeats.sampling:
+            yield from self._heartbeat_log_metrics(heartbeats)
+        # Likewise, event metrics only exist when events are queued.
+        events: Optional[EventBus] = current_app.config.get("EVENT_BUS")
+        if events is not None and events.queued:
+            yield from self._event_metrics(mconf, events)
+        # Likewise, persister metrics only exist when write-behind or
+        # degraded mode is on.
+        if persister is not None and (
+            persister.write_behind or persister.degraded_mode_enabled
+        ):
+            yield from self._persister_metrics(persister)
+
+    @staticmethod
+    def _save_latency_metric(
+        mconf: MachinesConfig, latency: SaveLatency
+    ) -> HistogramMetricFamily:
+        """Collect the per-machine, per-phase state save latency histogram."""
+        hist: HistogramMetricFamily = HistogramMetricFamily(
+            "mac_state_save_phase_seconds",
+            "Time spent in each phase of saving machine state",
+            labels=["machine_name", "display_name", "phase"],
+        )
+        bounds: List[str] = [str(b) for b in latency.buckets] + ["+Inf"]
+        for (name, phase), h in sorted(latency.histograms.items()):
+            machine: Optional[Machine] = mconf.machines_by_name.get(name)
+            counts, total = h.cumulative()
+            hist.add_metric(
+                [name, machine.display_name if machine else name, phase],
+                list(zip(bounds, counts)),
+                total,
+            )
+        return hist
+
+    @staticmethod
+    def _probe_metrics(persister: StatePersister) -> Generator[Metric, None, None]:
+        """Collect disk probe latency and the budgets derived from it."""
+        probe: DiskProbe = persister.probe
+        ewma: LabeledGaugeMetricFamily = LabeledGaugeMetricFamily(
+            "mac_state_disk_latency_ewma_seconds",
+            "Moving average of state directory write+fsync probe latency",
+        )
+        ewma.add_metric({}, probe.ewma_sec or 0.0)
+        quantiles: LabeledGaugeMetricFamily = LabeledGaugeMetricFamily(
+            "mac_state_disk_latency_seconds",
+            "Percentiles of recent state directory write+fsync probe latency",
+        )
+        for q in ("0.5", "0.9", "0.99"):
+            quantiles.add_metric({"quantile": q}, probe.percentile(float(q)))
+        inflight: LabeledGaugeMetricFamily = LabeledGaugeMetricFamily(
+            "mac_state_disk_probe_inflight_seconds",
+            "How long the current state directory probe has been running",
+        )
+        inflight.add_metric({}, probe.in_flight_sec)
+        errors: LabeledCounterMetricFamily = LabeledCounterMetricFamily(
+            "mac_state_disk_probe_errors",
+            "Count of state directory probes that failed",
+        )
+        errors.add_metric({}, probe.errors)
+        budget: LabeledGaugeMetricFamily = LabeledGaugeMetricFamily(
+            "mac_state_save_budget_seconds",
+            "Current time limit for writing machine state through to disk",
+        )
+        adaptive: Optional[float] = persister.save_budget_sec
+        budget.add_metric({}, STATE_SAVE_TIMEOUT_SEC if adaptive is None else adaptive)
+        interval: LabeledGaugeMetricFamily = LabeledGaugeMetricFamily(
+            "mac_state_flush_interval_seconds",
+            "Current interval between write-behind flushes (0 if disabled)",
+        )
+        interval.add_metric({}, persister.effective_flush_interval_sec)
+        yield ewma
+        yield quantiles
+        yield inflight
+        yield errors
+        yield budget
+        yield interval
+
+    @staticmethod
+    def _heartbeat_log_metrics(
+        heartbeats: HeartbeatLog,
+    ) -> Generator[Metric, None, None]:
+        """Collect counts of heartbeats logged and suppressed."""
+        logged: LabeledCounterMetricFamily = LabeledCounterMetricFamily(
+            "mac_heartbeat_log_lines",
+            "Count of machine update heartbeats logged, by reason",
+        )
+        logged.add_metric({"event": "transition"}, heartbeats.transitions)
+        logged.add_metric({"event": "sample"}, heartbeats.sampled)
+        suppressed: LabeledCounterMetricFamily = LabeledCounterMetricFamily(
+            "mac_heartbeat_log_suppressed",
+            "Count of no-op machine update heartbeats not logged",
+        )
+        suppressed.add_metric({}, heartbeats.suppressed)
+        access: LabeledCounterMetricFamily = LabeledCounterMetricFamily(
+            "mac_heartbeat_access_log_suppressed",
+            "Count of access log lines dropped for successful heartbeats",
+        )
+        access.add_metric({}, heartbeats.access_suppressed)
+        yield logged
+        yield suppressed
+        yield access
+
+    @staticmethod
+    def _event_metrics(
+        mconf: MachinesConfig, events: EventBus
+    ) -> Generator[Metric, None, None]:
+        """Collect counts of machine events and the state of their queue."""
+        counts: LabeledCounterMetricFamily = LabeledCounterMetricFamily(
+            "mac_machine_events",
+            "Count of machine state transition events, by kind",
+        )
+        for (name, kind), count in sorted(events.counter.counts.items()):
+            machine: Optional[Machine] = mconf.machines_by_name.get(name)
+            counts.add_metric(
+                {
+                    "machine_name": name,
+                    "display_name": machine.display_name if machine else name,
+                    "kind": kind,
+                },
+                count,
+            )
+        depth: LabeledGaugeMetricFamily = LabeledGaugeMetricFamily(
+            "mac_event_queue_depth",
+            "Number of machine events waiting to be delivered",
+        )
+        depth.add_metric({}, events.depth)
+        dropped: LabeledCounterMetricFamily = LabeledCounterMetricFamily(
+            "mac_events_dropped",
+            "Count of machine events dropped because the queue was full",
+        )
+        dropped.add_metric({}, events.dropped)
+        errors: LabeledCounterMetricFamily = LabeledCounterMetricFamily(
+            "mac_event_sink_errors",
+            "Count of exceptions raised while delivering machine events",
+        )
+        errors.add_metric({}, events.errors)
+        yield counts
+        yield depth
+        yield dropped
+        yield errors
+
+    @staticmethod
+    def _mirror_metrics(store: MirroredStateStore) -> Generator[Metric, None, None]:
+        """Collect per-directory metrics for mirrored state storage."""
+        backlog: LabeledGaugeMetricFamily = LabeledGaugeMetricFamily(
+            "mac_state_mirror_backlog",
+            "Number of machines whose latest state is not yet written to "
+            "this state directory",
+        )
+        errors: LabeledCounterMetricFamily = LabeledCounterMetricFamily(
+            "mac_state_mirror_errors",
+            "Count of failed state writes to this state directory",
+        )
+        for mirror, pending, failed in zip(store.stores, store.backlogs, store.errors):
+            backlog.add_metric({"state_dir": mirror.state_dir}, pending)
+            errors.add_metric({"state_dir": mirror.state_dir}, failed)
+        yield backlog
+        yield errors
+
+    @staticmethod
+    def _writer_metric(writers: List[ProcessStateStore]) -> Metric:
+        """Collect the respawn count of each state writer process."""
+        respawns: LabeledCounterMetricFamily = LabeledCounterMetricFamily(
+            "mac_state_writer_respawns",
+            "Count of state writer processes killed and respawned after "
+            "hanging or dying",
+        )
+        for writer in writers:
+            respawns.add_metric({"state_dir": writer.state_dir}, writer.respawns)
+        return respawns
+
+    @staticmethod
+    def _executor_metrics(
+        persister: StatePersister,
+    ) -> Generator[Metric, None, None]:
+        """Collect metrics for the state I/O executor."""
+        executor: PersistenceExecutor = persister.executor
+        depth: LabeledGaugeMetricFamily = LabeledGaugeMetricFamily(
+            "mac_state_executor_queue_depth",
+            "Number of state I/O jobs waiting for a worker thread",
+        )
+        depth.add_metric({}, executor.queue_depth)
+        active: LabeledGaugeMetricFamily = LabeledGaugeMetricFamily(
+            "mac_state_executor_active_workers",
+            "Number of state I/O worker threads currently running a job",
+        )
+        active.add_metric({}, executor.active_workers)
+        oldest: LabeledGaugeMetricFamily = LabeledGaugeMetricFamily(
+            "mac_state_executor_oldest_inflight_seconds",
+            "Age of the oldest queued or running state I/O job",
+        )
+        oldest.add_metric({}, executor.oldest_inflight_sec)
+        rejected: LabeledCounterMetricFamily = LabeledCounterMetricFamily(
+            "mac_state_executor_rejected",
+            "Count of state I/O jobs rejected because the queue was full",
+        )
+        rejected.add_metric({}, executor.rejected)
+        yield depth
+        yield active
+        yield oldest
+        yield rejected
+
+    @staticmethod
+    def _persister_metrics(
+        persister: StatePersister,
+    ) -> Generator[Metric, None, None]:
+        """Collect metrics for the write-behind / degraded-mode persister."""
+        dirty: LabeledGaugeMetricFamily = LabeledGaugeMetricFamily(
+            "mac_state_dirty_machines",
+            "Number of machines with state changes not yet flushed to disk",
+        )
+        dirty.add_metric({}, persister.dirty_count)
+        lag: LabeledGaugeMetricFamily = LabeledGaugeMetricFamily(
+            "mac_state_durability_lag_seconds",
+            "Age of the oldest machine state change not yet flushed to disk",
+        )
+        lag.add_metric({}, persister.durability_lag_sec)
+        flushes: LabeledCounterMetricFamily = LabeledCounterMetricFamily(
+            "mac_state_flushes", "Count of write-behind batch commits"
+        )
+        flushes.add_metric({}, persister.flush_count)
+        flushed: LabeledCounterMetricFamily = LabeledCounterMetricFamily(
+            "mac_state_flushed_states",
+            "Count of machine states written by write-behind batch commits",
+        )
+        flushed.add_metric({}, persister.flushed_states)
+        errors: LabeledCounterMetricFamily = LabeledCounterMetricFamily(
+            "mac_state_flush_errors",
+            "Count of write-behind batch commits that failed",
+        )
+        errors.add_metric({}, persister.flush_errors)
+        yield dirty
+        yield lag
+        yield flushes
+        yield flushed
+        yield errors
+        if not persister.degraded_mode_enabled:
+            return
+        degraded: LabeledGaugeMetricFamily = LabeledGaugeMetricFamily(
+            "mac_state_degraded",
+            "Whether machine state is being held in memory because the state "
+            "directory stalled (1) or written normally (0)",
+        )
+        degraded.add_metric({}, 1 if persister.degraded else 0)
+        entries: LabeledCounterMetricFamily = LabeledCounterMetricFamily(
+            "mac_state_degraded_entries",
+            "Count of times the server entered degraded state persistence mode",
+        )
+        entries.add_metric({}, persister.degraded_entries)
+        yield degraded
+        yield entries
 
 
 async def prometheus_route() -> Response:
@@ -0,0 +1,197 @@
+"""Tests for models.disk_probe."""
+
+import asyncio
+import os
+import threading
+from pathlib import Path
+from typing import List
+from typing import Optional
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import pytest
+
+from dm_mac.models.disk_probe import PROBE_FILENAME
+from dm_mac.models.disk_probe import DiskProbe
+from dm_mac.models.persistence import StatePersister
+
+
+class TestInit:
+    """Tests for DiskProbe construction."""
+
+    def test_disabled_by_default(self, tmp_path: Path) -> None:
+        """Probing is off unless an interval is configured."""
+        with patch.dict(os.environ, {}, clear=True):
+            probe: DiskProbe = DiskProbe(str(tmp_path))
+        assert probe.enabled is False
+        with patch.dict(os.environ, {"MACHINE_STATE_PROBE_INTERVAL_SEC": "5"}):
+            probe = DiskProbe(str(tmp_path))
+        assert probe.interval_sec == 5.0
+        assert probe.enabled is True
+
+
+class TestStatistics:
+    """Tests for the latency statistics and derived budgets."""
+
+    def test_record(self, tmp_path: Path) -> None:
+        """Samples feed the EWMA and percentiles."""
+        probe: DiskProbe = DiskProbe(str(tmp_path), interval_sec=1)
+        assert probe.percentile(0.5) == 0.0
+        for sec in (0.01, 0.01, 0.01, 0.01, 0.11):
+            probe.record(sec)
+        assert probe.ewma_sec == pytest.approx(0.03)
+        assert probe.percentile(0.5) == 0.01
+        assert probe.percentile(0.99) == 0.11
+
+    def test_save_budget(self, tmp_path: Path) -> None:
+        """The budget tracks p99 latency, within bounds."""
+        probe: DiskProbe = DiskProbe(str(tmp_path), interval_sec=1)
+        assert probe.save_budget_sec(2.0) == 2.0
+        probe.record(0.001)
+        assert probe.save_budget_sec(2.0) == 0.25
+        probe.record(0.2)
+        assert probe.save_budget_sec(2.0) == pytest.approx(0.8)
+        probe.record(1.0)
+        assert probe.save_budget_sec(2.0) == 2.0
+
+    def test_flush_interval(self, tmp_path: Path) -> None:
+        """The write-behind interval stretches while the disk is slow."""
+        probe: DiskProbe = DiskProbe(str(tmp_path), interval_sec=1)
+        assert probe.flush_interval_sec(1.0) == 1.0
+        probe.record(0.01)
+        assert probe.flush_interval_sec(1.0) == 1.0
+        assert probe.flush_interval_sec(0.0) == 0.0
+        probe.ewma_sec = 0.2
+        assert probe.flush_interval_sec(1.0) == 2.0
+        probe.ewma_sec = 5.0
+        assert probe.flush_interval_sec(1.0) == 4.0
+
+
+class TestRun:
+    """Tests for the background probe loop."""
+
+    def test_probe_once(self, tmp_path: Path) -> None:
+        """A probe writes the probe file and returns its latency."""
+        probe: DiskProbe = DiskProbe(str(tmp_path), interval_sec=1)
+        assert probe.probe_once() >= 0
+        assert os.path.getsize(tmp_path / PROBE_FILENAME) == 512
+
+    async def test_run(self, tmp_path: Path) -> None:
+        """The loop records a sample per probe and counts errors."""
+        probe: DiskProbe = DiskProbe(str(tmp_path), interval_sec=0.01)
+        task = asyncio.create_task(probe.run())
+        for _ in range(100):
+            if len(probe.samples) >= 2:
+                break
+            await asyncio.sleep(0.01)
+        assert len(probe.samples) >= 2
+        with patch.object(probe, "probe_once", side_effect=OSError("EIO")):
+            for _ in range(100):
+                if probe.errors:
+                    break
+                await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        probe.shutdown()
+        assert probe.errors >= 1
+
+    async def test_stall(self, tmp_path: Path) -> None:
+        """A stuck probe is reported once, then recorded when it finishes."""
+        probe: DiskProbe = DiskProbe(str(tmp_path), interval_sec=0.01)
+        release = threading.Event()
+        on_stall = Mock()
+        with patch("dm_mac.models.machine.STATE_SAVE_TIMEOUT_SEC", 0.05):
+            with patch.object(
+                probe, "probe_once", side_effect=lambda: release.wait(5.0) and 3.0
+            ):
+                task = asyncio.create_task(probe.run(on_stall=on_stall))
+                for _ in range(100):
+                    if on_stall.called:
+                        break
+                    await asyncio.sleep(0.01)
+                assert probe.stalled is True
+                await asyncio.sleep(0.05)
+                on_stall.assert_called_once()
+                assert on_stall.call_args[0][0] > 0.05
+                release.set()
+                for _ in range(100):
+                    if probe.samples:
+                        break
+                    await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        probe.shutdown()
+        assert list(probe.samples)[0] == 3.0
+
+
+class TestPersister:
+    """Tests for StatePersister's use of the probe."""
+
+    def test_save_budget(self, tmp_path: Path) -> None:
+        """The budget only adapts with both the probe and degraded mode on."""
+        probe: DiskProbe = DiskProbe(str(tmp_path), interval_sec=1)
+        probe.record(0.001)
+        p: StatePersister = StatePersister(
+            flush_interval_sec=0, store=Mock(), degraded_retry_sec=0, probe=probe
+        )
+        budgets: List[Optional[float]] = [p.save_budget_sec]
+        p.degraded_retry_sec = 1
+        budgets.append(p.save_budget_sec)
+        probe.interval_sec = 0
+        budgets.append(p.save_budget_sec)
+        assert budgets == [None, 0.25, None]
+
+    def test_flush_interval(self, tmp_path: Path) -> None:
+        """The write-behind interval follows the probe when it is enabled."""
+        probe: DiskProbe = DiskProbe(str(tmp_path), interval_sec=1)
+        probe.ewma_sec = 0.5
+        p: StatePersister = StatePersister(
+            flush_interval_sec=1, store=Mock(), probe=probe
+        )
+        assert p.effective_flush_interval_sec == 4.0
+        probe.interval_sec = 0
+        assert p.effective_flush_interval_sec == 1.0
+
+    def test_stall_degrades(self, tmp_path: Path) -> None:
+        """A stalled probe enters degraded mode, which persists until it ends."""
+        probe: DiskProbe = DiskProbe(str(tmp_path), interval_sec=10)
+        p: StatePersister = StatePersister(
+            flush_interval_sec=0, store=Mock(), degraded_retry_sec=1, probe=probe
+        )
+        p._probe_stalled(3.0)
+        assert p.degraded is True
+        assert p.degraded_entries == 1
+        with patch.object(DiskProbe, "stalled", True):
+            p._maybe_leave_degraded()
+            assert p.degraded is True
+        p._maybe_leave_degraded()
+        assert p.degraded is False
+
+    def test_stall_without_degraded_mode(self, tmp_path: Path) -> None:
+        """Without degraded mode, a stalled probe is only logged."""
+        p: StatePersister = StatePersister(
+            flush_interval_sec=0,
+            store=Mock(),
+            degraded_retry_sec=0,
+            probe=DiskProbe(str(tmp_path), interval_sec=10),
+        )
+        p._probe_stalled(3.0)
+        assert p.degraded is False
+
+    async def test_start_stop(self, tmp_path: Path) -> None:
+        """The probe runs for the persister's lifetime."""
+        probe: DiskProbe = DiskProbe(str(tmp_path), interval_sec=0.01)
+        p: StatePersister = StatePersister(
+            flush_interval_sec=0, store=Mock(), degraded_retry_sec=0, probe=probe
+        )
+        p.start()
+        assert p._task is None
+        for _ in range(100):
+            if probe.samples:
+                break
+            await asyncio.sleep(0.01)
+        await p.stop()
+        assert probe.samples
+        assert p._probe_task is None
@@ -0,0 +1,346 @@
+"""Tests for models.events."""
+
+import asyncio
+import logging
+import os
+from typing import List
+from typing import Optional
+from typing import Tuple
+from unittest.mock import AsyncMock
+from unittest.mock import Mock
+from unittest.mock import call
+from unittest.mock import patch
+
+import pytest
+
+from dm_mac.models.events import WARN_ONLY_AUTHORIZATION
+from dm_mac.models.events import DeniedEvent
+from dm_mac.models.events import EventBus
+from dm_mac.models.events import EventCounter
+from dm_mac.models.events import LoginEvent
+from dm_mac.models.events import LogoutEvent
+from dm_mac.models.events import MachineEvent
+from dm_mac.models.events import OopsEvent
+from dm_mac.models.events import RebootEvent
+from dm_mac.models.events import SecondRelayEvent
+from dm_mac.models.events import SlackSink
+from dm_mac.models.events import log_event
+from dm_mac.models.machine import Machine
+from dm_mac.models.machine import SecondRelayConfig
+from dm_mac.models.users import User
+from dm_mac.slack_handler import SlackHandler
+
+
+def make_machine(second_relay: Optional[SecondRelayConfig] = None) -> Machine:
+    """Return a mock machine."""
+    mach: Mock = Mock(spec_set=Machine)
+    type(mach).name = "metal-mill"
+    type(mach).display_name = "Metal Mill"
+    type(mach).second_relay = second_relay
+    return mach
+
+
+def make_user(name: str = "Jason Antman") -> User:
+    """Return a user."""
+    return User(
+        fob_codes=["0014916441"],
+        account_id="123",
+        full_name=name,
+        first_name="Jason",
+        last_name="Antman",
+        preferred_name="Jason",
+        email="jason@example.com",
+        expiration_ymd="2099-01-01",
+        authorizations=["Metal Mill"],
+    )
+
+
+class Recorder:
+    """Sink recording the events it is given."""
+
+    def __init__(self) -> None:
+        """Initialize Recorder."""
+        self.events: List[MachineEvent] = []
+
+    def __call__(self, event: MachineEvent) -> None:
+        """Record ``event``."""
+        self.events.append(event)
+
+
+class TestEventBus:
+    """Tests for EventBus."""
+
+    def test_defaults(self) -> None:
+        """Events are queued unless a queue size of 0 is configured."""
+        with patch.dict(os.environ, {}, clear=True):
+            bus: EventBus = EventBus()
+        assert bus.queued is True
+        assert bus.queue_size == 1000
+        assert bus.running is False
+        with patch.dict(os.environ, {"EVENT_QUEUE_SIZE": "0"}):
+            assert EventBus().queued is False
+
+    async def test_inline(self) -> None:
+        """Without a dispatcher, publish() delivers to every sink in order."""
+        bus: EventBus = EventBus(queue_size=0)
+        order: List[str] = []
+
+        async def slow(event: MachineEvent) -> None:
+            await asyncio.sleep(0.01)
+            order.append("slow")
+
+        bus.subscribe(lambda e: order.append("first"))
+        bus.subscribe(slow)
+        bus.subscribe(lambda e: order.append("last"))
+        bus.start()
+        assert bus.running is False
+        await bus.publish(RebootEvent(make_machine()))
+        assert order == ["first", "slow", "last"]
+        assert (bus.published, bus.dropped, bus.errors) == (1, 0, 0)
+
+    async def test_sink_errors(self) -> None:
+        """A failing sink is counted and does not stop the others."""
+        bus: EventBus = EventBus(queue_size=0)
+        rec: Recorder = Recorder()
+        bus.subscribe(Mock(side_effect=RuntimeError("boom")))
+        bus.subscribe(rec)
+        await bus.publish(RebootEvent(make_machine()))
+        bus.publish_nowait(RebootEvent(make_machine()))
+        assert len(rec.events) == 2
+        assert bus.errors == 2
+
+    def test_publish_nowait_without_loop(self) -> None:
+        """Sync sinks still run; coroutines are discarded without a loop."""
+        bus: EventBus = EventBus(queue_size=0)
+        rec: Recorder = Recorder()
+        m_async = AsyncMock()
+        bus.subscribe(rec)
+        bus.subscribe(m_async)
+        bus.publish_nowait(RebootEvent(make_machine()))
+        assert len(rec.events) == 1
+        m_async.assert_called_once()
+        m_async.assert_not_awaited()
+
+    async def test_publish_nowait_with_loop(self) -> None:
+        """Coroutines returned by sinks are run as tasks."""
+        bus: EventBus = EventBus(queue_size=0)
+        m_async = AsyncMock()
+        bus.subscribe(m_async)
+        bus.publish_nowait(RebootEvent(make_machine()))
+        assert len(bus._pending) == 1
+        await asyncio.sleep(0.01)
+        m_async.assert_awaited_once()
+        assert len(bus._pending) == 0
+
+    async def test_queued(self) -> None:
+        """With a dispatcher, publishing does not wait for sinks."""
+        bus: EventBus = EventBus(queue_size=10)
+        release: asyncio.Event = asyncio.Event()
+        rec: Recorder = Recorder()
+
+        async def blocked(event: MachineEvent) -> None:
+            await release.wait()
+
+        bus.subscribe(blocked)
+        bus.subscribe(rec)
+        bus.start()
+        assert bus.running is True
+        mach: Machine = make_machine()
+        events: List[MachineEvent] = [RebootEvent(mach) for _ in range(3)]
+        for event in events:
+            await asyncio.wait_for(bus.publish(event), timeout=0.1)
+        await asyncio.sleep(0.01)
+        assert rec.events == []
+        assert bus.depth == 2
+        release.set()
+        await bus.stop()
+        assert rec.events == events
+        assert (bus.running, bus.depth) == (False, 0)
+
+    async def test_queue_full(self) -> None:
+        """Events published while the queue is full are dropped."""
+        bus: EventBus = EventBus(queue_size=1)
+        rec: Recorder = Recorder()
+        bus.subscribe(rec)
+        bus.start()
+        mach: Machine = make_machine()
+        first: MachineEvent = RebootEvent(mach)
+        bus.publish_nowait(first)
+        bus.publish_nowait(RebootEvent(mach))
+        assert (bus.published, bus.dropped) == (2, 1)
+        await bus.stop()
+        assert rec.events == [first]
+
+    async def test_stop_timeout(self) -> None:
+        """Stopping gives up on events that cannot be delivered in time."""
+        bus: EventBus = EventBus(queue_size=10)
+
+        async def hung(event: MachineEvent) -> None:
+            await asyncio.sleep(10)
+
+        bus.subscribe(hung)
+        bus.start()
+        await bus.publish(RebootEvent(make_machine()))
+        with patch("dm_mac.models.events.EVENT_DRAIN_TIMEOUT_SEC", 0.05):
+            await asyncio.wait_for(bus.stop(), timeout=1)
+        assert bus.running is False
+
+
+class TestEventCounter:
+    """Tests for EventCounter."""
+
+    def test_counts(self) -> None:
+        """Events are counted by machine and kind."""
+        counter: EventCounter = EventCounter()
+        mach: Machine = make_machine()
+        counter(RebootEvent(mach))
+        counter(RebootEvent(mach))
+        counter(OopsEvent(mach, None, None))
+        assert counter.counts == {
+            ("metal-mill", "reboot"): 2,
+            ("metal-mill", "oops"): 1,
+        }
+
+
+class TestLogEvent:
+    """Tests for log_event()."""
+
+    def messages(
+        self, caplog: pytest.LogCaptureFixture, event: MachineEvent
+    ) -> List[Tuple[str, str, str]]:
+        """Return the log messages for ``event``."""
+        caplog.clear()
+        with caplog.at_level(logging.INFO):
+            log_event(event)
+        return [(r.name, r.levelname, r.getMessage()) for r in caplog.records]
+
+    def test_login(self, caplog: pytest.LogCaptureFixture) -> None:
+        """Logins log why the user was authorized, then the session start."""
+        mach: Machine = make_machine()
+        user: User = make_user()
+        assert self.messages(
+            caplog, LoginEvent(mach, user, "0014916441", authorization="Metal Mill")
+        ) == [
+            (
+                "AUTH",
+                "INFO",
+                "User Jason Antman (123) authorized for Metal Mill based on "
+                "Metal Mill",
+            ),
+            (
+                "AUTH",
+                "INFO",
+                "User Jason Antman (123) authorized for Metal Mill; " "session start",
+            ),
+        ]
+        assert self.messages(
+            caplog,
+            LoginEvent(mach, user, "0014916441", authorization=WARN_ONLY_AUTHORIZATION),
+        )[0] == (
+            "AUTH",
+            "WARNING",
+            "User Jason Antman (123) authorized for Metal Mill based on "
+            "unauthorized_warn_only==True",
+        )
+        assert self.messages(
+            caplog, LoginEvent(mach, user, "0014916441", override=True)
+        ) == [
+            (
+                "AUTH",
+                "INFO",
+                "Override login on Metal Mill by Jason Antman " "(0014916441)",
+            )
+        ]
+
+    def test_denied_and_logout(self, caplog: pytest.LogCaptureFixture) -> None:
+        """Refused logins and logouts are logged."""
+        mach: Machine = make_machine()
+        user: User = make_user()
+        assert self.messages(
+            caplog, DeniedEvent(mach, DeniedEvent.LOCKED_OUT, "0014916441", user)
+        ) == [
+            (
+                "AUTH",
+                "WARNING",
+                "RFID login attempt while locked out on Metal Mill by Jason "
+                "Antman (0014916441)",
+            )
+        ]
+        assert self.messages(caplog, LogoutEvent(mach, None, "0000000001", 61.5)) == [
+            (
+                "AUTH",
+                "INFO",
+                "RFID logout on Metal Mill by 0000000001; session duration 61 "
+                "seconds",
+            )
+        ]
+
+    def test_oops_and_second_relay(self, caplog: pytest.LogCaptureFixture) -> None:
+        """Oops button presses and second relay decisions are logged."""
+        mach: Machine = make_machine(
+            SecondRelayConfig(authorizations_or=["x"], alias="Rotary")
+        )
+        assert self.messages(caplog, OopsEvent(mach, "0000000001", None)) == [
+            (
+                "OOPS",
+                "WARNING",
+                "Machine Metal Mill was Oopsed. RFID card is present but unknown.",
+            )
+        ]
+        assert self.messages(caplog, SecondRelayEvent(mach, "denied", make_user())) == [
+            (
+                "AUTH",
+                "INFO",
+                "User Jason Antman UNAUTHORIZED for accessory Rotary on machine "
+                "Metal Mill",
+            )
+        ]
+
+
+class TestSlackSink:
+    """Tests for SlackSink."""
+
+    async def test_disabled(self) -> None:
+        """Nothing is posted when Slack is not enabled."""
+        sink: SlackSink = SlackSink(lambda: None)
+        assert sink(RebootEvent(make_machine())) is None
+
+    async def test_posts(self) -> None:
+        """Events are posted in the admin channel."""
+        slack = AsyncMock(spec_set=SlackHandler)
+        sink: SlackSink = SlackSink(lambda: slack)
+        mach: Machine = make_machine(SecondRelayConfig(authorizations_or=["x"]))
+        user: User = make_user()
+        for event in (
+            LoginEvent(
+                mach,
+                user,
+                "0014916441",
+                authorization=WARN_ONLY_AUTHORIZATION,
+                second_relay_authorization="warn",
+            ),
+            DeniedEvent(mach, DeniedEvent.UNKNOWN_FOB, "0000000001", blocked=True),
+            OopsEvent(mach, None, None),
+            LoginEvent(mach, user, "0014916441", override=True),
+        ):
+            coro = sink(event)
+            assert coro is not None
+            await coro
+        assert sink(SecondRelayEvent(mach, "warn", user)) is None
+        assert slack.mock_calls == [
+            call.admin_log(
+                "WARNING - Authorizing user Jason Antman for Metal Mill based on "
+                "unauthorized_warn_only setting for machine. User is NOT "
+                "authorized for this machine."
+            ),
+            call.admin_log(
+                "RFID login on Metal Mill by authorized user Jason Antman; "
+                "second relay WARN-ONLY override — relay on"
+            ),
+            call.admin_log(
+                "RFID login attempt on Metal Mill by unknown fob when oopsed or "
+                "locked out."
+            ),
+            call.log_oops(mach, "Oops button without RFID present", user_name=None),
+            call.log_override_login(mach, "Jason Antman"),
+        ]
@@ -0,0 +1,89 @@
+"""Tests for models.heartbeat_log."""
+
+import logging
+from unittest.mock import patch
+
+import pytest
+
+from dm_mac.models.heartbeat_log import HeartbeatLog
+from dm_mac.models.heartbeat_log import logfmt
+
+
+def access_record(request_line: str, status: str) -> logging.LogRecord:
+    """Return a record shaped like hypercorn's access log records."""
+    record = logging.LogRecord(
+        "hypercorn.access", logging.INFO, __file__, 1, "%(r)s %(s)s", None, None
+    )
+    record.args = {"r": request_line, "s": status}
+    return record
+
+
+class TestLogfmt:
+    """Tests for logfmt()."""
+
+    def test_logfmt(self) -> None:
+        """Values are rendered and quoted only when needed."""
+        assert (
+            logfmt(
+                {
+                    "a": 1,
+                    "b": True,
+                    "c": None,
+                    "d": "two words",
+                    "e": 'say "hi"',
+                    "f": "x=y",
+                    "g": "plain",
+                }
+            )
+            == 'a=1 b=true c="" d="two words" e="say \\"hi\\"" f="x=y" g=plain'
+        )
+
+
+class TestHeartbeatLog:
+    """Tests for HeartbeatLog."""
+
+    def test_default_logs_everything(self, caplog: pytest.LogCaptureFixture) -> None:
+        """By default, every heartbeat is logged."""
+        caplog.set_level(logging.INFO, "dm_mac.models.heartbeat_log")
+        hb: HeartbeatLog = HeartbeatLog()
+        assert hb.sample_every == 1
+        assert hb.sampling is False
+        assert hb.record("m1", [], {"uptime": 1.5}) is True
+        assert hb.record("m1", ["relay_desired_state"], {"rfid_value": "123"})
+        assert [r.getMessage() for r in caplog.records] == [
+            'event=sample machine=m1 changed="" uptime=1.5',
+            "event=transition machine=m1 changed=relay_desired_state " "rfid_value=123",
+        ]
+        assert (hb.transitions, hb.sampled, hb.suppressed) == (1, 1, 0)
+
+    def test_sampling(self, caplog: pytest.LogCaptureFixture) -> None:
+        """One in N no-op heartbeats per machine are logged, plus transitions."""
+        caplog.set_level(logging.INFO, "dm_mac.models.heartbeat_log")
+        with patch.dict("os.environ", {"HEARTBEAT_LOG_SAMPLE": "3"}):
+            hb: HeartbeatLog = HeartbeatLog()
+        assert hb.sampling is True
+        logged = [hb.record("m1", [], {}) for _ in range(6)]
+        assert logged == [True, False, False, True, False, False]
+        assert hb.record("m2", [], {}) is True
+        assert hb.record("m1", ["oops"], {}) is True
+        assert (hb.transitions, hb.sampled, hb.suppressed) == (1, 3, 4)
+        assert len(caplog.records) == 4
+
+    def test_transitions_only(self, caplog: pytest.LogCaptureFixture) -> None:
+        """A sample rate of 0 logs only transitions."""
+        caplog.set_level(logging.INFO, "dm_mac.models.heartbeat_log")
+        hb: HeartbeatLog = HeartbeatLog(sample_every=0)
+        assert hb.record("m1", [], {}) is False
+        assert hb.record("m1", ["current_amps"], {}) is True
+        assert (hb.transitions, hb.sampled, hb.suppressed) == (1, 0, 1)
+        assert len(caplog.records) == 1
+
+    def test_access_filter(self) -> None:
+        """Successful heartbeat access lines are dropped only when sampling."""
+        ok = access_record("POST /api/machine/update 1.1", "200")
+        assert HeartbeatLog(sample_every=1).access_filter(ok) is True
+        hb: HeartbeatLog = HeartbeatLog(sample_every=0)
+        assert hb.access_filter(ok) is False
+        assert hb.access_filter(access_record("POST /api/machine/update 1.1", "503"))
+        assert hb.access_filter(access_record("GET /metrics 1.1", "200"))
+        assert hb.access_suppressed == 1
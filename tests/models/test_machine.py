@@ -112,7 +112,7 @@ class TestMachine:
         assert cls.name == "mName"
         assert cls.authorizations_or == ["Foo", "Bar"]
         assert cls.unauthorized_warn_only is False
-        assert m_state.mock_calls == [call(cls)]
+        assert m_state.mock_calls == [call(cls, load_state=True)]
         assert cls.state == m_state.return_value
         assert cls.as_dict == {
             "name": "mName",
@@ -133,7 +133,7 @@ class TestMachine:
         assert cls.name == "mName"
         assert cls.authorizations_or == ["Foo", "Bar"]
         assert cls.unauthorized_warn_only is True
-        assert m_state.mock_calls == [call(cls)]
+        assert m_state.mock_calls == [call(cls, load_state=True)]
         assert cls.state == m_state.return_value
         assert cls.as_dict == {
             "name": "mName",
@@ -155,7 +155,7 @@ class TestMachine:
         assert cls.alias == "My Machine"
         assert cls.display_name == "My Machine"
         assert cls.authorizations_or == ["Foo", "Bar"]
-        assert m_state.mock_calls == [call(cls)]
+        assert m_state.mock_calls == [call(cls, load_state=True)]
         assert cls.state == m_state.return_value
         assert cls.as_dict == {
             "name": "mName",
@@ -1,10 +1,15 @@
 """Tests for models.machine."""
 
 import asyncio
+import json
 import os
 import pickle
+import threading
 import time
 from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
 from unittest.mock import AsyncMock
 from unittest.mock import MagicMock
 from unittest.mock import Mock
@@ -13,10 +18,17 @@ from unittest.mock import patch
 
 import pytest
 
+from dm_mac.models.events import EventBus
+from dm_mac.models.events import LogoutEvent
+from dm_mac.models.events import MachineEvent
+from dm_mac.models.events import SlackSink
+from dm_mac.models.events import log_event
+from dm_mac.models.machine import DEFAULT_EVENT_BUS
 from dm_mac.models.machine import FleetTimeoutTracker
 from dm_mac.models.machine import Machine
 from dm_mac.models.machine import MachineState
 from dm_mac.models.machine import StateSaveTimeoutError
+from dm_mac.models.machine import make_event_bus
 from dm_mac.models.users import User
 from dm_mac.models.users import UsersConfig
 
@@ -29,7 +41,7 @@ class MachineStateTester:
 
     def setup_method(self) -> None:
         """Setup mocks and a test class instance."""
-        self.machine: Machine = Mock(spec_set=Machine)
+        self.machine: Mock = Mock(spec_set=Machine)
         type(self.machine).name = "MachineName"
         type(self.machine).second_relay = None
         with patch(f"{pb}._load_from_cache") as self.m_load:
@@ -159,7 +171,7 @@ class TestSaveCache(MachineStateTester):
             "wifi_signal_db": None,
             "wifi_signal_percent": None,
             "internal_temperature_c": None,
-            "current_user": None,
+            "current_user_account_id": None,
             "second_relay_desired_state": False,
             "second_relay_authorization": None,
             "state_save_timeouts": 0,
@@ -212,7 +224,7 @@ class TestSaveCache(MachineStateTester):
             "wifi_signal_db": 0.25,
             "wifi_signal_percent": 0.9,
             "internal_temperature_c": 52.1,
-            "current_user": user,
+            "current_user_account_id": user.account_id,
             "second_relay_desired_state": False,
             "second_relay_authorization": None,
             "state_save_timeouts": 0,
@@ -404,6 +416,43 @@ class TestMachineResponse(MachineStateTester):
             "second_relay": False,
         }
 
+    def test_body_is_cached(self) -> None:
+        """The serialized response is only rebuilt when a field changes."""
+        body: bytes = self.cls.machine_response_body
+        assert json.loads(body) == self.cls.machine_response
+        assert body.endswith(b"\n")
+        self.cls.uptime = 123.0
+        self.cls.current_amps = 2.0
+        assert self.cls.machine_response_body is body
+        assert self.cls.response_renders == 1
+        self.cls.status_led_rgb = (0.0, 1.0, 0.0)
+        changed: bytes = self.cls.machine_response_body
+        assert json.loads(changed)["status_led_rgb"] == [0.0, 1.0, 0.0]
+        assert self.cls.response_renders == 2
+        self.cls.second_relay_desired_state = True
+        assert json.loads(self.cls.machine_response_body)["second_relay"] is True
+        assert self.cls.response_renders == 3
+
+    def test_state_version(self) -> None:
+        """The version only advances when the response changes."""
+        version: int = self.cls.state_version
+        self.cls.uptime = 123.0
+        assert self.cls.state_version == version
+        assert json.loads(self.cls.conditional_response_body(version)) == {
+            "state_version": version,
+            "unchanged": True,
+        }
+        assert json.loads(self.cls.conditional_response_body(0)) == {
+            **self.cls.machine_response,
+            "state_version": version,
+        }
+        self.cls.is_oopsed = True
+        assert self.cls.state_version == version + 1
+        assert json.loads(self.cls.conditional_response_body(version)) == {
+            **self.cls.machine_response,
+            "state_version": version + 1,
+        }
+
 
 class TestOverrideLogin(MachineStateTester):
     """Tests for the oops/lockout override login feature."""
@@ -854,3 +903,415 @@ class TestFleetTimeoutNotification(MachineStateTester):
                         await self.cls.save_cache()
                     await asyncio.sleep(0)
         slack.app.client.chat_postMessage.assert_not_called()
+
+
+class TestVolatileSaveThrottle(MachineStateTester):
+    """Tests for dirty-field tracking and volatile-only save throttling."""
+
+    def setup_method(self) -> None:
+        """Set up a state with volatile save throttling enabled."""
+        with patch.dict(os.environ, {"MACHINE_STATE_VOLATILE_SAVE_INTERVAL_SEC": "60"}):
+            super().setup_method()
+        type(self.machine).always_enabled = False
+        type(self.machine).display_name = "MachineName"
+        self.users: UsersConfig = Mock()
+        self.users.users_by_fob = {}
+
+    async def _update(self, **kwargs: object) -> AsyncMock:
+        """Run an update with save_cache mocked; return the mock."""
+        m_app = MagicMock()
+        m_app.config = {}
+        with patch.object(self.cls, "save_cache", new_callable=AsyncMock) as m_save:
+            with patch(f"{pbm}.current_app", new=m_app):
+                await self.cls.update(self.users, **kwargs)  # type: ignore
+        return m_save
+
+    def test_default_interval(self) -> None:
+        """Throttling is disabled unless configured."""
+        with patch.dict(os.environ, {}, clear=True):
+            super().setup_method()
+        assert self.cls.volatile_save_interval_sec == 0.0
+
+    async def test_changed_fields_classified(self) -> None:
+        """An update records exactly the persisted fields it changed."""
+        self.cls._last_save_request = time.monotonic()
+        m_save = await self._update(uptime=10.0, wifi_signal_db=-50.0)
+        m_save.assert_not_called()
+        assert self.cls.dirty_fields == {"uptime", "wifi_signal_db", "last_checkin"}
+        assert self.cls.dirty_fields.issubset(MachineState.VOLATILE_STATE_FIELDS)
+        assert self.cls.skipped_saves == 1
+
+    async def test_first_update_is_saved(self) -> None:
+        """Volatile changes are saved if nothing has been saved yet."""
+        m_save = await self._update(uptime=10.0)
+        m_save.assert_called_once_with(urgent=False)
+
+    async def test_volatile_saved_after_interval(self) -> None:
+        """Volatile-only changes are saved once the interval has elapsed."""
+        self.cls._last_save_request = time.monotonic() - 61
+        m_save = await self._update(uptime=10.0)
+        m_save.assert_called_once_with(urgent=False)
+
+    async def test_durable_change_saved_immediately(self) -> None:
+        """A durable change is always saved, and urgently if auth-relevant."""
+        self.cls._last_save_request = time.monotonic()
+        m_save = await self._update(uptime=10.0, rfid_value="1234")
+        m_save.assert_called_once_with(urgent=True)
+
+    async def test_login_saved_urgently(self) -> None:
+        """A change of current user alone is saved urgently."""
+        self.cls._last_save_request = time.monotonic()
+        user: User = Mock(spec=User)
+        user.account_id = "123"
+
+        async def login(users: UsersConfig, rfid_value: str) -> None:
+            self.cls.current_user = user
+
+        with patch.object(self.cls, "_handle_rfid_insert", side_effect=login):
+            m_save = await self._update(rfid_value="1234")
+        m_save.assert_called_once_with(urgent=True)
+        assert "current_user_account_id" in self.cls.dirty_fields
+        assert "rfid_value" not in self.cls.dirty_fields
+
+    async def test_save_cache_clears_dirty_fields(self, tmp_path: Path) -> None:
+        """Requesting a save clears dirty_fields and restarts the interval."""
+        self.cls._state_path = str(tmp_path) + "/MachineName-state.pickle"
+        self.cls.dirty_fields = {"uptime"}
+        await self.cls.save_cache()
+        assert self.cls.dirty_fields == set()
+        assert self.cls._last_save_request is not None
+
+
+class TestResolveCurrentUser(MachineStateTester):
+    """Tests for persisting current_user by account ID."""
+
+    def _users(self, fixtures_path: str) -> UsersConfig:
+        with patch.dict(
+            "os.environ",
+            {"USERS_CONFIG": os.path.join(fixtures_path, "users.json")},
+        ):
+            return UsersConfig()
+
+    def test_round_trip(self, tmp_path: Path, fixtures_path: str) -> None:
+        """Only the account ID is saved; loading resolves the live User."""
+        uconf: UsersConfig = self._users(fixtures_path)
+        user: User = uconf.users_by_fob["8682768676"]
+        self.cls.current_user = user
+        self.cls._state_path = str(tmp_path) + "/MachineName-state.pickle"
+        self.cls._save_cache()
+        with open(self.cls._state_path, "rb") as f:
+            state = pickle.load(f)
+        assert state["current_user_account_id"] == user.account_id
+        assert "current_user" not in state
+        with patch(f"{pbm}.os.makedirs"):
+            loaded: MachineState = MachineState(self.machine, load_state=False)
+        loaded._state_path = self.cls._state_path
+        loaded._load_from_cache()
+        assert loaded.current_user == user
+        assert loaded.current_user is not user
+        assert loaded.current_user.authorizations == []
+        loaded.resolve_current_user(uconf)
+        assert loaded.current_user is user
+
+    def test_legacy_user_object(self, fixtures_path: str) -> None:
+        """State saved with a pickled User is resolved to the live User."""
+        uconf: UsersConfig = self._users(fixtures_path)
+        user: User = uconf.users_by_fob["8682768676"]
+        stale: User = User(**dict(user.as_dict, full_name="Old Name"))
+        self.cls._apply_state({"current_user": stale})
+        assert self.cls.current_user is stale
+        self.cls.resolve_current_user(uconf)
+        assert self.cls.current_user is user
+
+    def test_unknown_account(self, fixtures_path: str) -> None:
+        """An account missing from users config is left in place."""
+        uconf: UsersConfig = self._users(fixtures_path)
+        self.cls._apply_state({"current_user_account_id": "nope"})
+        with patch(f"{pbm}.logger") as m_log:
+            self.cls.resolve_current_user(uconf)
+        assert self.cls.current_user is not None
+        assert self.cls.current_user.account_id == "nope"
+        assert m_log.warning.call_count == 1
+
+    async def test_unknown_account_logout(
+        self, fixtures_path: str, caplog: pytest.LogCaptureFixture
+    ) -> None:
+        """Logging out a user missing from users config names the account."""
+        type(self.machine).always_enabled = False
+        type(self.machine).display_name = "MachineName"
+        uconf: UsersConfig = self._users(fixtures_path)
+        self.cls._apply_state(
+            {
+                "current_user_account_id": "nope",
+                "rfid_value": "0123456789",
+                "rfid_present_since": time.time() - 60,
+                "relay_desired_state": True,
+            }
+        )
+        self.cls.resolve_current_user(uconf)
+        events: List[MachineEvent] = []
+        self.cls.event_bus = EventBus(queue_size=0)
+        self.cls.event_bus.subscribe(events.append)
+        self.cls.event_bus.subscribe(log_event)
+        with patch.object(self.cls, "save_cache", new_callable=AsyncMock):
+            await self.cls.update(uconf, rfid_value=None)
+        assert isinstance(events[0], LogoutEvent)
+        assert SlackSink.logout_message(events[0]) == (
+            "RFID logout on MachineName by account nope; session duration a minute"
+        )
+        assert (
+            "RFID logout on MachineName by account nope; session duration 60 seconds"
+            in caplog.messages
+        )
+
+    def test_no_user(self, fixtures_path: str) -> None:
+        """No current user stays None."""
+        self.cls._apply_state({"current_user_account_id": None})
+        self.cls.resolve_current_user(self._users(fixtures_path))
+        assert self.cls.current_user is None
+
+
+class TestUpdateLock(MachineStateTester):
+    """Tests for serializing concurrent updates of one machine."""
+
+    def setup_method(self) -> None:
+        """Set up a state whose Slack logging can be held up."""
+        super().setup_method()
+        type(self.machine).always_enabled = False
+        type(self.machine).display_name = "MachineName"
+        self.users: UsersConfig = Mock()
+        self.users.users_by_fob = {}
+        self.release: asyncio.Event = asyncio.Event()
+        self.events: list[str] = []
+
+        async def admin_log(msg: str) -> None:
+            self.events.append("slack start")
+            await self.release.wait()
+            self.events.append("slack end")
+
+        self.slack: AsyncMock = AsyncMock()
+        self.slack.admin_log.side_effect = admin_log
+        self.m_app = MagicMock()
+        self.m_app.config = {"SLACK_HANDLER": self.slack}
+        self.cls.save_cache = AsyncMock()  # type: ignore[method-assign]
+
+    async def _update(self, name: str) -> None:
+        """Run one unknown-fob update, recording when it finishes."""
+        await self.cls.update(self.users, rfid_value="1234")
+        self.events.append(f"{name} done")
+
+    async def test_duplicate_updates_do_not_stall_loop(self) -> None:
+        """A second update waits for the first without blocking the loop."""
+        gaps: list[float] = []
+
+        async def ticker() -> None:
+            last: float = time.monotonic()
+            while True:
+                await asyncio.sleep(0.01)
+                now: float = time.monotonic()
+                gaps.append(now - last)
+                last = now
+
+        with patch(f"{pbm}.current_app", new=self.m_app):
+            tick = asyncio.create_task(ticker())
+            first = asyncio.create_task(self._update("first"))
+            second = asyncio.create_task(self._update("second"))
+            await asyncio.sleep(0.2)
+            assert self.cls.update_lock.locked()
+            assert self.events == ["slack start"]
+            self.release.set()
+            await asyncio.wait_for(asyncio.gather(first, second), timeout=2)
+            tick.cancel()
+        assert len(gaps) >= 10
+        assert max(gaps) < 0.1
+        # the second update saw the first one's result, so changed nothing
+        assert self.events == ["slack start", "slack end", "first done", "second done"]
+        assert self.slack.admin_log.call_count == 1
+        assert self.cls.display_text == "Unknown RFID"
+
+    async def test_admin_action_waits_for_update(self) -> None:
+        """An Oops from the API is applied after an in-flight update."""
+        mach = Mock()
+        mach.state = self.cls
+        with patch(f"{pbm}.current_app", new=self.m_app):
+            update = asyncio.create_task(self._update("update"))
+            await asyncio.sleep(0.05)
+            oops = asyncio.create_task(Machine.oops(mach, slack=self.slack))
+            await asyncio.sleep(0.05)
+            assert not oops.done()
+            assert self.cls.machine_response["oops_led"] is False
+            self.release.set()
+            await asyncio.wait_for(asyncio.gather(update, oops), timeout=2)
+        assert self.cls.is_oopsed is True
+        assert self.cls.display_text == MachineState.OOPS_DISPLAY_TEXT
+
+    async def test_slow_write_does_not_hold_state_lock(self, tmp_path: Path) -> None:
+        """The in-process lock is free while a save is writing to disk."""
+        writing = threading.Event()
+        unblock = threading.Event()
+
+        def slow_write(path: str, data: Dict[str, Any]) -> None:
+            writing.set()
+            unblock.wait(timeout=5)
+
+        self.cls._state_path = str(tmp_path) + "/MachineName-state.pickle"
+        with patch(f"{pbm}.PickleStateStore.write_file", side_effect=slow_write):
+            save = asyncio.create_task(asyncio.to_thread(self.cls._save_cache))
+            assert await asyncio.to_thread(writing.wait, 2)
+            try:
+                assert self.cls._lock.acquire(timeout=1)
+                self.cls._lock.release()
+                self.cls.lockout()
+                assert self.cls.is_locked_out is True
+            finally:
+                unblock.set()
+            await save
+
+    async def test_save_during_rfid_insert(self, tmp_path: Path) -> None:
+        """A save racing an RFID insert sees the whole login or none of it."""
+        type(self.machine).authorizations_or = ["Metal Mill"]
+        user: User = User(
+            fob_codes=["0014916441"],
+            account_id="123",
+            full_name="Jason Antman",
+            first_name="Jason",
+            last_name="Antman",
+            preferred_name="Jason",
+            email="jason@example.com",
+            expiration_ymd="2099-01-01",
+            authorizations=["Metal Mill"],
+        )
+        saved: List[Dict[str, Any]] = []
+        saver: threading.Thread = threading.Thread(target=self.cls._save_cache)
+
+        def lookup(fob: str) -> User:
+            # save on another thread while the insert is half-applied
+            saver.start()
+            saver.join(timeout=0.2)
+            return user
+
+        self.users.users_by_fob = Mock()
+        self.users.users_by_fob.get.side_effect = lookup
+        self.cls._state_path = str(tmp_path) + "/MachineName-state.pickle"
+        self.release.set()
+        with patch(f"{pbm}.current_app", new=self.m_app):
+            with patch(
+                f"{pbm}.PickleStateStore.write_file",
+                side_effect=lambda path, data: saved.append(data),
+            ):
+                await self.cls.update(self.users, rfid_value="0014916441")
+                await asyncio.to_thread(saver.join, 2)
+        assert len(saved) == 1
+        assert saved[0]["rfid_value"] == "0014916441"
+        assert saved[0]["current_user_account_id"] == "123"
+        assert saved[0]["relay_desired_state"] is True
+        assert saved[0]["display_text"] == "Welcome,\nJason"
+
+
+class TestEventPublishing(MachineStateTester):
+    """Tests for publishing transition side effects to an event bus."""
+
+    def setup_method(self) -> None:
+        """Set up a state publishing to a queued event bus."""
+        super().setup_method()
+        type(self.machine).always_enabled = False
+        type(self.machine).display_name = "MachineName"
+        self.users: UsersConfig = Mock()
+        self.users.users_by_fob = {}
+        self.bus: EventBus = make_event_bus(queue_size=10)
+        self.cls.event_bus = self.bus
+
+    def test_default_bus(self) -> None:
+        """States not attached to an app's bus deliver events inline."""
+        super().setup_method()
+        assert self.cls.event_bus is DEFAULT_EVENT_BUS
+        assert DEFAULT_EVENT_BUS.running is False
+
+    async def test_update_does_not_wait_for_slack(self) -> None:
+        """A queued event's Slack post happens after the update returns."""
+        release: asyncio.Event = asyncio.Event()
+        events: list[str] = []
+
+        async def admin_log(msg: str) -> None:
+            events.append("slack start")
+            await release.wait()
+            events.append("slack end")
+
+        slack: AsyncMock = AsyncMock()
+        slack.admin_log.side_effect = admin_log
+        m_app = MagicMock()
+        m_app.config = {"SLACK_HANDLER": slack}
+        with patch(f"{pbm}.current_app", new=m_app):
+            self.bus.start()
+            with patch.object(self.cls, "save_cache", new_callable=AsyncMock):
+                await asyncio.wait_for(
+                    self.cls.update(self.users, rfid_value="1234"), timeout=0.5
+                )
+            assert self.cls.display_text == "Unknown RFID"
+            await asyncio.sleep(0.01)
+            assert slack.admin_log.mock_calls == [
+                call("RFID login attempt on MachineName by unknown fob")
+            ]
+            # the update finished while the Slack sink is still blocked
+            assert events == ["slack start"]
+            assert self.bus.depth == 0
+            release.set()
+            await self.bus.stop()
+        assert events == ["slack start", "slack end"]
+        assert self.bus.counter.counts == {("MachineName", "denied"): 1}
+        assert self.bus.errors == 0
+
+
+class TestWaitForChange(MachineStateTester):
+    """Tests for MachineState.wait_for_change()."""
+
+    def setup_method(self) -> None:
+        """Set up a state that does not save."""
+        super().setup_method()
+        type(self.machine).always_enabled = False
+        type(self.machine).display_name = "MachineName"
+        self.users: UsersConfig = Mock()
+        self.users.users_by_fob = {}
+        self.cls.save_cache = AsyncMock()  # type: ignore[method-assign]
+
+    async def test_already_changed(self) -> None:
+        """A stale version returns the current one without waiting."""
+        version: int = self.cls.state_version
+        result: int = await asyncio.wait_for(
+            self.cls.wait_for_change(version - 1, 10), timeout=0.1
+        )
+        assert result == version
+
+    async def test_timeout(self) -> None:
+        """Heartbeats that do not change the response do not end the wait."""
+        version: int = self.cls.state_version
+        waiter = asyncio.create_task(self.cls.wait_for_change(version, 0.1))
+        await asyncio.sleep(0.01)
+        await self.cls.update(self.users, uptime=10.0, amps=1.5)
+        assert not waiter.done()
+        assert await waiter == version
+        assert self.cls._version_waiters is not None
+
+    async def test_admin_action(self) -> None:
+        """Every waiter is woken as soon as the machine is Oopsed."""
+        version: int = self.cls.state_version
+        waiters = [
+            asyncio.create_task(self.cls.wait_for_change(version, 10)) for _ in range(3)
+        ]
+        await asyncio.sleep(0.01)
+        assert not any(w.done() for w in waiters)
+        start: float = time.monotonic()
+        self.cls.oops()
+        results = await asyncio.wait_for(asyncio.gather(*waiters), timeout=0.5)
+        assert time.monotonic() - start < 0.1
+        assert results == [version + 1] * 3
+        assert self.cls._version_waiters is None
+
+    async def test_update(self) -> None:
+        """Waiters are woken by an update that changes the response."""
+        version: int = self.cls.state_version
+        waiter = asyncio.create_task(self.cls.wait_for_change(version, 10))
+        await asyncio.sleep(0.01)
+        await self.cls.update(self.users, oops=True)
+        assert await asyncio.wait_for(waiter, timeout=0.5) == version + 1
+        assert self.cls.is_oopsed is True
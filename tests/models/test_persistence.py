@@ -0,0 +1,1212 @@
+"""Tests for models.persistence."""
+
+import asyncio
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+from unittest.mock import MagicMock
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import pytest
+from filelock import FileLock
+
+from dm_mac.models.machine import Machine
+from dm_mac.models.machine import MachineState
+from dm_mac.models.machine import StateSaveTimeoutError
+from dm_mac.models.persistence import JournalStateStore
+from dm_mac.models.persistence import MirroredStateStore
+from dm_mac.models.persistence import MmapStateStore
+from dm_mac.models.persistence import PersistenceExecutor
+from dm_mac.models.persistence import PersistenceQueueFullError
+from dm_mac.models.persistence import PickleStateStore
+from dm_mac.models.persistence import ProcessStateStore
+from dm_mac.models.persistence import SqliteStateStore
+from dm_mac.models.persistence import StatePersister
+from dm_mac.models.persistence import StateStore
+from dm_mac.models.persistence import StateWriterHungError
+from dm_mac.models.persistence import make_state_store
+from dm_mac.models.persistence import write_atomic
+from dm_mac.models.state_codec import StateDecodeError
+
+pbm: str = "dm_mac.models.persistence"
+
+
+def make_state(name: str, state_dir: Path) -> MachineState:
+    """Return a MachineState for a mocked Machine, saving under state_dir."""
+    mach: Mock = Mock(spec_set=Machine)
+    type(mach).name = name
+    type(mach).display_name = name
+    type(mach).second_relay = None
+    with patch.dict(os.environ, {"MACHINE_STATE_DIR": str(state_dir)}):
+        state: MachineState = MachineState(mach, load_state=False)
+    type(mach).state = state
+    return state
+
+
+def read_state(state: MachineState) -> Dict[str, Any]:
+    """Read a machine's pickled state back from disk."""
+    with open(state._state_path, "rb") as f:
+        data: Dict[str, Any] = pickle.load(f)
+    return data
+
+
+class TestInit:
+    """Tests for StatePersister construction."""
+
+    def test_default_is_write_through(self) -> None:
+        """Without configuration, write-behind is disabled."""
+        with patch.dict(os.environ, {}, clear=True):
+            p: StatePersister = StatePersister(store=Mock())
+        assert p.flush_interval_sec == 0.0
+        assert p.write_behind is False
+
+    def test_interval_from_env(self) -> None:
+        """The flush interval is read from the environment."""
+        with patch.dict(os.environ, {"MACHINE_STATE_FLUSH_INTERVAL_SEC": "2.5"}):
+            p: StatePersister = StatePersister(store=Mock())
+        assert p.flush_interval_sec == 2.5
+        assert p.write_behind is True
+
+    def test_attach(self, tmp_path: Path) -> None:
+        """attach() points each machine's state at the persister."""
+        p: StatePersister = StatePersister(
+            flush_interval_sec=1.0, store=PickleStateStore(str(tmp_path))
+        )
+        s1 = make_state("m1", tmp_path)
+        s2 = make_state("m2", tmp_path)
+        p.attach([s1.machine, s2.machine])
+        assert s1.persister is p
+        assert s2.persister is p
+
+
+class TestLoad:
+    """Tests for fleet state hydration."""
+
+    def test_load_hydrates_and_times(self, tmp_path: Path) -> None:
+        """load() applies stored state to every machine and records timing."""
+        store = PickleStateStore(str(tmp_path))
+        store.save_batch({"m1": {"uptime": 5.0}, "m2": {"is_oopsed": True}})
+        p: StatePersister = StatePersister(flush_interval_sec=0, store=store)
+        states: List[MachineState] = [
+            make_state(n, tmp_path) for n in ("m1", "m2", "m3")
+        ]
+        with patch.object(store, "load_all", wraps=store.load_all) as m_load:
+            p.load([s.machine for s in states])
+        assert m_load.call_count == 1
+        assert states[0].uptime == 5.0
+        assert states[1].is_oopsed is True
+        assert states[2].uptime == 0.0
+        assert p.loaded_states == 2
+        assert p.load_duration_sec > 0
+
+
+class TestFlush:
+    """Tests for batch commits."""
+
+    async def test_save_cache_marks_dirty_without_writing(self, tmp_path: Path) -> None:
+        """With write-behind on, save_cache() only marks the state dirty."""
+        p: StatePersister = StatePersister(
+            flush_interval_sec=10.0, store=PickleStateStore(str(tmp_path))
+        )
+        state = make_state("m1", tmp_path)
+        p.attach([state.machine])
+        state.uptime = 12.0
+        await state.save_cache(urgent=False)
+        assert not os.path.exists(state._state_path)
+        assert p.dirty_count == 1
+        assert p.durability_lag_sec > 0
+
+    async def test_flush_commits_all_dirty(self, tmp_path: Path) -> None:
+        """One flush writes every dirty machine and clears the dirty set."""
+        p: StatePersister = StatePersister(
+            flush_interval_sec=10.0, store=PickleStateStore(str(tmp_path))
+        )
+        states: List[MachineState] = [make_state(f"m{i}", tmp_path) for i in range(3)]
+        p.attach([s.machine for s in states])
+        for i, s in enumerate(states):
+            s.uptime = float(i + 100)
+            p.mark_dirty(s)
+        # marking the same machine twice only writes it once
+        p.mark_dirty(states[0])
+        assert p.dirty_count == 3
+        assert await p.flush() == 3
+        assert p.dirty_count == 0
+        assert p.durability_lag_sec == 0.0
+        assert p.flush_count == 1
+        assert p.flushed_states == 3
+        assert p.last_flush_time is not None
+        for i, s in enumerate(states):
+            assert read_state(s)["uptime"] == float(i + 100)
+        # nothing dirty: no-op
+        assert await p.flush() == 0
+        assert p.flush_count == 1
+
+    async def test_flush_error_requeues(self, tmp_path: Path) -> None:
+        """A failed commit is counted and the batch is retried next time."""
+        p: StatePersister = StatePersister(
+            flush_interval_sec=10.0, store=PickleStateStore(str(tmp_path))
+        )
+        state = make_state("m1", tmp_path)
+        p.mark_dirty(state)
+        with patch.object(
+            StatePersister, "_commit", side_effect=OSError("disk on fire")
+        ):
+            assert await p.flush() == 0
+        assert p.flush_errors == 1
+        assert p.dirty_count == 1
+        assert await p.flush() == 1
+        assert os.path.exists(state._state_path)
+
+
+class TestBackgroundFlusher:
+    """Tests for the background flush loop."""
+
+    async def test_urgent_wakes_flusher(self, tmp_path: Path) -> None:
+        """An urgent mark is flushed without waiting for the interval."""
+        p: StatePersister = StatePersister(
+            flush_interval_sec=60.0, store=PickleStateStore(str(tmp_path))
+        )
+        state = make_state("m1", tmp_path)
+        p.attach([state.machine])
+        p.start()
+        try:
+            state.is_oopsed = True
+            await state.save_cache(urgent=True)
+            for _ in range(100):
+                if p.flush_count:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await p.stop()
+        assert p.flush_count == 1
+        assert read_state(state)["is_oopsed"] is True
+
+    async def test_interval_flush(self, tmp_path: Path) -> None:
+        """Non-urgent marks are flushed on the next tick."""
+        p: StatePersister = StatePersister(
+            flush_interval_sec=0.05, store=PickleStateStore(str(tmp_path))
+        )
+        state = make_state("m1", tmp_path)
+        p.start()
+        try:
+            p.mark_dirty(state)
+            for _ in range(100):
+                if p.flush_count:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await p.stop()
+        assert p.flush_count == 1
+        assert os.path.exists(state._state_path)
+
+    async def test_stop_flushes_pending(self, tmp_path: Path) -> None:
+        """stop() commits anything still dirty."""
+        p: StatePersister = StatePersister(
+            flush_interval_sec=60.0, store=PickleStateStore(str(tmp_path))
+        )
+        state = make_state("m1", tmp_path)
+        p.start()
+        p.mark_dirty(state)
+        await p.stop()
+        assert p.dirty_count == 0
+        assert os.path.exists(state._state_path)
+
+    async def test_stop_flush_timeout(
+        self, tmp_path: Path, caplog: pytest.LogCaptureFixture
+    ) -> None:
+        """stop() gives up on a hung final flush and logs what was lost."""
+        block = threading.Event()
+        p: StatePersister = StatePersister(
+            flush_interval_sec=60.0, store=PickleStateStore(str(tmp_path))
+        )
+        p.mark_dirty(make_state("m2", tmp_path))
+        p.mark_dirty(make_state("m1", tmp_path))
+        with patch.object(
+            StatePersister, "_commit", side_effect=lambda b: block.wait(5.0)
+        ):
+            with patch(f"{pbm}.STOP_FLUSH_TIMEOUT_SEC", 0.05):
+                await asyncio.wait_for(p.stop(), timeout=2)
+        block.set()
+        assert p.dirty_count == 2
+        assert (
+            "Timed out after 0.1s saving state on shutdown; state of 2 "
+            "machine(s) was not saved: m1, m2"
+        ) in caplog.messages
+
+    @pytest.mark.parametrize("dirty", [True, False])
+    async def test_stop_with_stuck_write(
+        self, tmp_path: Path, caplog: pytest.LogCaptureFixture, dirty: bool
+    ) -> None:
+        """stop() returns while a write holds the store's lock."""
+        store = SqliteStateStore(str(tmp_path))
+        p: StatePersister = StatePersister(flush_interval_sec=60.0, store=store)
+        if dirty:
+            p.mark_dirty(make_state("m1", tmp_path))
+        # stand in for a writer thread hung on the disk for a second
+        locked = threading.Event()
+
+        def hung_write() -> None:
+            with store._conn_lock:
+                locked.set()
+                time.sleep(1.0)
+
+        writer = threading.Thread(target=hung_write)
+        writer.start()
+        assert locked.wait(1)
+        start: float = time.monotonic()
+        with patch(f"{pbm}.STOP_FLUSH_TIMEOUT_SEC", 0.05):
+            await p.stop()
+        assert time.monotonic() - start < 0.5
+        writer.join()
+        if dirty:
+            assert p.dirty_count == 1
+            assert "Timed out closing" not in caplog.text
+        else:
+            assert (
+                "Timed out after 0.1s closing state store on shutdown"
+                in caplog.messages
+            )
+
+    def test_start_noop_when_write_through(self) -> None:
+        """start() does not spawn a task when write-behind is disabled."""
+        p: StatePersister = StatePersister(flush_interval_sec=0, store=Mock())
+        with patch(f"{pbm}.asyncio.create_task") as m_create:
+            p.start()
+        m_create.assert_not_called()
+
+    async def test_hung_disk_uses_one_thread(self, tmp_path: Path) -> None:
+        """Marks keep accumulating while a single commit is blocked."""
+        block = threading.Event()
+        spawned: List[int] = []
+
+        def hung_commit(batch: List[MachineState]) -> None:
+            spawned.append(len(batch))
+            block.wait(timeout=5.0)
+
+        p: StatePersister = StatePersister(
+            flush_interval_sec=0.01, store=PickleStateStore(str(tmp_path))
+        )
+        s1 = make_state("m1", tmp_path)
+        s2 = make_state("m2", tmp_path)
+        with patch.object(StatePersister, "_commit", side_effect=hung_commit):
+            p.start()
+            p.mark_dirty(s1)
+            await asyncio.sleep(0.1)
+            p.mark_dirty(s2)
+            await asyncio.sleep(0.1)
+            assert spawned == [1]
+            # m1 is being committed, m2 is waiting; both are unsaved
+            assert p.dirty_count == 2
+            block.set()
+            await p.stop()
+        assert p.dirty_count == 0
+        # stop() cancels the in-flight flush, which re-queues m1; the final
+        # flush then commits both machines in one batch.
+        assert spawned == [1, 2]
+
+
+@pytest.mark.parametrize("urgent", [True, False])
+async def test_update_urgency(tmp_path: Path, urgent: bool) -> None:
+    """MachineState.update() flags auth-relevant changes as urgent."""
+    p: StatePersister = StatePersister(
+        flush_interval_sec=60.0, store=PickleStateStore(str(tmp_path))
+    )
+    state = make_state("m1", tmp_path)
+    type(state.machine).always_enabled = False
+    p.attach([state.machine])
+    users = Mock()
+    users.users_by_fob = {}
+    m_app = MagicMock()
+    m_app.config = {}
+    with patch.object(p, "mark_dirty") as m_mark:
+        with patch("dm_mac.models.machine.current_app", new=m_app):
+            await state.update(users, uptime=10.0, rfid_value="123" if urgent else None)
+    m_mark.assert_called_once_with(state, urgent=urgent)
+
+
+class TestStores:
+    """Tests for the state storage backends."""
+
+    def test_make_state_store_default(self, tmp_path: Path) -> None:
+        """The pickle backend is the default."""
+        with patch.dict(os.environ, {"MACHINE_STATE_DIR": str(tmp_path)}, clear=True):
+            store = make_state_store()
+        assert isinstance(store, PickleStateStore)
+        assert store.state_dir == str(tmp_path)
+
+    def test_make_state_store_sqlite(self, tmp_path: Path) -> None:
+        """MACHINE_STATE_BACKEND selects the backend."""
+        with patch.dict(
+            os.environ,
+            {"MACHINE_STATE_DIR": str(tmp_path), "MACHINE_STATE_BACKEND": "sqlite"},
+        ):
+            store = make_state_store()
+        assert isinstance(store, SqliteStateStore)
+        assert store.path == os.path.join(str(tmp_path), "machine_state.sqlite3")
+
+    def test_make_state_store_unknown(self, tmp_path: Path) -> None:
+        """An unknown backend is a startup error."""
+        with pytest.raises(RuntimeError, match="Unknown MACHINE_STATE_BACKEND"):
+            make_state_store(backend="floppy", state_dir=str(tmp_path))
+
+    def test_pickle_round_trip(self, tmp_path: Path) -> None:
+        """PickleStateStore writes one file per machine."""
+        store = PickleStateStore(str(tmp_path))
+        store.save_batch({"m1": {"uptime": 1.0}, "m2": {"uptime": 2.0}})
+        assert os.path.exists(store.path_for("m1"))
+        assert store.load_all(["m1", "m2", "m3"]) == {
+            "m1": {"uptime": 1.0},
+            "m2": {"uptime": 2.0},
+        }
+        assert store.load("m3") is None
+
+    def test_pickle_load_all_concurrent(self, tmp_path: Path) -> None:
+        """PickleStateStore reads many files on several threads."""
+        store = PickleStateStore(str(tmp_path))
+        names: List[str] = [f"m{i}" for i in range(40)]
+        store.save_batch({n: {"uptime": float(i)} for i, n in enumerate(names)})
+        threads: Set[int] = set()
+        real_read = PickleStateStore.read_file
+
+        def tracking_read(path: str, locking: str) -> Optional[Dict[str, Any]]:
+            threads.add(threading.get_ident())
+            return real_read(path, locking)
+
+        with patch.object(PickleStateStore, "read_file", side_effect=tracking_read):
+            result = store.load_all(names + ["missing"])
+        assert result == {n: {"uptime": float(i)} for i, n in enumerate(names)}
+        assert len(threads) > 1
+
+    @pytest.mark.parametrize("store_cls", [PickleStateStore, SqliteStateStore])
+    def test_binary_codec(self, tmp_path: Path, store_cls: type) -> None:
+        """Stores write with MACHINE_STATE_CODEC and read either codec."""
+        legacy = store_cls(str(tmp_path))
+        legacy.save_batch({"m1": {"uptime": 1.0, "current_user": None}})
+        legacy.close()
+        with patch.dict(os.environ, {"MACHINE_STATE_CODEC": "binary"}):
+            store = store_cls(str(tmp_path))
+        assert store.codec == "binary"
+        assert store.load_all(["m1"]) == {
+            "m1": {"uptime": 1.0, "current_user_account_id": None}
+        }
+        store.save_batch({"m2": {"machine_name": "m2", "uptime": 2.0}})
+        loaded = store.load("m2")
+        assert loaded is not None
+        assert loaded["uptime"] == 2.0
+        assert loaded["is_oopsed"] is False
+        store.close()
+
+    def test_unknown_codec(self, tmp_path: Path) -> None:
+        """An unknown codec is a startup error."""
+        with patch.dict(os.environ, {"MACHINE_STATE_CODEC": "xml"}):
+            with pytest.raises(RuntimeError, match="Unknown MACHINE_STATE_CODEC"):
+                PickleStateStore(str(tmp_path))
+
+    def test_sqlite_round_trip(self, tmp_path: Path) -> None:
+        """SqliteStateStore upserts and loads the fleet from one file."""
+        store = SqliteStateStore(str(tmp_path))
+        store.save_batch({"m1": {"uptime": 1.0}, "m2": {"uptime": 2.0}})
+        store.save_batch({"m1": {"uptime": 3.0}})
+        assert store.load_all(["m1", "m2", "m3"]) == {
+            "m1": {"uptime": 3.0},
+            "m2": {"uptime": 2.0},
+        }
+        assert store.load("m2") == {"uptime": 2.0}
+        store.close()
+        assert not [f for f in os.listdir(tmp_path) if f.endswith(".pickle")]
+        # data survives reopening
+        assert SqliteStateStore(str(tmp_path)).load("m1") == {"uptime": 3.0}
+
+    def test_sqlite_batch_is_one_transaction(self, tmp_path: Path) -> None:
+        """A failing batch leaves no partial writes behind."""
+        store = SqliteStateStore(str(tmp_path))
+        store.save_batch({"m1": {"uptime": 1.0}})
+        # the second row cannot be bound, after the first has been written
+        with pytest.raises(sqlite3.ProgrammingError):
+            store.save_batch(
+                {"m1": {"uptime": 2.0}, ("m2",): {"uptime": 2.0}}  # type: ignore
+            )
+        assert store.load_all(["m1", "m2"]) == {"m1": {"uptime": 1.0}}
+        store.close()
+
+    def test_sqlite_imports_legacy_pickles(self, tmp_path: Path) -> None:
+        """Machines without a row are imported from legacy pickle files."""
+        PickleStateStore(str(tmp_path)).save_batch({"old": {"uptime": 9.0}})
+        store = SqliteStateStore(str(tmp_path))
+        store.save_batch({"new": {"uptime": 1.0}})
+        assert store.load_all(["old", "new"]) == {
+            "old": {"uptime": 9.0},
+            "new": {"uptime": 1.0},
+        }
+        # now stored in the database
+        os.remove(PickleStateStore(str(tmp_path)).path_for("old"))
+        assert store.load("old") == {"uptime": 9.0}
+        store.close()
+
+    async def test_flush_to_sqlite(self, tmp_path: Path) -> None:
+        """The persister commits a batch to SQLite and loads it back."""
+        store = SqliteStateStore(str(tmp_path))
+        p: StatePersister = StatePersister(flush_interval_sec=10.0, store=store)
+        states: List[MachineState] = [make_state(f"m{i}", tmp_path) for i in range(3)]
+        p.attach([s.machine for s in states])
+        for i, s in enumerate(states):
+            s.uptime = float(i)
+            p.mark_dirty(s)
+        with patch.object(store, "save_batch", wraps=store.save_batch) as m_save:
+            assert await p.flush() == 3
+        assert m_save.call_count == 1
+        fresh: List[MachineState] = [make_state(f"m{i}", tmp_path) for i in range(3)]
+        p.load([s.machine for s in fresh])
+        assert [s.uptime for s in fresh] == [0.0, 1.0, 2.0]
+        assert not os.path.exists(states[0]._state_path)
+        await p.stop()
+
+
+class TestJournalStore:
+    """Tests for JournalStateStore."""
+
+    def test_appends_only_changed_fields(self, tmp_path: Path) -> None:
+        """Saves append deltas, and a reopened store replays them."""
+        store = JournalStateStore(str(tmp_path))
+        full = {"uptime": 1.0, "is_oopsed": False, "display_text": "hi"}
+        store.save_batch({"m1": full})
+        size: int = os.path.getsize(store.journal_path)
+        store.save_batch({"m1": dict(full, uptime=2.0)})
+        delta_size: int = os.path.getsize(store.journal_path) - size
+        assert 0 < delta_size < size
+        # an unchanged save appends nothing
+        store.save_batch({"m1": dict(full, uptime=2.0)})
+        assert os.path.getsize(store.journal_path) == size + delta_size
+        store.close()
+        again = JournalStateStore(str(tmp_path))
+        assert again.load_all(["m1", "m2"]) == {"m1": dict(full, uptime=2.0)}
+        again.close()
+
+    def test_torn_tail_is_discarded(self, tmp_path: Path) -> None:
+        """A partially written final frame is ignored and truncated."""
+        store = JournalStateStore(str(tmp_path))
+        store.save_batch({"m1": {"uptime": 1.0}})
+        store.close()
+        good: int = os.path.getsize(store.journal_path)
+        with open(store.journal_path, "ab") as f:
+            f.write(b"\x00\x00\x01\x00garbage")
+        again = JournalStateStore(str(tmp_path))
+        assert again.load("m1") == {"uptime": 1.0}
+        assert os.path.getsize(again.journal_path) == good
+        again.save_batch({"m1": {"uptime": 5.0}})
+        again.close()
+        assert JournalStateStore(str(tmp_path)).load("m1") == {"uptime": 5.0}
+
+    def test_compaction(self, tmp_path: Path) -> None:
+        """A large journal is compacted into a snapshot in the background."""
+        with patch.dict(os.environ, {"MACHINE_STATE_JOURNAL_COMPACT_BYTES": "200"}):
+            store = JournalStateStore(str(tmp_path))
+        for i in range(20):
+            store.save_batch({"m1": {"uptime": float(i)}, "m2": {"n": i}})
+        store.close()
+        assert store.compactions >= 1
+        assert os.path.exists(store.snapshot_path)
+        assert not os.path.exists(store.rotated_path)
+        again = JournalStateStore(str(tmp_path))
+        assert again.load_all(["m1", "m2"]) == {
+            "m1": {"uptime": 19.0},
+            "m2": {"n": 19},
+        }
+        again.close()
+
+    def test_interrupted_compaction(self, tmp_path: Path) -> None:
+        """A rotated journal left behind by a crash is replayed on load."""
+        store = JournalStateStore(str(tmp_path))
+        store.save_batch({"m1": {"uptime": 1.0, "is_oopsed": True}})
+        store.close()
+        os.replace(store.journal_path, store.rotated_path)
+        store = JournalStateStore(str(tmp_path))
+        store.save_batch({"m1": {"uptime": 2.0, "is_oopsed": True}})
+        store.close()
+        again = JournalStateStore(str(tmp_path))
+        assert again.load("m1") == {"uptime": 2.0, "is_oopsed": True}
+        again.close()
+
+    def test_failed_compaction_is_kept(self, tmp_path: Path) -> None:
+        """A compaction after a failed one keeps the older rotated journal."""
+        with patch.dict(os.environ, {"MACHINE_STATE_JOURNAL_COMPACT_BYTES": "1"}):
+            store = JournalStateStore(str(tmp_path))
+        with patch(f"{pbm}.write_atomic", side_effect=OSError("disk full")):
+            store.save_batch({"m1": {"uptime": 1.0}})
+            assert store._compactor is not None
+            store._compactor.join()
+            store.save_batch({"m2": {"uptime": 2.0}})
+            store.close()
+        assert store.compactions == 0
+        assert not os.path.exists(store.snapshot_path)
+        again = JournalStateStore(str(tmp_path))
+        assert again.load_all(["m1", "m2"]) == {
+            "m1": {"uptime": 1.0},
+            "m2": {"uptime": 2.0},
+        }
+        again.compact_bytes = 1
+        again.save_batch({"m1": {"uptime": 3.0}})
+        again.close()
+        assert again.compactions == 1
+        assert not os.path.exists(again.rotated_path)
+        assert JournalStateStore(str(tmp_path)).load_all(["m1", "m2"]) == {
+            "m1": {"uptime": 3.0},
+            "m2": {"uptime": 2.0},
+        }
+
+    def test_imports_legacy_pickles(self, tmp_path: Path) -> None:
+        """Machines missing from the journal are imported from pickle files."""
+        PickleStateStore(str(tmp_path)).save_batch({"old": {"uptime": 9.0}})
+        store = JournalStateStore(str(tmp_path))
+        assert store.load_all(["old"]) == {"old": {"uptime": 9.0}}
+        store.close()
+        os.remove(PickleStateStore(str(tmp_path)).path_for("old"))
+        assert JournalStateStore(str(tmp_path)).load("old") == {"uptime": 9.0}
+
+
+class TestMmapStore:
+    """Tests for MmapStateStore."""
+
+    def test_round_trip(self, tmp_path: Path) -> None:
+        """State is laid out in load order and survives reopening."""
+        store = MmapStateStore(str(tmp_path))
+        assert store.load_all(["m1", "m2"]) == {}
+        assert store.slots == {"m1": 0, "m2": 1}
+        size: int = os.path.getsize(store.path)
+        for i in range(3):
+            store.save_batch({"m2": {"uptime": float(i), "display_text": "hi"}})
+        assert os.path.getsize(store.path) == size
+        store.save_batch({"m3": {"uptime": 3.0}})
+        assert store.slots == {"m1": 0, "m2": 1, "m3": 2}
+        store.close()
+        again = MmapStateStore(str(tmp_path))
+        loaded = again.load_all(["m3", "m2", "m1"])
+        assert again.slots == {"m3": 0, "m2": 1, "m1": 2}
+        assert sorted(loaded) == ["m2", "m3"]
+        assert loaded["m2"]["uptime"] == 2.0
+        assert loaded["m2"]["display_text"] == "hi"
+        assert loaded["m3"]["uptime"] == 3.0
+        assert list(again.saved_times(["m1", "m2"])) == ["m2"]
+        again.close()
+
+    def test_torn_write(self, tmp_path: Path) -> None:
+        """A corrupt copy is ignored in favor of the previous one."""
+        store = MmapStateStore(str(tmp_path))
+        store.save_batch({"m1": {"uptime": 1.0}})
+        store.save_batch({"m1": {"uptime": 2.0}})
+        off: int = store._offset(0, store._latest[0][1])
+        store.close()
+        with open(store.path, "r+b") as f:
+            f.seek(off + 30)
+            f.write(b"garbage")
+        again = MmapStateStore(str(tmp_path))
+        assert again.load_all(["m1"])["m1"]["uptime"] == 1.0
+        again.save_batch({"m1": {"uptime": 3.0}})
+        again.close()
+        again = MmapStateStore(str(tmp_path))
+        assert again.load_all(["m1"])["m1"]["uptime"] == 3.0
+
+    def test_state_too_large(self, tmp_path: Path) -> None:
+        """State that does not fit a record fails the save."""
+        store = MmapStateStore(str(tmp_path))
+        with pytest.raises(ValueError, match="holds at most"):
+            store.save_batch({"m1": {"display_text": "x" * 2000}})
+        store.close()
+
+    def test_not_a_state_map(self, tmp_path: Path) -> None:
+        """A file that is not a state map is not overwritten."""
+        (tmp_path / MmapStateStore.FILENAME).write_bytes(b"x" * 64)
+        with pytest.raises(StateDecodeError):
+            MmapStateStore(str(tmp_path)).load_all(["m1"])
+
+    def test_imports_legacy_pickles(self, tmp_path: Path) -> None:
+        """Machines missing from the file are imported from pickle files."""
+        PickleStateStore(str(tmp_path)).save_batch({"old": {"uptime": 9.0}})
+        store = MmapStateStore(str(tmp_path))
+        assert store.load_all(["old"]) == {"old": {"uptime": 9.0}}
+        store.close()
+        os.remove(PickleStateStore(str(tmp_path)).path_for("old"))
+        again = MmapStateStore(str(tmp_path))
+        assert again.load_all(["old"])["old"]["uptime"] == 9.0
+
+
+class TestDegradedMode:
+    """Tests for degraded mode during disk stalls."""
+
+    def test_disabled_by_default(self) -> None:
+        """Degraded mode is off unless a retry interval is configured."""
+        with patch.dict(os.environ, {}, clear=True):
+            p: StatePersister = StatePersister(store=Mock())
+        assert p.degraded_mode_enabled is False
+        with patch.dict(os.environ, {"MACHINE_STATE_DEGRADED_RETRY_SEC": "2"}):
+            p = StatePersister(store=Mock())
+        assert p.degraded_retry_sec == 2.0
+        assert p.degraded_mode_enabled is True
+        assert p.defers_saves is False
+
+    async def test_enter_and_drain(self, tmp_path: Path) -> None:
+        """A timed-out save enters degraded mode; the retry loop drains it."""
+        p: StatePersister = StatePersister(
+            flush_interval_sec=0,
+            store=PickleStateStore(str(tmp_path)),
+            degraded_retry_sec=0.05,
+        )
+        state = make_state("m1", tmp_path)
+        p.attach([state.machine])
+        stalled = threading.Event()
+        m_app = MagicMock()
+        m_app.config = {}
+        p.start()
+        try:
+            with patch("dm_mac.models.machine.current_app", new=m_app):
+                with patch.object(
+                    state, "_save_cache", side_effect=lambda: stalled.wait(5.0)
+                ):
+                    with patch("dm_mac.models.machine.STATE_SAVE_TIMEOUT_SEC", 0.05):
+                        await state.save_cache()
+                assert [p.degraded, p.defers_saves] == [True, True]
+                assert p.degraded_entries == 1
+                state.is_oopsed = True
+                # while degraded, saves are queued without waiting
+                await state.save_cache()
+                assert p.dirty_count == 1
+            stalled.set()
+            for _ in range(100):
+                if not p.degraded:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await p.stop()
+        assert p.degraded is False
+        assert p.degraded_since is None
+        assert p.dirty_count == 0
+        assert read_state(state)["is_oopsed"] is True
+
+    async def test_stays_degraded_on_error(self, tmp_path: Path) -> None:
+        """A failed drain keeps the persister degraded."""
+        p: StatePersister = StatePersister(
+            flush_interval_sec=0,
+            store=PickleStateStore(str(tmp_path)),
+            degraded_retry_sec=0.01,
+        )
+        state = make_state("m1", tmp_path)
+        p.enter_degraded(state)
+        with patch.object(StatePersister, "_commit", side_effect=OSError("EIO")):
+            p.start()
+            for _ in range(100):
+                if p.flush_errors:
+                    break
+                await asyncio.sleep(0.01)
+            assert p.degraded is True
+            assert p.dirty_count == 1
+        await p.stop()
+        assert p.dirty_count == 0
+
+
+class TestCollecting:
+    """Tests for collecting write-through saves into one batch commit."""
+
+    async def test_collect_and_save_batch(self, tmp_path: Path) -> None:
+        """Saves in a collecting block are written by one batch commit."""
+        store = PickleStateStore(str(tmp_path))
+        p: StatePersister = StatePersister(flush_interval_sec=0, store=store)
+        states: List[MachineState] = [make_state(f"m{i}", tmp_path) for i in range(3)]
+        p.attach([s.machine for s in states])
+        assert p.collect(states[0]) is False
+
+        async def elsewhere() -> None:
+            # concurrent tasks are not collected
+            states[2].uptime = 7.0
+            await states[2].save_cache()
+
+        with patch.object(store, "save_batch", wraps=store.save_batch) as m_save:
+            with p.collecting() as collected:
+                for s in states[:2]:
+                    s.uptime = 12.0
+                    await s.save_cache()
+                await asyncio.create_task(elsewhere())
+                # only the other task's save was written through
+                assert m_save.call_count == 1
+                assert list(m_save.call_args.args[0]) == ["m2"]
+                assert not os.path.exists(states[0]._state_path)
+            assert collected == {"m0": states[0], "m1": states[1]}
+            assert p.collect(states[0]) is False
+            await MachineState.save_batch(list(collected.values()))
+        assert m_save.call_count == 2
+        assert sorted(m_save.call_args.args[0]) == ["m0", "m1"]
+        assert [read_state(s)["uptime"] for s in states] == [12.0, 12.0, 7.0]
+
+    async def test_save_batch_timeout(self, tmp_path: Path) -> None:
+        """A batch commit over budget counts a timeout for every machine."""
+        p: StatePersister = StatePersister(
+            flush_interval_sec=0, store=PickleStateStore(str(tmp_path))
+        )
+        states: List[MachineState] = [make_state(f"m{i}", tmp_path) for i in range(2)]
+        p.attach([s.machine for s in states])
+        stalled = threading.Event()
+        m_app = MagicMock()
+        m_app.config = {}
+        try:
+            with patch("dm_mac.models.machine.current_app", new=m_app):
+                with patch.object(
+                    StatePersister,
+                    "_commit",
+                    side_effect=lambda batch: stalled.wait(5.0),
+                ):
+                    with patch("dm_mac.models.machine.STATE_SAVE_TIMEOUT_SEC", 0.05):
+                        with pytest.raises(
+                            StateSaveTimeoutError,
+                            match="Batch state save of 2 machine",
+                        ):
+                            await MachineState.save_batch(states)
+        finally:
+            stalled.set()
+            await p.stop()
+        assert [s.state_save_timeouts for s in states] == [1, 1]
+
+    async def test_save_batch_degraded(self, tmp_path: Path) -> None:
+        """With degraded mode, a batch over budget is queued instead."""
+        p: StatePersister = StatePersister(
+            flush_interval_sec=0,
+            store=PickleStateStore(str(tmp_path)),
+            degraded_retry_sec=10.0,
+        )
+        states: List[MachineState] = [make_state(f"m{i}", tmp_path) for i in range(2)]
+        p.attach([s.machine for s in states])
+        stalled = threading.Event()
+        m_app = MagicMock()
+        m_app.config = {}
+        try:
+            with patch("dm_mac.models.machine.current_app", new=m_app):
+                with patch.object(
+                    StatePersister,
+                    "_commit",
+                    side_effect=lambda batch: stalled.wait(5.0),
+                ):
+                    with patch("dm_mac.models.machine.STATE_SAVE_TIMEOUT_SEC", 0.05):
+                        await MachineState.save_batch(states)
+            assert p.degraded is True
+            assert p.dirty_count == 2
+        finally:
+            stalled.set()
+            await p.stop()
+
+
+class TestPersistenceExecutor:
+    """Tests for the bounded state I/O executor."""
+
+    def test_init_from_env(self) -> None:
+        """Worker count and queue limit come from the environment."""
+        with patch.dict(os.environ, {}, clear=True):
+            ex: PersistenceExecutor = PersistenceExecutor()
+        assert ex.max_workers == 4
+        assert ex.queue_limit == 64
+        with patch.dict(
+            os.environ,
+            {"MACHINE_STATE_WORKERS": "2", "MACHINE_STATE_QUEUE_LIMIT": "8"},
+        ):
+            ex = PersistenceExecutor()
+        assert ex.max_workers == 2
+        assert ex.queue_limit == 8
+
+    async def test_run(self) -> None:
+        """Jobs run on a dedicated, named worker thread."""
+        ex: PersistenceExecutor = PersistenceExecutor(max_workers=1, queue_limit=1)
+        name: str = await ex.run(lambda: threading.current_thread().name)
+        assert name.startswith("machine-state")
+        assert ex.queue_depth == 0
+        assert ex.active_workers == 0
+        assert ex.oldest_inflight_sec == 0.0
+        ex.shutdown()
+
+    async def test_queue_full(self) -> None:
+        """Jobs beyond the queue limit are rejected and counted."""
+        ex: PersistenceExecutor = PersistenceExecutor(max_workers=1, queue_limit=1)
+        stalled = threading.Event()
+        running = asyncio.create_task(ex.run(stalled.wait, 5.0))
+        queued = asyncio.create_task(ex.run(lambda: "queued"))
+        for _ in range(100):
+            if ex.active_workers == 1:
+                break
+            await asyncio.sleep(0.01)
+        assert ex.active_workers == 1
+        assert ex.queue_depth == 1
+        assert ex.oldest_inflight_sec > 0
+        with pytest.raises(PersistenceQueueFullError):
+            await ex.run(lambda: None)
+        assert ex.rejected == 1
+        stalled.set()
+        assert await running is True
+        assert await queued == "queued"
+        assert ex.queue_depth == 0
+        assert ex.active_workers == 0
+        assert ex.oldest_inflight_sec == 0.0
+        ex.shutdown()
+
+    async def test_shutdown_drops_queued(self) -> None:
+        """Shutdown drops queued jobs but keeps tracking running ones."""
+        ex: PersistenceExecutor = PersistenceExecutor(max_workers=1, queue_limit=4)
+        stalled = threading.Event()
+        running = asyncio.create_task(ex.run(stalled.wait, 5.0))
+        queued = asyncio.create_task(ex.run(lambda: None))
+        for _ in range(100):
+            if ex.active_workers == 1 and ex.queue_depth == 1:
+                break
+            await asyncio.sleep(0.01)
+        ex.shutdown()
+        assert ex.queue_depth == 0
+        assert ex.oldest_inflight_sec > 0
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        stalled.set()
+        assert await running is True
+        assert ex.oldest_inflight_sec == 0.0
+
+    async def test_save_cache_queue_full(self, tmp_path: Path) -> None:
+        """A write-through save rejected by a full queue counts as a timeout."""
+        ex: PersistenceExecutor = PersistenceExecutor(max_workers=1, queue_limit=0)
+        p: StatePersister = StatePersister(
+            flush_interval_sec=0, store=Mock(), degraded_retry_sec=0, executor=ex
+        )
+        state = make_state("m1", tmp_path)
+        p.attach([state.machine])
+        m_app = MagicMock()
+        m_app.config = {}
+        with patch("dm_mac.models.machine.current_app", new=m_app):
+            with pytest.raises(StateSaveTimeoutError, match="rejected"):
+                await state.save_cache()
+        assert state.state_save_timeouts == 1
+        assert ex.rejected == 1
+
+
+class TestSaveLatency:
+    """Tests for per-phase save latency recording."""
+
+    def test_disabled_by_default(self, tmp_path: Path) -> None:
+        """Stores record nothing unless buckets are configured."""
+        with patch.dict(os.environ, {}, clear=True):
+            store = PickleStateStore(str(tmp_path))
+        assert store.latency is None
+        store.save_batch({"m1": {"uptime": 1.0}})
+
+    @pytest.mark.parametrize("backend", ["pickle", "sqlite", "journal", "mmap"])
+    def test_store_phases(self, tmp_path: Path, backend: str) -> None:
+        """Every backend records serialize, lock wait and write per machine."""
+        with patch.dict(os.environ, {"MACHINE_STATE_LATENCY_BUCKETS": "60"}):
+            store = make_state_store(backend=backend, state_dir=str(tmp_path))
+        assert store.latency is not None
+        store.save_batch({"m1": {"uptime": 1.0}, "m2": {"uptime": 2.0}})
+        store.close()
+        assert sorted(store.latency.histograms) == [
+            (name, phase)
+            for name in ("m1", "m2")
+            for phase in ("filelock_wait", "serialize", "write")
+        ]
+        for hist in store.latency.histograms.values():
+            assert hist.counts == [1, 0]
+
+    def test_lock_wait(self, tmp_path: Path) -> None:
+        """Write-through saves and batch commits record the state lock wait."""
+        with patch.dict(os.environ, {"MACHINE_STATE_LATENCY_BUCKETS": "60"}):
+            p: StatePersister = StatePersister(
+                flush_interval_sec=0, store=PickleStateStore(str(tmp_path))
+            )
+        state = make_state("m1", tmp_path)
+        p.attach([state.machine])
+        state._save_cache()
+        p._commit([state])
+        assert p.store.latency is not None
+        assert p.store.latency.histogram("m1", "lock_wait").count == 2
+        assert p.store.latency.histogram("m1", "write").count == 2
+
+
+class TestAtomicWrites:
+    """Tests for atomic state file writes, fsync modes and locking."""
+
+    def test_defaults(self, tmp_path: Path) -> None:
+        """No fsync and FileLock locking by default."""
+        with patch.dict(os.environ, {}, clear=True):
+            store = PickleStateStore(str(tmp_path))
+        assert store.fsync == "none"
+        assert store.locking == "filelock"
+        store.save_batch({"m1": {"uptime": 1.0}})
+        assert sorted(os.listdir(tmp_path)) == [
+            "m1-state.pickle",
+            "m1-state.pickle.lock",
+        ]
+
+    @pytest.mark.parametrize("var", ["MACHINE_STATE_FSYNC", "MACHINE_STATE_LOCKING"])
+    def test_unknown_mode(self, tmp_path: Path, var: str) -> None:
+        """An unknown mode is a startup error."""
+        with patch.dict(os.environ, {var: "sometimes"}):
+            with pytest.raises(RuntimeError, match=f"Unknown {var} 'sometimes'"):
+                PickleStateStore(str(tmp_path))
+
+    def test_failed_write_keeps_old_file(self, tmp_path: Path) -> None:
+        """A write that fails part-way leaves the previous contents intact."""
+        path: str = str(tmp_path / "state")
+        write_atomic(path, b"old")
+        with patch(f"{pbm}.os.replace", side_effect=OSError("EIO")):
+            with pytest.raises(OSError):
+                write_atomic(path, b"new")
+        with open(path, "rb") as f:
+            assert f.read() == b"old"
+        assert os.listdir(tmp_path) == ["state"]
+
+    @pytest.mark.parametrize(
+        "mode, file_syncs, dir_syncs",
+        [("none", 0, 0), ("file", 1, 0), ("file+dir", 1, 1)],
+    )
+    def test_fsync_modes(
+        self, tmp_path: Path, mode: str, file_syncs: int, dir_syncs: int
+    ) -> None:
+        """Each fsync mode syncs the file and/or the directory."""
+        with patch.dict(os.environ, {"MACHINE_STATE_FSYNC": mode}):
+            store = PickleStateStore(str(tmp_path))
+        with patch(f"{pbm}.os.fsync") as m_fsync:
+            with patch(f"{pbm}.fsync_dir") as m_fsync_dir:
+                store.save_batch({"m1": {"uptime": 1.0}})
+        assert m_fsync.call_count == file_syncs
+        if dir_syncs:
+            m_fsync_dir.assert_called_once_with(str(tmp_path))
+        else:
+            m_fsync_dir.assert_not_called()
+        assert store.load("m1") == {"uptime": 1.0}
+
+    def test_no_filelock(self, tmp_path: Path) -> None:
+        """With locking off, no lock files are created or taken."""
+        with patch.dict(os.environ, {"MACHINE_STATE_LOCKING": "none"}):
+            store = PickleStateStore(str(tmp_path))
+        with patch(f"{pbm}.FileLock") as m_lock:
+            store.save_batch({"m1": {"uptime": 1.0}})
+            assert store.load_all(["m1"]) == {"m1": {"uptime": 1.0}}
+        m_lock.assert_not_called()
+        assert os.listdir(tmp_path) == ["m1-state.pickle"]
+
+    def test_journal_fsync(self, tmp_path: Path) -> None:
+        """The journal fsyncs each append unless the mode is none."""
+        with patch.dict(os.environ, {"MACHINE_STATE_FSYNC": "file"}):
+            store = JournalStateStore(str(tmp_path))
+        with patch(f"{pbm}.os.fsync") as m_fsync:
+            store.save_batch({"m1": {"uptime": 1.0}})
+        store.close()
+        m_fsync.assert_called_once()
+
+
+class HungStore(StateStore):
+    """Store whose writes block until released."""
+
+    def __init__(self, state_dir: str) -> None:
+        """Initialize HungStore."""
+        self.state_dir = state_dir
+        self.release = threading.Event()
+        self.batches: List[Dict[str, Dict[str, Any]]] = []
+
+    def save_batch(self, records: Dict[str, Dict[str, Any]]) -> None:
+        """Block until released, then record the batch."""
+        self.release.wait(5.0)
+        self.batches.append(dict(records))
+
+    def load_all(self, names: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Never finish loading."""
+        self.release.wait(5.0)
+        return {}
+
+
+class TestMirroredStore:
+    """Tests for hedged writes across several state directories."""
+
+    def test_make_state_store(self, tmp_path: Path) -> None:
+        """MACHINE_STATE_MIRROR_DIRS adds mirrors of the configured backend."""
+        dirs = [str(tmp_path / d) for d in ("a", "b", "c")]
+        with patch.dict(
+            os.environ,
+            {
+                "MACHINE_STATE_DIR": dirs[0],
+                "MACHINE_STATE_BACKEND": "sqlite",
+                "MACHINE_STATE_MIRROR_DIRS": os.pathsep.join(dirs[1:]),
+            },
+        ):
+            store = make_state_store()
+        assert isinstance(store, MirroredStateStore)
+        assert [s.state_dir for s in store.stores] == dirs
+        assert all(isinstance(s, SqliteStateStore) for s in store.stores)
+        store.close()
+
+    def test_round_trip(self, tmp_path: Path) -> None:
+        """Every directory eventually gets a copy."""
+        store = MirroredStateStore(
+            [
+                PickleStateStore(str(tmp_path / "a")),
+                SqliteStateStore(str(tmp_path / "b")),
+            ]
+        )
+        store.save_batch({"m1": {"uptime": 1.0}})
+        for _ in range(100):
+            if store.backlogs == [0, 0] and all(s.load("m1") for s in store.stores):
+                break
+            threading.Event().wait(0.01)
+        for s in store.stores:
+            assert s.load("m1") == {"uptime": 1.0}
+        assert store.load_all(["m1", "m2"]) == {"m1": {"uptime": 1.0}}
+        store.close()
+
+    def test_hung_mirror(self, tmp_path: Path) -> None:
+        """A hung directory neither blocks saves nor queues unboundedly."""
+        hung = HungStore(str(tmp_path / "hung"))
+        good = PickleStateStore(str(tmp_path / "good"))
+        store = MirroredStateStore([hung, good])
+        for i in range(5):
+            store.save_batch({"m1": {"uptime": float(i)}, f"x{i}": {}})
+        assert good.load("m1") == {"uptime": 4.0}
+        # the first batch is in flight; the rest are coalesced
+        assert store.backlogs[0] == 5
+        hung.release.set()
+        for _ in range(100):
+            if len(hung.batches) == 2:
+                break
+            threading.Event().wait(0.01)
+        assert hung.batches[1]["m1"] == {"uptime": 4.0}
+        store.close()
+
+    def test_all_fail(self, tmp_path: Path) -> None:
+        """The save fails only if every directory fails."""
+        a, b = Mock(spec=StateStore), Mock(spec=StateStore)
+        a.latency = None
+        a.save_batch.side_effect = OSError("a")
+        b.save_batch.side_effect = OSError("b")
+        store = MirroredStateStore([a, b])
+        with pytest.raises(OSError):
+            store.save_batch({"m1": {}})
+        assert store.errors == [1, 1]
+        b.save_batch.side_effect = None
+        store.save_batch({"m1": {}})
+        # the save returns once b succeeds; a's failure is counted after
+        for _ in range(100):
+            if store.errors[0] == 2:
+                break
+            time.sleep(0.01)
+        assert store.errors == [2, 1]
+        store.close()
+
+    def test_load_newest(self, tmp_path: Path) -> None:
+        """Each machine's newest copy wins; bad directories are skipped."""
+        a = PickleStateStore(str(tmp_path / "a"))
+        b = PickleStateStore(str(tmp_path / "b"))
+        a.save_batch({"m1": {"uptime": 1.0}, "m2": {"uptime": 2.0}})
+        b.save_batch({"m1": {"uptime": 10.0}})
+        os.utime(a.path_for("m1"), (1000, 1000))
+        broken = Mock(spec=StateStore)
+        broken.latency = None
+        broken.state_dir = "broken"
+        broken.load_all.side_effect = OSError("EIO")
+        hung = HungStore(str(tmp_path / "hung"))
+        store = MirroredStateStore([a, broken, hung, b])
+        with patch(f"{pbm}.MIRROR_LOAD_TIMEOUT_SEC", 0.1):
+            assert store.load_all(["m1", "m2"]) == {
+                "m1": {"uptime": 10.0},
+                "m2": {"uptime": 2.0},
+            }
+        hung.release.set()
+        store.close()
+
+    @pytest.mark.parametrize("backend", ["pickle", "sqlite", "journal", "mmap"])
+    def test_saved_times(self, tmp_path: Path, backend: str) -> None:
+        """Every backend reports when each machine was saved."""
+        store = make_state_store(backend=backend, state_dir=str(tmp_path))
+        assert store.saved_times(["m1"]) == {}
+        store.save_batch({"m1": {"uptime": 1.0}})
+        times = store.saved_times(["m1", "m2"])
+        assert list(times) == ["m1"]
+        assert times["m1"] > 1e9
+        store.close()
+
+
+class TestProcessStore:
+    """Tests for the out-of-process state writer."""
+
+    def test_make_state_store(self, tmp_path: Path) -> None:
+        """MACHINE_STATE_WRITER=process gives each directory its own writer."""
+        dirs = [str(tmp_path / d) for d in ("a", "b")]
+        with patch.dict(
+            os.environ,
+            {
+                "MACHINE_STATE_DIR": dirs[0],
+                "MACHINE_STATE_BACKEND": "journal",
+                "MACHINE_STATE_MIRROR_DIRS": dirs[1],
+                "MACHINE_STATE_WRITER": "process",
+                "MACHINE_STATE_WRITER_TIMEOUT_SEC": "2.5",
+            },
+        ):
+            store = make_state_store()
+        assert isinstance(store, MirroredStateStore)
+        assert [s.state_dir for s in store.stores] == dirs
+        for s in store.stores:
+            assert isinstance(s, ProcessStateStore)
+            assert s.backend == "journal"
+            assert s.timeout_sec == 2.5
+            assert s.pid is None
+        store.close()
+
+    def test_unknown_writer(self, tmp_path: Path) -> None:
+        """An unknown MACHINE_STATE_WRITER is a configuration error."""
+        with patch.dict(os.environ, {"MACHINE_STATE_WRITER": "fork"}):
+            with pytest.raises(RuntimeError, match="MACHINE_STATE_WRITER"):
+                make_state_store(state_dir=str(tmp_path))
+
+    def test_round_trip(self, tmp_path: Path) -> None:
+        """Requests are served by the writer; latency comes back with them."""
+        with patch.dict(
+            os.environ, {"MACHINE_STATE_LATENCY_BUCKETS": "0.1,1"}, clear=True
+        ):
+            store = ProcessStateStore("pickle", str(tmp_path), timeout_sec=5.0)
+            store.save_batch({"m1": {"uptime": 2.0}})
+        assert store.pid is not None and store.pid != os.getpid()
+        assert store.load_all(["m1", "m2"]) == {"m1": {"uptime": 2.0}}
+        assert list(store.saved_times(["m1", "m2"])) == ["m1"]
+        assert store.latency is not None
+        assert store.latency.histogram("m1", "write").count == 1
+        assert store.respawns == 0
+        store.close()
+        assert store.pid is None
+
+    def test_hung_writer(self, tmp_path: Path) -> None:
+        """A hung writer is killed and respawned, then given up on."""
+        store = ProcessStateStore("pickle", str(tmp_path), timeout_sec=0.5)
+        store.save_batch({"m1": {"uptime": 1.0}})
+        lock = FileLock(str(tmp_path / "m1-state.pickle.lock"))
+        errors: List[Exception] = []
+
+        def save() -> None:
+            try:
+                store.save_batch({"m1": {"uptime": 2.0}})
+            except Exception as ex:
+                errors.append(ex)
+
+        with lock:
+            t = threading.Thread(target=save)
+            t.start()
+            for _ in range(100):
+                if store.respawns:
+                    break
+                threading.Event().wait(0.05)
+        t.join(15)
+        assert errors == []
+        assert store.respawns == 1
+        assert store.load_all(["m1"]) == {"m1": {"uptime": 2.0}}
+        with lock:
+            with pytest.raises(StateWriterHungError, match="after respawn"):
+                store.save_batch({"m1": {"uptime": 3.0}})
+        assert store.respawns == 3
+        assert store.load_all(["m1"]) == {"m1": {"uptime": 2.0}}
+        store.close()
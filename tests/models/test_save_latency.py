@@ -0,0 +1,63 @@
+"""Tests for models.save_latency."""
+
+import os
+from unittest.mock import patch
+
+import pytest
+
+from dm_mac.models.save_latency import LatencyHistogram
+from dm_mac.models.save_latency import SaveLatency
+from dm_mac.models.save_latency import save_latency_from_env
+
+
+class TestLatencyHistogram:
+    """Tests for LatencyHistogram."""
+
+    def test_observe(self) -> None:
+        """Observations land in the first bucket they fit, or +Inf."""
+        h: LatencyHistogram = LatencyHistogram((0.01, 0.1, 1.0))
+        for sec in (0.005, 0.01, 0.05, 0.5, 3.0):
+            h.observe(sec)
+        assert h.counts == [2, 1, 1, 1]
+        assert h.count == 5
+        assert h.sum == pytest.approx(3.565)
+        counts, total = h.cumulative()
+        assert counts == [2, 3, 4, 5]
+        assert total == pytest.approx(3.565)
+
+
+class TestSaveLatency:
+    """Tests for SaveLatency."""
+
+    def test_observe(self) -> None:
+        """Histograms are created per machine and phase, with sorted buckets."""
+        lat: SaveLatency = SaveLatency((1.0, 0.1))
+        assert lat.buckets == (0.1, 1.0)
+        lat.observe("m1", "write", 0.5)
+        lat.observe("m1", "write", 0.05)
+        lat.observe("m2", "serialize", 2.0)
+        assert sorted(lat.histograms) == [("m1", "write"), ("m2", "serialize")]
+        assert lat.histogram("m1", "write").counts == [1, 1, 0]
+        assert lat.histogram("m2", "serialize").counts == [0, 0, 1]
+
+
+class TestFromEnv:
+    """Tests for save_latency_from_env."""
+
+    def test_unset(self) -> None:
+        """Histograms are disabled by default."""
+        with patch.dict(os.environ, {}, clear=True):
+            assert save_latency_from_env() is None
+
+    def test_buckets(self) -> None:
+        """Buckets are parsed from a comma-separated list."""
+        with patch.dict(os.environ, {"MACHINE_STATE_LATENCY_BUCKETS": "0.01, 0.1,2,"}):
+            lat = save_latency_from_env()
+        assert lat is not None
+        assert lat.buckets == (0.01, 0.1, 2.0)
+
+    def test_invalid(self) -> None:
+        """A non-numeric bucket is a configuration error."""
+        with patch.dict(os.environ, {"MACHINE_STATE_LATENCY_BUCKETS": "0.1,fast"}):
+            with pytest.raises(RuntimeError, match="Invalid"):
+                save_latency_from_env()
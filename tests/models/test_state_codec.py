@@ -0,0 +1,148 @@
+"""Tests for models.state_codec."""
+
+import pickle
+import struct
+from typing import Any
+from typing import Dict
+
+import pytest
+
+from dm_mac.models.state_codec import CURRENT_VERSION
+from dm_mac.models.state_codec import FIELDS
+from dm_mac.models.state_codec import MAGIC
+from dm_mac.models.state_codec import StateDecodeError
+from dm_mac.models.state_codec import decode_state
+from dm_mac.models.state_codec import encode_state
+from dm_mac.models.state_codec import encode_state_into
+from dm_mac.models.users import User
+
+
+def full_state() -> Dict[str, Any]:
+    """Return a state dict with every field set to a non-default value."""
+    return {
+        "machine_name": "metal-mill",
+        "last_checkin": 1689477248.5,
+        "last_update": 1689477200.25,
+        "rfid_value": "0014916441",
+        "rfid_present_since": 1689477100.0,
+        "relay_desired_state": True,
+        "is_oopsed": False,
+        "is_locked_out": True,
+        "is_override_login": True,
+        "current_amps": 3.5,
+        "display_text": "Welcome,\nJäson",
+        "uptime": 123.0,
+        "status_led_rgb": (0.0, 1.0, 0.5),
+        "status_led_brightness": 0.5,
+        "wifi_signal_db": -54.0,
+        "wifi_signal_percent": 92.0,
+        "internal_temperature_c": 53.89,
+        "current_user_account_id": "4",
+        "second_relay_desired_state": True,
+        "second_relay_authorization": "granted",
+        "state_save_timeouts": 7,
+    }
+
+
+class TestBinaryCodec:
+    """Tests for the binary codec."""
+
+    def test_round_trip(self) -> None:
+        """Every field survives an encode/decode round trip."""
+        state: Dict[str, Any] = full_state()
+        assert set(state) == set(FIELDS)
+        buf: bytes = encode_state(state)
+        assert buf[:4] == MAGIC
+        assert buf[4] == CURRENT_VERSION
+        assert decode_state(buf) == state
+        assert len(buf) < len(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+
+    def test_optional_fields_none(self) -> None:
+        """None-valued optional fields decode as None, not zero or empty."""
+        state: Dict[str, Any] = dict(FIELDS, machine_name="m")
+        assert decode_state(encode_state(state)) == state
+
+    def test_unknown_keys_ignored(self) -> None:
+        """Keys outside the schema are not encoded."""
+        state: Dict[str, Any] = dict(full_state(), bogus=1)
+        assert "bogus" not in decode_state(encode_state(state))
+
+    def test_unsupported_version(self) -> None:
+        """A state from a newer schema version is rejected."""
+        buf: bytearray = bytearray(encode_state(full_state()))
+        buf[4] = 99
+        with pytest.raises(StateDecodeError, match="Unsupported state version 99"):
+            decode_state(bytes(buf))
+
+    @pytest.mark.parametrize("cut", [1, 10, 40])
+    def test_truncated(self, cut: int) -> None:
+        """A truncated state is reported as corrupt."""
+        buf: bytes = encode_state(full_state())
+        with pytest.raises(StateDecodeError):
+            decode_state(buf[:-cut])
+
+    def test_trailing_bytes(self) -> None:
+        """Extra bytes after the last field are reported as corrupt."""
+        with pytest.raises(StateDecodeError, match="trailing"):
+            decode_state(encode_state(full_state()) + b"x")
+
+    def test_unknown_codec(self) -> None:
+        """Encoding with an unknown codec is an error."""
+        with pytest.raises(ValueError):
+            encode_state(full_state(), codec="xml")
+
+
+class TestEncodeInto:
+    """Tests for encode_state_into()."""
+
+    def test_matches_encode_state(self) -> None:
+        """Bytes written in place are those encode_state() returns."""
+        expected: bytes = encode_state(full_state())
+        buf: bytearray = bytearray(b"x" * 512)
+        assert encode_state_into(full_state(), buf, 3, 500) == len(expected)
+        assert bytes(buf[3 : 3 + len(expected)]) == expected
+        assert buf[:3] == b"xxx"
+        assert buf[3 + len(expected) :] == b"x" * (509 - len(expected))
+
+    def test_too_long(self) -> None:
+        """State longer than the limit is rejected without writing."""
+        size: int = len(encode_state(full_state()))
+        buf: bytearray = bytearray(512)
+        with pytest.raises(ValueError, match=f"Encoded state is {size} bytes"):
+            encode_state_into(full_state(), buf, 0, size - 1)
+        assert buf == bytearray(512)
+
+
+class TestLegacyPickle:
+    """Tests for decoding and migrating pickled state."""
+
+    def test_pickle_codec(self) -> None:
+        """The pickle codec round-trips through decode_state()."""
+        state: Dict[str, Any] = full_state()
+        assert decode_state(encode_state(state, codec="pickle")) == state
+
+    def test_migrates_user_object(self) -> None:
+        """A pickled User becomes its account ID; unknown keys are dropped."""
+        user = User.unresolved("19")
+        legacy: Dict[str, Any] = {
+            "machine_name": "hammer",
+            "current_user": user,
+            "status_led_rgb": [1.0, 0.0, 0.0],
+            "removed_field": True,
+        }
+        assert decode_state(pickle.dumps(legacy)) == {
+            "machine_name": "hammer",
+            "current_user_account_id": "19",
+            "status_led_rgb": (1.0, 0.0, 0.0),
+        }
+
+    def test_migrates_no_user(self) -> None:
+        """A pickled None user clears the account ID."""
+        assert decode_state(pickle.dumps({"current_user": None})) == {
+            "current_user_account_id": None
+        }
+
+    def test_garbage(self) -> None:
+        """Bytes that are neither format are reported as unreadable."""
+        with pytest.raises(StateDecodeError, match="Unreadable"):
+            decode_state(struct.pack("<I", 12345))
@@ -0,0 +1,110 @@
+"""Tests for dm_mac.cbor module."""
+
+import math
+from typing import Any
+
+import pytest
+
+from dm_mac.cbor import CBORDecodeError
+from dm_mac.cbor import dumps
+from dm_mac.cbor import loads
+
+
+class TestCbor:
+    """Tests for CBOR encoding and decoding."""
+
+    @pytest.mark.parametrize(
+        "obj, encoded",
+        [
+            # examples from RFC 8949 Appendix A
+            (0, "00"),
+            (23, "17"),
+            (24, "1818"),
+            (1000, "1903e8"),
+            (1000000, "1a000f4240"),
+            (1000000000000, "1b000000e8d4a51000"),
+            (18446744073709551615, "1bffffffffffffffff"),
+            (-1, "20"),
+            (-1000, "3903e7"),
+            (0.0, "f90000"),
+            (1.5, "f93e00"),
+            (100000.0, "fa47c35000"),
+            (1.1, "fb3ff199999999999a"),
+            (-4.1, "fbc010666666666666"),
+            (float("inf"), "f97c00"),
+            (False, "f4"),
+            (True, "f5"),
+            (None, "f6"),
+            (b"\x01\x02\x03\x04", "4401020304"),
+            ("", "60"),
+            ("IETF", "6449455446"),
+            ("ü", "62c3bc"),
+            ([1, [2, 3], [4, 5]], "8301820203820405"),
+            ({"a": 1, "b": [2, 3]}, "a26161016162820203"),
+        ],
+    )
+    def test_vectors(self, obj: Any, encoded: str) -> None:
+        """Encoding matches the RFC and round-trips."""
+        assert dumps(obj).hex() == encoded
+        assert loads(bytes.fromhex(encoded)) == obj
+
+    def test_response(self) -> None:
+        """Keys are sorted, and a machine response round-trips."""
+        response = {
+            "relay": True,
+            "display": "Welcome,\njantman",
+            "oops_led": False,
+            "status_led_rgb": [0.0, 1.0, 0.0],
+            "status_led_brightness": 0.5,
+            "second_relay": False,
+            "state_version": 1721096048000,
+        }
+        assert dumps(response) == dumps(dict(sorted(response.items())))
+        assert loads(dumps(response)) == response
+
+    def test_nan(self) -> None:
+        """NaN is encoded as a half-precision float."""
+        assert dumps(float("nan")).hex() == "f97e00"
+        assert math.isnan(loads(dumps(float("nan"))))
+
+    @pytest.mark.parametrize(
+        "encoded, obj",
+        [
+            ("9f018202039f0405ffff", [1, [2, 3], [4, 5]]),
+            ("bf6346756ef563416d7421ff", {"Fun": True, "Amt": -2}),
+            ("7f657374726561646d696e67ff", "streaming"),
+            ("c074323031332d30332d32315432303a30343a30305a", "2013-03-21T20:04:00Z"),
+            ("f7", None),
+            ("1800", 0),
+        ],
+    )
+    def test_decode_only(self, encoded: str, obj: Any) -> None:
+        """Indefinite lengths, tags and non-shortest forms are accepted."""
+        assert loads(bytes.fromhex(encoded)) == obj
+
+    @pytest.mark.parametrize(
+        "encoded, message",
+        [
+            ("", "Unexpected end of data"),
+            ("6449", "Unexpected end of data"),
+            ("9f01", "Unexpected end of data"),
+            ("0000", "1 bytes of extra data"),
+            ("1c", "Invalid additional information 28"),
+            ("62c328", "Invalid UTF-8"),
+            ("a1800000", "Unsupported map key type"),
+            ("e0", "Unsupported simple value 0"),
+            ("7f4100ff", "Invalid chunk"),
+            ("81" * 20 + "00", "Nesting deeper than 16 levels"),
+        ],
+    )
+    def test_decode_errors(self, encoded: str, message: str) -> None:
+        """Malformed or unsupported input raises CBORDecodeError."""
+        with pytest.raises(CBORDecodeError, match=message):
+            loads(bytes.fromhex(encoded))
+
+    def test_encode_errors(self) -> None:
+        """Unsupported types and oversize integers are rejected."""
+        with pytest.raises(TypeError, match="set is not CBOR serializable"):
+            dumps({1, 2})
+        with pytest.raises(ValueError, match="Integer too large"):
+            dumps(2**64)
@@ -0,0 +1,104 @@
+"""Tests for dm_mac.json_provider module."""
+
+import datetime
+import json
+from unittest.mock import patch
+
+import pytest
+from quart import Quart
+from quart import jsonify
+from quart_schema import QuartSchema
+
+from dm_mac import json_provider
+from dm_mac.json_provider import OrjsonProvider
+from dm_mac.json_provider import dumps_bytes
+from dm_mac.json_provider import install
+
+pbm = "dm_mac.json_provider"
+
+RESPONSE = {
+    "relay": True,
+    "display": "Welcome,\njantman",
+    "oops_led": False,
+    "status_led_rgb": [0.0, 1.0, 0.0],
+    "status_led_brightness": 0.5,
+    "second_relay": False,
+}
+
+needs_orjson = pytest.mark.skipif(
+    json_provider.orjson is None, reason="orjson is not installed"
+)
+
+
+def make_app() -> Quart:
+    """Return an app configured like create_app() does."""
+    app: Quart = Quart("dm_mac")
+    QuartSchema(app)
+    return app
+
+
+class TestDumpsBytes:
+    """Tests for dumps_bytes()."""
+
+    async def test_matches_jsonify(self) -> None:
+        """Output is byte-identical to jsonify, with or without orjson."""
+        app: Quart = make_app()
+        async with app.app_context():
+            expected: bytes = await jsonify(RESPONSE).get_data(as_text=False)
+        assert dumps_bytes(RESPONSE) == expected
+        with patch(f"{pbm}.orjson", None):
+            assert dumps_bytes(RESPONSE) == expected
+
+    async def test_non_ascii(self) -> None:
+        """Non-ASCII text is raw UTF-8, with or without orjson."""
+        app: Quart = make_app()
+        with patch(f"{pbm}.orjson", None):
+            install(app)
+        data = dict(RESPONSE, display="Welcome,\nJosé 🔧")
+        async with app.app_context():
+            expected: bytes = await jsonify(data).get_data(as_text=False)
+        assert "José 🔧".encode() in expected
+        assert dumps_bytes(data) == expected
+        with patch(f"{pbm}.orjson", None):
+            assert dumps_bytes(data) == expected
+
+
+class TestInstall:
+    """Tests for install() and OrjsonProvider."""
+
+    def test_without_orjson(self) -> None:
+        """The app's provider is left alone if orjson is not installed."""
+        app: Quart = make_app()
+        before = app.json
+        with patch(f"{pbm}.orjson", None):
+            assert install(app) is False
+        assert app.json is before
+        assert app.json.ensure_ascii is False  # type: ignore[attr-defined]
+
+    @needs_orjson
+    async def test_with_orjson(self) -> None:
+        """Encoding and decoding match the replaced provider."""
+        app: Quart = make_app()
+        before = app.json
+        assert install(app) is True
+        assert isinstance(app.json, OrjsonProvider)
+        assert app.json.fallback is before
+        data = dict(RESPONSE, when=datetime.date(2024, 7, 16))
+        async with app.app_context():
+            body: bytes = await jsonify(data).get_data(as_text=False)
+        assert body == (before.dumps(data, separators=(",", ":")) + "\n").encode()
+        assert app.json.loads(body) == json.loads(body)
+        assert app.json.dumps(data, indent=2) == before.dumps(data, indent=2)
+
+    @needs_orjson
+    async def test_non_ascii_matches_fallback(self) -> None:
+        """orjson and the replaced provider agree byte for byte on non-ASCII."""
+        app: Quart = make_app()
+        before = app.json
+        install(app)
+        data = dict(RESPONSE, display="Welcome,\nJosé 🔧")
+        async with app.app_context():
+            body: bytes = await jsonify(data).get_data(as_text=False)
+        assert body == (before.dumps(data, separators=(",", ":")) + "\n").encode()
+        assert app.json.dumps(data, indent=2) == before.dumps(data, indent=2)
+        assert "José 🔧" in app.json.dumps(data, indent=2)
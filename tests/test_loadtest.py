@@ -0,0 +1,323 @@
+"""Tests for loadtest module."""
+
+import json
+import os
+import random
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+from unittest.mock import patch
+
+import pytest
+from _pytest.capture import CaptureFixture
+from aiohttp import ClientError
+from jsonschema.exceptions import ValidationError
+
+from dm_mac.loadtest import InProcessTarget
+from dm_mac.loadtest import LoadTest
+from dm_mac.loadtest import Scenario
+from dm_mac.loadtest import SimulatedMCU
+from dm_mac.loadtest import Target
+from dm_mac.loadtest import compare
+from dm_mac.loadtest import main
+from dm_mac.loadtest import percentile
+from dm_mac.models.users import UsersConfig
+
+pbm = "dm_mac.loadtest"
+
+
+def fast_scenario(**kwargs: Any) -> Dict[str, Any]:
+    """Return a scenario config that runs in a fraction of a second."""
+    return {
+        "name": "fast",
+        "machines": 3,
+        "duration_sec": 0.3,
+        "interval_sec": 0.05,
+        **kwargs,
+    }
+
+
+class RecordingTarget(Target):
+    """Target recording payloads and answering with fixed statuses."""
+
+    description = "recording"
+
+    def __init__(self, statuses: List[Any]) -> None:
+        """Initialize RecordingTarget; exceptions in statuses are raised."""
+        self.statuses: List[Any] = statuses
+        self.payloads: List[Dict[str, Any]] = []
+
+    async def post(self, payload: Dict[str, Any]) -> int:
+        """Record the payload and return (or raise) the next status."""
+        self.payloads.append(payload)
+        status: Any = self.statuses[(len(self.payloads) - 1) % len(self.statuses)]
+        if isinstance(status, Exception):
+            raise status
+        return int(status)
+
+
+class TestScenario:
+    """Tests for Scenario."""
+
+    def test_defaults(self) -> None:
+        """Optional fields are filled in, and machines and fobs generated."""
+        scenario: Scenario = Scenario({"machines": 2, "duration_sec": 5})
+        assert scenario.machine_names == ["loadtest-0001", "loadtest-0002"]
+        assert scenario.fobs == ["9000000001", "9000000002"]
+        assert scenario.interval_sec == 10.0
+        assert scenario.session_heartbeats == (6, 60)
+        assert scenario.as_dict()["seed"] == 0
+
+    def test_named_machines(self) -> None:
+        """Machines and fobs can be given explicitly."""
+        scenario: Scenario = Scenario(
+            {"machines": ["metal-mill"], "duration_sec": 5, "fobs": ["0014916441"]}
+        )
+        assert scenario.machine_names == ["metal-mill"]
+        assert scenario.fobs == ["0014916441"]
+
+    def test_invalid(self) -> None:
+        """Invalid scenarios are rejected."""
+        with pytest.raises(ValidationError):
+            Scenario({"machines": 0, "duration_sec": 5})
+        with pytest.raises(ValidationError):
+            Scenario({"machines": 2, "duration_sec": 5, "bogus": True})
+
+    def test_example_is_valid(self) -> None:
+        """The example scenario validates."""
+        assert Scenario(Scenario.example()).name == "200-mcus"
+
+    def test_write_config(self, tmp_path: Path) -> None:
+        """Generated configs authorize every fob on every machine."""
+        scenario: Scenario = Scenario({"machines": 2, "duration_sec": 5})
+        mpath, upath = scenario.write_config(str(tmp_path))
+        with open(mpath) as fh:
+            assert json.load(fh) == {
+                "loadtest-0001": {"authorizations_or": ["Load Test"]},
+                "loadtest-0002": {"authorizations_or": ["Load Test"]},
+            }
+        with patch.dict(os.environ, {"USERS_CONFIG": upath}):
+            uconf: UsersConfig = UsersConfig()
+        assert sorted(uconf.users_by_fob) == ["9000000001", "9000000002"]
+
+
+class TestSimulatedMCU:
+    """Tests for SimulatedMCU."""
+
+    def mcu(self, **kwargs: Any) -> SimulatedMCU:
+        """Return a simulated MCU for a scenario with the given settings."""
+        scenario: Scenario = Scenario(fast_scenario(**kwargs))
+        return SimulatedMCU("loadtest-0001", scenario, random.Random(1))
+
+    def test_heartbeat(self) -> None:
+        """Heartbeats look like ESPHome updates, with uptime increasing."""
+        mcu: SimulatedMCU = self.mcu(
+            session_probability=0, oops_probability=0, reboot_probability=0
+        )
+        first: Dict[str, Any] = mcu.heartbeat()
+        second: Dict[str, Any] = mcu.heartbeat()
+        assert sorted(first) == [
+            "amps",
+            "internal_temperature_c",
+            "machine_name",
+            "oops",
+            "rfid_value",
+            "uptime",
+            "wifi_signal_db",
+            "wifi_signal_percent",
+        ]
+        assert first["machine_name"] == "loadtest-0001"
+        assert first["rfid_value"] == ""
+        assert first["oops"] is False
+        assert second["uptime"] == pytest.approx(first["uptime"] + 0.05)
+
+    def test_session(self) -> None:
+        """A card stays inserted for the configured number of heartbeats."""
+        mcu: SimulatedMCU = self.mcu(
+            session_probability=1,
+            session_heartbeats=[3, 3],
+            unknown_fob_probability=0,
+            oops_probability=0,
+            reboot_probability=0,
+        )
+        values: List[str] = [mcu.heartbeat()["rfid_value"] for _ in range(5)]
+        assert values[0] in mcu.scenario.fobs
+        assert values[0] == values[1] == values[2] != ""
+        assert values[3] == ""
+        assert values[4] != ""
+        assert mcu.sessions == 2
+        assert mcu.unknown_sessions == 0
+
+    def test_unknown_fob(self) -> None:
+        """Unknown fobs are never among the scenario's fobs."""
+        mcu: SimulatedMCU = self.mcu(
+            session_probability=1,
+            session_heartbeats=[1, 1],
+            unknown_fob_probability=1,
+            reboot_probability=0,
+        )
+        for _ in range(10):
+            assert mcu.heartbeat()["rfid_value"] not in mcu.scenario.fobs
+        assert mcu.unknown_sessions == mcu.sessions > 0
+
+    def test_oops_and_reboot(self) -> None:
+        """Reboots reset the uptime and remove the card; oops is one-shot."""
+        mcu: SimulatedMCU = self.mcu(
+            session_probability=0, oops_probability=1, reboot_probability=1
+        )
+        mcu.rfid_value = "9000000001"
+        mcu.session_left = 10
+        payload: Dict[str, Any] = mcu.heartbeat()
+        assert payload["oops"] is True
+        assert payload["uptime"] < 10
+        assert payload["rfid_value"] == ""
+        assert (mcu.oopses, mcu.reboots) == (1, 1)
+
+
+class TestPercentile:
+    """Tests for percentile()."""
+
+    def test_percentile(self) -> None:
+        """Nearest-rank percentiles of sorted values."""
+        ordered: List[float] = [float(i) for i in range(1, 101)]
+        assert percentile(ordered, 0.5) == 51.0
+        assert percentile(ordered, 0.99) == 100.0
+        assert percentile([], 0.5) == 0.0
+
+
+class TestLoadTest:
+    """Tests for LoadTest."""
+
+    async def test_statuses_and_errors(self) -> None:
+        """Error responses, 503s and failed requests are all counted."""
+        target: RecordingTarget = RecordingTarget(
+            [200, 503, 200, ClientError("refused")]
+        )
+        results: Dict[str, Any] = await LoadTest(
+            Scenario(fast_scenario(machines=2)), target
+        ).run()
+        assert results["requests"] == len(target.payloads) > 0
+        assert sum(results["status_counts"].values()) == results["requests"]
+        assert set(results["status_counts"]) == {"200", "503", "error"}
+        assert results["http_503"] == results["status_counts"]["503"]
+        assert results["errors"] == (
+            results["status_counts"]["503"] + results["status_counts"]["error"]
+        )
+        assert results["error_rate"] == pytest.approx(
+            results["errors"] / results["requests"], abs=1e-6
+        )
+        assert results["target"] == "recording"
+        assert {p["machine_name"] for p in target.payloads} == {
+            "loadtest-0001",
+            "loadtest-0002",
+        }
+
+    async def test_repeatable(self) -> None:
+        """Runs of a scenario send the same heartbeats from each machine."""
+        runs: List[Dict[str, List[Any]]] = []
+        for _ in range(2):
+            target: RecordingTarget = RecordingTarget([200])
+            await LoadTest(
+                Scenario(fast_scenario(session_probability=0.5)), target
+            ).run()
+            by_machine: Dict[str, List[Any]] = {}
+            for payload in target.payloads:
+                by_machine.setdefault(payload["machine_name"], []).append(
+                    payload["rfid_value"]
+                )
+            runs.append(by_machine)
+        for name in runs[0]:
+            count: int = min(len(runs[0][name]), len(runs[1][name]))
+            assert runs[0][name][:count] == runs[1][name][:count]
+
+    async def test_in_process(self) -> None:
+        """Heartbeats, logins included, succeed against an in-process app."""
+        scenario: Scenario = Scenario(
+            fast_scenario(
+                session_probability=0.5,
+                unknown_fob_probability=0,
+                oops_probability=0,
+                reboot_probability=0,
+            )
+        )
+        target: InProcessTarget = InProcessTarget(scenario)
+        results: Dict[str, Any] = await LoadTest(scenario, target).run()
+        assert results["requests"] > 0
+        assert results["status_counts"] == {"200": results["requests"]}
+        assert results["sessions"] > 0
+        assert results["target"] == "in-process"
+        assert target._tmpdir is None
+
+
+class TestCompare:
+    """Tests for compare()."""
+
+    def results(
+        self, p99: float, errors: int = 0, scenario: str = "fast"
+    ) -> Dict[str, Any]:
+        """Return minimal run results."""
+        return {
+            "scenario": {"name": scenario},
+            "requests": 1000,
+            "latency_ms": {"p50": 1.0, "p95": 2.0, "p99": p99},
+            "error_rate": errors / 1000,
+            "http_503": errors,
+        }
+
+    def test_no_regression(self) -> None:
+        """Changes within the allowed percentage are not regressions."""
+        lines, regressions = compare(self.results(3.2), self.results(3.0), 10.0)
+        assert regressions == []
+        assert "latency_ms.p99: 3 -> 3.2 (+6.7%)" in lines
+
+    def test_regressions(self) -> None:
+        """Slower percentiles and new errors are regressions."""
+        lines, regressions = compare(
+            self.results(4.0, errors=2), self.results(3.0, scenario="other"), 10.0
+        )
+        assert lines[0] == "WARNING: baseline was run with a different scenario"
+        assert regressions == [
+            "latency_ms.p99: 3 -> 4 (+33.3%)",
+            "error_rate: 0 -> 0.002 (n/a)",
+            "http_503_rate: 0 -> 0.002 (n/a)",
+        ]
+
+
+class TestMain:
+    """Tests for the command-line entrypoint."""
+
+    def test_dump_example_scenario(self, capsys: CaptureFixture[str]) -> None:
+        """The example scenario is printed as JSON."""
+        with patch("sys.argv", ["mac-loadtest", "-v", "--dump-example-scenario"]):
+            main()
+        assert json.loads(capsys.readouterr().out) == Scenario.example()
+
+    def test_write_config(self, tmp_path: Path) -> None:
+        """Configs for the scenario are written to the given directory."""
+        with patch("sys.argv", ["mac-loadtest", "-v", "--write-config", str(tmp_path)]):
+            main()
+        assert sorted(os.listdir(tmp_path)) == ["machines.json", "users.json"]
+
+    def test_run_and_compare(self, tmp_path: Path, capsys: CaptureFixture[str]) -> None:
+        """Results are saved, and regressions against them exit non-zero."""
+        spath: str = str(tmp_path / "scenario.json")
+        rpath: str = str(tmp_path / "results.json")
+        with open(spath, "w") as fh:
+            json.dump(fast_scenario(), fh)
+        with patch(f"{pbm}.InProcessTarget", lambda s: RecordingTarget([200])):
+            with patch("sys.argv", ["mac-loadtest", "-v", spath, "-o", rpath]):
+                main()
+        assert "Statuses: 200=" in capsys.readouterr().out
+        with open(rpath) as fh:
+            baseline: Dict[str, Any] = json.load(fh)
+        baseline["latency_ms"]["p99"] = 0.0
+        baseline["requests"] = 1
+        with open(rpath, "w") as fh:
+            json.dump(baseline, fh)
+        with patch(f"{pbm}.InProcessTarget", lambda s: RecordingTarget([503])):
+            with patch("sys.argv", ["mac-loadtest", "-v", spath, "-c", rpath]):
+                with pytest.raises(SystemExit) as exc:
+                    main()
+        assert exc.value.code == 1
+        assert "REGRESSION" in capsys.readouterr().out
@@ -10,6 +10,7 @@ from quart import Quart
 from quart import Response
 from quart.typing import TestClientProtocol
 
+from dm_mac.models.users import User
 from dm_mac.models.users import UsersConfig
 
 from .quart_test_helpers import app_and_client
@@ -177,3 +178,23 @@ class TestReloadUsers:
         assert users.users_by_fob["0091703745"].account_id == "3"
         assert users.users_by_fob["0014916441"].account_id == "4"
         assert users.users_by_fob["8682768000"].account_id == "19"
+        assert sorted(users.users_by_account_id) == ["1", "19", "3", "4"]
+        assert users.users_by_account_id["19"] is users.users[-1]
+
+    async def test_resolves_machine_users(
+        self, tmp_path: Path, fixtures_path: str
+    ) -> None:
+        """Reloading users re-resolves each machine's current user."""
+        uconf: str = str(os.path.join(tmp_path, "users.json"))
+        copy(os.path.join(fixtures_path, "users.json"), uconf)
+        with patch.dict("os.environ", {"USERS_CONFIG": uconf}):
+            app: Quart
+            client: TestClientProtocol
+            app, client = app_and_client(tmp_path)
+            mstate = app.config["MACHINES"].machines_by_name["metal-mill"].state
+            mstate.current_user = User.unresolved("4")
+            copy(os.path.join(fixtures_path, "users-changed.json"), uconf)
+            response: Response = await client.post("/api/reload-users")
+        assert response.status_code == 200
+        assert mstate.current_user is app.config["USERS"].users_by_account_id["4"]
+        assert mstate.current_user.preferred_name == "jantman"
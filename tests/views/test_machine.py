@@ -1,15 +1,27 @@
 """Tests for /machine API endpoints."""
 
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
 from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
 from unittest.mock import AsyncMock
 from unittest.mock import call
 from unittest.mock import patch
 
+import pytest
 from freezegun import freeze_time
 from quart import Quart
 from quart import Response
 from quart.typing import TestClientProtocol
 
+from dm_mac import cbor
 from dm_mac.models.machine import Machine
 from dm_mac.models.machine import MachineState
 from dm_mac.slack_handler import SlackHandler
@@ -70,12 +82,56 @@ class TestRouteSpecialCases:
             },
         )
         # check response
-        assert response.status_code == 500
+        assert response.status_code == 400
         assert await response.json == {
-            "error": "MachineState.update() got an unexpected keyword "
-            "argument 'foo'",
+            "error": "Invalid update: foo: Extra inputs are not permitted",
         }
 
+    @pytest.mark.parametrize(
+        "body, error",
+        [
+            (b'{"machine_name": "metal-mill", "oops": ', "Invalid JSON: "),
+            (b'{"oops": false}', "Invalid update: machine_name: Field required"),
+            (
+                b'{"machine_name": "metal-mill", "uptime": "soon"}',
+                "Invalid update: uptime: Input should be a valid number",
+            ),
+            (b"[]", "Invalid update: Input should be an object"),
+        ],
+    )
+    async def test_invalid_update(
+        self, tmp_path: Path, body: bytes, error: str
+    ) -> None:
+        """Malformed updates are rejected before the machine is touched."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        m: Machine = app.config["MACHINES"].machines_by_name["metal-mill"]
+        response: Response = await client.post(
+            "/api/machine/update",
+            data=body,
+            headers={"Content-Type": "application/json"},
+        )
+        assert response.status_code == 400
+        assert error in (await response.json)["error"]
+        assert m.state.last_checkin is None
+
+    async def test_update_exception(self, tmp_path: Path) -> None:
+        """An error while handling a valid update is a 500."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        with patch(
+            "dm_mac.models.machine.MachineState.update",
+            side_effect=RuntimeError("boom"),
+        ):
+            response: Response = await client.post(
+                "/api/machine/update",
+                json={"machine_name": "metal-mill", "oops": False},
+            )
+        assert response.status_code == 500
+        assert await response.json == {"error": "boom"}
+
     @freeze_time("2023-07-16 03:14:08", tz_offset=0)
     async def test_state_save_timeout_returns_503(self, tmp_path: Path) -> None:
         """Verify state-save timeout surfaces as HTTP 503 to firmware."""
@@ -85,7 +141,7 @@ class TestRouteSpecialCases:
         mname: str = "metal-mill"
         m: Machine = app.config["MACHINES"].machines_by_name[mname]
 
-        async def boom() -> None:
+        async def boom(urgent: bool = True) -> None:
             m.state.state_save_timeouts += 1
             raise StateSaveTimeoutError("simulated")
 
@@ -106,6 +162,516 @@ class TestRouteSpecialCases:
         assert await response.json == {"error": "state save timeout"}
 
 
+@freeze_time("2023-07-16 03:14:08", tz_offset=0)
+class TestUpdateWriteBehind:
+    """Tests for /machine/update with write-behind persistence enabled."""
+
+    async def test_update_defers_write_until_flush(self, tmp_path: Path) -> None:
+        """The heartbeat returns before state is written; a flush writes it."""
+        app: Quart
+        client: TestClientProtocol
+        with patch.dict("os.environ", {"MACHINE_STATE_FLUSH_INTERVAL_SEC": "30"}):
+            app, client = app_and_client(tmp_path)
+        mname: str = "metal-mill"
+        m: Machine = app.config["MACHINES"].machines_by_name[mname]
+        response: Response = await client.post(
+            "/api/machine/update",
+            json={
+                "machine_name": mname,
+                "oops": False,
+                "rfid_value": "",
+                "uptime": 12.3,
+                "wifi_signal_db": -54,
+                "wifi_signal_percent": 92,
+                "internal_temperature_c": 53.89,
+            },
+        )
+        assert response.status_code == 200
+        assert m.state.uptime == 12.3
+        assert not os.path.exists(m.state._state_path)
+        persister = app.config["STATE_PERSISTER"]
+        assert persister.dirty_count == 1
+        assert await persister.flush() == 1
+        with patch.dict("os.environ", {"MACHINE_STATE_DIR": m.state._state_dir}):
+            ms: MachineState = MachineState(m)
+        assert ms.uptime == 12.3
+        assert ms.last_checkin == 1689477248.0
+
+
+class TestUpdateHeartbeatLog:
+    """Tests for /machine/update heartbeat logging."""
+
+    async def test_transitions_logged_when_sampling(
+        self, tmp_path: Path, caplog: pytest.LogCaptureFixture
+    ) -> None:
+        """With sampling disabled, only state-changing heartbeats are logged."""
+        caplog.set_level(logging.INFO, "dm_mac.models.heartbeat_log")
+        app: Quart
+        client: TestClientProtocol
+        with patch.dict("os.environ", {"HEARTBEAT_LOG_SAMPLE": "0"}):
+            app, client = app_and_client(tmp_path)
+        body: Dict[str, Any] = {
+            "machine_name": "metal-mill",
+            "oops": False,
+            "rfid_value": "",
+            "uptime": 12.3,
+            "wifi_signal_db": -54,
+            "wifi_signal_percent": 92,
+            "internal_temperature_c": 53.89,
+        }
+        for uptime in (12.3, 13.3, 14.3):
+            body["uptime"] = uptime
+            response: Response = await client.post("/api/machine/update", json=body)
+            assert response.status_code == 200
+        body["oops"] = True
+        response = await client.post("/api/machine/update", json=body)
+        assert response.status_code == 200
+        messages: List[str] = [
+            r.getMessage()
+            for r in caplog.records
+            if r.name == "dm_mac.models.heartbeat_log"
+        ]
+        assert len(messages) == 1
+        assert messages[0].startswith("event=transition machine=metal-mill ")
+        assert "oops=true" in messages[0]
+        heartbeats = app.config["HEARTBEAT_LOG"]
+        assert heartbeats.suppressed == 3
+        assert heartbeats.transitions == 1
+
+
+class TestUpdateStateVersion:
+    """Tests for /machine/update conditional responses."""
+
+    async def test_unchanged(self, tmp_path: Path) -> None:
+        """An MCU echoing the current version gets a minimal reply."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        body: Dict[str, Any] = {
+            "machine_name": "metal-mill",
+            "oops": False,
+            "rfid_value": "",
+            "uptime": 12.3,
+            "state_version": 0,
+        }
+        response: Response = await client.post("/api/machine/update", json=body)
+        assert response.status_code == 200
+        full: Dict[str, Any] = await response.json
+        version: int = full.pop("state_version")
+        assert full == {
+            "relay": False,
+            "display": "Please Insert\nRFID Card",
+            "oops_led": False,
+            "status_led_rgb": [0.0, 0.0, 0.0],
+            "status_led_brightness": 0.0,
+            "second_relay": False,
+        }
+        body.update(uptime=13.3, state_version=version)
+        response = await client.post("/api/machine/update", json=body)
+        assert response.status_code == 200
+        assert await response.json == {"state_version": version, "unchanged": True}
+        # an admin Oops changes the response
+        response = await client.post("/api/machine/oops/metal-mill")
+        assert response.status_code == 200
+        body.update(uptime=14.3)
+        response = await client.post("/api/machine/update", json=body)
+        assert response.status_code == 200
+        changed: Dict[str, Any] = await response.json
+        assert changed["state_version"] == version + 1
+        assert changed["oops_led"] is True
+
+    async def test_no_version_without_request(self, tmp_path: Path) -> None:
+        """MCUs that do not send state_version get the usual response."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        response: Response = await client.post(
+            "/api/machine/update", json={"machine_name": "metal-mill"}
+        )
+        assert response.status_code == 200
+        assert "state_version" not in await response.json
+
+
+class TestPoll:
+    """Tests for /machine/poll long-polling."""
+
+    async def test_timeout(self, tmp_path: Path) -> None:
+        """Without a change, the poll answers unchanged after the timeout."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        m: Machine = app.config["MACHINES"].machines_by_name["metal-mill"]
+        version: int = m.state.state_version
+        start: float = time.monotonic()
+        response: Response = await client.get(
+            f"/api/machine/poll/metal-mill?state_version={version}&timeout=0.1"
+        )
+        assert time.monotonic() - start >= 0.1
+        assert response.status_code == 200
+        assert await response.json == {"state_version": version, "unchanged": True}
+
+    async def test_timeout_capped(self, tmp_path: Path) -> None:
+        """Timeouts are capped at LONG_POLL_MAX_SEC; 0 answers immediately."""
+        app: Quart
+        client: TestClientProtocol
+        with patch.dict("os.environ", {"LONG_POLL_MAX_SEC": "0"}):
+            app, client = app_and_client(tmp_path)
+        assert app.config["LONG_POLL_MAX_SEC"] == 0.0
+        m: Machine = app.config["MACHINES"].machines_by_name["metal-mill"]
+        version: int = m.state.state_version
+        response: Response = await asyncio.wait_for(
+            client.get(
+                f"/api/machine/poll/metal-mill?state_version={version}&timeout=30"
+            ),
+            timeout=1,
+        )
+        assert response.status_code == 200
+        assert await response.json == {"state_version": version, "unchanged": True}
+
+    async def test_stale_version(self, tmp_path: Path) -> None:
+        """An MCU behind the current version gets the full response at once."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        m: Machine = app.config["MACHINES"].machines_by_name["metal-mill"]
+        response: Response = await asyncio.wait_for(
+            client.get("/api/machine/poll/metal-mill?state_version=0"), timeout=1
+        )
+        assert response.status_code == 200
+        assert await response.json == {
+            **m.state.machine_response,
+            "state_version": m.state.state_version,
+        }
+
+    async def test_admin_oops(self, tmp_path: Path) -> None:
+        """A parked poll returns as soon as an admin Oopses the machine."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        m: Machine = app.config["MACHINES"].machines_by_name["metal-mill"]
+        version: int = m.state.state_version
+        poll = asyncio.create_task(
+            client.get(
+                f"/api/machine/poll/metal-mill?state_version={version}&timeout=10"
+            )
+        )
+        await asyncio.sleep(0.05)
+        assert not poll.done()
+        response: Response = await client.post("/api/machine/oops/metal-mill")
+        assert response.status_code == 200
+        response = await asyncio.wait_for(poll, timeout=1)
+        assert response.status_code == 200
+        body: Dict[str, Any] = await response.json
+        assert body["state_version"] == version + 1
+        assert body["oops_led"] is True
+        assert body["display"] == MachineState.OOPS_DISPLAY_TEXT
+
+    async def test_cbor(self, tmp_path: Path) -> None:
+        """The response is CBOR if the Accept header asks for it."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        m: Machine = app.config["MACHINES"].machines_by_name["metal-mill"]
+        response: Response = await client.get(
+            "/api/machine/poll/metal-mill?state_version=0",
+            headers={"Accept": "application/cbor"},
+        )
+        assert response.status_code == 200
+        assert response.mimetype == "application/cbor"
+        assert cbor.loads(await response.get_data(as_text=False)) == {
+            **m.state.machine_response,
+            "state_version": m.state.state_version,
+        }
+
+    @pytest.mark.parametrize(
+        "query", ["", "?state_version=abc", "?state_version=1&timeout=x"]
+    )
+    async def test_invalid(self, tmp_path: Path, query: str) -> None:
+        """A missing or malformed query parameter gets a 400."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        response: Response = await client.get(f"/api/machine/poll/metal-mill{query}")
+        assert response.status_code == 400
+        assert (await response.json)["error"].startswith("Invalid poll: ")
+
+    async def test_unknown_machine(self, tmp_path: Path) -> None:
+        """Polling an unknown machine gets a 404."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        response: Response = await client.get(
+            "/api/machine/poll/nonexistent?state_version=0"
+        )
+        assert response.status_code == 404
+        assert await response.json == {"error": "No such machine: nonexistent"}
+
+
+class TestUpdateCbor:
+    """Tests for /machine/update with CBOR bodies."""
+
+    async def test_cbor_request(self, tmp_path: Path) -> None:
+        """A CBOR request gets a CBOR response with the same content."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        response: Response = await client.post(
+            "/api/machine/update",
+            data=cbor.dumps(
+                {
+                    "machine_name": "metal-mill",
+                    "oops": False,
+                    "rfid_value": "",
+                    "uptime": 12.3,
+                    "wifi_signal_db": -54,
+                    "wifi_signal_percent": 92,
+                    "internal_temperature_c": 53.89,
+                    "state_version": 0,
+                }
+            ),
+            headers={"Content-Type": "application/cbor"},
+        )
+        assert response.status_code == 200
+        assert response.mimetype == "application/cbor"
+        body: Dict[str, Any] = cbor.loads(await response.get_data(as_text=False))
+        m: Machine = app.config["MACHINES"].machines_by_name["metal-mill"]
+        assert body == {
+            **m.state.machine_response,
+            "state_version": m.state.state_version,
+        }
+        assert m.state.uptime == 12.3
+        assert m.state.wifi_signal_db == -54
+
+    @pytest.mark.parametrize(
+        "content_type, accept, expected",
+        [
+            ("application/json", None, "application/json"),
+            ("application/json", "application/cbor", "application/cbor"),
+            ("application/cbor", None, "application/cbor"),
+            ("application/cbor", "*/*", "application/cbor"),
+            ("application/cbor", "application/json", "application/json"),
+        ],
+    )
+    async def test_negotiation(
+        self,
+        tmp_path: Path,
+        content_type: str,
+        accept: Optional[str],
+        expected: str,
+    ) -> None:
+        """The response is in the request's format unless Accept says otherwise."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        payload: Dict[str, Any] = {"machine_name": "metal-mill", "uptime": 1.0}
+        headers: Dict[str, str] = {"Content-Type": content_type}
+        if accept:
+            headers["Accept"] = accept
+        response: Response = await client.post(
+            "/api/machine/update",
+            data=(
+                cbor.dumps(payload)
+                if content_type == "application/cbor"
+                else json.dumps(payload)
+            ),
+            headers=headers,
+        )
+        assert response.status_code == 200
+        assert response.mimetype == expected
+        raw: bytes = await response.get_data(as_text=False)
+        body: Dict[str, Any] = (
+            cbor.loads(raw) if expected == "application/cbor" else json.loads(raw)
+        )
+        assert body["relay"] is False
+
+    @pytest.mark.parametrize(
+        "data, error",
+        [
+            (b"\xa1\x61", "Invalid update: Invalid CBOR: Unexpected end of data"),
+            (
+                cbor.dumps({"machine_name": "metal-mill", "foo": 1}),
+                "Invalid update: foo: Extra inputs are not permitted",
+            ),
+            (
+                cbor.dumps({"machine_name": "nope"}),
+                "No such machine: nope",
+            ),
+        ],
+    )
+    async def test_cbor_errors(self, tmp_path: Path, data: bytes, error: str) -> None:
+        """Errors are reported in CBOR too."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        response: Response = await client.post(
+            "/api/machine/update",
+            data=data,
+            headers={"Content-Type": "application/cbor"},
+        )
+        assert response.status_code in (400, 404)
+        assert response.mimetype == "application/cbor"
+        assert cbor.loads(await response.get_data(as_text=False)) == {"error": error}
+
+
+class TestBatchUpdate:
+    """Tests for /machine/batch_update."""
+
+    async def test_batch(self, tmp_path: Path) -> None:
+        """Updates are applied in order and saved in one commit."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        machines = app.config["MACHINES"].machines_by_name
+        store = app.config["STATE_PERSISTER"].store
+        with patch.object(store, "save_batch", wraps=store.save_batch) as m_save:
+            response: Response = await client.post(
+                "/api/machine/batch_update",
+                json={
+                    "updates": [
+                        {"machine_name": "metal-mill", "uptime": 12.3},
+                        {"machine_name": "nope", "uptime": 1.0},
+                        {"machine_name": "hammer", "oops": True, "state_version": 0},
+                    ]
+                },
+            )
+        assert response.status_code == 200
+        body: Dict[str, Any] = await response.json
+        hammer: Machine = machines["hammer"]
+        assert body == {
+            "results": [
+                {
+                    "machine_name": "metal-mill",
+                    "status": 200,
+                    "response": machines["metal-mill"].state.machine_response,
+                },
+                {
+                    "machine_name": "nope",
+                    "status": 404,
+                    "error": "No such machine: nope",
+                },
+                {
+                    "machine_name": "hammer",
+                    "status": 200,
+                    "response": {
+                        **hammer.state.machine_response,
+                        "state_version": hammer.state.state_version,
+                    },
+                },
+            ]
+        }
+        assert hammer.state.is_oopsed is True
+        assert m_save.call_count == 1
+        assert sorted(m_save.call_args.args[0]) == ["hammer", "metal-mill"]
+        assert os.path.exists(machines["metal-mill"].state._state_path)
+
+    async def test_batch_update_error(self, tmp_path: Path) -> None:
+        """An exception updating one machine does not fail the others."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        hammer: Machine = app.config["MACHINES"].machines_by_name["hammer"]
+        with patch.object(
+            hammer.state, "update", AsyncMock(side_effect=RuntimeError("foo"))
+        ):
+            response: Response = await client.post(
+                "/api/machine/batch_update",
+                json={
+                    "updates": [
+                        {"machine_name": "hammer"},
+                        {"machine_name": "metal-mill"},
+                    ]
+                },
+            )
+        assert response.status_code == 200
+        results: List[Dict[str, Any]] = (await response.json)["results"]
+        assert results[0] == {"machine_name": "hammer", "status": 500, "error": "foo"}
+        assert results[1]["status"] == 200
+
+    async def test_batch_invalid(self, tmp_path: Path) -> None:
+        """An invalid update rejects the whole batch."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        response: Response = await client.post(
+            "/api/machine/batch_update",
+            json={"updates": [{"machine_name": "hammer", "foo": 1}]},
+        )
+        assert response.status_code == 400
+        assert await response.json == {
+            "error": "Invalid update: updates.0.foo: Extra inputs are not permitted"
+        }
+
+    async def test_batch_timeout(self, tmp_path: Path) -> None:
+        """A batch save timeout fails the request with a 503."""
+        from dm_mac.models.machine import StateSaveTimeoutError
+
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        with patch.object(
+            MachineState,
+            "save_batch",
+            AsyncMock(side_effect=StateSaveTimeoutError("simulated")),
+        ):
+            response: Response = await client.post(
+                "/api/machine/batch_update",
+                json={"updates": [{"machine_name": "hammer"}]},
+            )
+        assert response.status_code == 503
+        assert await response.json == {"error": "state save timeout"}
+
+
+class TestUpdateDegradedMode:
+    """Tests for /machine/update while state persistence is degraded."""
+
+    async def test_stalled_disk_still_returns_200(self, tmp_path: Path) -> None:
+        """A save timeout queues the state instead of returning 503."""
+        app: Quart
+        client: TestClientProtocol
+        with patch.dict("os.environ", {"MACHINE_STATE_DEGRADED_RETRY_SEC": "5"}):
+            app, client = app_and_client(tmp_path)
+        mname: str = "metal-mill"
+        m: Machine = app.config["MACHINES"].machines_by_name[mname]
+        persister = app.config["STATE_PERSISTER"]
+        stalled = threading.Event()
+        calls: List[int] = []
+
+        def hung_save() -> None:
+            calls.append(1)
+            stalled.wait(timeout=5.0)
+
+        payload: Dict[str, Any] = {
+            "machine_name": mname,
+            "oops": False,
+            "rfid_value": "",
+            "uptime": 12.3,
+            "wifi_signal_db": -54,
+            "wifi_signal_percent": 92,
+            "internal_temperature_c": 53.89,
+        }
+        try:
+            with patch.object(m.state, "_save_cache", side_effect=hung_save):
+                with patch("dm_mac.models.machine.STATE_SAVE_TIMEOUT_SEC", 0.05):
+                    response: Response = await client.post(
+                        "/api/machine/update", json=payload
+                    )
+                    assert response.status_code == 200
+                    assert persister.degraded is True
+                    assert persister.dirty_count == 1
+                    payload["uptime"] = 20.0
+                    response = await client.post("/api/machine/update", json=payload)
+                    assert response.status_code == 200
+        finally:
+            stalled.set()
+        # only the first request attempted a write-through save
+        assert calls == [1]
+        assert m.state.state_save_timeouts == 1
+        assert await persister.flush() == 1
+        with patch.dict("os.environ", {"MACHINE_STATE_DIR": m.state._state_dir}):
+            ms: MachineState = MachineState(m)
+        assert ms.uptime == 20.0
+
+
 @freeze_time("2023-07-16 03:14:08", tz_offset=0)
 class TestUpdateNewMachine:
     """Tests for /machine/update API endpoint for a brand new machine."""
@@ -3,6 +3,7 @@
 from pathlib import Path
 from textwrap import dedent
 from time import time
+from unittest.mock import patch
 
 from freezegun import freeze_time
 from quart import Quart
@@ -101,6 +102,9 @@ class TestPrometheus:
         # HELP machine_config_load_timestamp The timestamp when the machine config was loaded
         # TYPE machine_config_load_timestamp gauge
         machine_config_load_timestamp 1.689477248e+09
+        # HELP machine_state_load_seconds Seconds taken to load the state of all machines at startup
+        # TYPE machine_state_load_seconds gauge
+        machine_state_load_seconds 0.0
         # HELP user_config_load_timestamp The timestamp when the users config was loaded
         # TYPE user_config_load_timestamp gauge
         user_config_load_timestamp 1.689477248e+09
@@ -270,6 +274,29 @@ class TestPrometheus:
         mac_state_save_timeouts_total{display_name="restrictive-lathe",machine_name="restrictive-lathe"} 0.0
         mac_state_save_timeouts_total{display_name="esp32test",machine_name="esp32test"} 0.0
         mac_state_save_timeouts_total{display_name="always-on-machine",machine_name="always-on-machine"} 0.0
+        # HELP mac_state_executor_queue_depth Number of state I/O jobs waiting for a worker thread
+        # TYPE mac_state_executor_queue_depth gauge
+        mac_state_executor_queue_depth 0.0
+        # HELP mac_state_executor_active_workers Number of state I/O worker threads currently running a job
+        # TYPE mac_state_executor_active_workers gauge
+        mac_state_executor_active_workers 0.0
+        # HELP mac_state_executor_oldest_inflight_seconds Age of the oldest queued or running state I/O job
+        # TYPE mac_state_executor_oldest_inflight_seconds gauge
+        mac_state_executor_oldest_inflight_seconds 0.0
+        # HELP mac_state_executor_rejected_total Count of state I/O jobs rejected because the queue was full
+        # TYPE mac_state_executor_rejected_total counter
+        mac_state_executor_rejected_total 0.0
+        # HELP mac_machine_events_total Count of machine state transition events, by kind
+        # TYPE mac_machine_events_total counter
+        # HELP mac_event_queue_depth Number of machine events waiting to be delivered
+        # TYPE mac_event_queue_depth gauge
+        mac_event_queue_depth 0.0
+        # HELP mac_events_dropped_total Count of machine events dropped because the queue was full
+        # TYPE mac_events_dropped_total counter
+        mac_events_dropped_total 0.0
+        # HELP mac_event_sink_errors_total Count of exceptions raised while delivering machine events
+        # TYPE mac_event_sink_errors_total counter
+        mac_event_sink_errors_total 0.0
         """).replace("__FILE_MTIME__", actual_mtime_str)  # noqa: E501
         assert custom_metrics == expected
         assert (
@@ -299,6 +326,9 @@ class TestPrometheus:
         # HELP machine_config_load_timestamp The timestamp when the machine config was loaded
         # TYPE machine_config_load_timestamp gauge
         machine_config_load_timestamp 1.689477248e+09
+        # HELP machine_state_load_seconds Seconds taken to load the state of all machines at startup
+        # TYPE machine_state_load_seconds gauge
+        machine_state_load_seconds 0.0
         # HELP user_config_load_timestamp The timestamp when the users config was loaded
         # TYPE user_config_load_timestamp gauge
         user_config_load_timestamp 1.689477248e+09
@@ -468,8 +498,277 @@ class TestPrometheus:
         mac_state_save_timeouts_total{display_name="restrictive-lathe",machine_name="restrictive-lathe"} 0.0
         mac_state_save_timeouts_total{display_name="esp32test",machine_name="esp32test"} 0.0
         mac_state_save_timeouts_total{display_name="always-on-machine",machine_name="always-on-machine"} 0.0
+        # HELP mac_state_executor_queue_depth Number of state I/O jobs waiting for a worker thread
+        # TYPE mac_state_executor_queue_depth gauge
+        mac_state_executor_queue_depth 0.0
+        # HELP mac_state_executor_active_workers Number of state I/O worker threads currently running a job
+        # TYPE mac_state_executor_active_workers gauge
+        mac_state_executor_active_workers 0.0
+        # HELP mac_state_executor_oldest_inflight_seconds Age of the oldest queued or running state I/O job
+        # TYPE mac_state_executor_oldest_inflight_seconds gauge
+        mac_state_executor_oldest_inflight_seconds 0.0
+        # HELP mac_state_executor_rejected_total Count of state I/O jobs rejected because the queue was full
+        # TYPE mac_state_executor_rejected_total counter
+        mac_state_executor_rejected_total 0.0
+        # HELP mac_machine_events_total Count of machine state transition events, by kind
+        # TYPE mac_machine_events_total counter
+        # HELP mac_event_queue_depth Number of machine events waiting to be delivered
+        # TYPE mac_event_queue_depth gauge
+        mac_event_queue_depth 0.0
+        # HELP mac_events_dropped_total Count of machine events dropped because the queue was full
+        # TYPE mac_events_dropped_total counter
+        mac_events_dropped_total 0.0
+        # HELP mac_event_sink_errors_total Count of exceptions raised while delivering machine events
+        # TYPE mac_event_sink_errors_total counter
+        mac_event_sink_errors_total 0.0
         """).replace("__FILE_MTIME__", actual_mtime_str)  # noqa: E501
         assert custom_metrics == expected
         assert (
             response.headers["Content-Type"] == CONTENT_TYPE_LATEST + "; charset=utf-8"
         )
+
+
+class TestPrometheusWriteBehind:
+    """Tests for write-behind persister metrics."""
+
+    async def test_metrics_absent_when_write_through(self, tmp_path: Path) -> None:
+        """Write-behind metrics are not emitted in write-through mode."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        response: Response = await client.get("/metrics")
+        text = await response.get_data(True)
+        assert "mac_state_dirty_machines" not in text
+        assert "mac_state_durability_lag_seconds" not in text
+
+    async def test_metrics_present_when_write_behind(self, tmp_path: Path) -> None:
+        """Write-behind metrics reflect the persister's dirty set."""
+        app: Quart
+        client: TestClientProtocol
+        with patch.dict("os.environ", {"MACHINE_STATE_FLUSH_INTERVAL_SEC": "30"}):
+            app, client = app_and_client(tmp_path)
+        mconf: MachinesConfig = app.config["MACHINES"]
+        app.config["STATE_PERSISTER"].mark_dirty(
+            mconf.machines_by_name["metal-mill"].state
+        )
+        response: Response = await client.get("/metrics")
+        text = await response.get_data(True)
+        assert "mac_state_dirty_machines 1.0" in text
+        assert "# TYPE mac_state_durability_lag_seconds gauge" in text
+        assert "mac_state_flushes_total 0.0" in text
+        assert "mac_state_flushed_states_total 0.0" in text
+        assert "mac_state_flush_errors_total 0.0" in text
+
+    async def test_degraded_metrics(self, tmp_path: Path) -> None:
+        """Degraded-mode metrics are emitted when degraded mode is enabled."""
+        app: Quart
+        client: TestClientProtocol
+        with patch.dict("os.environ", {"MACHINE_STATE_DEGRADED_RETRY_SEC": "5"}):
+            app, client = app_and_client(tmp_path)
+        mconf: MachinesConfig = app.config["MACHINES"]
+        app.config["STATE_PERSISTER"].enter_degraded(
+            mconf.machines_by_name["metal-mill"].state
+        )
+        response: Response = await client.get("/metrics")
+        text = await response.get_data(True)
+        assert "mac_state_dirty_machines 1.0" in text
+        assert "mac_state_degraded 1.0" in text
+        assert "mac_state_degraded_entries_total 1.0" in text
+
+    async def test_degraded_metrics_absent_with_write_behind_only(
+        self, tmp_path: Path
+    ) -> None:
+        """Degraded-mode metrics are not emitted unless it is enabled."""
+        app: Quart
+        client: TestClientProtocol
+        with patch.dict("os.environ", {"MACHINE_STATE_FLUSH_INTERVAL_SEC": "30"}):
+            app, client = app_and_client(tmp_path)
+        response: Response = await client.get("/metrics")
+        text = await response.get_data(True)
+        assert "mac_state_dirty_machines 0.0" in text
+        assert "mac_state_degraded" not in text
+
+
+class TestPrometheusSaveLatency:
+    """Tests for the state save latency histogram."""
+
+    async def test_absent_by_default(self, tmp_path: Path) -> None:
+        """The histogram is not emitted unless buckets are configured."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        app.config["MACHINES"].machines_by_name["hammer"].state._save_cache()
+        response: Response = await client.get("/metrics")
+        text = await response.get_data(True)
+        assert "mac_state_save_phase_seconds" not in text
+
+    async def test_histogram(self, tmp_path: Path) -> None:
+        """Each save phase is recorded per machine."""
+        app: Quart
+        client: TestClientProtocol
+        with patch.dict("os.environ", {"MACHINE_STATE_LATENCY_BUCKETS": "0.5,60"}):
+            app, client = app_and_client(tmp_path)
+        app.config["MACHINES"].machines_by_name["hammer"].state._save_cache()
+        response: Response = await client.get("/metrics")
+        text = await response.get_data(True)
+        assert "# TYPE mac_state_save_phase_seconds histogram" in text
+        for phase in ("lock_wait", "serialize", "filelock_wait", "write"):
+            for le in ("60.0", "+Inf"):
+                assert (
+                    "mac_state_save_phase_seconds_bucket{"
+                    f'display_name="hammer",le="{le}",machine_name="hammer",'
+                    f'phase="{phase}"}} 1.0'
+                ) in text
+            assert (
+                "mac_state_save_phase_seconds_count{"
+                f'display_name="hammer",machine_name="hammer",phase="{phase}"}} 1.0'
+            ) in text
+        assert (
+            'machine_name="metal-mill"'
+            not in text.split("mac_state_save_phase_seconds")[-1]
+        )
+
+
+class TestPrometheusMirrors:
+    """Tests for mirrored state directory metrics."""
+
+    async def test_mirror_metrics(self, tmp_path: Path) -> None:
+        """Each state directory's backlog and errors are exported."""
+        app: Quart
+        client: TestClientProtocol
+        mirror: str = str(tmp_path / "mirror")
+        with patch.dict("os.environ", {"MACHINE_STATE_MIRROR_DIRS": mirror}):
+            app, client = app_and_client(tmp_path)
+        store = app.config["STATE_PERSISTER"].store
+        response: Response = await client.get("/metrics")
+        text = await response.get_data(True)
+        for state_dir in (store.stores[0].state_dir, mirror):
+            assert f'mac_state_mirror_backlog{{state_dir="{state_dir}"}} 0.0' in text
+            assert (
+                f'mac_state_mirror_errors_total{{state_dir="{state_dir}"}} 0.0' in text
+            )
+        store.close()
+
+
+class TestPrometheusWriters:
+    """Tests for state writer process metrics."""
+
+    async def test_writer_metrics(self, tmp_path: Path) -> None:
+        """Each directory's writer process respawn count is exported."""
+        app: Quart
+        client: TestClientProtocol
+        mirror: str = str(tmp_path / "mirror")
+        with patch.dict(
+            "os.environ",
+            {"MACHINE_STATE_MIRROR_DIRS": mirror, "MACHINE_STATE_WRITER": "process"},
+        ):
+            app, client = app_and_client(tmp_path)
+        store = app.config["STATE_PERSISTER"].store
+        store.stores[1].respawns = 2
+        response: Response = await client.get("/metrics")
+        text = await response.get_data(True)
+        state_dir: str = store.stores[0].state_dir
+        assert f'mac_state_writer_respawns_total{{state_dir="{state_dir}"}} 0.0' in text
+        assert f'mac_state_writer_respawns_total{{state_dir="{mirror}"}} 2.0' in text
+        store.close()
+
+
+class TestPrometheusDiskProbe:
+    """Tests for disk probe metrics."""
+
+    async def test_absent_by_default(self, tmp_path: Path) -> None:
+        """Probe metrics are only emitted when the probe is enabled."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        response: Response = await client.get("/metrics")
+        text = await response.get_data(True)
+        assert "mac_state_disk_latency" not in text
+
+    async def test_probe_metrics(self, tmp_path: Path) -> None:
+        """Probe latency and the adaptive budget are exported."""
+        app: Quart
+        client: TestClientProtocol
+        with patch.dict(
+            "os.environ",
+            {
+                "MACHINE_STATE_PROBE_INTERVAL_SEC": "60",
+                "MACHINE_STATE_DEGRADED_RETRY_SEC": "5",
+            },
+        ):
+            app, client = app_and_client(tmp_path)
+        probe = app.config["STATE_PERSISTER"].probe
+        probe.record(0.1)
+        response: Response = await client.get("/metrics")
+        text = await response.get_data(True)
+        assert "mac_state_disk_latency_ewma_seconds 0.1" in text
+        assert 'mac_state_disk_latency_seconds{quantile="0.99"} 0.1' in text
+        assert "mac_state_disk_probe_inflight_seconds 0.0" in text
+        assert "mac_state_disk_probe_errors_total 0.0" in text
+        assert "mac_state_save_budget_seconds 0.4" in text
+        assert "mac_state_flush_interval_seconds 0.0" in text
+
+
+class TestPrometheusHeartbeatLog:
+    """Tests for heartbeat log metrics."""
+
+    async def test_absent_by_default(self, tmp_path: Path) -> None:
+        """Heartbeat log metrics are only emitted when sampling."""
+        app: Quart
+        client: TestClientProtocol
+        app, client = app_and_client(tmp_path)
+        response: Response = await client.get("/metrics")
+        text = await response.get_data(True)
+        assert "mac_heartbeat_log" not in text
+
+    async def test_sampling_metrics(self, tmp_path: Path) -> None:
+        """Logged and suppressed heartbeat counts are exported."""
+        app: Quart
+        client: TestClientProtocol
+        with patch.dict("os.environ", {"HEARTBEAT_LOG_SAMPLE": "10"}):
+            app, client = app_and_client(tmp_path)
+        heartbeats = app.config["HEARTBEAT_LOG"]
+        for _ in range(3):
+            heartbeats.record("metal-mill", [], {})
+        heartbeats.record("metal-mill", ["oops"], {})
+        response: Response = await client.get("/metrics")
+        text = await response.get_data(True)
+        assert 'mac_heartbeat_log_lines_total{event="transition"} 1.0' in text
+        assert 'mac_heartbeat_log_lines_total{event="sample"} 1.0' in text
+        assert "mac_heartbeat_log_suppressed_total 2.0" in text
+        assert "mac_heartbeat_access_log_suppressed_total 0.0" in text
+
+
+class TestPrometheusEvents:
+    """Tests for machine event metrics."""
+
+    async def test_absent_when_inline(self, tmp_path: Path) -> None:
+        """Event metrics are only emitted when events are queued."""
+        app: Quart
+        client: TestClientProtocol
+        with patch.dict("os.environ", {"EVENT_QUEUE_SIZE": "0"}):
+            app, client = app_and_client(tmp_path)
+        response: Response = await client.get("/metrics")
+        text = await response.get_data(True)
+        assert "mac_machine_events" not in text
+
+    async def test_event_metrics(self, tmp_path: Path) -> None:
+        """Event counts and queue state are exported."""
+        app: Quart
+        client: TestClientProtocol
+        with patch.dict("os.environ", {"EVENT_QUEUE_SIZE": "100"}):
+            app, client = app_and_client(tmp_path)
+        response: Response = await client.post(
+            "/api/machine/update",
+            json={"machine_name": "metal-mill", "oops": True, "rfid_value": ""},
+        )
+        assert response.status_code == 200
+        response = await client.get("/metrics")
+        text = await response.get_data(True)
+        assert (
+            'mac_machine_events_total{display_name="Metal Mill",kind="oops",'
+            'machine_name="metal-mill"} 1.0'
+        ) in text
+        assert "mac_event_queue_depth 0.0" in text
+        assert "mac_events_dropped_total 0.0" in text
+        assert "mac_event_sink_errors_total 0.0" in text